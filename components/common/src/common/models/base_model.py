@@ -17,6 +17,7 @@ FireO BaseModel to be inherited by all other objects in ORM
 import datetime
 from typing import List, Tuple
 import fireo
+from fireo.database import db
 from fireo.models import Model
 from fireo.fields import DateTime, TextField
 from fireo.fields.errors import (RequiredField,
@@ -26,6 +27,12 @@ from fireo.fields.errors import (RequiredField,
 from common.utils.errors import ResourceNotFoundException
 import common.config
 
+# maximum number of values allowed in a Firestore "in" filter
+FIRESTORE_IN_FILTER_LIMIT = 30
+
+# maximum number of writes allowed in a single Firestore batch
+FIRESTORE_BATCH_LIMIT = 500
+
 
 # pylint: disable = too-few-public-methods, arguments-renamed
 class BaseModel(Model):
@@ -147,6 +154,69 @@ class BaseModel(Model):
     return obj
 
 
+  @classmethod
+  def find_by_ids(cls, doc_ids: List[str]) -> list:
+    """Looks up multiple objects of this type by id, issuing one "in" query
+       per FIRESTORE_IN_FILTER_LIMIT ids rather than one query per id.
+       Ids that are not found (or are soft deleted) are skipped.
+
+        Args:
+            doc_ids (List[str]): list of document ids
+        Returns:
+            list: objects found, in no particular order
+        """
+    doc_ids = list(dict.fromkeys(doc_ids))
+    objects = []
+    for i in range(0, len(doc_ids), FIRESTORE_IN_FILTER_LIMIT):
+      id_batch = doc_ids[i: i + FIRESTORE_IN_FILTER_LIMIT]
+      objects.extend(cls.collection.filter("id", "in", id_batch).filter(
+          "deleted_at_timestamp", "==", None).fetch())
+    return objects
+
+  @classmethod
+  def save_all(cls, objects: list, batch_size=FIRESTORE_BATCH_LIMIT) -> list:
+    """Saves a list of objects of this type using Firestore batch writes,
+       committing one batch per batch_size objects.  Objects without an id
+       are assigned a Firestore generated id before they are written, so
+       ids are available to callers once this returns.
+
+        Args:
+            objects (list): list of objects to save
+            batch_size (int): number of writes per batch commit
+        Returns:
+            list: the saved objects
+        """
+    for i in range(0, len(objects), batch_size):
+      batch = fireo.batch()
+      for obj in objects[i: i + batch_size]:
+        if not obj.id:
+          obj.id = cls.generate_id()
+        obj.save(batch=batch)
+      batch.commit()
+    return objects
+
+  @classmethod
+  def delete_by_ids(cls, doc_ids: List[str],
+                    batch_size=FIRESTORE_BATCH_LIMIT):
+    """Deletes objects of this type by id (not key) using Firestore batch
+       writes, committing one batch per batch_size ids.
+
+        Args:
+            doc_ids (List[str]): list of document ids
+            batch_size (int): number of deletes per batch commit
+        """
+    for i in range(0, len(doc_ids), batch_size):
+      batch = fireo.batch()
+      for doc_id in doc_ids[i: i + batch_size]:
+        key = fireo.utils.utils.generateKeyFromId(cls, doc_id)
+        cls.collection.delete(key, batch=batch)
+      batch.commit()
+
+  @classmethod
+  def generate_id(cls) -> str:
+    """Generate a new Firestore document id for this collection"""
+    return db.conn.collection(cls.collection_name).document().id
+
   def reload(self):
     """ reload this model """
     return self.find_by_id(self.id)
@@ -18,6 +18,7 @@ from typing import List
 from fireo.fields import (TextField, ListField, IDField,
                           BooleanField, NumberField, MapField)
 from common.models import BaseModel
+from common.models.base_model import FIRESTORE_IN_FILTER_LIMIT
 
 # constants used as tags for query history
 QUERY_HUMAN = "HumanQuestion"
@@ -295,6 +296,7 @@ class QueryResult(BaseModel):
   query_engine_id = TextField(required=True)
   query_engine = TextField(required=True)
   query_refs = ListField(default=[])
+  prompt = TextField(required=False)
   response = TextField(required=True)
 
   class Meta:
@@ -322,6 +324,9 @@ class QueryDocument(BaseModel):
   index_start = NumberField(required=False)
   index_end = NumberField(required=False)
   metadata = MapField(required=False)
+  # hash or version of the source document content, used to find changed
+  # documents when the query engine is refreshed
+  content_hash = TextField(required=False)
 
   class Meta:
     ignore_none_field = False
@@ -392,6 +397,31 @@ class QueryDocument(BaseModel):
           None).get()
     return q_doc
 
+  @classmethod
+  def find_by_index_files(cls, query_engine_id, index_files):
+    """
+    Fetch documents for a query engine for a list of index files, using
+    one "in" query per FIRESTORE_IN_FILTER_LIMIT index files.
+
+    Args:
+        query_engine_id (str): Query Engine id
+        index_files (List[str]): Query document index files
+
+    Returns:
+        List[QueryDocument]: documents found, in no particular order
+
+    """
+    index_files = list(dict.fromkeys(index_files))
+    q_docs = []
+    for i in range(0, len(index_files), FIRESTORE_IN_FILTER_LIMIT):
+      index_file_batch = index_files[i: i + FIRESTORE_IN_FILTER_LIMIT]
+      q_docs.extend(cls.collection.filter(
+          "query_engine_id", "==", query_engine_id).filter(
+              "index_file", "in", index_file_batch).filter(
+              "deleted_at_timestamp", "==",
+              None).fetch())
+    return q_docs
+
 
 class QueryDocumentChunk(BaseModel):
   """
@@ -438,3 +468,53 @@ class QueryDocumentChunk(BaseModel):
             "deleted_at_timestamp", "==",
             None).get()
     return q_chunk
+
+  @classmethod
+  def find_by_query_document_ids(cls, query_engine_id, query_document_ids):
+    """
+    Fetch the chunks of a list of documents, using one "in" query per
+    FIRESTORE_IN_FILTER_LIMIT documents.
+
+    Args:
+        query_engine_id (str): Query engine id
+        query_document_ids (List[str]): QueryDocument ids
+
+    Returns:
+        List[QueryDocumentChunk]: chunks found, in no particular order
+
+    """
+    query_document_ids = list(dict.fromkeys(query_document_ids))
+    q_chunks = []
+    for i in range(0, len(query_document_ids), FIRESTORE_IN_FILTER_LIMIT):
+      doc_id_batch = query_document_ids[i: i + FIRESTORE_IN_FILTER_LIMIT]
+      q_chunks.extend(cls.collection.filter(
+          "query_engine_id", "==", query_engine_id).filter(
+              "query_document_id", "in", doc_id_batch).filter(
+              "deleted_at_timestamp", "==",
+              None).fetch())
+    return q_chunks
+
+  @classmethod
+  def find_by_indexes(cls, query_engine_id, indexes):
+    """
+    Fetch document chunks for a query engine for a list of indexes, using
+    one "in" query per FIRESTORE_IN_FILTER_LIMIT indexes.
+
+    Args:
+        query_engine_id (str): Query engine id
+        indexes (List[int]): QueryDocumentChunk indexes
+
+    Returns:
+        List[QueryDocumentChunk]: chunks found, in no particular order
+
+    """
+    indexes = list(dict.fromkeys(indexes))
+    q_chunks = []
+    for i in range(0, len(indexes), FIRESTORE_IN_FILTER_LIMIT):
+      index_batch = indexes[i: i + FIRESTORE_IN_FILTER_LIMIT]
+      q_chunks.extend(cls.collection.filter(
+          "query_engine_id", "==", query_engine_id).filter(
+              "index", "in", index_batch).filter(
+              "deleted_at_timestamp", "==",
+              None).fetch())
+    return q_chunks
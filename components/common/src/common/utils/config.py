@@ -80,6 +80,7 @@ DEFAULT_JOB_REQUESTS = {
 }
 
 JOB_TYPE_QUERY_ENGINE_BUILD = "query_engine_build"
+JOB_TYPE_QUERY_ENGINE_REFRESH = "query_engine_refresh"
 JOB_TYPE_QUERY_EXECUTE = "query_engine_execute_query"
 JOB_TYPE_AGENT_PLAN_EXECUTE = "agent_plan_execute"
 JOB_TYPE_AGENT_RUN = "agent_run"
@@ -88,6 +89,7 @@ JOB_TYPE_WEBSCRAPER = "webscraper"
 
 JOB_TYPES_WITH_PREDETERMINED_TITLES = [
     JOB_TYPE_QUERY_ENGINE_BUILD,
+    JOB_TYPE_QUERY_ENGINE_REFRESH,
     JOB_TYPE_QUERY_EXECUTE,
     JOB_TYPE_AGENT_RUN,
     JOB_TYPE_AGENT_PLAN_EXECUTE,
@@ -102,6 +104,7 @@ class JobTypes(Enum):
   in Jobs Service
   """
   JOB_TYPE_QUERY_ENGINE_BUILD = "query_engine_build"
+  JOB_TYPE_QUERY_ENGINE_REFRESH = "query_engine_refresh"
   JOB_TYPE_QUERY_EXECUTE = "query_engine_execute_query"
   JOB_TYPE_AGENT_RUN = "agent_run"
   JOB_TYPE_AGENT_PLAN_EXECUTE = "agent_plan_execute"
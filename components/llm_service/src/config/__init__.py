@@ -72,6 +72,52 @@ from config.config import (
     # query engine and other defaults
     DEFAULT_WEB_DEPTH_LIMIT,
     MODALITY_SET,
+
+    # query embedding cache
+    QUERY_EMBEDDING_CACHE_SIZE,
+    QUERY_EMBEDDING_CACHE_TTL,
+    QUERY_EMBEDDING_CACHE_REDIS,
+
+    # embedding requests
+    EMBEDDING_MAX_CONCURRENCY,
+
+    # chunk embedding cache for builds
+    QUERY_BUILD_EMBEDDING_CACHE,
+    QUERY_BUILD_EMBEDDING_CACHE_PATH,
+    QUERY_BUILD_EMBEDDING_CACHE_TTL,
+
+    # query semantic cache
+    QUERY_SEMANTIC_CACHE,
+    QUERY_SEMANTIC_CACHE_THRESHOLD,
+    QUERY_SEMANTIC_CACHE_TTL,
+    QUERY_SEMANTIC_CACHE_SIZE,
+
+    # hybrid retrieval
+    QUERY_HYBRID_SEARCH,
+    QUERY_HYBRID_RRF_K,
+    QUERY_LEXICAL_INDEX_CACHE_SIZE,
+
+    # reranker
+    RERANK_MODEL_NAME,
+    RERANK_MODEL_TYPE,
+    RERANK_QUANTIZE,
+    RERANK_MAX_BATCH_SIZE,
+    RERANK_MAX_WAIT_MS,
+
+    # batch query jobs
+    QUERY_BATCH_CONCURRENCY,
+    QUERY_BATCH_CHUNK_SIZE,
+    QUERY_BATCH_PROGRESS_INTERVAL,
+    QUERY_BATCH_BUCKETS,
+
+    # query engine build pipeline
+    QUERY_BUILD_PARSE_WORKERS,
+    QUERY_BUILD_EMBED_CONCURRENCY,
+    QUERY_BUILD_WRITE_CONCURRENCY,
+    QUERY_BUILD_QUEUE_SIZE,
+    QUERY_BUILD_DOWNLOAD_WORKERS,
+    QUERY_BUILD_COMMIT_CONCURRENCY,
+    QUERY_BUILD_PROGRESS_INTERVAL,
     )
 
 from config.model_config import (
@@ -107,6 +153,8 @@ from config.model_config import (
     KEY_MODEL_PARAMS,
     KEY_MODEL_CONTEXT_LENGTH,
     KEY_MODEL_TOKEN_LIMIT,
+    KEY_MODEL_TOKENIZER,
+    KEY_EMBEDDING_BATCHING,
     KEY_IS_CHAT,
     KEY_IS_MULTI,
     KEY_MODEL_FILE_URL,
@@ -142,6 +190,7 @@ from config.model_config import (
 from config.vector_store_config import (
   DEFAULT_VECTOR_STORE,
   VECTOR_STORES,
+  REFRESH_VECTOR_STORES,
   PG_HOST
 )
 
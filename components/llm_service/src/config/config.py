@@ -19,7 +19,8 @@
 import os
 import json
 from common.config import REGION
-from common.utils.config import get_environ_flag, load_config_json
+from common.utils.config import (get_environ_flag, get_env_setting,
+                                 load_config_json)
 from common.utils.logging_handler import Logger
 from common.utils.secrets import get_secret
 from common.utils.token_handler import UserCredentials
@@ -132,6 +133,101 @@ DEFAULT_CHAT_SUMMARY_MODEL = VERTEX_LLM_TYPE_GEMINI_2_0_FLASH
 # other defaults
 DEFAULT_WEB_DEPTH_LIMIT = 1
 
+# query embedding cache: max in-process entries, redis ttl in seconds and
+# whether to use the redis tier
+QUERY_EMBEDDING_CACHE_SIZE = int(
+    get_env_setting("QUERY_EMBEDDING_CACHE_SIZE", 10000))
+QUERY_EMBEDDING_CACHE_TTL = int(
+    get_env_setting("QUERY_EMBEDDING_CACHE_TTL", 86400))
+QUERY_EMBEDDING_CACHE_REDIS = get_environ_flag("QUERY_EMBEDDING_CACHE_REDIS",
+                                               True)
+
+# max embedding requests in flight across the process (see
+# services/embedding_executor.py)
+EMBEDDING_MAX_CONCURRENCY = int(get_env_setting("EMBEDDING_MAX_CONCURRENCY",
+                                                32))
+
+# chunk embedding cache for query engine builds: backend ("sqlite",
+# "redis" or "postgres", or "" for no cache), sqlite file path and redis
+# ttl in seconds (see services/chunk_embedding_cache.py)
+QUERY_BUILD_EMBEDDING_CACHE = get_env_setting("QUERY_BUILD_EMBEDDING_CACHE",
+                                              "")
+QUERY_BUILD_EMBEDDING_CACHE_PATH = get_env_setting(
+    "QUERY_BUILD_EMBEDDING_CACHE_PATH", "/tmp/chunk_embedding_cache.db")
+QUERY_BUILD_EMBEDDING_CACHE_TTL = int(
+    get_env_setting("QUERY_BUILD_EMBEDDING_CACHE_TTL", 30 * 86400))
+
+# semantic answer cache: default for engines without a "semantic_cache"
+# param, min cosine similarity of prompts to reuse a result, result ttl in
+# seconds and max cached results per engine per process
+QUERY_SEMANTIC_CACHE = get_environ_flag("QUERY_SEMANTIC_CACHE", False)
+QUERY_SEMANTIC_CACHE_THRESHOLD = float(
+    get_env_setting("QUERY_SEMANTIC_CACHE_THRESHOLD", 0.95))
+QUERY_SEMANTIC_CACHE_TTL = int(
+    get_env_setting("QUERY_SEMANTIC_CACHE_TTL", 86400))
+QUERY_SEMANTIC_CACHE_SIZE = int(
+    get_env_setting("QUERY_SEMANTIC_CACHE_SIZE", 1000))
+
+# hybrid lexical + vector retrieval: default for engines without a
+# "hybrid_search" param, reciprocal rank fusion constant and number of
+# lexical indexes kept loaded per process
+QUERY_HYBRID_SEARCH = get_environ_flag("QUERY_HYBRID_SEARCH", False)
+QUERY_HYBRID_RRF_K = int(get_env_setting("QUERY_HYBRID_RRF_K", 60))
+QUERY_LEXICAL_INDEX_CACHE_SIZE = int(
+    get_env_setting("QUERY_LEXICAL_INDEX_CACHE_SIZE", 16))
+
+# reranker for integrated search references.  RERANK_MODEL_TYPE selects a
+# rerankers backend, e.g. "flashrank" for int8 ONNX cross-encoders on CPU
+# (requires rerankers[flashrank]); RERANK_QUANTIZE applies int8 dynamic
+# quantization to torch models on CPU.  Concurrent rerank requests are
+# batched, up to RERANK_MAX_BATCH_SIZE requests or RERANK_MAX_WAIT_MS.
+RERANK_MODEL_NAME = get_env_setting("RERANK_MODEL_NAME", "colbert")
+RERANK_MODEL_TYPE = get_env_setting("RERANK_MODEL_TYPE", None)
+RERANK_QUANTIZE = get_environ_flag("RERANK_QUANTIZE", False)
+RERANK_MAX_BATCH_SIZE = int(get_env_setting("RERANK_MAX_BATCH_SIZE", 8))
+RERANK_MAX_WAIT_MS = int(get_env_setting("RERANK_MAX_WAIT_MS", 5))
+
+# batch query jobs over a JSONL file of prompts: max concurrent prompts,
+# prompts per output shard (the checkpoint unit) and min seconds between
+# job progress updates
+QUERY_BATCH_CONCURRENCY = int(get_env_setting("QUERY_BATCH_CONCURRENCY", 8))
+QUERY_BATCH_CHUNK_SIZE = int(get_env_setting("QUERY_BATCH_CHUNK_SIZE", 100))
+QUERY_BATCH_PROGRESS_INTERVAL = int(
+    get_env_setting("QUERY_BATCH_PROGRESS_INTERVAL", 30))
+# comma separated GCS buckets that batch query jobs may read prompts from
+# and write results to.  Batch queries over files are disabled if unset.
+QUERY_BATCH_BUCKETS = [
+  bucket.strip() for bucket in
+  get_env_setting("QUERY_BATCH_BUCKETS", "").split(",") if bucket.strip()
+]
+
+# query engine build pipeline: documents are downloaded, chunked (in
+# QUERY_BUILD_PARSE_WORKERS processes, or a thread if 0), embedded and
+# written to the vector store, and saved to Firestore in overlapping
+# stages, with this many documents in flight per stage.  Parse worker
+# processes are spawned per build and each re-imports the service config,
+# so they only pay off for builds of many large documents.
+QUERY_BUILD_PARSE_WORKERS = int(get_env_setting(
+    "QUERY_BUILD_PARSE_WORKERS", 0))
+QUERY_BUILD_EMBED_CONCURRENCY = int(
+    get_env_setting("QUERY_BUILD_EMBED_CONCURRENCY", 4))
+QUERY_BUILD_WRITE_CONCURRENCY = int(
+    get_env_setting("QUERY_BUILD_WRITE_CONCURRENCY", 4))
+QUERY_BUILD_QUEUE_SIZE = int(get_env_setting("QUERY_BUILD_QUEUE_SIZE", 8))
+
+# GCS documents are downloaded by this many threads, with up to twice as
+# many downloaded files waiting to be processed
+QUERY_BUILD_DOWNLOAD_WORKERS = int(
+    get_env_setting("QUERY_BUILD_DOWNLOAD_WORKERS", 8))
+
+# chunk models are written in Firestore batches with up to this many
+# batch commits in flight, and build progress is saved to the build job at
+# most every QUERY_BUILD_PROGRESS_INTERVAL seconds
+QUERY_BUILD_COMMIT_CONCURRENCY = int(
+    get_env_setting("QUERY_BUILD_COMMIT_CONCURRENCY", 4))
+QUERY_BUILD_PROGRESS_INTERVAL = int(
+    get_env_setting("QUERY_BUILD_PROGRESS_INTERVAL", 30))
+
 # config for agents and datasets
 AGENT_CONFIG_PATH = os.environ.get("AGENT_CONFIG_PATH")
 if not AGENT_CONFIG_PATH:
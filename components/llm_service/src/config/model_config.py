@@ -52,6 +52,8 @@ KEY_MODEL_NAME = "model_name"
 KEY_MODEL_PARAMS = "model_params"
 KEY_MODEL_CONTEXT_LENGTH = "context_length"
 KEY_MODEL_TOKEN_LIMIT = "token_limit"
+KEY_MODEL_TOKENIZER = "tokenizer"
+KEY_EMBEDDING_BATCHING = "batching"
 KEY_IS_CHAT = "is_chat"
 KEY_IS_MULTI = "is_multi"
 KEY_MODEL_FILE_URL = "model_file_url"
@@ -82,6 +84,8 @@ MODEL_CONFIG_KEYS = [
   KEY_MODEL_PARAMS,
   KEY_MODEL_CONTEXT_LENGTH,
   KEY_MODEL_TOKEN_LIMIT,
+  KEY_MODEL_TOKENIZER,
+  KEY_EMBEDDING_BATCHING,
   KEY_IS_CHAT,
   KEY_IS_MULTI,
   KEY_MODEL_FILE_URL,
@@ -16,6 +16,8 @@ Vector Store Config
 """
 # pylint: disable=broad-exception-caught
 
+import os
+import tempfile
 from common.utils.logging_handler import Logger
 from common.utils.secrets import get_secret
 from common.utils.config import get_env_setting
@@ -26,12 +28,20 @@ Logger = Logger.get_logger(__file__)
 # vector store types
 VECTOR_STORE_MATCHING_ENGINE = "matching_engine"
 VECTOR_STORE_LANGCHAIN_PGVECTOR = "langchain_pgvector"
+VECTOR_STORE_LOCAL = "local"
 PG_VECTOR_DEFAULT_DBNAME = "pgvector"
 LOCAL_HOST = "127.0.0.1"
 
 VECTOR_STORES = [
   VECTOR_STORE_MATCHING_ENGINE,
-  VECTOR_STORE_LANGCHAIN_PGVECTOR
+  VECTOR_STORE_LANGCHAIN_PGVECTOR,
+  VECTOR_STORE_LOCAL
+]
+
+# vector stores that support incremental query engine refresh
+REFRESH_VECTOR_STORES = [
+  VECTOR_STORE_LANGCHAIN_PGVECTOR,
+  VECTOR_STORE_LOCAL
 ]
 
 # postgres
@@ -44,6 +54,34 @@ PG_PASSWD = None
 Logger.info(f"PG_HOST = [{PG_HOST}]")
 Logger.info(f"PG_DBNAME = [{PG_DBNAME}]")
 
+# postgres connection pool settings, shared by all query engines
+PG_POOL_SIZE = int(get_env_setting("PG_POOL_SIZE", 5))
+PG_MAX_OVERFLOW = int(get_env_setting("PG_MAX_OVERFLOW", 10))
+PG_POOL_PRE_PING = \
+    str(get_env_setting("PG_POOL_PRE_PING", "true")).lower() == "true"
+PG_POOL_RECYCLE = int(get_env_setting("PG_POOL_RECYCLE", 1800))
+
+# default pgvector ANN index type ("hnsw", "ivfflat" or "none") and index
+# build settings, used when a query engine doesn't set them in its params
+PG_ANN_INDEX = get_env_setting("PG_ANN_INDEX", "hnsw")
+PG_HNSW_M = int(get_env_setting("PG_HNSW_M", 16))
+PG_HNSW_EF_CONSTRUCTION = int(get_env_setting("PG_HNSW_EF_CONSTRUCTION", 64))
+
+# local vector store.  Index data is persisted under LOCAL_VECTOR_STORE_PATH,
+# a local directory or gs:// uri; if not set a bucket is created per engine.
+# Data persisted to GCS is downloaded to LOCAL_VECTOR_STORE_CACHE_DIR.
+LOCAL_VECTOR_STORE_PATH = get_env_setting("LOCAL_VECTOR_STORE_PATH", None)
+LOCAL_VECTOR_STORE_CACHE_DIR = get_env_setting(
+    "LOCAL_VECTOR_STORE_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "local_vector_store"))
+# embedding storage dtype ("float32" or "float16")
+LOCAL_VECTOR_STORE_DTYPE = get_env_setting("LOCAL_VECTOR_STORE_DTYPE",
+                                           "float32")
+# min number of embeddings for building an in-memory HNSW graph (requires
+# hnswlib); smaller engines use exact search
+LOCAL_VECTOR_STORE_ANN_MIN_ROWS = \
+    int(get_env_setting("LOCAL_VECTOR_STORE_ANN_MIN_ROWS", 50000))
+
 # load secrets
 secrets = secretmanager.SecretManagerServiceClient()
 try:
@@ -38,6 +38,7 @@ from common.monitoring.middleware import (
   PrometheusMiddleware,
   create_metrics_router
 )
+from services.token_counter import load_token_counters
 
 # Basic API config
 service_title = "LLM Service API's"
@@ -69,6 +70,14 @@ app.add_middleware(
 
 metrics_router = create_metrics_router()
 
+@app.on_event("startup")
+def startup_load_token_counters():
+  """Load the tokenizers of configured models in the background, so
+  request metrics don't load them on the event loop"""
+  model_config = config.get_model_config()
+  load_token_counters(model_config.get_llm_types() +
+                      model_config.get_embedding_types())
+
 @app.get("/ping")
 def health_check():
   """Health Check API
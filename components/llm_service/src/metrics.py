@@ -19,6 +19,7 @@ import asyncio
 import inspect
 from functools import wraps
 from typing import Callable, Dict, Any
+from fastapi.responses import StreamingResponse
 
 from common.monitoring.metrics import (
   Counter, Histogram, Gauge,
@@ -30,6 +31,7 @@ from common.monitoring.metrics import (
 from common.utils.logging_handler import Logger
 from common.utils.context_vars import get_context, set_context, reset_context
 from common.models import QueryEngine
+from services.token_counter import count_tokens_nowait
 
 # Initialize logger
 logger = Logger.get_logger("llm_service.metrics")
@@ -63,6 +65,58 @@ EMBEDDING_GENERATE_LATENCY = Histogram(
   ["embedding_type"]
 )
 
+EMBEDDING_CACHE_HIT_COUNT = Counter(
+  "embedding_cache_hit_count", "Embedding Cache Hit Count",
+  ["embedding_type", "tier"]
+)
+
+EMBEDDING_CACHE_MISS_COUNT = Counter(
+  "embedding_cache_miss_count", "Embedding Cache Miss Count",
+  ["embedding_type"]
+)
+
+# Embedding Executor Metrics
+EMBEDDING_EXECUTOR_IN_FLIGHT = Gauge(
+  "embedding_executor_in_flight", "Embedding Requests In Flight"
+)
+
+EMBEDDING_EXECUTOR_QUEUED = Gauge(
+  "embedding_executor_queued", "Embedding Requests Waiting For A Slot"
+)
+
+EMBEDDING_EXECUTOR_WAIT = Histogram(
+  "embedding_executor_wait_seconds", "Embedding Request Queue Wait Time"
+)
+
+# Semantic Cache Metrics
+SEMANTIC_CACHE_HIT_COUNT = Counter(
+  "semantic_cache_hit_count", "Query Semantic Cache Hit Count",
+  ["engine_name"]
+)
+
+SEMANTIC_CACHE_MISS_COUNT = Counter(
+  "semantic_cache_miss_count", "Query Semantic Cache Miss Count",
+  ["engine_name"]
+)
+
+# Query Streaming Metrics
+QUERY_STREAM_TTFB = Histogram(
+  "query_stream_time_to_first_byte_seconds",
+  "Time from Query Request to First Streamed Event",
+  ["event"], buckets=[.1, .25, .5, 1, 2, 3, 5, 7.5, 10, 15, 30, 60]
+)
+
+# Rerank Metrics
+RERANK_LATENCY = Histogram(
+  "rerank_latency_seconds", "Rerank Request Latency",
+  ["model"], buckets=[.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10]
+)
+
+RERANK_BATCH_SIZE = Histogram(
+  "rerank_batch_size", "Number of Rerank Requests per Batch",
+  ["model"], buckets=[1, 2, 4, 8, 16, 32]
+)
+
 # Chat Metrics
 CHAT_GENERATE_COUNT = Counter(
   "chat_generate_count", "Chat Generation Count",
@@ -96,11 +150,12 @@ ACTIVE_USERS = Gauge(
   ["time_window"]
 )
 
-# Prompt size
-PROMPT_SIZE = Histogram(
-  "prompt_size_bytes", "Prompt Size in Bytes",
+# Prompt size, counted with the tokenizer of the model
+PROMPT_TOKENS = Histogram(
+  "prompt_size_tokens", "Prompt Size in Tokens",
   ["type"], buckets=[
-    64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536]
+    16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768,
+    131072]
 )
 
 # Agent Metrics
@@ -162,14 +217,16 @@ def extract_llm_params(kwargs: Dict[str, Any]) -> Dict[str, Any]:
   llm_type = config_dict.get("llm_type", "unknown")
   prompt = config_dict.get("prompt", "")
   prompt_size = len(prompt)
+  prompt_tokens = count_tokens_nowait(prompt, llm_type)
 
   # Record prompt size
-  if prompt_size > 0:
-    PROMPT_SIZE.labels("llm").observe(prompt_size)
+  if prompt_tokens > 0:
+    PROMPT_TOKENS.labels("llm").observe(prompt_tokens)
 
   return {
     "llm_type": llm_type,
-    "prompt_size": prompt_size
+    "prompt_size": prompt_size,
+    "prompt_tokens": prompt_tokens
   }
 
 
@@ -188,14 +245,16 @@ def extract_embedding_params(kwargs: Dict[str, Any]) -> Dict[str, Any]:
   embedding_type = config_dict.get("embedding_type", "unknown")
   text = config_dict.get("text", "")
   text_size = len(text)
+  text_tokens = count_tokens_nowait(text, embedding_type)
 
   # Record text size
-  if text_size > 0:
-    PROMPT_SIZE.labels("embedding").observe(text_size)
+  if text_tokens > 0:
+    PROMPT_TOKENS.labels("embedding").observe(text_tokens)
 
   return {
     "embedding_type": embedding_type,
-    "text_size": text_size
+    "text_size": text_size,
+    "text_tokens": text_tokens
   }
 
 
@@ -216,6 +275,7 @@ def extract_chat_params(kwargs: Dict[str, Any]) -> Dict[str, Any]:
     "with_file": False,
     "with_tools": False,
     "prompt_size": 0,
+    "prompt_tokens": 0,
     "is_streaming": False
   }
 
@@ -229,6 +289,7 @@ def extract_chat_params(kwargs: Dict[str, Any]) -> Dict[str, Any]:
       params["with_tools"] = kwargs.get("tool_names") is not None
       params["is_streaming"] = kwargs.get("stream", False)
       params["prompt_size"] = len(prompt) if prompt else 0
+      params["prompt_tokens"] = count_tokens_nowait(prompt, params["llm_type"])
     else:
       # For other chat functions with gen_config
       config_dict = safe_extract_config_dict(gen_config)
@@ -238,14 +299,16 @@ def extract_chat_params(kwargs: Dict[str, Any]) -> Dict[str, Any]:
                            config_dict.get("chat_file_url") is not None)
       params["with_tools"] = config_dict.get("tool_names") is not None
       params["is_streaming"] = config_dict.get("stream", False)
-      params["prompt_size"] = len(config_dict.get("prompt", ""))
+      prompt = config_dict.get("prompt", "")
+      params["prompt_size"] = len(prompt)
+      params["prompt_tokens"] = count_tokens_nowait(prompt, params["llm_type"])
   except Exception as e:
     logger.error(f"Error extracting chat parameters: {type(e).__name__}: {e}")
     raise
 
   # Record prompt size metric
-  if params["prompt_size"] > 0:
-    PROMPT_SIZE.labels("chat").observe(params["prompt_size"])
+  if params["prompt_tokens"] > 0:
+    PROMPT_TOKENS.labels("chat").observe(params["prompt_tokens"])
 
   return params
 
@@ -689,6 +752,29 @@ def track_agent_execution(func: Callable):
   return wrapper
 
 
+def _record_vector_db_query_latency(start_time: float, db_type: str,
+                                    engine_name: str):
+  latency = measure_latency(
+    start_time,
+    "vector_db_query",
+    {"db_type": db_type, "engine_name": engine_name}
+  )
+  VECTOR_DB_QUERY_LATENCY.labels(
+    db_type=db_type,
+    engine_name=engine_name
+  ).observe(latency)
+
+
+async def _track_vector_db_query_stream(body_iterator, start_time: float,
+                                        db_type: str, engine_name: str):
+  """Pass through a response stream, recording query latency at its end"""
+  try:
+    async for chunk in body_iterator:
+      yield chunk
+  finally:
+    _record_vector_db_query_latency(start_time, db_type, engine_name)
+
+
 def track_vector_db_query(func: Callable):
   """Decorator to track vector database query metrics"""
 
@@ -720,10 +806,17 @@ def track_vector_db_query(func: Callable):
 
       # Start timing
       start_time = time.time()
+      streaming = False
 
       try:
         result = await func(*args, **kwargs)
 
+        # streamed responses are timed until the stream completes
+        if isinstance(result, StreamingResponse):
+          streaming = True
+          result.body_iterator = _track_vector_db_query_stream(
+              result.body_iterator, start_time, db_type, engine_name)
+
         # Record success metrics
         VECTOR_DB_QUERY_COUNT.labels(
           db_type=db_type,
@@ -767,15 +860,8 @@ def track_vector_db_query(func: Callable):
 
       finally:
         # Record latency
-        latency = measure_latency(
-          start_time,
-          "vector_db_query",
-          {"db_type": db_type, "engine_name": engine_name}
-        )
-        VECTOR_DB_QUERY_LATENCY.labels(
-          db_type=db_type,
-          engine_name=engine_name
-        ).observe(latency)
+        if not streaming:
+          _record_vector_db_query_latency(start_time, db_type, engine_name)
     finally:
       # Always reset context to ensure no leaks
       reset_context(context_tokens)
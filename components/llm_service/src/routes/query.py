@@ -15,28 +15,39 @@
 # pylint: disable = broad-except
 
 """ Query endpoints """
+import asyncio
+import json
+import time
 import traceback
+from typing import Optional
 from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
 
 from common.models import (QueryEngine,
                            User, UserQuery, QueryDocument, UserChat)
-from common.models.llm_query import QE_TYPE_INTEGRATED_SEARCH
+from common.models.llm_query import (QE_TYPE_INTEGRATED_SEARCH,
+                                     QE_TYPE_VERTEX_SEARCH)
 from common.schemas.batch_job_schemas import BatchJobModel
-from common.utils.auth_service import validate_token
+from common.utils.auth_service import validate_token, create_authz_filter
 from common.utils.batch_jobs import initiate_batch_job
 from common.utils.config import (JOB_TYPE_QUERY_ENGINE_BUILD,
+                                 JOB_TYPE_QUERY_ENGINE_REFRESH,
                                  JOB_TYPE_QUERY_EXECUTE)
 from common.utils.errors import (ResourceNotFoundException,
                                  ValidationError,
                                  PayloadTooLargeError)
 from common.utils.http_exceptions import (InternalServerError, BadRequest,
-                                          ResourceNotFound)
+                                          ResourceNotFound, Unauthorized)
 from common.utils.logging_handler import Logger
 from config import (PROJECT_ID, DATABASE_PREFIX, PAYLOAD_FILE_SIZE,
                     ERROR_RESPONSES, ENABLE_OPENAI_LLM, ENABLE_COHERE_LLM,
-                    DEFAULT_VECTOR_STORE, VECTOR_STORES, PG_HOST,
-                    ONEDRIVE_CLIENT_ID, ONEDRIVE_TENANT_ID)
+                    DEFAULT_VECTOR_STORE, VECTOR_STORES,
+                    REFRESH_VECTOR_STORES, PG_HOST,
+                    ONEDRIVE_CLIENT_ID, ONEDRIVE_TENANT_ID,
+                    DEFAULT_QUERY_CHAT_MODEL, QUERY_BATCH_BUCKETS,
+                    get_model_config)
 from schemas.llm_schema import (LLMQueryModel,
+                                LLMBatchQueryModel,
                                 LLMUserAllQueriesResponse,
                                 LLMUserQueryResponse,
                                 UserQueryUpdateModel,
@@ -48,10 +59,16 @@ from schemas.llm_schema import (LLMQueryModel,
                                 LLMGetVectorStoreTypesResponse,
                                 LLMQueryEngineUpdateModel)
 from services.query.query_service import (query_generate,
-                                          delete_engine, update_user_query)
+                                          query_generate_stream,
+                                          QUERY_EVENT_REFERENCES,
+                                          QUERY_EVENT_TOKEN,
+                                          QUERY_EVENT_RESULT,
+                                          delete_engine, reindex_engine,
+                                          update_user_query)
 from services.llm_generate import generate_chat_summary
 from utils.gcs_helper import upload_b64files_to_gcs
-from metrics import track_vector_db_query, track_vector_db_build
+from metrics import (track_vector_db_query, track_vector_db_build,
+                     QUERY_STREAM_TTFB)
 
 Logger = Logger.get_logger(__file__)
 router = APIRouter(prefix="/query", tags=["Query"], responses=ERROR_RESPONSES)
@@ -447,6 +464,91 @@ def delete_query_engine(query_engine_id: str, hard_delete: bool = True):
   }
 
 
+@router.post(
+  "/engine/{query_engine_id}/reindex",
+  name="Rebuild the search index for a query engine")
+def reindex_query_engine(query_engine_id: str):
+  """
+  Rebuild the vector store search index of a query engine, e.g. after
+  documents have been bulk loaded.
+
+  Args:
+      query_engine_id (str)
+  Returns:
+    [JSON]: {'success': 'True'} if the query engine is reindexed,
+    ResourceNotFoundException if the query engine not found,
+    InternalServerErrorResponseModel if the reindex raises an exception
+  """
+  q_engine = QueryEngine.find_by_id(query_engine_id)
+  if q_engine is None:
+    raise ResourceNotFoundException(f"Engine {query_engine_id} not found")
+
+  try:
+    reindex_engine(q_engine)
+    Logger.info(f"Successfully reindexed q_engine=[{q_engine.name}]")
+  except Exception as e:
+    Logger.error(e)
+    raise InternalServerError(str(e)) from e
+
+  return {
+    "success": True,
+    "message": f"Successfully reindexed query engine {query_engine_id}",
+  }
+
+
+@router.post(
+  "/engine/{query_engine_id}/refresh",
+  name="Refresh a query engine from its documents",
+  response_model=BatchJobModel)
+def refresh_query_engine(query_engine_id: str):
+  """
+  Start a job that refreshes a query engine from its doc_url: new and
+  changed documents are indexed and removed documents are deleted, while
+  unchanged documents keep their existing index.
+
+  Args:
+      query_engine_id (str)
+  Returns:
+      BatchJobModel
+  """
+  q_engine = QueryEngine.find_by_id(query_engine_id)
+  if q_engine is None:
+    raise ResourceNotFoundException(f"Engine {query_engine_id} not found")
+
+  if q_engine.query_engine_type in (QE_TYPE_VERTEX_SEARCH,
+                                    QE_TYPE_INTEGRATED_SEARCH):
+    raise BadRequest(
+        f"Refresh not supported for {q_engine.query_engine_type} engines")
+
+  vector_store_type = q_engine.vector_store or DEFAULT_VECTOR_STORE
+  if vector_store_type not in REFRESH_VECTOR_STORES:
+    raise BadRequest(
+        f"Refresh not supported for {vector_store_type} vector stores")
+
+  try:
+    data = {
+      "query_engine_id": query_engine_id,
+    }
+    env_vars = {
+      "DATABASE_PREFIX": DATABASE_PREFIX,
+      "PROJECT_ID": PROJECT_ID,
+      "ENABLE_OPENAI_LLM": str(ENABLE_OPENAI_LLM),
+      "ENABLE_COHERE_LLM": str(ENABLE_COHERE_LLM),
+      "DEFAULT_VECTOR_STORE": str(DEFAULT_VECTOR_STORE),
+      "PG_HOST": PG_HOST,
+      "ONEDRIVE_CLIENT_ID": ONEDRIVE_CLIENT_ID,
+      "ONEDRIVE_TENANT_ID": ONEDRIVE_TENANT_ID,
+    }
+    response = initiate_batch_job(data, JOB_TYPE_QUERY_ENGINE_REFRESH,
+                                  env_vars)
+    Logger.info(f"Batch job response: {response}")
+    return response
+  except Exception as e:
+    Logger.error(e)
+    Logger.error(traceback.print_exc())
+    raise InternalServerError(str(e)) from e
+
+
 @router.post(
     "/engine",
     name="Create a query engine",
@@ -540,7 +642,9 @@ async def query(query_engine_id: str,
                 gen_config: LLMQueryModel,
                 user_data: dict = Depends(validate_token)):
   """
-  Send a query to a query engine and return the response
+  Send a query to a query engine and return the response.  If stream is
+  set in gen_config the response is streamed as server-sent events (see
+  query_event_stream).
 
   Args:
       query_engine_id (str):
@@ -583,7 +687,6 @@ async def query(query_engine_id: str,
   Logger.info(f"run_as_batch_job = {run_as_batch_job}")
 
   user_query = None
-  user_chat = None
   if run_as_batch_job:
     # create user query object to hold the query state
     user_query = UserQuery(user_id=user.user_id,
@@ -628,6 +731,18 @@ async def query(query_engine_id: str,
       Logger.error(traceback.print_exc())
       raise InternalServerError(str(e)) from e
 
+  if genconfig_dict.get("stream", False):
+    # errors raised once the stream has started are sent as error events
+    # with a 200 status, so the request is validated first
+    validate_query_filter(query_filter)
+    llm_type = llm_type or q_engine.llm_type or DEFAULT_QUERY_CHAT_MODEL
+    if not get_model_config().is_model_enabled_for_user(llm_type, user_data):
+      raise Unauthorized("User does not have access to model")
+    return StreamingResponse(
+        query_event_stream(user, prompt, q_engine, user_data, llm_type,
+                           rank_sentences, query_filter, chat_mode),
+        media_type="text/event-stream")
+
   # perform normal synchronous query
   try:
     query_result, query_references = await query_generate(user.id,
@@ -642,48 +757,9 @@ async def query(query_engine_id: str,
     Logger.info(f"Query response="
                 f"[{query_result.response}]")
 
-    # save user query history
-    user_query, query_reference_dicts = \
-        update_user_query(prompt,
-                          query_result.response,
-                          user.id,
-                          q_engine,
-                          query_references, None,
-                          query_filter)
-
-    # Create UserChat if chat_mode is enabled
-    if chat_mode:
-      user_chat = UserChat(user_id=user.user_id,
-                          llm_type=llm_type,
-                          prompt=prompt)
-      user_chat.history = UserChat.get_history_entry(prompt,
-                                                     query_result.response)
-
-      # Add query engine results to chat history
-      user_chat.update_history(
-        query_engine=q_engine,
-        query_result=query_result,
-        query_references=query_references
-      )
-
-      user_chat.save()
-
-      # Generate and set chat title
-      summary = await generate_chat_summary(user_chat)
-      user_chat.title = summary
-      user_chat.save()
-
-    query_result_dict = query_result.get_fields(reformat_datetime=True)
-
-    response_data = {
-      "user_query_id": user_query.id,
-      "query_result": query_result_dict,
-      "query_references": query_reference_dicts
-    }
-
-    if chat_mode and user_chat:
-      response_data["user_chat_id"] = user_chat.id
-      response_data["user_chat"] = user_chat.get_fields(reformat_datetime=True)
+    response_data = await save_query_response(
+        user, prompt, q_engine, llm_type, query_result, query_references,
+        query_filter, chat_mode)
 
     return {
         "success": True,
@@ -696,6 +772,249 @@ async def query(query_engine_id: str,
     raise InternalServerError(str(e)) from e
 
 
+@router.post(
+    "/engine/{query_engine_id}/batch",
+    name="Run a batch query job over a file of prompts",
+    response_model=LLMQueryResponse)
+async def batch_query(query_engine_id: str,
+                      batch_config: LLMBatchQueryModel,
+                      user_data: dict = Depends(validate_token)):
+  """
+  Launch a batch job that queries a query engine with each prompt in a
+  JSONL file in GCS, writing results as JSONL files to output_uri.
+
+  Args:
+      query_engine_id (str):
+      batch_config (LLMBatchQueryModel):
+      user_data (dict):
+
+  Returns:
+      LLMQueryResponse
+  """
+  q_engine = QueryEngine.find_by_id(query_engine_id)
+  if q_engine is None:
+    raise ResourceNotFound(f"Engine {query_engine_id} not found")
+
+  batch_dict = {**batch_config.dict()}
+  for uri_key in ["prompts_uri", "output_uri"]:
+    uri = batch_dict.get(uri_key)
+    if uri:
+      validate_batch_uri(uri_key, uri)
+
+  user = User.find_by_email(user_data.get("email"))
+  if user is None:
+    raise ResourceNotFound(f"User {user_data.get('email')} not found")
+
+  # check if user has access to model, as for single queries
+  llm_type = batch_dict.get("llm_type") or q_engine.llm_type or \
+      DEFAULT_QUERY_CHAT_MODEL
+  if not get_model_config().is_model_enabled_for_user(llm_type, user_data):
+    raise Unauthorized("User does not have access to model")
+
+  # RBAC roles of the user are applied to the query filter in the job
+  authz_filter = create_authz_filter(user_data)
+
+  try:
+    data = {
+      "query_engine_id": query_engine_id,
+      "user_id": user.id,
+      **batch_dict,
+      "llm_type": llm_type,
+      "authz_filter": authz_filter
+    }
+    env_vars = {
+      "DATABASE_PREFIX": DATABASE_PREFIX,
+      "PROJECT_ID": PROJECT_ID,
+      "ENABLE_OPENAI_LLM": str(ENABLE_OPENAI_LLM),
+      "ENABLE_COHERE_LLM": str(ENABLE_COHERE_LLM),
+      "DEFAULT_VECTOR_STORE": str(DEFAULT_VECTOR_STORE),
+      "PG_HOST": PG_HOST,
+    }
+    response = initiate_batch_job(data, JOB_TYPE_QUERY_EXECUTE, env_vars)
+    Logger.info(f"Batch job response: {response}")
+
+    return {
+      "success": True,
+      "message": "Successfully started batch query job",
+      "data": {
+        "batch_job": response["data"],
+      },
+    }
+  except Exception as e:
+    Logger.error(e)
+    Logger.error(traceback.print_exc())
+    raise InternalServerError(str(e)) from e
+
+
+def validate_query_filter(query_filter: Optional[str]):
+  """
+  Check that a query filter is a JSON object, as parsed by
+  query_generate_stream.
+
+  Raises:
+    BadRequest if the query filter is not valid
+  """
+  if query_filter is None:
+    return
+  try:
+    parsed_filter = json.loads(query_filter)
+  except ValueError as e:
+    raise BadRequest(f"Invalid query_filter: {e}") from e
+  if not isinstance(parsed_filter, dict):
+    raise BadRequest("query_filter must be a JSON object")
+
+
+def validate_batch_uri(uri_key: str, uri: str):
+  """
+  Check that a batch query uri is a gs:// uri in one of the
+  QUERY_BATCH_BUCKETS, as batch jobs read and write it with the service
+  account.
+
+  Raises:
+    BadRequest if the uri is not allowed
+  """
+  if not uri.startswith("gs://"):
+    raise BadRequest(f"{uri_key} must be a gs:// uri")
+  bucket_name, _, path = uri[len("gs://"):].partition("/")
+  if not path or ".." in path.split("/"):
+    raise BadRequest(f"Invalid {uri_key} {uri}")
+  if bucket_name not in QUERY_BATCH_BUCKETS:
+    raise BadRequest(f"{uri_key} bucket {bucket_name} is not enabled for "
+                     "batch queries")
+
+
+async def save_query_response(user: User, prompt: str, q_engine: QueryEngine,
+                              llm_type: str, query_result, query_references,
+                              query_filter, chat_mode: bool) -> dict:
+  """
+  Save user query history (and a user chat in chat mode) for a generated
+  query response.
+
+  Returns:
+    response data dict for the query endpoint
+  """
+  user_query, query_reference_dicts = \
+      update_user_query(prompt,
+                        query_result.response,
+                        user.id,
+                        q_engine,
+                        query_references, None,
+                        query_filter)
+
+  # Create UserChat if chat_mode is enabled
+  user_chat = None
+  if chat_mode:
+    user_chat = UserChat(user_id=user.user_id,
+                        llm_type=llm_type,
+                        prompt=prompt)
+    user_chat.history = UserChat.get_history_entry(prompt,
+                                                   query_result.response)
+
+    # Add query engine results to chat history
+    user_chat.update_history(
+      query_engine=q_engine,
+      query_result=query_result,
+      query_references=query_references
+    )
+
+    user_chat.save()
+
+    # Generate and set chat title
+    summary = await generate_chat_summary(user_chat)
+    user_chat.title = summary
+    user_chat.save()
+
+  query_result_dict = query_result.get_fields(reformat_datetime=True)
+
+  response_data = {
+    "user_query_id": user_query.id,
+    "query_result": query_result_dict,
+    "query_references": query_reference_dicts
+  }
+
+  if chat_mode and user_chat:
+    response_data["user_chat_id"] = user_chat.id
+    response_data["user_chat"] = user_chat.get_fields(reformat_datetime=True)
+  return response_data
+
+
+def sse_event(event: str, data) -> str:
+  """ Format a server-sent event with a JSON payload """
+  return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+# tasks of streaming queries in progress, which run to completion and save
+# the response even if the client disconnects
+query_stream_tasks = set()
+
+# end of stream marker for the query task events
+_QUERY_STREAM_END = "end"
+
+
+async def query_event_stream(user: User, prompt: str, q_engine: QueryEngine,
+                             user_data: dict, llm_type: str, rank_sentences,
+                             query_filter, chat_mode: bool):
+  """
+  Generate server-sent events for a streaming query:
+    references: the query references, as soon as retrieval is done
+    token: {"text": ...} for each chunk of the generated response
+    done: the query response data (as returned by the non-streaming
+          endpoint), once the query has been saved
+    error: {"message": ...} if the query fails
+  The query runs in a task, so the response is generated and saved even if
+  the client disconnects mid-stream.  The time to the first references and
+  token events is exported in the QUERY_STREAM_TTFB metric.
+  """
+  start_time = time.monotonic()
+  events = asyncio.Queue()
+
+  async def run_query():
+    try:
+      async for event, data in query_generate_stream(user.id,
+                                                     prompt,
+                                                     q_engine,
+                                                     user_data,
+                                                     llm_type,
+                                                     None,
+                                                     rank_sentences,
+                                                     query_filter):
+        if event == QUERY_EVENT_RESULT:
+          query_result, query_references = data
+          data = await save_query_response(
+              user, prompt, q_engine, llm_type, query_result,
+              query_references, query_filter, chat_mode)
+          event = "done"
+        events.put_nowait((event, data))
+    except Exception as e:
+      Logger.error(e)
+      Logger.error(traceback.print_exc())
+      events.put_nowait(("error", {"message": str(e)}))
+    finally:
+      events.put_nowait((_QUERY_STREAM_END, None))
+
+  task = asyncio.create_task(run_query())
+  query_stream_tasks.add(task)
+  task.add_done_callback(query_stream_tasks.discard)
+
+  while True:
+    event, data = await events.get()
+    if event == _QUERY_STREAM_END:
+      break
+    if event == QUERY_EVENT_REFERENCES:
+      QUERY_STREAM_TTFB.labels(event=event).observe(
+          time.monotonic() - start_time)
+      yield sse_event(event, [ref.get_fields(reformat_datetime=True)
+                              for ref in data])
+    elif event == QUERY_EVENT_TOKEN:
+      if start_time is not None:
+        QUERY_STREAM_TTFB.labels(event=event).observe(
+            time.monotonic() - start_time)
+        start_time = None
+      yield sse_event(event, {"text": data})
+    else:
+      yield sse_event(event, data)
+
+
 @router.post(
     "/{user_query_id}",
     name="Continue chat with a prior user query",
@@ -18,6 +18,8 @@
 # disabling pylint rules that conflict with pytest fixtures
 # pylint: disable=unused-argument,redefined-outer-name,unused-import,unused-variable,ungrouped-imports,use-implicit-booleaness-not-comparison
 import os
+import asyncio
+import json
 import pytest
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
@@ -63,6 +65,7 @@ api_url = f"{API_URL}/query"
 
 with mock.patch("common.utils.secrets.get_secret"):
   with mock.patch("kubernetes.config.load_incluster_config"):
+    from routes import query as query_routes
     from routes.query import router
 
 app = FastAPI()
@@ -247,6 +250,65 @@ def test_create_query_engine(create_user, client_with_emulator):
   query_engine_data = json_response.get("data")
   assert query_engine_data == FAKE_QE_BUILD_RESPONSE["data"]
 
+def test_refresh_query_engine(create_engine, client_with_emulator):
+  qe_id = QUERY_ENGINE_EXAMPLE["id"]
+  url = f"{api_url}/engine/{qe_id}/refresh"
+  with mock.patch("routes.query.initiate_batch_job",
+                  return_value=FAKE_QE_BUILD_RESPONSE) as mock_initiate:
+    resp = client_with_emulator.post(url)
+
+  assert resp.status_code == 200, "Status 200"
+  assert resp.json().get("data") == FAKE_QE_BUILD_RESPONSE["data"]
+  assert mock_initiate.call_args[0][0] == {"query_engine_id": qe_id}
+
+  # vector stores without refresh support are rejected
+  q_engine = QueryEngine.find_by_id(qe_id)
+  q_engine.vector_store = "matching_engine"
+  q_engine.update()
+  with mock.patch("routes.query.initiate_batch_job") as mock_initiate:
+    resp = client_with_emulator.post(url)
+  assert resp.status_code == 400, "Status 400"
+  mock_initiate.assert_not_called()
+
+def test_batch_query(create_user, create_engine, client_with_emulator):
+  qe_id = QUERY_ENGINE_EXAMPLE["id"]
+  url = f"{api_url}/engine/{qe_id}/batch"
+  params = {
+    "prompts_uri": "gs://batch-bucket/eval/prompts.jsonl",
+    "output_uri": "gs://batch-bucket/eval/results/",
+  }
+  authz_filter = {"authz": {"contains": "admin"}}
+  with mock.patch("routes.query.QUERY_BATCH_BUCKETS", ["batch-bucket"]), \
+       mock.patch("config.model_config.ModelConfig.is_model_enabled_for_user",
+                  return_value=True), \
+       mock.patch("routes.query.create_authz_filter",
+                  return_value=authz_filter), \
+       mock.patch("routes.query.initiate_batch_job",
+                  return_value=FAKE_QE_BUILD_RESPONSE) as mock_initiate:
+    resp = client_with_emulator.post(url, json=params)
+
+  assert resp.status_code == 200, "Status 200"
+  data = mock_initiate.call_args[0][0]
+  assert data["authz_filter"] == authz_filter
+  assert data["llm_type"] == QUERY_ENGINE_EXAMPLE["llm_type"]
+
+  # buckets not enabled for batch queries are rejected
+  with mock.patch("routes.query.QUERY_BATCH_BUCKETS", ["batch-bucket"]), \
+       mock.patch("routes.query.initiate_batch_job") as mock_initiate:
+    resp = client_with_emulator.post(url, json={
+      **params, "output_uri": "gs://other-bucket/results/"})
+  assert resp.status_code == 400, "Status 400"
+  mock_initiate.assert_not_called()
+
+  # users without access to the model are rejected
+  with mock.patch("routes.query.QUERY_BATCH_BUCKETS", ["batch-bucket"]), \
+       mock.patch("config.model_config.ModelConfig.is_model_enabled_for_user",
+                  return_value=False), \
+       mock.patch("routes.query.initiate_batch_job") as mock_initiate:
+    resp = client_with_emulator.post(url, json=params)
+  assert resp.status_code == 401, "Status 401"
+  mock_initiate.assert_not_called()
+
 def test_get_query_engine(create_engine, client_with_emulator):
   qe_id = QUERY_ENGINE_EXAMPLE["id"]
   url = f"{api_url}/engine/{qe_id}"
@@ -386,6 +448,93 @@ def test_query(create_user, create_engine,
     "returned query references"
 
 
+def test_query_stream(create_user, create_engine,
+                      create_query_result, create_query_reference,
+                      client_with_emulator):
+  q_engine_id = QUERY_ENGINE_EXAMPLE["id"]
+  url = f"{api_url}/engine/{q_engine_id}"
+
+  query_result = QueryResult.find_by_id(QUERY_RESULT_EXAMPLE["id"])
+  async def fake_query_stream(*args, **kwargs):
+    yield "references", [create_query_reference]
+    yield "token", "Hello "
+    yield "token", "world"
+    yield "result", (query_result, [create_query_reference])
+
+  with mock.patch("routes.query.query_generate_stream",
+                  new=fake_query_stream), \
+       mock.patch("config.model_config.ModelConfig.is_model_enabled_for_user",
+                  return_value=True):
+    resp = client_with_emulator.post(url,
+                                     json={**FAKE_QUERY_PARAMS, "stream": True})
+
+  assert resp.status_code == 200, "Status 200"
+  assert resp.headers["content-type"].startswith("text/event-stream")
+  events = [event.split("\n") for event in resp.text.strip().split("\n\n")]
+  assert [event[0] for event in events] == [
+    "event: references", "event: token", "event: token", "event: done"]
+  assert events[1][1] == 'data: {"text": "Hello "}'
+  done_data = json.loads(events[3][1][len("data: "):])
+  assert done_data["query_result"]["id"] == QUERY_RESULT_EXAMPLE.get("id")
+  assert UserQuery.find_by_id(done_data["user_query_id"]) is not None
+
+
+def test_query_stream_invalid(create_user, create_engine,
+                              client_with_emulator):
+  q_engine_id = QUERY_ENGINE_EXAMPLE["id"]
+  url = f"{api_url}/engine/{q_engine_id}"
+  params = {**FAKE_QUERY_PARAMS, "stream": True}
+
+  # invalid requests get an error status instead of an error event
+  with mock.patch("routes.query.query_generate_stream") as mock_stream, \
+       mock.patch("config.model_config.ModelConfig.is_model_enabled_for_user",
+                  return_value=True):
+    resp = client_with_emulator.post(
+        url, json={**params, "query_filter": "{not json"})
+  assert resp.status_code == 400, "Status 400"
+
+  with mock.patch("routes.query.query_generate_stream") as mock_stream, \
+       mock.patch("config.model_config.ModelConfig.is_model_enabled_for_user",
+                  return_value=False):
+    resp = client_with_emulator.post(url, json=params)
+  assert resp.status_code == 401, "Status 401"
+  mock_stream.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_query_stream_disconnect(create_user, create_engine,
+                                       create_query_result,
+                                       create_query_reference):
+  query_result = QueryResult.find_by_id(QUERY_RESULT_EXAMPLE["id"])
+  async def fake_query_stream(*args, **kwargs):
+    yield "references", [create_query_reference]
+    await asyncio.sleep(0.01)
+    yield "token", "Hello world"
+    yield "result", (query_result, [create_query_reference])
+
+  with mock.patch("routes.query.query_generate_stream",
+                  new=fake_query_stream), \
+      mock.patch("routes.query.save_query_response",
+                 new=mock.AsyncMock(return_value={})) as mock_save:
+    stream = query_routes.query_event_stream(
+        User.from_dict(USER_EXAMPLE), "prompt",
+        QueryEngine.find_by_id(QUERY_ENGINE_EXAMPLE["id"]), FAKE_USER_DATA,
+        None, False, None, False)
+    events = []
+    async for event in stream:
+      events.append(event)
+      break
+    assert events[0].startswith("event: references")
+
+    # the client disconnects before the response is generated
+    await stream.aclose()
+    await asyncio.gather(*query_routes.query_stream_tasks)
+
+  # the response is still saved
+  mock_save.assert_called_once()
+  assert mock_save.call_args[0][4] == query_result
+
+
 def test_query_generate(create_user, create_engine, create_user_query,
                         create_query_result, create_query_reference,
                         client_with_emulator):
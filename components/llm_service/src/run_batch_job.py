@@ -18,6 +18,7 @@ import json
 import asyncio
 from absl import flags, app
 from common.utils.config import (JOB_TYPE_QUERY_ENGINE_BUILD,
+                                 JOB_TYPE_QUERY_ENGINE_REFRESH,
                                  JOB_TYPE_QUERY_EXECUTE,
                                  JOB_TYPE_AGENT_RUN,
                                  JOB_TYPE_AGENT_PLAN_EXECUTE,
@@ -26,6 +27,7 @@ from common.utils.logging_handler import Logger
 from common.utils.kf_job_app import kube_delete_job
 from common.models.batch_job import BatchJobModel, JobStatus
 from services.query.query_service import (batch_build_query_engine,
+                                          batch_refresh_query_engine,
                                           batch_query_generate)
 from services.agents.routing_agent import batch_run_dispatch
 from services.agents.agent_service import (batch_run_agent,
@@ -52,6 +54,9 @@ def main(argv):
     if job.type == JOB_TYPE_QUERY_ENGINE_BUILD:
       _ = asyncio.get_event_loop().run_until_complete(
       batch_build_query_engine(request_body, job))
+    elif job.type == JOB_TYPE_QUERY_ENGINE_REFRESH:
+      _ = asyncio.get_event_loop().run_until_complete(
+      batch_refresh_query_engine(request_body, job))
     elif job.type ==  JOB_TYPE_QUERY_EXECUTE:
       _ = asyncio.get_event_loop().run_until_complete(
         batch_query_generate(request_body, job))
@@ -21,6 +21,7 @@ from pydantic import ConfigDict, BaseModel
 from schemas.schema_examples import (LLM_GENERATE_EXAMPLE,
                                    LLM_MULTIMODAL_GENERATE_EXAMPLE,
                                    QUERY_EXAMPLE,
+                                   BATCH_QUERY_EXAMPLE,
                                    QUERY_ENGINE_BUILD_EXAMPLE,
                                    QUERY_ENGINE_UPDATE_EXAMPLE,
                                    QUERY_RETRIEVE_EXAMPLE,
@@ -207,10 +208,22 @@ class LLMQueryModel(BaseModel):
   rank_sentences: Optional[str] = None
   query_filter: Optional[str] = None
   chat_mode: Optional[bool] = False
+  stream: Optional[bool] = False
   model_config = ConfigDict(from_attributes=True, json_schema_extra={
       "example": QUERY_EXAMPLE
   })
 
+class LLMBatchQueryModel(BaseModel):
+  """LLM batch query model, for a JSONL file of prompts in GCS"""
+  prompts_uri: str
+  output_uri: Optional[str] = None
+  llm_type: Optional[str] = None
+  rank_sentences: Optional[bool] = False
+  query_filter: Optional[str] = None
+  model_config = ConfigDict(from_attributes=True, json_schema_extra={
+      "example": BATCH_QUERY_EXAMPLE
+  })
+
 class FileB64(TypedDict):
   name: str
   b64: str
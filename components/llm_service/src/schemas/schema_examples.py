@@ -45,6 +45,12 @@ QUERY_EXAMPLE = {
   "query_filter": "{\"Title\":\"Document Title\"}"
 }
 
+BATCH_QUERY_EXAMPLE = {
+  "prompts_uri": "gs://my-bucket/eval/prompts.jsonl",
+  "output_uri": "gs://my-bucket/eval/results/",
+  "llm_type": "gemini-2.0-flash-001"
+}
+
 USER_QUERY_EXAMPLE = {
   "id": "asd98798as7dhjgkjsdfh",
   "user_id": "fake-user-id",
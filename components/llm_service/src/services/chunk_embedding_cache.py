@@ -0,0 +1,259 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Content addressed cache of chunk embeddings.
+
+Embeddings are keyed by embedding type and the sha256 hash of the
+normalized chunk text (as for query embeddings, see
+embedding_cache.EmbeddingCache.cache_key), so a chunk indexed into several
+query engines, or again when an engine is rebuilt, is embedded once.
+
+The backend is set by QUERY_BUILD_EMBEDDING_CACHE:
+  - "sqlite": a SQLite file at QUERY_BUILD_EMBEDDING_CACHE_PATH, e.g. on a
+    volume mounted by build jobs
+  - "redis": the service redis (common.utils.cache_service), with a ttl of
+    QUERY_BUILD_EMBEDDING_CACHE_TTL
+  - "postgres": a table in the pgvector database
+Cache errors are logged and treated as misses, so they don't fail builds.
+"""
+# pylint: disable=broad-exception-caught,import-outside-toplevel
+
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+from common.utils.logging_handler import Logger
+from config import (QUERY_BUILD_EMBEDDING_CACHE,
+                    QUERY_BUILD_EMBEDDING_CACHE_PATH,
+                    QUERY_BUILD_EMBEDDING_CACHE_TTL)
+from services.embedding_cache import (EmbeddingCache, encode_embedding,
+                                      decode_embedding)
+
+Logger = Logger.get_logger(__file__)
+
+CACHE_BACKEND_SQLITE = "sqlite"
+CACHE_BACKEND_REDIS = "redis"
+CACHE_BACKEND_POSTGRES = "postgres"
+
+# table of cached embeddings for the sqlite and postgres backends
+EMBEDDING_CACHE_TABLE = "chunk_embedding_cache"
+
+# max keys per backend lookup
+LOOKUP_BATCH_SIZE = 500
+
+
+class EmbeddingCacheBackend():
+  """ Storage for encoded embeddings by cache key """
+
+  def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+    """ Return the stored embeddings of the keys that are in the cache """
+    raise NotImplementedError
+
+  def set_many(self, items: Dict[str, bytes]):
+    """ Store encoded embeddings by key """
+    raise NotImplementedError
+
+
+class SqliteEmbeddingCacheBackend(EmbeddingCacheBackend):
+  """ Embeddings stored in a local SQLite file """
+
+  def __init__(self, path: str = QUERY_BUILD_EMBEDDING_CACHE_PATH) -> None:
+    self.path = path
+    self._lock = threading.Lock()
+    self._conn = sqlite3.connect(path, check_same_thread=False)
+    with self._lock, self._conn:
+      self._conn.execute("PRAGMA journal_mode=WAL")
+      self._conn.execute(
+          f"CREATE TABLE IF NOT EXISTS {EMBEDDING_CACHE_TABLE} "
+          "(key TEXT PRIMARY KEY, embedding BLOB)")
+
+  def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+    results = {}
+    with self._lock:
+      for i in range(0, len(keys), LOOKUP_BATCH_SIZE):
+        batch = keys[i:i + LOOKUP_BATCH_SIZE]
+        placeholders = ",".join("?" * len(batch))
+        rows = self._conn.execute(
+            f"SELECT key, embedding FROM {EMBEDDING_CACHE_TABLE} "
+            f"WHERE key IN ({placeholders})", batch).fetchall()
+        results.update(rows)
+    return results
+
+  def set_many(self, items: Dict[str, bytes]):
+    with self._lock, self._conn:
+      self._conn.executemany(
+          f"INSERT OR REPLACE INTO {EMBEDDING_CACHE_TABLE} "
+          "(key, embedding) VALUES (?, ?)", list(items.items()))
+
+
+class RedisEmbeddingCacheBackend(EmbeddingCacheBackend):
+  """ Embeddings stored in redis with a ttl """
+
+  def __init__(self, ttl: int = QUERY_BUILD_EMBEDDING_CACHE_TTL) -> None:
+    from common.utils import cache_service
+    self.redis = cache_service.r
+    self.ttl = ttl
+
+  def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+    results = {}
+    for i in range(0, len(keys), LOOKUP_BATCH_SIZE):
+      batch = keys[i:i + LOOKUP_BATCH_SIZE]
+      for key, data in zip(batch, self.redis.mget(batch)):
+        if data is not None:
+          results[key] = data
+    return results
+
+  def set_many(self, items: Dict[str, bytes]):
+    pipeline = self.redis.pipeline(transaction=False)
+    for key, data in items.items():
+      pipeline.set(key, data, ex=self.ttl)
+    pipeline.execute()
+
+
+class PostgresEmbeddingCacheBackend(EmbeddingCacheBackend):
+  """ Embeddings stored in a table of the pgvector database """
+
+  def __init__(self) -> None:
+    import sqlalchemy
+    from services.query.vector_store import get_pg_engine
+    self.sqlalchemy = sqlalchemy
+    self.engine = get_pg_engine()
+    with self.engine.begin() as conn:
+      conn.execute(sqlalchemy.text(
+          f"CREATE TABLE IF NOT EXISTS {EMBEDDING_CACHE_TABLE} "
+          "(key TEXT PRIMARY KEY, embedding BYTEA)"))
+
+  def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+    results = {}
+    query = self.sqlalchemy.text(
+        f"SELECT key, embedding FROM {EMBEDDING_CACHE_TABLE} "
+        "WHERE key = ANY(:keys)")
+    with self.engine.connect() as conn:
+      for i in range(0, len(keys), LOOKUP_BATCH_SIZE):
+        batch = keys[i:i + LOOKUP_BATCH_SIZE]
+        for key, data in conn.execute(query, {"keys": batch}):
+          results[key] = bytes(data)
+    return results
+
+  def set_many(self, items: Dict[str, bytes]):
+    with self.engine.begin() as conn:
+      conn.execute(self.sqlalchemy.text(
+          f"INSERT INTO {EMBEDDING_CACHE_TABLE} (key, embedding) "
+          "VALUES (:key, :embedding) ON CONFLICT (key) DO NOTHING"),
+          [{"key": key, "embedding": data} for key, data in items.items()])
+
+
+EMBEDDING_CACHE_BACKENDS = {
+  CACHE_BACKEND_SQLITE: SqliteEmbeddingCacheBackend,
+  CACHE_BACKEND_REDIS: RedisEmbeddingCacheBackend,
+  CACHE_BACKEND_POSTGRES: PostgresEmbeddingCacheBackend,
+}
+
+
+class ChunkEmbeddingCache():
+  """
+  Looks up and stores chunk embeddings in a backend, and counts hits and
+  misses.  A cache without a backend is disabled.
+  """
+
+  def __init__(self, backend: Optional[EmbeddingCacheBackend]) -> None:
+    self.backend = backend
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+
+  @property
+  def enabled(self) -> bool:
+    return self.backend is not None
+
+  def get_many(self, embedding_type: str,
+               texts: List[str]) -> List[Optional[List[float]]]:
+    """
+    Look up the embeddings of a list of texts.
+
+    Returns:
+      list of embeddings by text, None for a cache miss
+    """
+    if not self.enabled or not texts:
+      return [None] * len(texts)
+
+    keys = [EmbeddingCache.cache_key(embedding_type, text) for text in texts]
+    try:
+      stored = self.backend.get_many(list(set(keys)))
+    except Exception as e:
+      Logger.warning(f"Chunk embedding cache lookup error: {e}")
+      stored = {}
+
+    embeddings = [decode_embedding(stored[key]).tolist()
+                  if key in stored else None for key in keys]
+    num_hits = sum(embedding is not None for embedding in embeddings)
+    with self._lock:
+      self.hits += num_hits
+      self.misses += len(texts) - num_hits
+    return embeddings
+
+  def set_many(self, embedding_type: str, texts: List[str], embeddings):
+    """ Store the embeddings of a list of texts """
+    if not self.enabled or not texts:
+      return
+    items = {
+      EmbeddingCache.cache_key(embedding_type, text):
+          encode_embedding(embedding)
+      for text, embedding in zip(texts, embeddings)
+    }
+    try:
+      self.backend.set_many(items)
+    except Exception as e:
+      Logger.warning(f"Chunk embedding cache store error: {e}")
+
+  def stats(self) -> Dict[str, int]:
+    with self._lock:
+      return {"hits": self.hits, "misses": self.misses}
+
+  def stats_since(self, start: Dict[str, int]) -> Dict:
+    """
+    Return hits, misses and hit ratio since a previous stats() result,
+    e.g. for one query engine build.
+    """
+    stats = self.stats()
+    hits = stats["hits"] - start["hits"]
+    misses = stats["misses"] - start["misses"]
+    return {
+      "hits": hits,
+      "misses": misses,
+      "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else None,
+    }
+
+
+_chunk_embedding_cache = None
+_chunk_embedding_cache_lock = threading.Lock()
+
+def get_chunk_embedding_cache() -> ChunkEmbeddingCache:
+  """
+  Return the process-wide chunk embedding cache, creating its backend on
+  first use.  If the backend can't be created the cache is disabled.
+  """
+  global _chunk_embedding_cache
+  with _chunk_embedding_cache_lock:
+    if _chunk_embedding_cache is None:
+      backend = None
+      if QUERY_BUILD_EMBEDDING_CACHE:
+        try:
+          backend = EMBEDDING_CACHE_BACKENDS[QUERY_BUILD_EMBEDDING_CACHE]()
+          Logger.info(f"Using [{QUERY_BUILD_EMBEDDING_CACHE}] chunk "
+                      f"embedding cache")
+        except Exception as e:
+          Logger.error(f"Error creating [{QUERY_BUILD_EMBEDDING_CACHE}] "
+                       f"chunk embedding cache, not caching: {e}")
+      _chunk_embedding_cache = ChunkEmbeddingCache(backend)
+    return _chunk_embedding_cache
@@ -0,0 +1,60 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Unit tests for the chunk embedding cache
+"""
+from unittest import mock
+from services.chunk_embedding_cache import (ChunkEmbeddingCache,
+                                            EmbeddingCacheBackend,
+                                            SqliteEmbeddingCacheBackend)
+
+EMBEDDING_TYPE = "test-embedding"
+
+
+def test_sqlite_cache(tmp_path):
+  path = str(tmp_path / "cache.db")
+  cache = ChunkEmbeddingCache(SqliteEmbeddingCacheBackend(path))
+  assert cache.get_many(EMBEDDING_TYPE, ["one", "two"]) == [None, None]
+  cache.set_many(EMBEDDING_TYPE, ["one", "two"], [[1.0, 0.0], [0.0, 1.0]])
+
+  # the cache persists across processes, and text is normalized
+  cache = ChunkEmbeddingCache(SqliteEmbeddingCacheBackend(path))
+  start = cache.stats()
+  assert cache.get_many(EMBEDDING_TYPE, [" two ", "three", "one"]) == \
+      [[0.0, 1.0], None, [1.0, 0.0]]
+  assert cache.get_many("other-embedding", ["one"]) == [None]
+  assert cache.stats_since(start) == \
+      {"hits": 2, "misses": 2, "hit_ratio": 0.5}
+
+
+def test_disabled_cache():
+  cache = ChunkEmbeddingCache(None)
+  assert not cache.enabled
+  assert cache.get_many(EMBEDDING_TYPE, ["one"]) == [None]
+  cache.set_many(EMBEDDING_TYPE, ["one"], [[1.0]])
+  assert cache.stats_since(cache.stats()) == \
+      {"hits": 0, "misses": 0, "hit_ratio": None}
+
+
+def test_cache_errors():
+  backend = mock.Mock(spec=EmbeddingCacheBackend)
+  backend.get_many.side_effect = RuntimeError("unavailable")
+  backend.set_many.side_effect = RuntimeError("unavailable")
+  cache = ChunkEmbeddingCache(backend)
+
+  # errors are misses
+  cache.set_many(EMBEDDING_TYPE, ["one"], [[1.0]])
+  assert cache.get_many(EMBEDDING_TYPE, ["one"]) == [None]
+  assert cache.stats() == {"hits": 0, "misses": 1}
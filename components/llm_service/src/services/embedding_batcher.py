@@ -0,0 +1,234 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Token aware batching of embedding requests.
+
+Texts are packed in order into batches of up to max_tokens estimated
+tokens and max_items texts, the request limits of the embedding model.
+Batches of an embedding type share an AIMD concurrency limit: a throttled
+batch (a quota or rate limit error) halves the limit and is retried after
+a jittered exponential backoff, and each successful batch raises the limit
+by 1/limit, i.e. by about one per round of batches, up to max_concurrency.
+
+Limits are set per embedding model by a "batching" dict in model config,
+e.g.
+  "batching": {"max_tokens": 15000, "max_items": 250, "concurrency": 4,
+               "max_concurrency": 16, "max_retries": 6}
+with defaults from DEFAULT_BATCHING for missing values.
+"""
+# pylint: disable=broad-exception-caught
+
+import asyncio
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+from google.api_core import exceptions as api_exceptions
+from common.utils.logging_handler import Logger
+from config import get_model_config_value, KEY_EMBEDDING_BATCHING, REGION
+from services.embedding_executor import ConcurrencyLimiter, embedding_executor
+from services.token_counter import token_counters
+
+Logger = Logger.get_logger(__file__)
+
+KEY_MAX_TOKENS = "max_tokens"
+KEY_MAX_ITEMS = "max_items"
+KEY_CONCURRENCY = "concurrency"
+KEY_MAX_CONCURRENCY = "max_concurrency"
+KEY_MAX_RETRIES = "max_retries"
+
+# per Vertex docs
+# https://cloud.google.com/vertex-ai/generative-ai/docs/embeddings/get-text-embeddings#get_text_embeddings_for_a_snippet_of_text
+# if region is us-central1 items per request is 250, in other regions it is
+# 5, and there is a 20000 token limit across all texts of a request.  The
+# default token budget leaves room for estimated token counts.
+DEFAULT_BATCHING = {
+  KEY_MAX_TOKENS: 15000,
+  KEY_MAX_ITEMS: 250 if REGION == "us-central1" else 5,
+  KEY_CONCURRENCY: 4,
+  KEY_MAX_CONCURRENCY: 16,
+  KEY_MAX_RETRIES: 6,
+}
+
+# retry backoff: a random delay of up to BACKOFF_BASE * 2^attempt seconds,
+# capped at BACKOFF_MAX
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# throttled batches halve the concurrency limit at most once per interval,
+# so a burst of throttled batches counts as one signal
+DECREASE_INTERVAL = 1.0
+
+THROTTLING_ERRORS = (api_exceptions.ResourceExhausted,
+                     api_exceptions.TooManyRequests)
+
+
+def is_throttling_error(e: Exception) -> bool:
+  """ Return True for quota and rate limit errors of embedding APIs """
+  if isinstance(e, THROTTLING_ERRORS):
+    return True
+  # e.g. openai.RateLimitError, or a requests HTTPError
+  status_code = getattr(e, "status_code", None) or \
+      getattr(getattr(e, "response", None), "status_code", None)
+  return status_code == 429
+
+
+def pack_batches(token_counts: List[int], max_tokens: int,
+                 max_items: int) -> List[List[int]]:
+  """
+  Pack texts in order into batches of up to max_tokens tokens and
+  max_items texts.  A text with more than max_tokens tokens is a batch of
+  its own.
+
+  Args:
+    token_counts: token count of each text
+    max_tokens: max tokens per batch
+    max_items: max texts per batch
+  Returns:
+    list of batches, each a list of text indexes
+  """
+  batches = []
+  batch = []
+  batch_tokens = 0
+  for i, num_tokens in enumerate(token_counts):
+    if batch and (batch_tokens + num_tokens > max_tokens or
+                  len(batch) >= max_items):
+      batches.append(batch)
+      batch = []
+      batch_tokens = 0
+    batch.append(i)
+    batch_tokens += num_tokens
+  if batch:
+    batches.append(batch)
+  return batches
+
+
+class AIMDLimiter(ConcurrencyLimiter):
+  """
+  Concurrency limit that is increased additively by successful requests
+  and decreased multiplicatively by throttled requests.
+  """
+
+  def __init__(self, concurrency: int, max_concurrency: int,
+               min_concurrency: int = 1) -> None:
+    super().__init__(concurrency)
+    self.min_concurrency = min_concurrency
+    self.max_concurrency = max(max_concurrency, min_concurrency)
+    self.limit = float(min(max(concurrency, min_concurrency),
+                           self.max_concurrency))
+    self._last_decrease = 0.0
+
+  def release(self, throttled: bool = False):
+    """ Release a request, adjusting the limit by its outcome """
+    with self._lock:
+      self.in_flight -= 1
+      if throttled:
+        now = time.monotonic()
+        if now - self._last_decrease >= DECREASE_INTERVAL:
+          self._last_decrease = now
+          self.limit = max(float(self.min_concurrency), self.limit / 2)
+          Logger.warning(f"Embedding requests throttled, concurrency limit "
+                         f"now {int(self.limit)}")
+      else:
+        self.limit = min(float(self.max_concurrency),
+                         self.limit + 1 / self.limit)
+      self._wake_waiters()
+
+
+class EmbeddingBatcher():
+  """ Batches and sends the embedding requests of an embedding type """
+
+  def __init__(self, embedding_type: str,
+               batching: Optional[Dict] = None) -> None:
+    self.embedding_type = embedding_type
+    self.batching = {**DEFAULT_BATCHING, **(batching or {})}
+    self.limiter = AIMDLimiter(self.batching[KEY_CONCURRENCY],
+                               self.batching[KEY_MAX_CONCURRENCY])
+
+  def count_tokens(self, texts: List[str]) -> List[int]:
+    # counted without the token count cache, as chunks are embedded once
+    counter = token_counters.get_counter(self.embedding_type)
+    return [counter.count(text) for text in texts]
+
+  async def embed(self, texts: List[str],
+                  generate_fn: Callable[[List[str], str], List]) -> List:
+    """
+    Embed texts in token aware batches.
+
+    Args:
+      texts: texts to embed
+      generate_fn: function called with a batch of texts and the
+        embedding type, returning the embedding of each text, run by the
+        process-wide embedding executor
+    Returns:
+      list of the embeddings returned for each batch, in order
+    """
+    # tokenizing, and loading the tokenizer on first use, run off the
+    # event loop
+    token_counts = await asyncio.to_thread(self.count_tokens, texts)
+    batches = [[texts[i] for i in batch] for batch in pack_batches(
+        token_counts, self.batching[KEY_MAX_TOKENS],
+        self.batching[KEY_MAX_ITEMS])]
+    results = await asyncio.gather(
+        *[self.embed_batch(batch, generate_fn) for batch in batches])
+    return [embedding for result in results for embedding in result]
+
+  async def embed_batch(self, batch: List[str],
+                        generate_fn: Callable[[List[str], str], List]) \
+                          -> List:
+    """
+    Embed a batch of texts, retrying throttled requests with backoff.
+    Returns None embeddings if the batch is still throttled after
+    max_retries retries.
+    """
+    max_retries = self.batching[KEY_MAX_RETRIES]
+    for attempt in range(max_retries + 1):
+      await self.limiter.acquire()
+      throttled = False
+      try:
+        return await embedding_executor.run(generate_fn, batch,
+                                            self.embedding_type)
+      except Exception as e:
+        if not is_throttling_error(e):
+          raise
+        throttled = True
+        Logger.warning(f"Embedding batch of {len(batch)} throttled "
+                       f"(attempt {attempt + 1}): {e}")
+      finally:
+        self.limiter.release(throttled)
+      if attempt < max_retries:
+        await asyncio.sleep(
+            random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+
+    Logger.error(f"Embedding batch of {len(batch)} throttled after "
+                 f"{max_retries} retries")
+    return [None] * len(batch)
+
+
+_batchers: Dict[str, EmbeddingBatcher] = {}
+_batchers_lock = threading.Lock()
+
+def get_embedding_batcher(embedding_type: str) -> EmbeddingBatcher:
+  """
+  Return the process-wide batcher for an embedding type, so concurrent
+  requests share its concurrency limit.
+  """
+  with _batchers_lock:
+    batcher = _batchers.get(embedding_type)
+    if batcher is None:
+      batching = get_model_config_value(embedding_type,
+                                        KEY_EMBEDDING_BATCHING, None)
+      batcher = EmbeddingBatcher(embedding_type, batching)
+      _batchers[embedding_type] = batcher
+    return batcher
@@ -0,0 +1,136 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Unit tests for embedding request batching
+"""
+# disabling pylint rules that conflict with pytest fixtures
+# pylint: disable=unused-argument,redefined-outer-name
+import asyncio
+import threading
+from unittest import mock
+import pytest
+from google.api_core import exceptions as api_exceptions
+from services import embedding_batcher
+from services.embedding_batcher import (AIMDLimiter, EmbeddingBatcher,
+                                        is_throttling_error, pack_batches)
+
+EMBEDDING_TYPE = "test-embedding"
+
+
+def test_pack_batches():
+  assert pack_batches([5, 5, 5, 5], max_tokens=10, max_items=10) == \
+      [[0, 1], [2, 3]]
+  assert pack_batches([1, 1, 1], max_tokens=10, max_items=2) == \
+      [[0, 1], [2]]
+  # a text over the token budget is sent on its own
+  assert pack_batches([3, 20, 3], max_tokens=10, max_items=10) == \
+      [[0], [1], [2]]
+  assert pack_batches([], max_tokens=10, max_items=10) == []
+
+
+def test_is_throttling_error():
+  assert is_throttling_error(api_exceptions.ResourceExhausted("quota"))
+  assert is_throttling_error(api_exceptions.TooManyRequests("rate"))
+  assert not is_throttling_error(api_exceptions.InvalidArgument("bad"))
+  assert not is_throttling_error(ValueError("bad"))
+
+
+def test_aimd_limiter():
+  limiter = AIMDLimiter(concurrency=4, max_concurrency=5)
+
+  async def acquire(n):
+    for _ in range(n):
+      await limiter.acquire()
+  asyncio.run(acquire(4))
+
+  # additive increase, up to max_concurrency
+  for _ in range(4):
+    limiter.release()
+  assert 4 < limiter.limit < 5
+  for _ in range(20):
+    asyncio.run(acquire(1))
+    limiter.release()
+  assert limiter.limit == 5
+
+  # multiplicative decrease, once for a burst of throttled requests
+  asyncio.run(acquire(2))
+  limiter.release(throttled=True)
+  limiter.release(throttled=True)
+  assert limiter.limit == 2.5
+
+
+@pytest.mark.asyncio
+async def test_aimd_limiter_waits():
+  limiter = AIMDLimiter(concurrency=1, max_concurrency=1)
+  await limiter.acquire()
+  waiter = asyncio.ensure_future(limiter.acquire())
+  await asyncio.sleep(0.01)
+  assert not waiter.done()
+  limiter.release()
+  await asyncio.wait_for(waiter, 1)
+  assert limiter.in_flight == 1
+
+
+class FakeEmbeddingModel():
+  """ Embeds texts as their length, throttling the first requests """
+
+  def __init__(self, num_throttled=0):
+    self.num_throttled = num_throttled
+    self.batches = []
+    self.lock = threading.Lock()
+
+  def generate(self, batch, embedding_type):
+    with self.lock:
+      self.batches.append(batch)
+      if self.num_throttled > 0:
+        self.num_throttled -= 1
+        raise api_exceptions.ResourceExhausted("quota exceeded")
+    return [[float(len(text))] for text in batch]
+
+
+@pytest.fixture
+def no_backoff():
+  with mock.patch.object(embedding_batcher, "BACKOFF_BASE", 0.001), \
+      mock.patch.object(embedding_batcher.token_counters, "get_counter",
+                        return_value=mock.Mock(count=len)):
+    yield
+
+
+@pytest.mark.asyncio
+async def test_embedding_batcher(no_backoff):
+  model = FakeEmbeddingModel(num_throttled=2)
+  batcher = EmbeddingBatcher(EMBEDDING_TYPE, {"max_tokens": 6,
+                                              "max_items": 10})
+  texts = ["aaa", "bb", "c", "dddd", "ee", "ffffff"]
+  embeddings = await batcher.embed(texts, model.generate)
+
+  # batches are packed by token count and results are in order
+  assert embeddings == [[3.0], [2.0], [1.0], [4.0], [2.0], [6.0]]
+  assert sorted(model.batches[2:]) == \
+      sorted([["aaa", "bb", "c"], ["dddd", "ee"], ["ffffff"]])
+  assert batcher.limiter.limit < 4
+
+
+@pytest.mark.asyncio
+async def test_embedding_batcher_retries(no_backoff):
+  model = FakeEmbeddingModel(num_throttled=10)
+  batcher = EmbeddingBatcher(EMBEDDING_TYPE, {"max_retries": 2})
+  assert await batcher.embed(["a", "b"], model.generate) == [None, None]
+  assert len(model.batches) == 3
+
+  def fail(batch, embedding_type):
+    raise ValueError("bad request")
+  with pytest.raises(ValueError):
+    await batcher.embed(["a"], fail)
@@ -0,0 +1,171 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Two tier cache for query embeddings.
+
+Embeddings are cached in a bounded in-process LRU and in Redis (via
+common.utils.cache_service), keyed by embedding type and a hash of the
+normalized text.  Vectors are stored as raw little-endian float32 bytes.
+"""
+# pylint: disable=broad-exception-caught
+
+import asyncio
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional
+import numpy as np
+from common.utils import cache_service
+from common.utils.logging_handler import Logger
+from config import (QUERY_EMBEDDING_CACHE_SIZE,
+                    QUERY_EMBEDDING_CACHE_TTL,
+                    QUERY_EMBEDDING_CACHE_REDIS)
+from metrics import EMBEDDING_CACHE_HIT_COUNT, EMBEDDING_CACHE_MISS_COUNT
+
+Logger = Logger.get_logger(__file__)
+
+EMBEDDING_CACHE_KEY_PREFIX = "embedding_cache"
+EMBEDDING_DTYPE = np.dtype("<f4")
+
+# seconds to skip the redis tier after a redis error
+REDIS_RETRY_INTERVAL = 60
+
+TIER_MEMORY = "memory"
+TIER_REDIS = "redis"
+
+
+def normalize_text(text: str) -> str:
+  """
+  Normalize text for cache lookups: unicode NFC, with leading and trailing
+  whitespace stripped and internal runs of whitespace collapsed.  Case is
+  preserved as embeddings are case sensitive.
+  """
+  text = unicodedata.normalize("NFC", text)
+  return re.sub(r"\s+", " ", text).strip()
+
+
+def encode_embedding(embedding) -> bytes:
+  return np.asarray(embedding, dtype=EMBEDDING_DTYPE).tobytes()
+
+
+def decode_embedding(data: bytes) -> np.ndarray:
+  return np.frombuffer(data, dtype=EMBEDDING_DTYPE)
+
+
+class EmbeddingCache():
+  """
+  Bounded in-process LRU cache of embeddings, backed by Redis.
+  """
+
+  def __init__(self,
+               max_size: int = QUERY_EMBEDDING_CACHE_SIZE,
+               ttl: int = QUERY_EMBEDDING_CACHE_TTL,
+               use_redis: bool = QUERY_EMBEDDING_CACHE_REDIS) -> None:
+    self.max_size = max_size
+    self.ttl = ttl
+    self.use_redis = use_redis
+    self._cache = OrderedDict()
+    self._lock = threading.Lock()
+    self._redis_retry_time = 0
+
+  @classmethod
+  def cache_key(cls, embedding_type: str, text: str) -> str:
+    text_hash = hashlib.sha256(
+        normalize_text(text).encode("utf-8")).hexdigest()
+    return f"{EMBEDDING_CACHE_KEY_PREFIX}::{embedding_type}::{text_hash}"
+
+  async def get(self, embedding_type: str, text: str) -> Optional[List[float]]:
+    """
+    Look up the embedding for a text, checking the in-process cache
+    first and then Redis.
+
+    Returns:
+      embedding vector as a list of floats, or None on a cache miss
+    """
+    key = self.cache_key(embedding_type, text)
+    embedding = self._get_local(key)
+    if embedding is not None:
+      EMBEDDING_CACHE_HIT_COUNT.labels(
+          embedding_type=embedding_type, tier=TIER_MEMORY).inc()
+      return embedding.tolist()
+
+    if self._redis_available():
+      data = await asyncio.to_thread(self._get_redis, key)
+      if data is not None:
+        embedding = decode_embedding(data)
+        self._set_local(key, embedding)
+        EMBEDDING_CACHE_HIT_COUNT.labels(
+            embedding_type=embedding_type, tier=TIER_REDIS).inc()
+        return embedding.tolist()
+
+    EMBEDDING_CACHE_MISS_COUNT.labels(embedding_type=embedding_type).inc()
+    return None
+
+  async def set(self, embedding_type: str, text: str, embedding):
+    """ Store the embedding for a text in both cache tiers """
+    key = self.cache_key(embedding_type, text)
+    embedding = np.asarray(embedding, dtype=EMBEDDING_DTYPE)
+    self._set_local(key, embedding)
+    if self._redis_available():
+      await asyncio.to_thread(self._set_redis, key,
+                              encode_embedding(embedding))
+
+  def clear(self):
+    """ Clear the in-process cache """
+    with self._lock:
+      self._cache.clear()
+
+  def _get_local(self, key: str) -> Optional[np.ndarray]:
+    with self._lock:
+      embedding = self._cache.get(key)
+      if embedding is not None:
+        self._cache.move_to_end(key)
+      return embedding
+
+  def _set_local(self, key: str, embedding: np.ndarray):
+    if self.max_size <= 0:
+      return
+    with self._lock:
+      self._cache[key] = embedding
+      self._cache.move_to_end(key)
+      while len(self._cache) > self.max_size:
+        self._cache.popitem(last=False)
+
+  def _redis_available(self) -> bool:
+    return self.use_redis and time.monotonic() >= self._redis_retry_time
+
+  def _redis_error(self, e: Exception):
+    Logger.warning(f"Embedding cache redis error, skipping redis for "
+                   f"{REDIS_RETRY_INTERVAL}s: {e}")
+    self._redis_retry_time = time.monotonic() + REDIS_RETRY_INTERVAL
+
+  def _get_redis(self, key: str) -> Optional[bytes]:
+    try:
+      return cache_service.get_key_normal(key)
+    except Exception as e:
+      self._redis_error(e)
+      return None
+
+  def _set_redis(self, key: str, data: bytes):
+    try:
+      cache_service.set_key_normal(key, data, expiry_time=self.ttl)
+    except Exception as e:
+      self._redis_error(e)
+
+
+# shared cache for query prompt embeddings
+query_embedding_cache = EmbeddingCache()
@@ -0,0 +1,84 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Unit tests for the embedding cache
+"""
+import pytest
+from unittest import mock
+import numpy.testing as npt
+from services.embedding_cache import (EmbeddingCache, encode_embedding,
+                                      decode_embedding)
+
+EMBEDDING_TYPE = "test-embedding"
+
+
+def test_cache_key_normalized():
+  assert EmbeddingCache.cache_key(EMBEDDING_TYPE, "  what is  RAG?\n") == \
+      EmbeddingCache.cache_key(EMBEDDING_TYPE, "what is RAG?")
+  assert EmbeddingCache.cache_key(EMBEDDING_TYPE, "what is RAG?") != \
+      EmbeddingCache.cache_key(EMBEDDING_TYPE, "what is rag?")
+  assert EmbeddingCache.cache_key(EMBEDDING_TYPE, "what is RAG?") != \
+      EmbeddingCache.cache_key("other-embedding", "what is RAG?")
+
+
+def test_encode_embedding():
+  data = encode_embedding([0.5, -1.25, 3.0])
+  assert len(data) == 12
+  npt.assert_array_equal(decode_embedding(data), [0.5, -1.25, 3.0])
+
+
+@pytest.mark.asyncio
+async def test_memory_cache():
+  cache = EmbeddingCache(max_size=2, use_redis=False)
+  await cache.set(EMBEDDING_TYPE, "one", [1.0, 0.0])
+  await cache.set(EMBEDDING_TYPE, "two", [0.0, 1.0])
+  assert await cache.get(EMBEDDING_TYPE, "one") == [1.0, 0.0]
+
+  # "two" is least recently used and is evicted
+  await cache.set(EMBEDDING_TYPE, "three", [1.0, 1.0])
+  assert await cache.get(EMBEDDING_TYPE, "two") is None
+  assert await cache.get(EMBEDDING_TYPE, "one") == [1.0, 0.0]
+  assert await cache.get(EMBEDDING_TYPE, "three") == [1.0, 1.0]
+
+
+@pytest.mark.asyncio
+@mock.patch("services.embedding_cache.cache_service")
+async def test_redis_cache(mock_cache_service):
+  cache = EmbeddingCache(max_size=10, use_redis=True)
+  mock_cache_service.get_key_normal.return_value = \
+      encode_embedding([0.25, 0.75])
+  assert await cache.get(EMBEDDING_TYPE, "one") == [0.25, 0.75]
+
+  # redis hits populate the in-process cache
+  mock_cache_service.get_key_normal.reset_mock()
+  assert await cache.get(EMBEDDING_TYPE, "one") == [0.25, 0.75]
+  mock_cache_service.get_key_normal.assert_not_called()
+
+  await cache.set(EMBEDDING_TYPE, "two", [1.0, 2.0])
+  key, data = mock_cache_service.set_key_normal.call_args[0]
+  assert key == EmbeddingCache.cache_key(EMBEDDING_TYPE, "two")
+  assert data == encode_embedding([1.0, 2.0])
+
+
+@pytest.mark.asyncio
+@mock.patch("services.embedding_cache.cache_service")
+async def test_redis_error(mock_cache_service):
+  cache = EmbeddingCache(max_size=10, use_redis=True)
+  mock_cache_service.get_key_normal.side_effect = ConnectionError("down")
+  assert await cache.get(EMBEDDING_TYPE, "one") is None
+
+  # redis is skipped after an error
+  assert await cache.get(EMBEDDING_TYPE, "one") is None
+  assert mock_cache_service.get_key_normal.call_count == 1
@@ -0,0 +1,127 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Process-wide executor for embedding requests.
+
+All embedding requests of the process, from builds and queries, run
+through one executor with at most EMBEDDING_MAX_CONCURRENCY requests in
+flight; further requests wait for a slot.  Async functions (provider
+async APIs) are awaited directly, and blocking functions run in a thread
+pool with one thread per slot.  The number of requests in flight and
+waiting, and the wait time, are exported as metrics.
+"""
+
+import asyncio
+import inspect
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+from config import EMBEDDING_MAX_CONCURRENCY
+from metrics import (EMBEDDING_EXECUTOR_IN_FLIGHT, EMBEDDING_EXECUTOR_QUEUED,
+                     EMBEDDING_EXECUTOR_WAIT)
+
+
+def _wake(waiter: asyncio.Future):
+  if not waiter.done():
+    waiter.set_result(None)
+
+
+class ConcurrencyLimiter():
+  """
+  Limit on the number of requests in flight.  Waiters may run in
+  different event loops, e.g. build jobs and LangchainEmbeddings.
+  """
+
+  def __init__(self, limit: int) -> None:
+    self.limit = float(max(1, limit))
+    self.in_flight = 0
+    self._waiters = deque()
+    self._lock = threading.Lock()
+
+  async def acquire(self):
+    """ Wait until a request can be sent within the limit """
+    while True:
+      with self._lock:
+        if self.in_flight < int(self.limit):
+          self.in_flight += 1
+          return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+      try:
+        await waiter
+      except asyncio.CancelledError:
+        with self._lock:
+          if waiter in self._waiters:
+            self._waiters.remove(waiter)
+          self._wake_waiters()
+        raise
+
+  def release(self):
+    """ Release a request """
+    with self._lock:
+      self.in_flight -= 1
+      self._wake_waiters()
+
+  def _wake_waiters(self):
+    # called with the lock held
+    free = int(self.limit) - self.in_flight
+    while self._waiters and free > 0:
+      waiter = self._waiters.popleft()
+      waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+      free -= 1
+
+
+class EmbeddingExecutor():
+  """ Runs embedding requests with a process-wide concurrency limit """
+
+  def __init__(self, max_concurrency: int = EMBEDDING_MAX_CONCURRENCY) \
+      -> None:
+    self.limiter = ConcurrencyLimiter(max_concurrency)
+    self.pool = ThreadPoolExecutor(max_workers=max(1, max_concurrency),
+                                   thread_name_prefix="embeddings")
+
+  async def run(self, fn: Callable, *args) -> Any:
+    """
+    Run an embedding request once a slot is free: await fn if it is an
+    async function, otherwise call it in the thread pool.
+    """
+    start = time.perf_counter()
+    EMBEDDING_EXECUTOR_QUEUED.inc()
+    try:
+      await self.limiter.acquire()
+    finally:
+      EMBEDDING_EXECUTOR_QUEUED.dec()
+    EMBEDDING_EXECUTOR_WAIT.observe(time.perf_counter() - start)
+
+    EMBEDDING_EXECUTOR_IN_FLIGHT.inc()
+    try:
+      if inspect.iscoroutinefunction(fn):
+        return await fn(*args)
+      return await self.run_blocking(fn, *args)
+    finally:
+      EMBEDDING_EXECUTOR_IN_FLIGHT.dec()
+      self.limiter.release()
+
+  async def run_blocking(self, fn: Callable, *args) -> Any:
+    """
+    Call a blocking function in the thread pool, without taking a slot,
+    e.g. the blocking part of a request already running in run.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        self.pool, fn, *args)
+
+
+embedding_executor = EmbeddingExecutor()
@@ -0,0 +1,93 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Unit tests for the embedding executor
+"""
+import asyncio
+import threading
+import time
+import pytest
+from services.embedding_executor import ConcurrencyLimiter, EmbeddingExecutor
+
+
+class InFlightCounter():
+  """ Counts concurrent calls of sync and async functions """
+
+  def __init__(self):
+    self.in_flight = 0
+    self.max_in_flight = 0
+    self.lock = threading.Lock()
+
+  def start(self):
+    with self.lock:
+      self.in_flight += 1
+      self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+  def end(self):
+    with self.lock:
+      self.in_flight -= 1
+
+  def embed_blocking(self, text):
+    self.start()
+    time.sleep(0.01)
+    self.end()
+    return [float(len(text))]
+
+  async def embed_async(self, text):
+    self.start()
+    await asyncio.sleep(0.01)
+    self.end()
+    return [float(len(text))]
+
+
+@pytest.mark.asyncio
+async def test_embedding_executor():
+  executor = EmbeddingExecutor(max_concurrency=3)
+  counter = InFlightCounter()
+  texts = ["a" * n for n in range(10)]
+  results = await asyncio.gather(
+      *[executor.run(counter.embed_blocking, text) for text in texts[:5]],
+      *[executor.run(counter.embed_async, text) for text in texts[5:]])
+
+  # blocking and async requests share the limit
+  assert results == [[float(n)] for n in range(10)]
+  assert counter.max_in_flight == 3
+  assert executor.limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_embedding_executor_error():
+  executor = EmbeddingExecutor(max_concurrency=1)
+
+  async def fail(text):
+    raise ValueError(text)
+  with pytest.raises(ValueError):
+    await executor.run(fail, "bad request")
+
+  # the slot is released
+  assert await executor.run(len, "text") == 4
+
+
+@pytest.mark.asyncio
+async def test_concurrency_limiter_cancel():
+  limiter = ConcurrencyLimiter(1)
+  await limiter.acquire()
+  cancelled = asyncio.ensure_future(limiter.acquire())
+  waiter = asyncio.ensure_future(limiter.acquire())
+  await asyncio.sleep(0.01)
+  cancelled.cancel()
+  limiter.release()
+  await asyncio.wait_for(waiter, 1)
+  assert limiter.in_flight == 1
@@ -15,9 +15,9 @@
 Generate Query embeddings. Currently, using Vertex TextEmbedding model.
 """
 import asyncio
+import functools
 import json
-from typing import List, Optional, Generator, Tuple
-from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 import numpy as np
 from vertexai.language_models import TextEmbeddingModel
 from vertexai.vision_models import (Image, MultiModalEmbeddingModel)
@@ -30,23 +30,15 @@ from config import (get_model_config, get_provider_embedding_types,
                     KEY_MODEL_TOKEN_LIMIT,
                     PROVIDER_VERTEX, PROVIDER_LANGCHAIN, PROVIDER_LLM_SERVICE,
                     DEFAULT_QUERY_EMBEDDING_MODEL,
-                    DEFAULT_QUERY_MULTIMODAL_EMBEDDING_MODEL,
-                    REGION)
+                    DEFAULT_QUERY_MULTIMODAL_EMBEDDING_MODEL)
 from langchain.schema.embeddings import Embeddings
+from services.chunk_embedding_cache import get_chunk_embedding_cache
+from services.embedding_executor import embedding_executor
+from services.embedding_batcher import (get_embedding_batcher,
+                                        is_throttling_error)
 
 # pylint: disable=broad-exception-caught
 
-# per Vertex docs
-# https://cloud.google.com/vertex-ai/generative-ai/docs/embeddings/get-text-embeddings#get_text_embeddings_for_a_snippet_of_text
-# if region is us-central1 items per request is 250, in other regions it is 5
-# Limiting to 50, even though the max is 250. There is an undocumented
-# token limit across all chunks of 20000, and with 250 chunks we often
-# exceeded the 20K limit.
-if REGION == "us-central1":
-  ITEMS_PER_REQUEST = 20
-else:
-  ITEMS_PER_REQUEST = 5
-
 Logger = Logger.get_logger(__file__)
 
 async def get_embeddings(text_chunks: List[str],
@@ -100,22 +92,33 @@ async def get_multimodal_embeddings(user_text: List[str],
 
 async def _generate_embeddings_batched(embedding_type,
                                        text_chunks):
-  embeddings_list: List[List[float]] = []
-
-  # Prepare the batches using a generator
-  batches = _generate_batches(text_chunks, ITEMS_PER_REQUEST)
-
-  loop = asyncio.get_running_loop()
-  with ThreadPoolExecutor() as pool:
-    futures = []
-    for batch in batches:
-      futures.append(
-        loop.run_in_executor(
-            pool, generate_embeddings, batch, embedding_type)
-      )
-    futures = await asyncio.gather(*futures)
-    for future in futures:
-      embeddings_list.extend(future)
+  # only chunks without a cached embedding are sent to the model
+  cache = get_chunk_embedding_cache()
+  if cache.enabled:
+    embeddings_list = await asyncio.to_thread(
+        cache.get_many, embedding_type, text_chunks)
+  else:
+    embeddings_list = [None] * len(text_chunks)
+  miss_indexes = [i for i, embedding in enumerate(embeddings_list)
+                  if embedding is None]
+  miss_chunks = [text_chunks[i] for i in miss_indexes]
+  generated = []
+  if miss_chunks:
+    generated = await get_embedding_batcher(embedding_type).embed(
+        miss_chunks, generate_embeddings)
+
+  if cache.enabled:
+    for i, embedding in zip(miss_indexes, generated):
+      embeddings_list[i] = embedding
+    new_chunks, new_embeddings = [], []
+    for text, embedding in zip(miss_chunks, generated):
+      if embedding is not None:
+        new_chunks.append(text)
+        new_embeddings.append(embedding)
+    await asyncio.to_thread(
+        cache.set_many, embedding_type, new_chunks, new_embeddings)
+  else:
+    embeddings_list = generated
 
   is_successful = [
       embedding is not None for sentence, embedding in zip(
@@ -130,21 +133,13 @@ async def _generate_embeddings_batched(embedding_type,
     embeddings_list_successful = []
   return is_successful, embeddings_list_successful
 
-# Generator function to yield batches of text_chunks
-def _generate_batches(text_chunks: List[str],
-                      batch_size: int) -> \
-                        Generator[List[str], None, None]:
-  """
-  Generate batches of text_chunks
-  """
-  for i in range(0, len(text_chunks), batch_size):
-    yield text_chunks[i: i + batch_size]
-
-def generate_embeddings(batch: List[str],
-                        embedding_type: str) -> \
-                          List[Optional[List[float]]]:
+async def generate_embeddings(batch: List[str],
+                              embedding_type: str) -> \
+                                List[Optional[List[float]]]:
   """
-  Generate embeddings for a list of strings
+  Generate embeddings for a list of strings, with the async API of the
+  provider where it has one.  Run by the embedding executor (see
+  _generate_embeddings_batched).
   Args:
     batch: list of text chunks to generate embeddings for
     embedding_type: str - model identifier
@@ -155,11 +150,12 @@ def generate_embeddings(batch: List[str],
   Logger.info(f"generating embeddings for embedding type {embedding_type}")
 
   if embedding_type in get_provider_embedding_types(PROVIDER_LANGCHAIN):
-    embeddings = get_langchain_embeddings(embedding_type, batch)
+    embeddings = await get_langchain_embeddings(embedding_type, batch)
   elif embedding_type in get_provider_embedding_types(PROVIDER_VERTEX):
-    embeddings = get_vertex_embeddings(embedding_type, batch)
+    embeddings = await get_vertex_embeddings(embedding_type, batch)
   elif embedding_type in get_provider_embedding_types(PROVIDER_LLM_SERVICE):
-    embeddings = get_llm_service_embeddings(embedding_type, batch)
+    embeddings = await embedding_executor.run_blocking(
+        get_llm_service_embeddings, embedding_type, batch)
   else:
     raise InternalServerError(f"Unsupported embedding type {embedding_type}")
   return embeddings
@@ -188,7 +184,12 @@ async def generate_multimodal_embeddings(user_text: str,
     raise InternalServerError(f"Unsupported embedding type {embedding_type}")
   return embeddings
 
-def get_vertex_embeddings(embedding_type: str,
+@functools.lru_cache(maxsize=None)
+def get_vertex_embedding_model(model_name: str) -> TextEmbeddingModel:
+  """ Return the Vertex text embedding model, loaded once per process """
+  return TextEmbeddingModel.from_pretrained(model_name)
+
+async def get_vertex_embeddings(embedding_type: str,
     sentence_list: List[str]) -> List[Optional[List[float]]]:
   """
   Generate an embedding from a Vertex model
@@ -216,14 +217,18 @@ def get_vertex_embeddings(embedding_type: str,
             f"chunk exceeds model {embedding_type} token limit {token_limit}")
   Logger.info(f"generating Vertex embeddings for {len(sentence_list)} chunk(s)"
               f" embedding model {google_llm}")
-  vertex_model = TextEmbeddingModel.from_pretrained(google_llm)
+  vertex_model = await embedding_executor.run_blocking(
+      get_vertex_embedding_model, google_llm)
   try:
-    embeddings = vertex_model.get_embeddings(sentence_list)
+    embeddings = await vertex_model.get_embeddings_async(sentence_list)
 
     return_value = [embedding.values for embedding in embeddings]
 
     return return_value
   except Exception as e:
+    if is_throttling_error(e):
+      # retried by the embedding batcher
+      raise
     Logger.error(f"error generating Vertex embeddings {str(e)}")
     return [None for _ in range(len(sentence_list))]
 
@@ -271,11 +276,13 @@ async def get_vertex_multimodal_embeddings(embedding_type: str,
       Logger.error(f"error generating Vertex embeddings {str(e)}")
       raise e
 
-  return_value = await asyncio.to_thread(_async_vertex_multimodal_embeddings)
+  # the multimodal model has no async API
+  return_value = await embedding_executor.run(
+      _async_vertex_multimodal_embeddings)
 
   return return_value
 
-def get_langchain_embeddings(embedding_type: str,
+async def get_langchain_embeddings(embedding_type: str,
     sentence_list: List[str]) -> List[Optional[List[float]]]:
   """
   Generate an embedding from a langchain model
@@ -287,7 +294,7 @@ def get_langchain_embeddings(embedding_type: str,
   """
   langchain_embedding = get_model_config().get_provider_value(
       PROVIDER_LANGCHAIN, KEY_MODEL_CLASS, embedding_type)
-  embeddings = langchain_embedding.embed_documents(sentence_list)
+  embeddings = await langchain_embedding.aembed_documents(sentence_list)
   return embeddings
 
 def get_llm_service_embeddings(embedding_type: str,
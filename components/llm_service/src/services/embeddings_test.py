@@ -26,6 +26,8 @@ from common.utils.config import set_env_var
 from vertexai.language_models import TextEmbedding
 from vertexai.vision_models import MultiModalEmbeddingResponse
 from services.embeddings import get_embeddings, get_multimodal_embeddings
+from services.chunk_embedding_cache import (ChunkEmbeddingCache,
+                                            SqliteEmbeddingCacheBackend)
 with set_env_var("PG_HOST", ""):
   from config import (get_model_config, DEFAULT_QUERY_EMBEDDING_MODEL,
                       DEFAULT_QUERY_MULTIMODAL_EMBEDDING_MODEL)
@@ -53,7 +55,8 @@ FAKE_MULTIMODAL_IMAGE_BYTES = \
    4c6QAAAA1JREFUGFdjYGBg+A8AAQQBAHAgZQsAAAAASUVORK5CYII="
 
 @pytest.mark.asyncio
-@mock.patch("services.embeddings.TextEmbeddingModel.get_embeddings")
+@mock.patch("services.embeddings.TextEmbeddingModel.get_embeddings_async",
+            new_callable=mock.AsyncMock)
 async def test_get_embeddings(mock_get_vertex_embeddings):
   mock_get_vertex_embeddings.return_value = FAKE_VERTEX_TEXT_EMBEDDINGS
   embedding_type = DEFAULT_QUERY_EMBEDDING_MODEL
@@ -63,7 +66,8 @@ async def test_get_embeddings(mock_get_vertex_embeddings):
   npt.assert_array_equal(embeddings, FAKE_TEXT_EMBEDDINGS)
 
 @pytest.mark.asyncio
-@mock.patch("services.embeddings.TextEmbeddingModel.get_embeddings")
+@mock.patch("services.embeddings.TextEmbeddingModel.get_embeddings_async",
+            new_callable=mock.AsyncMock)
 async def test_get_embeddings_empty(mock_get_vertex_embeddings):
   mock_get_vertex_embeddings.return_value = []
   embedding_type = DEFAULT_QUERY_EMBEDDING_MODEL
@@ -82,3 +86,23 @@ async def test_get_embeddings_multimodal(mock_get_vertex_embeddings):
   embeddings = await get_multimodal_embeddings(
       text_chunks, FAKE_MULTIMODAL_IMAGE_BYTES, embedding_type)
   assert embeddings == FAKE_MULTIMODAL_EMBEDDINGS
+
+@pytest.mark.asyncio
+@mock.patch("services.embeddings.generate_embeddings")
+async def test_get_embeddings_cached(mock_generate_embeddings, tmp_path):
+  mock_generate_embeddings.side_effect = \
+      lambda batch, embedding_type: [[float(len(text))] for text in batch]
+  cache = ChunkEmbeddingCache(
+      SqliteEmbeddingCacheBackend(str(tmp_path / "cache.db")))
+  embedding_type = DEFAULT_QUERY_EMBEDDING_MODEL
+  with mock.patch("services.embeddings.get_chunk_embedding_cache",
+                  return_value=cache):
+    await get_embeddings(["a", "bb"], embedding_type)
+    is_successful, embeddings = \
+        await get_embeddings(["a", "ccc", "bb"], embedding_type)
+
+  # only the chunk that was not cached is embedded again
+  assert mock_generate_embeddings.call_args.args[0] == ["ccc"]
+  assert all(is_successful)
+  npt.assert_array_equal(embeddings, [[1.0], [3.0], [2.0]])
+  assert cache.stats() == {"hits": 2, "misses": 3}
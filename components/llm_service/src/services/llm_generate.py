@@ -49,6 +49,7 @@ from config import (get_model_config, get_provider_models,
                     KEY_SUB_PROVIDER, SUB_PROVIDER_OPENAPI,
                     DEFAULT_CHAT_SUMMARY_MODEL)
 from services.langchain_service import langchain_llm_generate
+from services.token_counter import count_tokens, token_counters
 from services.query.data_source import DataSourceFile
 from utils.errors import ContextWindowExceededException
 from utils.file_helper import read_gcs_file_as_base64
@@ -56,9 +57,6 @@ from anthropic import AnthropicVertex
 
 Logger = Logger.get_logger(__file__)
 
-# A conservative characters-per-token constant, used to check
-# whether prompt length exceeds context window size
-CHARS_PER_TOKEN = 3
 SAFETY_SETTINGS = {
     HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
     HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
@@ -590,23 +588,32 @@ async def llm_chat(prompt: str, llm_type: str,
   try:
     response = None
 
+    # Add query references to the prompt if provided
+    if query_refs_str:
+      prompt += ("\n\nReference information for retrieved information:"
+        f" {query_refs_str}")
+
     # add chat history to prompt if necessary
     # Prompt history for gemini models is added using the native vertex API
+    history_tokens = 0
     if ((user_chat is not None or user_query is not None)
          and "gemini" not in llm_type):
-      context_prompt = get_context_prompt(
+      context_entries = get_context_prompt_entries(
           user_chat=user_chat, user_query=user_query)
+      # history token counts are cached per entry, so only entries added
+      # since the last turn are tokenized
+      history_tokens = sum(
+          token_counters.count_tokens_many(context_entries, llm_type))
       # context_prompt includes only text (no images/video) from
       # user_chat.history and user_query.history
+      context_prompt = "\n\n".join(context_entries)
+      prompt_text = prompt
       prompt = context_prompt + "\n" + prompt
-
-    # Add query references to the prompt if provided
-    if query_refs_str:
-      prompt += ("\n\nReference information for retrieved information:"
-        f" {query_refs_str}")
+    else:
+      prompt_text = prompt
 
     # check whether the context length exceeds the limit for the model
-    check_context_length(prompt, llm_type)
+    check_context_length(prompt_text, llm_type, history_tokens=history_tokens)
 
     # call the appropriate provider to generate the chat response
     if llm_type in get_provider_models(PROVIDER_LLM_SERVICE):
@@ -651,18 +658,18 @@ async def llm_chat(prompt: str, llm_type: str,
     Logger.error(traceback.print_exc())
     raise InternalServerError(str(e)) from e
 
-def get_context_prompt(user_chat=None,
-                       user_query=None) -> str:
+def get_context_prompt_entries(user_chat=None,
+                               user_query=None) -> List[str]:
   """
-  Get context prompt for chat based on previous chat or query history.
+  Get context prompt entries for chat based on previous chat or query
+  history, one per history entry.
 
   Args:
     user_chat (optional): previous user chat
     user_query (optional): previous user query
   Returns:
-    string context prompt
+    list of context prompt entries
   """
-  context_prompt = ""
   prompt_list = []
   if user_chat is not None:
     history = user_chat.history
@@ -684,31 +691,62 @@ def get_context_prompt(user_chat=None,
         prompt_list.append(f"AI response: {content}")
       # prompt_list includes only text from user_query.history
 
-  context_prompt = "\n\n".join(prompt_list)
+  return prompt_list
+
+def get_context_prompt(user_chat=None,
+                       user_query=None) -> str:
+  """
+  Get context prompt for chat based on previous chat or query history.
+
+  Args:
+    user_chat (optional): previous user chat
+    user_query (optional): previous user query
+  Returns:
+    string context prompt
+  """
+  return "\n\n".join(get_context_prompt_entries(user_chat, user_query))
 
-  return context_prompt
+def get_context_length(llm_type: str) -> Optional[int]:
+  """
+  Return the context length in tokens for a model, or None if no
+  context length is configured for the model.
+  """
+  max_context_length = get_model_config_value(llm_type,
+                                              KEY_MODEL_CONTEXT_LENGTH,
+                                              None)
+  return int(max_context_length) if max_context_length else None
 
-def check_context_length(prompt, llm_type):
+def check_token_length(token_length: int, llm_type: str):
   """
-  Check whether a prompt exceeds the maximum context length for
-  a model.
+  Check whether a prompt token count exceeds the maximum context length
+  for a model.
 
   Raise an exception if max context length exceeded.
   """
-  # check if prompt exceeds context window length for model
-  # assume a constant relationship between tokens and chars
   # TODO: Recalculate max_context_length for text prompt,
   # subtracting out tokens used by non-text context (image, video, etc)
-  token_length = len(prompt) / CHARS_PER_TOKEN
-  max_context_length = get_model_config_value(llm_type,
-                                              KEY_MODEL_CONTEXT_LENGTH,
-                                              None)
+  max_context_length = get_context_length(llm_type)
   if max_context_length and token_length > max_context_length:
     msg = f"Token length {token_length} exceeds llm_type {llm_type} " + \
           f"Max context length {max_context_length}"
     Logger.error(msg)
     raise ContextWindowExceededException(msg)
 
+def check_context_length(prompt, llm_type, history_tokens: int = 0):
+  """
+  Check whether a prompt exceeds the maximum context length for
+  a model.
+
+  Args:
+    prompt: prompt text
+    llm_type: llm type
+    history_tokens: tokens of chat history sent along with the prompt,
+      counted separately
+  Raise an exception if max context length exceeded.
+  """
+  token_length = count_tokens(prompt, llm_type) + history_tokens
+  check_token_length(token_length, llm_type)
+
 async def llm_truss_service_predict(llm_type: str, prompt: str,
                                     model_endpoint: str,
                                     parameters: dict = None) -> str:
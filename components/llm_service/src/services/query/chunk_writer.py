@@ -0,0 +1,113 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Batched Firestore writes of query document chunks during builds.
+"""
+
+import asyncio
+from typing import List, Optional
+from common.models import QueryDocumentChunk
+from common.models.base_model import FIRESTORE_BATCH_LIMIT
+from common.utils.logging_handler import Logger
+from config import QUERY_BUILD_COMMIT_CONCURRENCY
+
+Logger = Logger.get_logger(__file__)
+
+
+def assign_chunk_ids(query_doc_chunks: List[QueryDocumentChunk]):
+  """ Assign client side ids to chunks that don't have one """
+  for query_doc_chunk in query_doc_chunks:
+    if not query_doc_chunk.id:
+      query_doc_chunk.id = QueryDocumentChunk.generate_id()
+
+
+class ChunkWriter():
+  """
+  Writes QueryDocumentChunk models in Firestore batches.
+
+  Chunks are buffered across documents, so documents with few chunks
+  share batches, and each full batch of batch_size chunks is committed in
+  a thread.  Up to max_concurrency commits are in flight; add waits for a
+  commit to complete when that many are in flight.  Call flush once all
+  chunks are added.
+  """
+
+  def __init__(self, batch_size: int = FIRESTORE_BATCH_LIMIT,
+               max_concurrency: int = QUERY_BUILD_COMMIT_CONCURRENCY) -> None:
+    self.batch_size = batch_size
+    self.num_written = 0
+    self._buffer = []
+    self._commits = set()
+    self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    self._error: Optional[BaseException] = None
+
+  async def add(self, query_doc_chunks: List[QueryDocumentChunk]):
+    """
+    Add chunks to be written.  Chunks are assigned ids if they don't have
+    one.
+
+    Raises:
+      the error of a failed commit
+    """
+    self._raise_error()
+    assign_chunk_ids(query_doc_chunks)
+    self._buffer.extend(query_doc_chunks)
+    while len(self._buffer) >= self.batch_size:
+      batch = self._buffer[:self.batch_size]
+      self._buffer = self._buffer[self.batch_size:]
+      await self._commit(batch)
+
+  async def flush(self):
+    """
+    Write buffered chunks and wait for all commits to complete.
+
+    Raises:
+      the error of a failed commit
+    """
+    if self._buffer:
+      batch = self._buffer
+      self._buffer = []
+      await self._commit(batch)
+    await self.wait()
+    self._raise_error()
+
+  async def wait(self):
+    """ Wait for in flight commits to complete, without raising """
+    if self._commits:
+      await asyncio.wait(list(self._commits))
+
+  async def _commit(self, batch: List[QueryDocumentChunk]):
+    await self._semaphore.acquire()
+    if self._error is not None:
+      self._semaphore.release()
+      raise self._error
+    commit = asyncio.ensure_future(asyncio.to_thread(
+        QueryDocumentChunk.save_all, batch, self.batch_size))
+    self._commits.add(commit)
+    commit.add_done_callback(self._commit_done)
+
+  def _commit_done(self, commit: asyncio.Future):
+    self._commits.discard(commit)
+    self._semaphore.release()
+    if commit.cancelled():
+      return
+    if commit.exception() is not None:
+      Logger.error(f"Error writing chunk batch: {commit.exception()}")
+      self._error = self._error or commit.exception()
+      return
+    self.num_written += len(commit.result())
+
+  def _raise_error(self):
+    if self._error is not None:
+      raise self._error
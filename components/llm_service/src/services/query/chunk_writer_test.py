@@ -0,0 +1,103 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Unit tests for batched chunk writes
+"""
+# disabling pylint rules that conflict with pytest fixtures
+# pylint: disable=unused-argument,redefined-outer-name
+import itertools
+import threading
+import time
+from unittest import mock
+import pytest
+from services.query import chunk_writer
+from services.query.chunk_writer import ChunkWriter, assign_chunk_ids
+
+
+class FakeChunk():
+  def __init__(self, chunk_id=None):
+    self.id = chunk_id
+
+
+class FakeChunkModel():
+  """ Records batch writes in place of QueryDocumentChunk """
+
+  def __init__(self, fail_on_batch=None):
+    self.ids = itertools.count()
+    self.batches = []
+    self.in_flight = 0
+    self.max_in_flight = 0
+    self.fail_on_batch = fail_on_batch
+    self.lock = threading.Lock()
+
+  def generate_id(self):
+    return f"chunk-{next(self.ids)}"
+
+  def save_all(self, objects, batch_size):
+    with self.lock:
+      self.in_flight += 1
+      self.max_in_flight = max(self.max_in_flight, self.in_flight)
+      batch_num = len(self.batches)
+      self.batches.append(list(objects))
+    time.sleep(0.02)
+    with self.lock:
+      self.in_flight -= 1
+    if batch_num == self.fail_on_batch:
+      raise RuntimeError("commit failed")
+    return objects
+
+
+@pytest.fixture
+def fake_model():
+  model = FakeChunkModel()
+  with mock.patch.object(chunk_writer, "QueryDocumentChunk", model):
+    yield model
+
+
+def test_assign_chunk_ids(fake_model):
+  chunks = [FakeChunk(), FakeChunk("existing"), FakeChunk()]
+  assign_chunk_ids(chunks)
+  assert [chunk.id for chunk in chunks] == ["chunk-0", "existing", "chunk-1"]
+
+
+@pytest.mark.asyncio
+async def test_chunk_writer(fake_model):
+  writer = ChunkWriter(batch_size=4, max_concurrency=2)
+  docs = [[FakeChunk() for _ in range(n)] for n in [3, 6, 1, 5]]
+  for doc_chunks in docs:
+    await writer.add(doc_chunks)
+    # ids are assigned when chunks are added, before they are written
+    assert all(chunk.id for chunk in doc_chunks)
+
+  await writer.flush()
+  assert writer.num_written == 15
+  assert [len(batch) for batch in fake_model.batches] == [4, 4, 4, 3]
+  assert fake_model.max_in_flight == 2
+
+  written = [chunk for batch in fake_model.batches for chunk in batch]
+  assert written == [chunk for doc_chunks in docs for chunk in doc_chunks]
+
+
+@pytest.mark.asyncio
+async def test_chunk_writer_error():
+  model = FakeChunkModel(fail_on_batch=0)
+  with mock.patch.object(chunk_writer, "QueryDocumentChunk", model):
+    writer = ChunkWriter(batch_size=2, max_concurrency=1)
+    with pytest.raises(RuntimeError):
+      for _ in range(5):
+        await writer.add([FakeChunk(), FakeChunk()])
+      await writer.flush()
+    # no batches are committed after the failed one completes
+    assert len(model.batches) <= 2
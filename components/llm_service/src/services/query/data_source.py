@@ -20,14 +20,16 @@ import traceback
 import os
 import uuid
 import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote
 from copy import copy
 from base64 import b64encode
-from typing import List, Tuple
+from typing import Callable, Iterator, List, Optional, Tuple
 from pathlib import Path
 from common.utils.logging_handler import Logger
 from common.models import QueryEngine
-from config import get_default_manifest
+from config import get_default_manifest, QUERY_BUILD_DOWNLOAD_WORKERS
 from pypdf import PdfReader, PdfWriter, PageObject
 from pdf2image import convert_from_path
 from langchain_community.document_loaders import CSVLoader
@@ -65,13 +67,16 @@ class DataSourceFile():
                local_path:str=None,
                gcs_path:str=None,
                doc_id:str=None,
-               mime_type:str=None):
+               mime_type:str=None,
+               content_hash:str=None):
     self.doc_name = doc_name
     self.src_url = src_url
     self.local_path = local_path
     self.gcs_path = gcs_path
     self.doc_id = doc_id
     self.mime_type = mime_type
+    # hash or version of the file content, e.g. GCS md5 hash or web ETag
+    self.content_hash = content_hash
 
   def __repr__(self) -> str:
     """
@@ -83,7 +88,8 @@ class DataSourceFile():
       f"local_path={self.local_path}, "
       f"gcs_path={self.gcs_path}, "
       f"doc_id={self.doc_id}, "
-      f"mime_type={self.mime_type})"
+      f"mime_type={self.mime_type}, "
+      f"content_hash={self.content_hash})"
     )
 
 
@@ -144,21 +150,7 @@ class DataSource:
     Returns:
         list of DataSourceFile
     """
-    doc_filepaths = []
-    bucket_name = doc_url.split("gs://")[1].split("/")[0]
-    Logger.info(f"downloading {doc_url} from bucket {bucket_name}")
-
-    for blob in self.storage_client.list_blobs(bucket_name):
-      # Download the file to the tmp folder flattening all directories
-      file_name = Path(blob.name).name
-      file_path = os.path.join(temp_dir, file_name)
-      blob.download_to_filename(file_path)
-      gcs_path = blob.path.replace("/b/","")
-      gcs_url = f"gs://{gcs_path}"
-      doc_filepaths.append(DataSourceFile(doc_name=blob.name,
-                                          src_url=blob.public_url,
-                                          local_path=file_path,
-                                          gcs_path=gcs_url))
+    doc_filepaths = list(self._download_gcs_documents(doc_url, temp_dir))
 
     if len(doc_filepaths) == 0:
       raise NoDocumentsIndexedException(
@@ -166,6 +158,103 @@ class DataSource:
 
     return doc_filepaths
 
+  def iter_documents(self, doc_url: str, temp_dir: str,
+                     doc_filter: Optional[
+                         Callable[[DataSourceFile], bool]] = None) -> \
+        Iterator[DataSourceFile]:
+    """
+    Download files from doc_url source to a local tmp directory, yielding
+    each file once it is downloaded so it can be processed while later
+    files download.  Data sources that override download_documents yield
+    their files once all are downloaded.
+
+    Each file has a content_hash: the data source's hash or version of
+    the file if it has one, otherwise the sha256 hash of the downloaded
+    file.
+
+    Args:
+        doc_url: url pointing to container of documents to be indexed
+        temp_dir: Path to temporary directory to download files to
+        doc_filter: optional function called with each file (before it is
+          downloaded, for GCS) that returns False to skip the file
+
+    Yields:
+        DataSourceFile
+    """
+    if type(self).download_documents is not DataSource.download_documents:
+      for data_source_file in self.download_documents(doc_url, temp_dir):
+        if data_source_file.content_hash is None:
+          data_source_file.content_hash = \
+              get_file_hash(data_source_file.local_path)
+        if doc_filter is None or doc_filter(data_source_file):
+          yield data_source_file
+        else:
+          os.remove(data_source_file.local_path)
+      return
+
+    num_files = 0
+    for data_source_file in self._download_gcs_documents(doc_url, temp_dir,
+                                                         doc_filter):
+      num_files += 1
+      if data_source_file.local_path is not None:
+        yield data_source_file
+
+    if num_files == 0:
+      raise NoDocumentsIndexedException(
+          f"No documents can be indexed at url {doc_url}")
+
+  def _download_gcs_documents(self, doc_url: str, temp_dir: str,
+                              doc_filter: Optional[
+                                  Callable[[DataSourceFile], bool]] = None) \
+        -> Iterator[DataSourceFile]:
+    """
+    Download the files under a GCS url (a bucket, folder or file) in
+    parallel, yielding each file once it is downloaded.  Files keep their
+    folders under temp_dir, so files with the same name in different
+    folders don't overwrite each other.  Downloads run ahead of the
+    consumer by at most twice QUERY_BUILD_DOWNLOAD_WORKERS files, so a
+    large bucket isn't downloaded to disk all at once.
+
+    Files skipped by doc_filter are yielded without a local_path.
+    """
+    bucket_name, prefix = parse_gcs_url(doc_url)
+    Logger.info(f"downloading {doc_url} from bucket {bucket_name}, "
+                f"prefix [{prefix}]")
+
+    max_pending = 2 * QUERY_BUILD_DOWNLOAD_WORKERS
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=QUERY_BUILD_DOWNLOAD_WORKERS) \
+        as executor:
+      try:
+        for blob in self.storage_client.list_blobs(bucket_name,
+                                                   prefix=prefix or None):
+          if not is_gcs_document(blob.name, prefix):
+            continue
+          gcs_path = blob.path.replace("/b/","")
+          gcs_url = f"gs://{gcs_path}"
+          # composite objects have no md5 hash
+          content_hash = blob.md5_hash or str(blob.generation)
+          data_source_file = DataSourceFile(doc_name=blob.name,
+                                            src_url=blob.public_url,
+                                            gcs_path=gcs_url,
+                                            content_hash=content_hash)
+          if doc_filter is not None and not doc_filter(data_source_file):
+            yield data_source_file
+            continue
+
+          pending.append(executor.submit(
+              download_blob, blob, temp_dir, data_source_file))
+          # yield downloaded files in order, before listing further ahead
+          while pending and (len(pending) >= max_pending or pending[0].done()):
+            yield pending.popleft().result()
+
+        while pending:
+          yield pending.popleft().result()
+      finally:
+        # don't start queued downloads if the consumer stops early
+        for future in pending:
+          future.cancel()
+
   def init_metadata(self, q_engine: QueryEngine) -> dict:
     """ 
     Load metadata from manifest, if it is defined in the query engine
@@ -567,6 +656,71 @@ class DataSource:
       "filepath": page_pdf_filepath
     }
 
+# data sources used to chunk documents in a parse worker process, by
+# data source class and params
+_worker_data_sources = {}
+
+def chunk_document_in_worker(data_source_class: type, params: dict,
+                             doc_name: str, doc_url: str,
+                             doc_filepath: str) -> \
+                               Tuple[Optional[List[str]], List[str]]:
+  """
+  Chunk a document with DataSource.chunk_document in a worker process.
+  The data source is created in the worker without clients, as only its
+  params and parsing methods are needed to chunk text.
+
+  Returns:
+    text chunks, or None if the document could not be processed, and
+    the list of doc urls that could not be processed
+  """
+  key = (data_source_class, json.dumps(params, sort_keys=True, default=str))
+  data_source = _worker_data_sources.get(key)
+  if data_source is None:
+    data_source = data_source_class.__new__(data_source_class)
+    DataSource.__init__(data_source, None, params)
+    _worker_data_sources[key] = data_source
+  data_source.docs_not_processed = []
+  text_chunks = data_source.chunk_document(doc_name, doc_url, doc_filepath)
+  return text_chunks, data_source.docs_not_processed
+
+def parse_gcs_url(gcs_url: str) -> Tuple[str, str]:
+  """
+  Split a gs:// url into its bucket name and object prefix, e.g.
+  "gs://bucket/folder/" to ("bucket", "folder/").  The prefix is "" for a
+  bucket url.
+  """
+  bucket_name, _, prefix = gcs_url.split("gs://")[1].partition("/")
+  return bucket_name, prefix
+
+def is_gcs_document(blob_name: str, prefix: str) -> bool:
+  """
+  Return True if a blob listed under prefix is a document to index: not
+  a folder placeholder, not a file created by genie while parsing another
+  document, and in the folder (or the file) named by prefix rather than a
+  sibling with a longer name.
+  """
+  if blob_name.endswith("/") or blob_name.startswith(GENIE_FOLDER_MARKER):
+    return False
+  if prefix and not prefix.endswith("/"):
+    return blob_name == prefix or blob_name.startswith(prefix + "/")
+  return True
+
+def download_blob(blob, temp_dir: str,
+                  data_source_file: DataSourceFile) -> DataSourceFile:
+  """
+  Download a blob to its path under temp_dir, creating its folders, and
+  set the local_path of its data source file.
+  """
+  file_path = os.path.realpath(os.path.join(temp_dir, blob.name))
+  if os.path.commonpath([file_path, os.path.realpath(temp_dir)]) != \
+      os.path.realpath(temp_dir):
+    # a blob name with ".." components is downloaded flattened
+    file_path = os.path.join(temp_dir, Path(blob.name).name)
+  os.makedirs(os.path.dirname(file_path), exist_ok=True)
+  blob.download_to_filename(file_path)
+  data_source_file.local_path = file_path
+  return data_source_file
+
 def get_file_hash(filepath: str) -> str:
   """
   Calculates the sha256 hash of a file
@@ -14,8 +14,9 @@
 """
   Unit tests for Data Source
 """
-import services
+import os
 import tempfile
+import services
 
 import services.query.data_source
 
@@ -26,3 +27,75 @@ def test_get_file_hash():
     f.write(b"hello world!")
     file_hash = services.query.data_source.get_file_hash(f.name)
     assert file_hash == correct_hash
+
+def test_chunk_document_in_worker():
+  data_source = services.query.data_source
+  with tempfile.TemporaryDirectory() as temp_dir:
+    doc_path = f"{temp_dir}/doc.txt"
+    with open(doc_path, "w", encoding="utf-8") as f:
+      f.write("The sky is blue. " * 200)
+    text_chunks, docs_not_processed = data_source.chunk_document_in_worker(
+        data_source.DataSource, {"chunk_size": "250"}, "doc.txt",
+        "gs://bucket/doc.txt", doc_path)
+    assert len(text_chunks) > 1
+    assert not docs_not_processed
+
+    # unreadable documents are returned as not processed
+    text_chunks, docs_not_processed = data_source.chunk_document_in_worker(
+        data_source.DataSource, {}, "doc.unknown", "gs://bucket/doc.unknown",
+        doc_path)
+    assert text_chunks is None
+    assert docs_not_processed == ["gs://bucket/doc.unknown"]
+
+class FakeBlob():
+  """ A GCS blob with text content """
+  def __init__(self, name, content):
+    self.name = name
+    self.content = content
+    self.path = f"/b/bucket/o/{name}"
+    self.public_url = f"https://storage.googleapis.com/bucket/{name}"
+    self.md5_hash = f"md5-{content}"
+    self.generation = 1
+
+  def download_to_filename(self, file_path):
+    with open(file_path, "w", encoding="utf-8") as f:
+      f.write(self.content)
+
+
+class FakeStorageClient():
+  """ Lists the blobs of a single bucket """
+  def __init__(self, blobs):
+    self.blobs = blobs
+
+  def list_blobs(self, bucket_name, prefix=None):
+    assert bucket_name == "bucket"
+    return [blob for blob in self.blobs
+            if prefix is None or blob.name.startswith(prefix)]
+
+def test_download_gcs_documents():
+  data_source = services.query.data_source
+  storage_client = FakeStorageClient([
+    FakeBlob("docs/", ""),
+    FakeBlob("docs/a/doc.txt", "a"),
+    FakeBlob("docs/b/doc.txt", "b"),
+    FakeBlob("docs/c.txt", "c"),
+    FakeBlob("docs2/d.txt", "d"),
+    FakeBlob("_genie_/page.png", "png"),
+  ])
+  source = data_source.DataSource(storage_client)
+
+  with tempfile.TemporaryDirectory() as temp_dir:
+    # only files under the url prefix are downloaded, keeping their folders
+    files = list(source.iter_documents("gs://bucket/docs", temp_dir))
+    assert [f.doc_name for f in files] == \
+        ["docs/a/doc.txt", "docs/b/doc.txt", "docs/c.txt"]
+    for f in files:
+      assert f.local_path == os.path.join(temp_dir, f.doc_name)
+      with open(f.local_path, "r", encoding="utf-8") as local_file:
+        assert f.content_hash == f"md5-{local_file.read()}"
+
+    # files skipped by the filter are not downloaded
+    files = list(source.iter_documents(
+        "gs://bucket/", temp_dir,
+        doc_filter=lambda f: f.doc_name.endswith("d.txt")))
+    assert [f.doc_name for f in files] == ["docs2/d.txt"]
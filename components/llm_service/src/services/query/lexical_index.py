@@ -0,0 +1,303 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Lexical (BM25) index for hybrid retrieval.
+
+When hybrid search is enabled for a query engine (the "hybrid_search"
+param, defaulting to the QUERY_HYBRID_SEARCH setting) a BM25 inverted
+index over the clean text of the engine's chunks is built with the engine
+and stored in GCS as a compressed .npz of CSR postings arrays.  Indexes are
+loaded lazily and kept in a per-process LRU.  At query time lexical
+matches are fused with vector store matches by reciprocal rank fusion,
+which helps with exact identifiers (form numbers, SKUs, codes) that
+embeddings handle poorly.
+"""
+
+import io
+import math
+import re
+import threading
+import uuid
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional
+import numpy as np
+from google.cloud import storage
+from common.models import QueryEngine
+from common.utils.logging_handler import Logger
+from config import (PROJECT_ID, REGION, QUERY_HYBRID_SEARCH,
+                    QUERY_HYBRID_RRF_K, QUERY_LEXICAL_INDEX_CACHE_SIZE)
+from utils.gcs_helper import create_bucket
+
+Logger = Logger.get_logger(__file__)
+
+# query engine param to enable hybrid search
+HYBRID_SEARCH_PARAM = "hybrid_search"
+
+# query engine params set by the build
+LEXICAL_INDEX_BUCKET_PARAM = "lexical_index_bucket"
+LEXICAL_INDEX_URI_PARAM = "lexical_index_uri"
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# words, with identifiers such as "W-2", "1099.5" or "SKU/123" kept whole
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./:]\w+)*")
+TOKEN_SEPARATORS = re.compile(r"[-./:]")
+
+# max term frequency stored in postings
+MAX_TERM_FREQ = np.iinfo(np.uint16).max
+
+
+def tokenize(text: str) -> List[str]:
+  """
+  Lower case word tokens.  Compound identifiers are indexed both whole
+  and as their parts, so "W-2" matches "w-2", "w" and "2".
+  """
+  tokens = []
+  for token in TOKEN_PATTERN.findall(text.lower()):
+    tokens.append(token)
+    parts = TOKEN_SEPARATORS.split(token)
+    if len(parts) > 1:
+      tokens.extend(parts)
+  return tokens
+
+
+def is_hybrid_search_enabled(q_engine: QueryEngine) -> bool:
+  params = q_engine.params or {}
+  value = params.get(HYBRID_SEARCH_PARAM)
+  if isinstance(value, str):
+    return value.lower() == "true"
+  return QUERY_HYBRID_SEARCH
+
+
+def has_lexical_index(q_engine: QueryEngine) -> bool:
+  params = q_engine.params or {}
+  return bool(params.get(LEXICAL_INDEX_URI_PARAM))
+
+
+def reciprocal_rank_fusion(result_lists: List[List[int]],
+                           k: int = QUERY_HYBRID_RRF_K,
+                           limit: Optional[int] = None) -> List[int]:
+  """
+  Fuse ranked result lists by reciprocal rank fusion: each result scores
+  the sum of 1 / (k + rank) over the lists it appears in.  Ties keep the
+  order of the earlier lists.
+
+  Args:
+    result_lists: ranked lists of chunk indexes
+    k: RRF constant
+    limit: (optional) max number of results
+  Returns:
+    fused list of chunk indexes
+  """
+  scores = {}
+  for results in result_lists:
+    for rank, result in enumerate(results, start=1):
+      scores[result] = scores.get(result, 0.0) + 1.0 / (k + rank)
+  fused = sorted(scores, key=lambda result: -scores[result])
+  return fused[:limit] if limit is not None else fused
+
+
+class LexicalIndex():
+  """
+  BM25 inverted index over text chunks, stored as CSR postings: the
+  postings of term t are rows[offsets[t]:offsets[t + 1]] with term
+  frequencies in freqs.
+  """
+
+  def __init__(self, terms: List[str], offsets: np.ndarray, rows: np.ndarray,
+               freqs: np.ndarray, doc_lengths: np.ndarray,
+               chunk_indexes: np.ndarray) -> None:
+    self.terms = terms
+    self.vocab = {term: term_id for term_id, term in enumerate(terms)}
+    self.offsets = offsets
+    self.rows = rows
+    self.freqs = freqs
+    self.doc_lengths = doc_lengths
+    self.chunk_indexes = chunk_indexes
+    self.avg_doc_length = float(doc_lengths.mean()) if len(doc_lengths) else 0
+
+  @classmethod
+  def build(cls, chunk_texts: Dict[int, str]) -> "LexicalIndex":
+    """
+    Args:
+      chunk_texts: dict of chunk index to chunk text
+    """
+    vocab = {}
+    postings = []
+    doc_lengths = []
+    for row, text in enumerate(chunk_texts.values()):
+      term_counts = Counter(tokenize(text or ""))
+      doc_lengths.append(sum(term_counts.values()))
+      for term, count in term_counts.items():
+        term_id = vocab.setdefault(term, len(vocab))
+        if term_id == len(postings):
+          postings.append([])
+        postings[term_id].append((row, min(count, MAX_TERM_FREQ)))
+
+    offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(term_postings) for term_postings in postings])
+    rows = np.fromiter((row for term_postings in postings
+                        for row, _ in term_postings),
+                       dtype=np.int32, count=offsets[-1])
+    freqs = np.fromiter((count for term_postings in postings
+                         for _, count in term_postings),
+                        dtype=np.uint16, count=offsets[-1])
+    return cls(list(vocab), offsets, rows, freqs,
+               np.asarray(doc_lengths, dtype=np.int32),
+               np.fromiter(chunk_texts.keys(), dtype=np.int64,
+                           count=len(chunk_texts)))
+
+  def to_bytes(self) -> bytes:
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        terms=np.frombuffer("\n".join(self.terms).encode("utf-8"),
+                            dtype=np.uint8),
+        offsets=self.offsets,
+        rows=self.rows,
+        freqs=self.freqs,
+        doc_lengths=self.doc_lengths,
+        chunk_indexes=self.chunk_indexes)
+    return buffer.getvalue()
+
+  @classmethod
+  def from_bytes(cls, data: bytes) -> "LexicalIndex":
+    with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+      terms = arrays["terms"].tobytes().decode("utf-8")
+      return cls(terms.split("\n") if terms else [],
+                 arrays["offsets"], arrays["rows"], arrays["freqs"],
+                 arrays["doc_lengths"], arrays["chunk_indexes"])
+
+  def search(self, query: str, k: int) -> List[int]:
+    """
+    Returns:
+      indexes of the top k chunks by BM25 score that match a query term
+    """
+    num_docs = len(self.doc_lengths)
+    scores = np.zeros(num_docs, dtype=np.float32)
+    for term in set(tokenize(query)):
+      term_id = self.vocab.get(term)
+      if term_id is None:
+        continue
+      start, end = self.offsets[term_id], self.offsets[term_id + 1]
+      rows = self.rows[start:end]
+      freqs = self.freqs[start:end].astype(np.float32)
+      doc_freq = end - start
+      idf = math.log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+      length_norm = BM25_K1 * (
+          1 - BM25_B + BM25_B * self.doc_lengths[rows] / self.avg_doc_length)
+      scores[rows] += idf * freqs * (BM25_K1 + 1) / (freqs + length_norm)
+
+    matched = np.flatnonzero(scores)
+    if len(matched) > k:
+      matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+    matched = matched[np.argsort(-scores[matched], kind="stable")]
+    return self.chunk_indexes[matched].tolist()
+
+
+class LexicalIndexCache():
+  """
+  Per-process LRU of loaded lexical indexes, keyed by index uri.  Each
+  build writes a new uri, so entries for previous builds are not reused.
+  """
+
+  def __init__(self, max_size: int = QUERY_LEXICAL_INDEX_CACHE_SIZE) -> None:
+    self.max_size = max_size
+    self._indexes = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, uri: str, load_fn) -> LexicalIndex:
+    with self._lock:
+      lexical_index = self._indexes.get(uri)
+      if lexical_index is not None:
+        self._indexes.move_to_end(uri)
+        return lexical_index
+    lexical_index = load_fn(uri)
+    with self._lock:
+      self._indexes[uri] = lexical_index
+      while len(self._indexes) > self.max_size:
+        self._indexes.popitem(last=False)
+    return lexical_index
+
+  def clear(self):
+    with self._lock:
+      self._indexes.clear()
+
+
+lexical_index_cache = LexicalIndexCache()
+
+
+def _download_index(uri: str) -> LexicalIndex:
+  Logger.info(f"Loading lexical index {uri}")
+  storage_client = storage.Client(project=PROJECT_ID)
+  blob = storage.Blob.from_string(uri, client=storage_client)
+  return LexicalIndex.from_bytes(blob.download_as_bytes())
+
+
+def save_lexical_index(q_engine: QueryEngine, lexical_index: LexicalIndex,
+                       storage_client: Optional[storage.Client] = None):
+  """
+  Upload a lexical index for a query engine and record its uri in the
+  engine params, replacing any previous index.
+  """
+  storage_client = storage_client or storage.Client(project=PROJECT_ID)
+  params = q_engine.params or {}
+  bucket_name = params.get(LEXICAL_INDEX_BUCKET_PARAM)
+  if not bucket_name:
+    bucket_name = str(uuid.uuid4())
+    create_bucket(storage_client, bucket_name, location=REGION)
+    params[LEXICAL_INDEX_BUCKET_PARAM] = bucket_name
+
+  bucket = storage_client.bucket(bucket_name)
+  blob_name = f"lexical_index_{uuid.uuid4().hex}.npz"
+  bucket.blob(blob_name).upload_from_string(
+      lexical_index.to_bytes(), content_type="application/octet-stream")
+
+  previous_uri = params.get(LEXICAL_INDEX_URI_PARAM)
+  params[LEXICAL_INDEX_URI_PARAM] = f"gs://{bucket_name}/{blob_name}"
+  q_engine.params = params
+  q_engine.update()
+  Logger.info(f"Saved lexical index for q_engine [{q_engine.name}] with "
+              f"{len(lexical_index.doc_lengths)} chunks and "
+              f"{len(lexical_index.terms)} terms")
+
+  if previous_uri:
+    storage.Blob.from_string(previous_uri, client=storage_client).delete()
+
+
+def search_lexical_index(q_engine: QueryEngine, query: str,
+                         k: int) -> List[int]:
+  """
+  Search the lexical index of a query engine.
+
+  Returns:
+    list of matching chunk indexes, best first
+  """
+  params = q_engine.params or {}
+  lexical_index = lexical_index_cache.get(params[LEXICAL_INDEX_URI_PARAM],
+                                          _download_index)
+  return lexical_index.search(query, k)
+
+
+def delete_lexical_index(q_engine: QueryEngine):
+  """ Delete the lexical index bucket for a query engine """
+  params = q_engine.params or {}
+  bucket_name = params.get(LEXICAL_INDEX_BUCKET_PARAM)
+  if not bucket_name:
+    return
+  Logger.info(f"Deleting lexical index bucket {bucket_name}")
+  storage_client = storage.Client(project=PROJECT_ID)
+  storage_client.bucket(bucket_name).delete(force=True)
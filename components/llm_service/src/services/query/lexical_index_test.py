@@ -0,0 +1,55 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Unit tests for the lexical index
+"""
+from common.utils.config import set_env_var
+
+with set_env_var("PG_HOST", ""):
+  from services.query.lexical_index import (LexicalIndex, tokenize,
+                                            reciprocal_rank_fusion)
+
+CHUNK_TEXTS = {
+  10: "Employers file form W-2 for each employee.",
+  11: "Independent contractors receive form 1099-NEC instead of a W-2.",
+  12: "The employee handbook describes leave and benefits.",
+  13: "",
+}
+
+
+def test_tokenize():
+  assert tokenize("Form W-2, SKU/1234.") == \
+      ["form", "w-2", "w", "2", "sku/1234", "sku", "1234"]
+
+
+def test_search():
+  lexical_index = LexicalIndex.build(CHUNK_TEXTS)
+  assert lexical_index.search("w-2", 5) == [10, 11]
+  assert lexical_index.search("1099-NEC", 5) == [11]
+  assert lexical_index.search("employee handbook", 1) == [12]
+  assert lexical_index.search("no such terms", 5) == []
+
+
+def test_serialization():
+  lexical_index = LexicalIndex.from_bytes(
+      LexicalIndex.build(CHUNK_TEXTS).to_bytes())
+  assert lexical_index.search("w-2", 5) == [10, 11]
+  assert lexical_index.search("employee handbook", 5) == [12, 10]
+
+
+def test_reciprocal_rank_fusion():
+  assert reciprocal_rank_fusion([[1, 2, 3], [3, 4]]) == [3, 1, 2, 4]
+  assert reciprocal_rank_fusion([[1, 2], [2, 1]], limit=1) == [1]
+  assert reciprocal_rank_fusion([[], [5]]) == [5]
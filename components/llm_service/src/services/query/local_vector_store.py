@@ -0,0 +1,639 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Local (embedded) vector store.
+
+Each query engine build is stored as an embedding matrix (normalized, as
+a float32 or float16 .npy file), an id array and a JSON list of chunk
+metadata.  At query time the matrix is memory-mapped and searched in
+process.  For larger engines an HNSW graph is built with the index data
+when hnswlib is installed, and loaded into memory with it.
+
+Builds are persisted under LOCAL_VECTOR_STORE_PATH (a local directory or
+gs:// uri), or to a bucket created for the engine.  Data in GCS is
+downloaded to a local cache directory on first use.
+"""
+# pylint: disable=broad-exception-caught,unused-argument
+
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from typing import List, Optional, Union
+import numpy as np
+from google.cloud import storage
+from pyparsing import ParseResults
+from common.models import QueryEngine
+from common.utils.logging_handler import Logger
+from services import embeddings
+from services.query.vector_store import VectorStore, NUM_MATCH_RESULTS
+from config import PROJECT_ID, REGION
+from config.vector_store_config import (VECTOR_STORE_LOCAL,
+                                        LOCAL_VECTOR_STORE_PATH,
+                                        LOCAL_VECTOR_STORE_CACHE_DIR,
+                                        LOCAL_VECTOR_STORE_DTYPE,
+                                        LOCAL_VECTOR_STORE_ANN_MIN_ROWS)
+from utils.gcs_helper import create_bucket
+
+try:
+  import hnswlib
+except ImportError:
+  hnswlib = None
+
+Logger = Logger.get_logger(__file__)
+
+# query engine params set by the build: uri of the persisted index data,
+# uri of the previous build (deleted by the next build, as other workers
+# may still be querying it), and the bucket created for the engine if
+# LOCAL_VECTOR_STORE_PATH is not set
+LOCAL_VECTOR_STORE_URI_PARAM = "local_vector_store_uri"
+LOCAL_VECTOR_STORE_PREVIOUS_URI_PARAM = "local_vector_store_previous_uri"
+LOCAL_VECTOR_STORE_BUCKET_PARAM = "local_vector_store_bucket"
+
+EMBEDDINGS_FILE = "embeddings.npy"
+IDS_FILE = "ids.npy"
+METADATA_FILE = "metadata.json"
+INDEX_FILES = [EMBEDDINGS_FILE, IDS_FILE, METADATA_FILE]
+# optional HNSW graph of the embedding matrix
+GRAPH_FILE = "hnsw.bin"
+
+# names of build directories, written by deploy
+BUILD_DIR_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+# rows scored per block in exact search, bounding float32 temporaries
+SEARCH_BLOCK_SIZE = 65536
+
+# number of evaluated filter expressions cached per instance
+FILTER_CACHE_SIZE = 32
+
+# HNSW graph settings
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 100
+HNSW_EF_SEARCH = 64
+
+FILTER_CONNECTORS = ("AND", "OR")
+FILTER_NEGATIONS = ("NOT", "-")
+
+# comparison operators of dict filters, e.g. {"year": {"$gte": 2020}}
+DICT_FILTER_COMPARISONS = {"lt": "<", "lte": "<=", "gt": ">", "gte": ">="}
+
+
+def parse_gcs_uri(uri: str):
+  """ Split a gs://bucket/prefix uri into bucket name and prefix """
+  bucket_name, _, prefix = uri[len("gs://"):].partition("/")
+  return bucket_name, prefix.strip("/")
+
+
+class LocalVectorStore(VectorStore):
+  """
+  Vector store that searches memory-mapped embedding matrices in process.
+  """
+
+  def __init__(self, q_engine: QueryEngine, embedding_type: str = None) -> None:
+    super().__init__(q_engine, embedding_type)
+    self._storage_client = None
+    self._embeddings = []
+    self._ids = []
+    self._metadata = []
+    self._load_lock = threading.Lock()
+    self._index = None
+    self._filter_rows = OrderedDict()
+    self._filter_lock = threading.Lock()
+
+  @property
+  def vector_store_type(self):
+    return VECTOR_STORE_LOCAL
+
+  @property
+  def storage_client(self) -> storage.Client:
+    if self._storage_client is None:
+      self._storage_client = storage.Client(project=PROJECT_ID)
+    return self._storage_client
+
+  def init_index(self):
+    self._embeddings = []
+    self._ids = []
+    self._metadata = []
+
+  def init_refresh(self, delete_indexes: List[int]):
+    """
+    Start a refresh from the current build of the query engine, less the
+    embeddings at delete_indexes.  deploy writes the refreshed index to a
+    new location, as for a build.
+    """
+    self.init_index()
+    index = self.load()
+    keep = ~np.isin(index["ids"], np.asarray(delete_indexes, dtype=np.int64))
+    self._embeddings.append(np.asarray(index["embeddings"][keep],
+                                       dtype=np.float32))
+    self._ids.append(index["ids"][keep])
+    self._metadata.extend(
+        metadata for metadata, kept in zip(index["metadata"], keep) if kept)
+    Logger.info(f"Refreshing local vector store for q_engine "
+                f"[{self.q_engine.name}]: kept {int(keep.sum())} of "
+                f"{len(keep)} embeddings")
+
+  def delete_embeddings(self, delete_indexes: List[int]):
+    """
+    Remove embeddings at delete_indexes from the refreshed index.  The
+    current build is not changed until deploy.
+    """
+    if not self._ids or not delete_indexes:
+      return
+    ids = np.concatenate(self._ids)
+    keep = ~np.isin(ids, np.asarray(delete_indexes, dtype=np.int64))
+    self._embeddings = [np.concatenate(self._embeddings)[keep]]
+    self._ids = [ids[keep]]
+    self._metadata = [
+      metadata for metadata, kept in zip(self._metadata, keep) if kept]
+    Logger.info(f"Deleted {len(keep) - int(keep.sum())} embeddings from "
+                f"refresh of q_engine [{self.q_engine.name}]")
+
+  async def index_document(self, doc_name: str, text_chunks: List[str],
+                           index_base: int,
+                           metadata: List[dict] = None) -> int:
+    is_successful, chunk_embeddings = \
+        await embeddings.get_embeddings(text_chunks, self.embedding_type)
+    if len(chunk_embeddings) == 0 or not all(is_successful):
+      raise RuntimeError(f"failed to generate embeddings for {doc_name}")
+
+    if not metadata:
+      metadata = [None] * len(text_chunks)
+    self._add(chunk_embeddings, index_base, metadata)
+    Logger.info(f"Indexed {len(text_chunks)} embeddings for [{doc_name}]")
+    return index_base + len(text_chunks)
+
+  async def index_document_multimodal(self,
+                                      doc_name: str,
+                                      doc_chunks: List[object],
+                                      index_base: int) -> int:
+    _, chunk_embeddings = \
+        await self.get_multimodal_chunk_embeddings(doc_name, doc_chunks)
+    if len(chunk_embeddings) == 0:
+      raise RuntimeError(f"failed to generate embeddings for {doc_name}")
+
+    self._add(chunk_embeddings, index_base, [None] * len(chunk_embeddings))
+    Logger.info(f"Indexed {len(chunk_embeddings)} embeddings for [{doc_name}]")
+    return index_base + len(chunk_embeddings)
+
+  def _add(self, chunk_embeddings, index_base: int, metadata: List[dict]):
+    self._embeddings.append(np.asarray(chunk_embeddings, dtype=np.float32))
+    self._ids.append(
+        np.arange(index_base, index_base + len(chunk_embeddings),
+                  dtype=np.int64))
+    self._metadata.extend(metadata)
+
+  def deploy(self):
+    """
+    Write the index data for the build and record its location in the
+    query engine params.
+    """
+    if not self._embeddings:
+      raise RuntimeError(
+          f"No embeddings indexed for q_engine [{self.q_engine.name}]")
+
+    params = self.q_engine.params or {}
+    base_uri = LOCAL_VECTOR_STORE_PATH
+    if not base_uri:
+      bucket_name = params.get(LOCAL_VECTOR_STORE_BUCKET_PARAM)
+      if not bucket_name:
+        bucket_name = str(uuid.uuid4())
+        create_bucket(self.storage_client, bucket_name, location=REGION)
+        params[LOCAL_VECTOR_STORE_BUCKET_PARAM] = bucket_name
+      base_uri = f"gs://{bucket_name}"
+
+    # each build is written to a new location, so running queries on
+    # the previous build are not affected
+    uri = f"{base_uri.rstrip('/')}/{self.q_engine.id}/{uuid.uuid4().hex}"
+    with tempfile.TemporaryDirectory() as temp_dir:
+      self._write(temp_dir)
+      if uri.startswith("gs://"):
+        bucket_name, prefix = parse_gcs_uri(uri)
+        bucket = self.storage_client.bucket(bucket_name)
+        for filename in os.listdir(temp_dir):
+          bucket.blob(f"{prefix}/{filename}").upload_from_filename(
+              os.path.join(temp_dir, filename))
+      else:
+        shutil.copytree(temp_dir, uri)
+    Logger.info(f"Wrote local vector store for q_engine "
+                f"[{self.q_engine.name}] to {uri}")
+
+    # the previous build is kept for workers that have not reloaded the
+    # query engine yet, and the build before it is deleted
+    stale_uri = params.get(LOCAL_VECTOR_STORE_PREVIOUS_URI_PARAM)
+    previous_uri = params.get(LOCAL_VECTOR_STORE_URI_PARAM)
+    params[LOCAL_VECTOR_STORE_URI_PARAM] = uri
+    if previous_uri:
+      params[LOCAL_VECTOR_STORE_PREVIOUS_URI_PARAM] = previous_uri
+    self.q_engine.params = params
+    self.q_engine.update()
+    if stale_uri:
+      self._delete_data(stale_uri)
+
+    self._embeddings = []
+    self._ids = []
+    self._metadata = []
+
+  def _write(self, path: str):
+    matrix = np.concatenate(self._embeddings)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = matrix / np.maximum(norms, np.finfo(np.float32).tiny)
+    np.save(os.path.join(path, EMBEDDINGS_FILE),
+            matrix.astype(LOCAL_VECTOR_STORE_DTYPE), allow_pickle=False)
+    np.save(os.path.join(path, IDS_FILE), np.concatenate(self._ids),
+            allow_pickle=False)
+    with open(os.path.join(path, METADATA_FILE), "w", encoding="utf-8") as f:
+      json.dump(self._metadata, f)
+    if hnswlib is not None and len(matrix) >= LOCAL_VECTOR_STORE_ANN_MIN_ROWS:
+      graph = self._build_graph(matrix)
+      graph.save_index(os.path.join(path, GRAPH_FILE))
+
+  def _build_graph(self, matrix: np.ndarray):
+    """ Build the HNSW graph of a normalized embedding matrix """
+    Logger.info(f"Building HNSW graph for q_engine [{self.q_engine.name}] "
+                f"with {len(matrix)} embeddings")
+    graph = hnswlib.Index(space="ip", dim=matrix.shape[1])
+    graph.init_index(max_elements=len(matrix), M=HNSW_M,
+                     ef_construction=HNSW_EF_CONSTRUCTION)
+    graph.add_items(np.asarray(matrix, dtype=np.float32),
+                    np.arange(len(matrix)))
+    graph.set_ef(HNSW_EF_SEARCH)
+    return graph
+
+  def _local_path(self, uri: str) -> str:
+    """ Local directory for index data, downloading it from GCS if needed """
+    if not uri.startswith("gs://"):
+      return uri
+    bucket_name, prefix = parse_gcs_uri(uri)
+    local_path = os.path.join(LOCAL_VECTOR_STORE_CACHE_DIR, bucket_name, prefix)
+    if os.path.isdir(local_path):
+      return local_path
+
+    self._prune_cache(os.path.dirname(local_path))
+    Logger.info(f"Downloading local vector store data from {uri}")
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    download_path = tempfile.mkdtemp(dir=os.path.dirname(local_path))
+    bucket = self.storage_client.bucket(bucket_name)
+    for blob in bucket.list_blobs(prefix=f"{prefix}/"):
+      blob.download_to_filename(
+          os.path.join(download_path, os.path.basename(blob.name)))
+    try:
+      os.rename(download_path, local_path)
+    except OSError:
+      # downloaded concurrently by another worker
+      shutil.rmtree(download_path, ignore_errors=True)
+    return local_path
+
+  def _prune_cache(self, engine_path: str):
+    """
+    Remove the cached data of previous builds of the query engine from
+    LOCAL_VECTOR_STORE_CACHE_DIR, before a new build is downloaded.
+    Builds still memory-mapped by other instances stay readable until
+    they are unmapped.
+    """
+    if not os.path.isdir(engine_path):
+      return
+    for name in os.listdir(engine_path):
+      if BUILD_DIR_PATTERN.fullmatch(name):
+        Logger.info(f"Removing cached local vector store data at "
+                    f"{os.path.join(engine_path, name)}")
+        shutil.rmtree(os.path.join(engine_path, name), ignore_errors=True)
+
+  def load(self) -> dict:
+    """
+    Load (memory-map) the index data for the current build of the query
+    engine.  The data is loaded once per instance.  Builds without a
+    persisted HNSW graph get one built in the background, and use exact
+    search until it is ready.
+
+    Returns:
+      dict with the embedding matrix, ids, metadata and optional HNSW graph
+    """
+    if self._index is not None:
+      return self._index
+    with self._load_lock:
+      if self._index is not None:
+        return self._index
+      params = self.q_engine.params or {}
+      uri = params.get(LOCAL_VECTOR_STORE_URI_PARAM)
+      if not uri:
+        raise RuntimeError(
+            f"No local vector store data for q_engine [{self.q_engine.name}]")
+      local_path = self._local_path(uri)
+      matrix = np.load(os.path.join(local_path, EMBEDDINGS_FILE),
+                       mmap_mode="r", allow_pickle=False)
+      ids = np.load(os.path.join(local_path, IDS_FILE), allow_pickle=False)
+      with open(os.path.join(local_path, METADATA_FILE),
+                encoding="utf-8") as f:
+        metadata = json.load(f)
+
+      graph = None
+      use_graph = hnswlib is not None and \
+          len(ids) >= LOCAL_VECTOR_STORE_ANN_MIN_ROWS
+      graph_path = os.path.join(local_path, GRAPH_FILE)
+      if use_graph and os.path.exists(graph_path):
+        graph = hnswlib.Index(space="ip", dim=matrix.shape[1])
+        graph.load_index(graph_path, max_elements=len(ids))
+        graph.set_ef(HNSW_EF_SEARCH)
+
+      self._index = {
+        "embeddings": matrix,
+        "ids": ids,
+        "metadata": metadata,
+        "graph": graph,
+      }
+      if use_graph and graph is None:
+        threading.Thread(target=self._build_graph_in_background,
+                         args=(self._index,), name="hnsw-graph-builder",
+                         daemon=True).start()
+      return self._index
+
+  def _build_graph_in_background(self, index: dict):
+    """ Build the HNSW graph of a loaded index, for builds without one """
+    try:
+      index["graph"] = self._build_graph(index["embeddings"])
+    except Exception as e:
+      Logger.error(f"Error building HNSW graph for q_engine "
+                   f"[{self.q_engine.name}], using exact search: {e}")
+
+  def similarity_search(self, q_engine: QueryEngine,
+                        query_embedding: List[float],
+                        query_filter: Optional[Union[str, dict]] = None) \
+                        -> List[int]:
+    """
+    Retrieve text matches for query embeddings.
+    Args:
+      q_engine: QueryEngine model
+      query_embedding: single embedding array for query
+      query_filter: (optional) filter expression, or dict filter (see
+        match_dict_filter)
+    Returns:
+      list of indexes that are matched of length NUM_MATCH_RESULTS
+    """
+    index = self.load()
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query = query / max(np.linalg.norm(query), np.finfo(np.float32).tiny)
+    num_rows = len(index["ids"])
+
+    rows = None
+    if query_filter:
+      rows = self.filter_rows(query_filter)
+      if len(rows) == 0:
+        return []
+    k = min(NUM_MATCH_RESULTS, num_rows if rows is None else len(rows))
+
+    if rows is None and index["graph"] is not None:
+      labels, _ = index["graph"].knn_query(query, k=k)
+      return index["ids"][labels[0]].tolist()
+
+    if rows is None:
+      scores = np.concatenate([
+        np.asarray(index["embeddings"][start:start + SEARCH_BLOCK_SIZE],
+                   dtype=np.float32) @ query
+        for start in range(0, num_rows, SEARCH_BLOCK_SIZE)
+      ])
+    else:
+      scores = np.asarray(index["embeddings"][rows], dtype=np.float32) @ query
+
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    if rows is not None:
+      top = rows[top]
+    return index["ids"][top].tolist()
+
+  def filter_rows(self, query_filter: Union[str, dict]) -> np.ndarray:
+    """ Row numbers of chunks matching a filter expression or dict """
+    if isinstance(query_filter, dict):
+      filter_key = json.dumps(query_filter, sort_keys=True, default=str)
+    else:
+      filter_key = query_filter
+    with self._filter_lock:
+      rows = self._filter_rows.get(filter_key)
+    if rows is None:
+      all_metadata = self.load()["metadata"]
+      if isinstance(query_filter, dict):
+        matches = [self.match_dict_filter(query_filter, metadata)
+                   for metadata in all_metadata]
+      else:
+        parsed_filter = self.parse_filter(query_filter)
+        matches = [self.match_filter(parsed_filter, metadata)
+                   for metadata in all_metadata]
+      rows = np.flatnonzero(matches)
+      with self._filter_lock:
+        self._filter_rows[filter_key] = rows
+        while len(self._filter_rows) > FILTER_CACHE_SIZE:
+          self._filter_rows.popitem(last=False)
+    return rows
+
+  @classmethod
+  def match_filter(cls, parsed_filter: Union[ParseResults, list],
+                   metadata: Optional[dict]) -> bool:
+    """
+    Evaluate a parsed filter expression (see VectorStore.parse_filter)
+    against chunk metadata.  AND binds more tightly than OR, and
+    parenthesized expressions are evaluated first.  For list metadata
+    values, a text or numerical expression matches if it matches any item.
+    """
+    metadata = metadata or {}
+    tokens = list(parsed_filter)
+    any_match = False
+    all_match = True
+    i = 0
+    while i < len(tokens):
+      negate = isinstance(tokens[i], str) and tokens[i] in FILTER_NEGATIONS
+      if negate:
+        i += 1
+      if isinstance(tokens[i], (ParseResults, list)):
+        match = cls.match_filter(tokens[i], metadata)
+        i += 1
+      else:
+        match, i = cls._match_expression(tokens, i, metadata)
+      all_match = all_match and (match != negate)
+
+      connector = tokens[i] if i < len(tokens) else None
+      i += 1
+      if connector != "AND":
+        any_match = any_match or all_match
+        all_match = True
+    return any_match
+
+  @classmethod
+  def _match_expression(cls, tokens: list, i: int, metadata: dict):
+    """
+    Evaluate the text or numerical expression at tokens[i].
+
+    Returns:
+      match result, and the position of the token after the expression
+    """
+    field_name, operator = tokens[i], tokens[i + 1]
+    i += 2
+    if operator == "ANY":
+      literals = []
+      while i < len(tokens) and tokens[i] not in FILTER_CONNECTORS:
+        literals.append(tokens[i])
+        i += 1
+      match = cls._match_values(metadata.get(field_name),
+                                lambda value: str(value) in literals)
+    elif operator == "IN":
+      lower, lower_type, i = cls._filter_bound(tokens, i)
+      upper, upper_type, i = cls._filter_bound(tokens, i)
+      match = cls._match_values(
+          metadata.get(field_name),
+          lambda value: cls._in_range(value, lower, lower_type,
+                                      upper, upper_type))
+    else:
+      value = tokens[i]
+      i += 1
+      match = cls._match_values(
+          metadata.get(field_name),
+          lambda x: cls._compare(x, operator, value))
+    return match, i
+
+  @classmethod
+  def match_dict_filter(cls, query_filter: dict,
+                        metadata: Optional[dict]) -> bool:
+    """
+    Evaluate a dict filter against chunk metadata, in the format sent by
+    query_generate (a json query filter merged with the authz filter):
+      {"field": value} matches equal values
+      {"field": {"$op": value}} with op one of eq, ne, lt, lte, gt, gte,
+        in, nin, between or contains (the $ is optional)
+      {"$and": [filters]} and {"$or": [filters]} combine filters
+    All keys of a filter must match.  For list metadata values, a
+    condition matches if it matches any item.
+
+    Raises:
+      ValueError for unsupported operators
+    """
+    metadata = metadata or {}
+    for key, condition in query_filter.items():
+      connector = key.lstrip("$").lower()
+      if connector in ("and", "or") and isinstance(condition, list):
+        matches = (cls.match_dict_filter(clause, metadata)
+                   for clause in condition)
+        match = all(matches) if connector == "and" else any(matches)
+      elif isinstance(condition, dict):
+        match = all(cls._match_condition(metadata.get(key), operator, value)
+                    for operator, value in condition.items())
+      else:
+        match = cls._match_condition(metadata.get(key), "eq", condition)
+      if not match:
+        return False
+    return True
+
+  @classmethod
+  def _match_condition(cls, value, operator: str, target) -> bool:
+    """ Evaluate a single dict filter condition against a metadata value """
+    operator = operator.lstrip("$").lower()
+    if operator == "eq":
+      return cls._match_values(value, lambda x: x == target)
+    if operator == "ne":
+      return not cls._match_values(value, lambda x: x == target)
+    if operator == "in":
+      return cls._match_values(value, lambda x: x in target)
+    if operator == "nin":
+      return not cls._match_values(value, lambda x: x in target)
+    if operator == "contains":
+      if isinstance(value, str):
+        return str(target) in value
+      return cls._match_values(value, lambda x: x == target)
+    if operator == "between":
+      lower, upper = target
+      return cls._match_values(
+          value, lambda x: cls._in_range(x, float(lower), "i",
+                                         float(upper), "i"))
+    if operator in DICT_FILTER_COMPARISONS:
+      return cls._match_values(
+          value, lambda x: cls._compare(x, DICT_FILTER_COMPARISONS[operator],
+                                        float(target)))
+    raise ValueError(f"Unsupported filter operator {operator}")
+
+  @classmethod
+  def _filter_bound(cls, tokens: list, i: int):
+    bound = tokens[i]
+    bound_type = "i"
+    i += 1
+    if i < len(tokens) and tokens[i] in ("e", "i"):
+      bound_type = tokens[i]
+      i += 1
+    return bound, bound_type, i
+
+  @classmethod
+  def _match_values(cls, value, predicate) -> bool:
+    values = value if isinstance(value, list) else [value]
+    for item in values:
+      if item is None:
+        continue
+      try:
+        if predicate(item):
+          return True
+      except (TypeError, ValueError):
+        continue
+    return False
+
+  @classmethod
+  def _in_range(cls, value, lower, lower_type, upper, upper_type) -> bool:
+    value = float(value)
+    if lower != "*":
+      if value < lower or (lower_type == "e" and value == lower):
+        return False
+    if upper != "*":
+      if value > upper or (upper_type == "e" and value == upper):
+        return False
+    return True
+
+  @classmethod
+  def _compare(cls, value, operator: str, target: float) -> bool:
+    value = float(value)
+    if operator == "<":
+      return value < target
+    if operator == "<=":
+      return value <= target
+    if operator == ">":
+      return value > target
+    if operator == ">=":
+      return value >= target
+    return value == target
+
+  def delete(self):
+    """ Delete the index data for this query engine """
+    params = self.q_engine.params or {}
+    for uri_param in (LOCAL_VECTOR_STORE_URI_PARAM,
+                      LOCAL_VECTOR_STORE_PREVIOUS_URI_PARAM):
+      uri = params.get(uri_param)
+      if uri:
+        self._delete_data(uri)
+    bucket_name = params.get(LOCAL_VECTOR_STORE_BUCKET_PARAM)
+    if bucket_name:
+      Logger.info(f"Deleting local vector store bucket {bucket_name}")
+      self.storage_client.bucket(bucket_name).delete(force=True)
+
+  def _delete_data(self, uri: str):
+    Logger.info(f"Deleting local vector store data at {uri}")
+    try:
+      if uri.startswith("gs://"):
+        bucket_name, prefix = parse_gcs_uri(uri)
+        shutil.rmtree(os.path.join(LOCAL_VECTOR_STORE_CACHE_DIR,
+                                   bucket_name, prefix), ignore_errors=True)
+        bucket = self.storage_client.bucket(bucket_name)
+        for blob in bucket.list_blobs(prefix=f"{prefix}/"):
+          blob.delete()
+      else:
+        shutil.rmtree(uri, ignore_errors=True)
+    except Exception as e:
+      Logger.error(f"Error deleting local vector store data at {uri}: {e}")
@@ -0,0 +1,242 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Unit tests for the local vector store
+"""
+# disabling pylint rules that conflict with pytest fixtures
+# pylint: disable=unused-argument,redefined-outer-name,ungrouped-imports
+import os
+import pytest
+from unittest import mock
+from common.utils.config import set_env_var
+
+with set_env_var("PG_HOST", ""):
+  from services.query.local_vector_store import (
+      LocalVectorStore, LOCAL_VECTOR_STORE_URI_PARAM,
+      LOCAL_VECTOR_STORE_PREVIOUS_URI_PARAM)
+
+EMBEDDINGS = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0],
+              [0.7, 0.7, 0.0]]
+METADATA = [{"category": "a", "year": 2020},
+            {"category": "b", "year": 2021},
+            {"category": ["a", "c"], "year": 2022},
+            {"category": "c", "year": 2023}]
+
+
+@pytest.fixture
+def q_engine():
+  engine = mock.Mock(id="test-engine", params={})
+  engine.name = "test engine"
+  return engine
+
+
+def test_match_filter(q_engine):
+  vector_store = LocalVectorStore(q_engine)
+  def matches(filter_str):
+    parsed_filter = vector_store.parse_filter(filter_str)
+    return [i for i, metadata in enumerate(METADATA)
+            if LocalVectorStore.match_filter(parsed_filter, metadata)]
+
+  assert matches('category: ANY("a")') == [0, 2]
+  assert matches('category: ANY("b", "c")') == [1, 2, 3]
+  assert matches("year >= 2022") == [2, 3]
+  assert matches("year: IN(2021, 2022)") == [1, 2]
+  assert matches("year: IN(2021e, *)") == [2, 3]
+  assert matches('NOT category: ANY("a")') == [1, 3]
+  assert matches('category: ANY("a") AND year > 2020 OR year < 2021') == \
+      [0, 2]
+  assert matches('missing: ANY("a")') == []
+  # parenthesized expressions are evaluated first
+  assert matches('NOT (category: ANY("a") OR year = 2021)') == [3]
+  assert matches('year > 2020 AND (category: ANY("a") OR year = 2023)') == \
+      [2, 3]
+  assert matches('(year < 2021 OR year > 2022) AND category: ANY("c")') == \
+      [3]
+
+
+def test_match_dict_filter():
+  def matches(query_filter):
+    return [i for i, metadata in enumerate(METADATA)
+            if LocalVectorStore.match_dict_filter(query_filter, metadata)]
+
+  assert matches({"category": "a"}) == [0, 2]
+  assert matches({"category": {"contains": "c"}}) == [2, 3]
+  assert matches({"year": {"$gte": 2021, "$lt": 2023}}) == [1, 2]
+  assert matches({"category": {"$in": ["b", "c"]}}) == [1, 2, 3]
+  assert matches({"category": {"$nin": ["a"]}, "year": {"$ne": 2023}}) == [1]
+  assert matches({"$or": [{"category": "b"}, {"year": 2023}]}) == [1, 3]
+  with pytest.raises(ValueError):
+    matches({"year": {"$regex": "20.*"}})
+
+
+@pytest.mark.asyncio
+@mock.patch("services.query.local_vector_store.embeddings.get_embeddings")
+async def test_local_vector_store(mock_get_embeddings, q_engine, tmp_path):
+  with mock.patch("services.query.local_vector_store.LOCAL_VECTOR_STORE_PATH",
+                  str(tmp_path)):
+    vector_store = LocalVectorStore(q_engine)
+    vector_store.init_index()
+    mock_get_embeddings.return_value = [True, True], EMBEDDINGS[:2]
+    index_base = await vector_store.index_document(
+        "doc1", ["chunk 0", "chunk 1"], 0, METADATA[:2])
+    mock_get_embeddings.return_value = [True, True], EMBEDDINGS[2:]
+    index_base = await vector_store.index_document(
+        "doc2", ["chunk 2", "chunk 3"], index_base, METADATA[2:])
+    assert index_base == 4
+    vector_store.deploy()
+
+  uri = q_engine.params[LOCAL_VECTOR_STORE_URI_PARAM]
+  assert uri.startswith(str(tmp_path))
+  q_engine.update.assert_called()
+
+  # a new instance loads the persisted index
+  vector_store = LocalVectorStore(q_engine)
+  matches = vector_store.similarity_search(q_engine, [1.0, 0.1, 0.0])
+  assert matches == [0, 3, 1, 2]
+  matches = vector_store.similarity_search(q_engine, [1.0, 0.1, 0.0],
+                                           'category: ANY("c")')
+  assert matches == [3, 2]
+  assert vector_store.similarity_search(q_engine, [1.0, 0.0, 0.0],
+                                        "year > 2030") == []
+  # dict filters, as merged with the authz filter by query_generate
+  matches = vector_store.similarity_search(
+      q_engine, [1.0, 0.1, 0.0],
+      {"category": {"contains": "a"}, "year": {"$gte": 2021}})
+  assert matches == [2]
+
+  vector_store.delete()
+  assert not os.path.exists(uri)
+
+
+@pytest.mark.asyncio
+@mock.patch("services.query.local_vector_store.embeddings.get_embeddings")
+async def test_local_vector_store_refresh(mock_get_embeddings, q_engine,
+                                          tmp_path):
+  with mock.patch("services.query.local_vector_store.LOCAL_VECTOR_STORE_PATH",
+                  str(tmp_path)):
+    vector_store = LocalVectorStore(q_engine)
+    vector_store.init_index()
+    mock_get_embeddings.return_value = [True] * 3, EMBEDDINGS[:3]
+    await vector_store.index_document(
+        "doc1", ["chunk 0", "chunk 1", "chunk 2"], 0, METADATA[:3])
+    vector_store.deploy()
+
+    # delete chunk 1, add chunk 3 at a new index, and then delete chunk 2
+    # (replaced by chunk 3)
+    vector_store = LocalVectorStore(q_engine)
+    vector_store.init_refresh([1])
+    mock_get_embeddings.return_value = [True], EMBEDDINGS[3:]
+    await vector_store.index_document("doc2", ["chunk 3"], 3, METADATA[3:])
+    vector_store.delete_embeddings([2])
+    vector_store.deploy()
+
+  vector_store = LocalVectorStore(q_engine)
+  assert vector_store.similarity_search(q_engine, [1.0, 0.1, 0.0]) == [0, 3]
+  assert vector_store.similarity_search(q_engine, [1.0, 0.1, 0.0],
+                                        'category: ANY("c")') == [3]
+
+
+@pytest.mark.asyncio
+@mock.patch("services.query.local_vector_store.LOCAL_VECTOR_STORE_ANN_MIN_ROWS",
+            1)
+@mock.patch("services.query.local_vector_store.hnswlib")
+@mock.patch("services.query.local_vector_store.embeddings.get_embeddings")
+async def test_local_vector_store_graph(mock_get_embeddings, mock_hnswlib,
+                                        q_engine, tmp_path):
+  graph = mock_hnswlib.Index.return_value
+  graph.save_index.side_effect = lambda path: open(path, "wb").close()
+  graph.knn_query.return_value = [[3, 0]], [[0.9, 0.7]]
+  with mock.patch("services.query.local_vector_store.LOCAL_VECTOR_STORE_PATH",
+                  str(tmp_path)):
+    vector_store = LocalVectorStore(q_engine)
+    vector_store.init_index()
+    mock_get_embeddings.return_value = [True] * 4, EMBEDDINGS
+    await vector_store.index_document(
+        "doc1", ["chunk 0", "chunk 1", "chunk 2", "chunk 3"], 0, METADATA)
+    vector_store.deploy()
+
+  # the graph is built with the index data, and loaded with it
+  graph.add_items.assert_called_once()
+  vector_store = LocalVectorStore(q_engine)
+  assert vector_store.similarity_search(q_engine, [1.0, 0.1, 0.0]) == [3, 0]
+  graph.load_index.assert_called_once()
+  graph.add_items.assert_called_once()
+
+  # builds without a graph use exact search until it is built in the
+  # background
+  uri = q_engine.params[LOCAL_VECTOR_STORE_URI_PARAM]
+  os.remove(os.path.join(uri, "hnsw.bin"))
+  vector_store = LocalVectorStore(q_engine)
+  with mock.patch("services.query.local_vector_store.threading.Thread") \
+      as mock_thread:
+    assert vector_store.similarity_search(q_engine, [1.0, 0.1, 0.0]) == \
+        [0, 3, 1, 2]
+  thread_kwargs = mock_thread.call_args.kwargs
+  thread_kwargs["target"](*thread_kwargs["args"])
+  assert graph.add_items.call_count == 2
+  assert vector_store.similarity_search(q_engine, [1.0, 0.1, 0.0]) == [3, 0]
+
+
+@pytest.mark.asyncio
+@mock.patch("services.query.local_vector_store.embeddings.get_embeddings")
+async def test_local_vector_store_deferred_delete(mock_get_embeddings,
+                                                  q_engine, tmp_path):
+  mock_get_embeddings.return_value = [True], EMBEDDINGS[:1]
+  uris = []
+  with mock.patch("services.query.local_vector_store.LOCAL_VECTOR_STORE_PATH",
+                  str(tmp_path)):
+    for _ in range(3):
+      vector_store = LocalVectorStore(q_engine)
+      vector_store.init_index()
+      await vector_store.index_document("doc1", ["chunk 0"], 0, METADATA[:1])
+      vector_store.deploy()
+      uris.append(q_engine.params[LOCAL_VECTOR_STORE_URI_PARAM])
+
+  # the previous build is kept for other workers, and older builds deleted
+  assert q_engine.params[LOCAL_VECTOR_STORE_PREVIOUS_URI_PARAM] == uris[1]
+  assert not os.path.exists(uris[0])
+  assert os.path.exists(uris[1])
+  assert os.path.exists(uris[2])
+
+  LocalVectorStore(q_engine).delete()
+  assert not os.path.exists(uris[1])
+  assert not os.path.exists(uris[2])
+
+
+@mock.patch("services.query.local_vector_store.storage.Client")
+def test_local_vector_store_cache_prune(mock_storage_client, q_engine,
+                                        tmp_path):
+  engine_path = tmp_path / "bucket" / "test-engine"
+  old_build = engine_path / ("a" * 32)
+  old_build.mkdir(parents=True)
+  download = engine_path / "tmp1234"
+  download.mkdir()
+  blob = mock.Mock()
+  blob.name = f"test-engine/{'b' * 32}/ids.npy"
+  bucket = mock_storage_client.return_value.bucket.return_value
+  bucket.list_blobs.return_value = [blob]
+
+  # cached data of previous builds is removed when a new build is
+  # downloaded, and downloads in progress are kept
+  with mock.patch(
+      "services.query.local_vector_store.LOCAL_VECTOR_STORE_CACHE_DIR",
+      str(tmp_path)):
+    local_path = LocalVectorStore(q_engine)._local_path(
+        f"gs://bucket/test-engine/{'b' * 32}")
+  assert local_path == str(engine_path / ("b" * 32))
+  assert os.path.isdir(local_path)
+  assert not old_build.exists()
+  assert download.exists()
+  blob.download_to_filename.assert_called_once()
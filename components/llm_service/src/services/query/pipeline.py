@@ -0,0 +1,110 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Staged asyncio pipelines.
+
+A pipeline passes items from a source through a sequence of stages
+connected by bounded queues.  Each stage runs a number of concurrent
+workers, so stages overlap across items, and a slow stage applies
+backpressure to the stages before it rather than buffering every item.
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Iterable, List, Optional
+
+DEFAULT_QUEUE_SIZE = 8
+
+# marks the end of the items in a queue
+_DONE = object()
+
+
+class PipelineStage():
+  """
+  A pipeline stage: an async function applied to each item with up to
+  concurrency items in flight.  The function returns the item passed to
+  the next stage, or None to drop the item.
+  """
+
+  def __init__(self, name: str,
+               fn: Callable[[Any], Awaitable[Optional[Any]]],
+               concurrency: int = 1) -> None:
+    self.name = name
+    self.fn = fn
+    self.concurrency = max(1, concurrency)
+
+
+async def run_pipeline(source: Iterable,
+                       stages: List[PipelineStage],
+                       queue_size: int = DEFAULT_QUEUE_SIZE) -> List[Any]:
+  """
+  Run items from source through the stages.
+
+  The source is iterated in a thread, so it may block, e.g. to download
+  each item.  If a stage raises, the pipeline is cancelled and the
+  exception is raised.
+
+  Args:
+    source: iterable of items
+    stages: list of stages, applied in order
+    queue_size: max items waiting between two stages
+  Returns:
+    list of the items returned by the last stage, in completion order
+  """
+  queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+  results = []
+
+  async def close(i: int):
+    """ signal the end of the items to each worker of stage i """
+    if i < len(stages):
+      for _ in range(stages[i].concurrency):
+        await queues[i].put(_DONE)
+
+  async def run_source():
+    iterator = iter(source)
+    while True:
+      item = await asyncio.to_thread(next, iterator, _DONE)
+      if item is _DONE:
+        break
+      await queues[0].put(item)
+    await close(0)
+
+  async def run_worker(i: int, stage: PipelineStage):
+    while True:
+      item = await queues[i].get()
+      if item is _DONE:
+        return
+      result = await stage.fn(item)
+      if result is None:
+        continue
+      if i + 1 < len(stages):
+        await queues[i + 1].put(result)
+      else:
+        results.append(result)
+
+  async def run_stage(i: int, stage: PipelineStage):
+    await asyncio.gather(*[run_worker(i, stage)
+                           for _ in range(stage.concurrency)])
+    await close(i + 1)
+
+  tasks = [asyncio.ensure_future(run_source())] + [
+      asyncio.ensure_future(run_stage(i, stage))
+      for i, stage in enumerate(stages)]
+  try:
+    await asyncio.gather(*tasks)
+  except BaseException:
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    raise
+  return results
@@ -0,0 +1,63 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Unit tests for staged pipelines
+"""
+import asyncio
+import pytest
+from services.query.pipeline import PipelineStage, run_pipeline
+
+
+@pytest.mark.asyncio
+async def test_run_pipeline():
+  in_flight = {"square": 0, "max_square": 0}
+
+  async def square(item):
+    in_flight["square"] += 1
+    in_flight["max_square"] = max(in_flight["max_square"],
+                                  in_flight["square"])
+    await asyncio.sleep(0.01)
+    in_flight["square"] -= 1
+    return item * item
+
+  async def drop_odd(item):
+    return item if item % 2 == 0 else None
+
+  results = await run_pipeline(range(10), [
+      PipelineStage("square", square, concurrency=3),
+      PipelineStage("drop_odd", drop_odd),
+  ], queue_size=2)
+  assert sorted(results) == [0, 4, 16, 36, 64]
+  assert in_flight["max_square"] == 3
+
+  # an empty source
+  assert await run_pipeline([], [PipelineStage("square", square)]) == []
+
+
+@pytest.mark.asyncio
+async def test_run_pipeline_error():
+  processed = []
+
+  async def fail_on_three(item):
+    if item == 3:
+      raise ValueError("three")
+    processed.append(item)
+    return item
+
+  with pytest.raises(ValueError):
+    await run_pipeline(range(100), [PipelineStage("fail", fail_on_three)],
+                       queue_size=1)
+  assert 3 not in processed
+  assert len(processed) < 100
@@ -14,40 +14,156 @@
 """
 Query prompt generator methods
 """
-from typing import List
+import re
+from typing import List, Optional, Tuple
 
 from config import TRUSS_LLM_LLAMA2_CHAT
 from services.query.query_prompt_config import \
   QUESTION_PROMPT, SUMMARY_PROMPT, LLAMA2_QUESTION_PROMPT
+from services.token_counter import count_tokens, token_counters
 from common.utils.logging_handler import Logger
 from common.models import QueryReference
 
 Logger = Logger.get_logger(__file__)
 
+# separator between reference texts in the question prompt context
+CONTEXT_SEPARATOR = "\n\n"
+
+# a reference that does not fit the prompt budget is truncated at the
+# last sentence end that fits, if at least this many chars remain
+MIN_TRUNCATED_REFERENCE_CHARS = 200
+SENTENCE_END_PATTERN = re.compile(r"[.!?](?=\s)|\n")
+
+# attempts to shrink a truncated reference until its tokens fit
+MAX_TRUNCATE_ATTEMPTS = 3
+
+def _question_template(llm_type: str):
+  if llm_type == TRUSS_LLM_LLAMA2_CHAT:
+    return LLAMA2_QUESTION_PROMPT
+  return QUESTION_PROMPT
+
+def _is_text_reference(ref: QueryReference) -> bool:
+  return hasattr(ref, "modality") and ref.modality == "text" and \
+      hasattr(ref, "document_text")
+
 def get_question_prompt(prompt: str,
                         chat_history: str,
                         query_context: List[QueryReference],
-                        llm_type: str) -> str:
-  """ Create question prompt with context for LLM """
+                        llm_type: str,
+                        context_texts: Optional[List[str]] = None) -> str:
+  """
+  Create question prompt with context for LLM.  If context_texts is
+  passed it is used as the text of the text references in query_context,
+  e.g. with texts truncated by pack_question_context.
+  """
   Logger.info(f"Creating question prompt with context "
               f"for LLM prompt=[{prompt}]")
-  context_list = []
-  for ref in query_context:
-    if hasattr(ref, "modality") and ref.modality=="text":
-      if hasattr(ref, "document_text"):
-        context_list.append(ref.document_text)
-  text_context = "\n\n".join(context_list)
+  if context_texts is None:
+    context_texts = [ref.document_text for ref in query_context
+                     if _is_text_reference(ref)]
+  text_context = CONTEXT_SEPARATOR.join(context_texts)
 
-  if llm_type == TRUSS_LLM_LLAMA2_CHAT:
-    question = LLAMA2_QUESTION_PROMPT.format(
-      question=prompt, chat_history=chat_history, context=text_context
-    )
-  else:
-    question = QUESTION_PROMPT.format(
-      question=prompt, chat_history=chat_history, context=text_context
-    )
+  question = _question_template(llm_type).format(
+    question=prompt, chat_history=chat_history, context=text_context
+  )
   return question
 
+def question_prompt_tokens(prompt: str, history_tokens: int,
+                           llm_type: str) -> int:
+  """
+  Tokens of the question prompt without any context, given the tokens
+  of the chat history.  Template and prompt counts are cached by the
+  token counter, so this does not tokenize the assembled prompt.
+  """
+  template_text = _question_template(llm_type).format(
+      question="", chat_history="", context="")
+  return count_tokens(template_text, llm_type) + \
+      count_tokens(prompt, llm_type) + history_tokens
+
+def context_tokens(context_texts: List[str], llm_type: str) -> int:
+  """ Tokens of the question prompt context made of context_texts """
+  if not context_texts:
+    return 0
+  separator_tokens = count_tokens(CONTEXT_SEPARATOR, llm_type)
+  return sum(token_counters.count_tokens_many(context_texts, llm_type)) + \
+      separator_tokens * (len(context_texts) - 1)
+
+def truncate_to_sentence(text: str, max_chars: int) -> str:
+  """
+  Truncate text to at most max_chars, at the end of the last complete
+  sentence, or at the last word boundary if there is no sentence end.
+  """
+  if len(text) <= max_chars:
+    return text
+  if max_chars <= 0:
+    return ""
+  truncated = text[:max_chars]
+  sentence_ends = [match.end() for match in
+                   SENTENCE_END_PATTERN.finditer(truncated)]
+  if sentence_ends:
+    return truncated[:sentence_ends[-1]].rstrip()
+  if text[max_chars].isspace() or truncated[-1].isspace() or \
+      not re.search(r"\s", truncated):
+    return truncated.rstrip()
+  return truncated.rsplit(None, 1)[0]
+
+def _truncate_to_tokens(text: str, text_tokens: int, max_tokens: int,
+                       llm_type: str) -> str:
+  """
+  Truncate text at a sentence boundary to at most max_tokens, estimating
+  the chars to keep from the chars per token of the text.
+  """
+  for _ in range(MAX_TRUNCATE_ATTEMPTS):
+    max_chars = int(len(text) * max_tokens / max(text_tokens, 1))
+    text = truncate_to_sentence(text, max_chars)
+    text_tokens = count_tokens(text, llm_type)
+    if text_tokens <= max_tokens:
+      return text
+  return ""
+
+def pack_question_context(query_references: List[QueryReference],
+                          budget_tokens: int,
+                          llm_type: Optional[str] = None) -> \
+                            Tuple[List[QueryReference], List[str]]:
+  """
+  Select references for the question prompt context within a budget of
+  context tokens.  Text references are taken greedily in rank order; one
+  that does not fit is truncated at a sentence boundary if enough of it
+  fits, otherwise skipped.  Non-text references use no context tokens and
+  are always kept.
+
+  Args:
+    query_references: references, most relevant first
+    budget_tokens: max tokens of the context text
+    llm_type: model whose tokenizer is used to count tokens
+  Returns:
+    selected references, and the (possibly truncated) text of each
+    selected text reference
+  """
+  packed_references = []
+  context_texts = []
+  remaining = budget_tokens
+  separator_tokens = count_tokens(CONTEXT_SEPARATOR, llm_type)
+  for ref in query_references:
+    if not _is_text_reference(ref):
+      packed_references.append(ref)
+      continue
+    text = ref.document_text or ""
+    text_tokens = count_tokens(text, llm_type)
+    separator_length = separator_tokens if context_texts else 0
+    if separator_length + text_tokens > remaining:
+      text = _truncate_to_tokens(text, text_tokens,
+                                 remaining - separator_length, llm_type)
+      if len(text) < MIN_TRUNCATED_REFERENCE_CHARS:
+        Logger.info(f"Dropped reference {ref.id}")
+        continue
+      text_tokens = count_tokens(text, llm_type)
+      Logger.info(f"Truncated reference {ref.id} to {text_tokens} tokens")
+    packed_references.append(ref)
+    context_texts.append(text)
+    remaining -= separator_length + text_tokens
+  return packed_references, context_texts
+
 def get_summarize_prompt(original_text: str) -> str:
   """ Create summarize prompt for LLM """
   Logger.info(f"Creating summarize prompt for original text=[{original_text}]")
@@ -16,8 +16,13 @@
 """
 # pylint: disable=unused-argument,redefined-outer-name,unused-import
 import pytest
-from services.query.query_prompts import get_question_prompt
+from services.query.query_prompts import (get_question_prompt,
+                                          pack_question_context,
+                                          question_prompt_tokens,
+                                          context_tokens,
+                                          truncate_to_sentence)
 from services.query.query_prompt_config import QUESTION_PROMPT
+from services.token_counter import count_tokens
 from common.models import QueryReference
 from common.testing.firestore_emulator import firestore_emulator, clean_firestore
 from schemas.schema_examples import (QUERY_REFERENCE_EXAMPLE_1,
@@ -66,3 +71,43 @@ def test_question_prompt(create_query_reference, create_query_reference_2):
     question, chat_history, query_context, llm_type
   )
   assert expected_prompt == actual_prompt, "Prompts don't match"
+
+
+def test_truncate_to_sentence():
+  text = "First sentence. Second sentence! Third one"
+  assert truncate_to_sentence(text, 100) == text
+  assert truncate_to_sentence(text, 35) == "First sentence. Second sentence!"
+  assert truncate_to_sentence(text, 20) == "First sentence."
+  assert truncate_to_sentence("no sentence end here", 12) == "no sentence"
+
+
+def test_pack_question_context(create_query_reference,
+                               create_query_reference_2):
+  text_1 = create_query_reference.document_text
+  text_2 = create_query_reference_2.document_text
+  references = [create_query_reference, create_query_reference_2]
+
+  # everything fits
+  packed, texts = pack_question_context(references, 100000)
+  assert packed == references
+  assert texts == [text_1, text_2]
+
+  # only the first reference fits
+  packed, texts = pack_question_context(references,
+                                        count_tokens(text_1, None) + 1)
+  assert packed == [create_query_reference]
+  assert texts == [text_1]
+
+  # nothing fits
+  packed, texts = pack_question_context(references, 0)
+  assert not packed
+
+  # the packed prompt is the same as the prompt built from the references
+  llm_type = "VertexAI-Chat"
+  packed, texts = pack_question_context(references, 100000, llm_type)
+  prompt = get_question_prompt("question", "", packed, llm_type, texts)
+  assert prompt == get_question_prompt("question", "", references, llm_type)
+  # the context estimate from per-text counts does not undercount
+  assert context_tokens(texts, None) >= \
+      count_tokens("\n\n".join(texts), None)
+  assert question_prompt_tokens("question", 0, llm_type) > 0
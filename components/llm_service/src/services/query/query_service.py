@@ -14,18 +14,21 @@
 """
 Query Engine Service
 """
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 import tempfile
 import traceback
 import os
 import json
 import re
-from numpy.linalg import norm
+import time
 import numpy as np
-import pandas as pd
-from typing import List, Optional, Tuple, Dict
+from typing import (Any, AsyncGenerator, Callable, List, Optional, Tuple,
+                    Dict, Union)
 from google.cloud import storage
-from rerankers import Reranker
 from common.utils.logging_handler import Logger
 from common.models import (UserQuery, QueryResult, QueryEngine,
                            QueryDocument,
@@ -41,35 +44,67 @@ from common.utils.errors import (ResourceNotFoundException,
                                  UnauthorizedUserError)
 from common.utils.http_exceptions import InternalServerError
 from services import embeddings
-from services.llm_generate import (get_context_prompt,
+from services.embedding_cache import query_embedding_cache
+from services.chunk_embedding_cache import get_chunk_embedding_cache
+from services.llm_generate import (get_context_prompt_entries,
                                    llm_chat,
-                                   check_context_length)
+                                   check_token_length,
+                                   get_context_length)
 from services.query.query_prompts import (get_question_prompt,
-                                          get_summarize_prompt)
+                                          get_summarize_prompt,
+                                          question_prompt_tokens,
+                                          context_tokens,
+                                          pack_question_context)
+from services.token_counter import count_tokens, token_counters
 from services.query.vector_store import (VectorStore,
                                          MatchingEngineVectorStore,
                                          PostgresVectorStore,
-                                         NUM_MATCH_RESULTS)
-from services.query.data_source import DataSource, DataSourceFile
+                                         NUM_MATCH_RESULTS,
+                                         vector_store_registry)
+from services.query.local_vector_store import LocalVectorStore
+from services.query.lexical_index import (LexicalIndex,
+                                          is_hybrid_search_enabled,
+                                          has_lexical_index,
+                                          save_lexical_index,
+                                          search_lexical_index,
+                                          delete_lexical_index,
+                                          reciprocal_rank_fusion)
+from services.query.reranker import reranker_service
+from services.query.data_source import (DataSource, DataSourceFile,
+                                        chunk_document_in_worker)
+from services.query.pipeline import PipelineStage, run_pipeline
+from services.query.chunk_writer import ChunkWriter, assign_chunk_ids
+from services.query.sentence_embeddings import SentenceEmbeddingStore
+from services.query.semantic_cache import (is_semantic_cache_enabled,
+                                           semantic_cache_key,
+                                           lookup_semantic_cache,
+                                           store_semantic_cache,
+                                           invalidate_semantic_cache)
 from services.query.web_datasource import WebDataSource
 from services.query.web_datasource_job import WebDataSourceJob
 from services.query.sharepoint_datasource import SharePointDataSource
 from services.query.vertex_search import (build_vertex_search,
                                           query_vertex_search,
                                           delete_vertex_search)
-from utils.errors import (NoDocumentsIndexedException,
-                          ContextWindowExceededException)
+from utils.errors import NoDocumentsIndexedException
 from utils.file_helper import validate_multimodal_file_type
 from utils import text_helper
+from utils.vector_helper import cosine_similarity
 from config import (PROJECT_ID, DEFAULT_QUERY_CHAT_MODEL,
                     DEFAULT_MULTIMODAL_LLM_TYPE,
                     DEFAULT_QUERY_EMBEDDING_MODEL,
                     DEFAULT_QUERY_MULTIMODAL_EMBEDDING_MODEL,
                     DEFAULT_WEB_DEPTH_LIMIT, get_model_config,
-                    MODALITY_SET)
+                    MODALITY_SET, QUERY_BATCH_CONCURRENCY,
+                    QUERY_BATCH_CHUNK_SIZE, QUERY_BATCH_PROGRESS_INTERVAL,
+                    QUERY_BUILD_PARSE_WORKERS, QUERY_BUILD_EMBED_CONCURRENCY,
+                    QUERY_BUILD_WRITE_CONCURRENCY, QUERY_BUILD_QUEUE_SIZE,
+                    QUERY_BUILD_PROGRESS_INTERVAL)
 from config.vector_store_config import (DEFAULT_VECTOR_STORE,
+                                        REFRESH_VECTOR_STORES,
                                         VECTOR_STORE_LANGCHAIN_PGVECTOR,
-                                        VECTOR_STORE_MATCHING_ENGINE)
+                                        VECTOR_STORE_MATCHING_ENGINE,
+                                        VECTOR_STORE_LOCAL)
 
 # pylint: disable=broad-exception-caught,ungrouped-imports
 
@@ -77,16 +112,29 @@ Logger = Logger.get_logger(__file__)
 
 VECTOR_STORES = {
   VECTOR_STORE_MATCHING_ENGINE: MatchingEngineVectorStore,
-  VECTOR_STORE_LANGCHAIN_PGVECTOR: PostgresVectorStore
+  VECTOR_STORE_LANGCHAIN_PGVECTOR: PostgresVectorStore,
+  VECTOR_STORE_LOCAL: LocalVectorStore
 }
 
-RERANK_MODEL_NAME = "colbert"
-reranker = Reranker(RERANK_MODEL_NAME, verbose=0)
-
 # minimum number of references to return
 MIN_QUERY_REFERENCES = 2
 # total number of references to return from integrated search
 NUM_INTEGRATED_QUERY_REFERENCES = 6
+# deadline in seconds for each child engine retrieval in integrated search
+# (can be overridden with the "child_timeout" query engine param)
+INTEGRATED_SEARCH_CHILD_TIMEOUT = 30
+
+# results shards written by batch_query_generate_file, named by the range
+# of prompt positions they hold
+BATCH_RESULTS_SHARD_NAME = "results-{:08d}-{:08d}.jsonl"
+BATCH_RESULTS_SHARD_PATTERN = re.compile(r"results-(\d{8})-(\d{8})\.jsonl")
+BATCH_ERRORS_SHARD_NAME = "errors-{:08d}-{:08d}.jsonl"
+BATCH_ERRORS_SHARD_PATTERN = re.compile(r"errors-(\d{8})-(\d{8})\.jsonl")
+
+# events yielded by query_generate_stream
+QUERY_EVENT_REFERENCES = "references"
+QUERY_EVENT_TOKEN = "token"
+QUERY_EVENT_RESULT = "result"
 
 
 async def query_generate(
@@ -124,6 +172,40 @@ async def query_generate(
   Raises:
     ResourceNotFoundException if the named query engine doesn't exist
   """
+  query_result, query_references = None, None
+  async for event, data in query_generate_stream(user_id, prompt, q_engine,
+                                                 user_data, llm_type,
+                                                 user_query, rank_sentences,
+                                                 query_filter, stream=False):
+    if event == QUERY_EVENT_RESULT:
+      query_result, query_references = data
+  return query_result, query_references
+
+
+async def query_generate_stream(
+            user_id: str,
+            prompt: str,
+            q_engine: QueryEngine,
+            user_data: Optional[dict] = None,
+            llm_type: Optional[str] = None,
+            user_query: Optional[UserQuery] = None,
+            rank_sentences=False,
+            query_filter: Optional[dict]=None,
+            stream: bool = True) -> \
+                AsyncGenerator[Tuple[str, Any], None]:
+  """
+  Execute a query over a query engine, yielding (event, data) tuples as
+  the response is produced:
+    QUERY_EVENT_REFERENCES: list of QueryReference objects, as soon as
+                            retrieval (and reranking) is done
+    QUERY_EVENT_TOKEN: text chunks of the generated response
+    QUERY_EVENT_RESULT: (QueryResult, list of QueryReference objects),
+                        once the response is complete and saved
+
+  Args: see query_generate, plus
+    stream: stream the response from the model.  Models without
+            streaming support yield the full response as a single token.
+  """
   Logger.info(f"Executing query: "
               f"llm_type=[{llm_type}], "
               f"user_id=[{user_id}], "
@@ -158,6 +240,38 @@ async def query_generate(
   if not get_model_config().is_model_enabled_for_user(llm_type, user_data):
     raise UnauthorizedUserError("User does not have access to model")
 
+  # check the semantic cache.  Queries with chat history are not cached
+  # as the history is part of the question prompt.
+  cache_key = None
+  prompt_embedding = None
+  if is_semantic_cache_enabled(q_engine) and \
+      (user_query is None or not user_query.history):
+    try:
+      cache_key = semantic_cache_key(llm_type, query_filter, rank_sentences)
+      _, prompt_embedding = await get_query_embeddings(
+          q_engine, prompt, is_multimodal_engine(q_engine))
+      cached = await asyncio.to_thread(lookup_semantic_cache, q_engine,
+                                       cache_key, prompt_embedding)
+    except Exception as e:
+      Logger.error(f"Error checking semantic cache: {e}")
+      cache_key = None
+      cached = None
+    if cached is not None:
+      cached_result, query_references = cached
+      if user_query:
+        update_user_query(prompt, cached_result.response, user_id,
+                          q_engine, query_references, user_query)
+      query_result = QueryResult(query_engine_id=q_engine.id,
+                                 query_engine=q_engine.name,
+                                 query_refs=cached_result.query_refs,
+                                 prompt=prompt,
+                                 response=cached_result.response)
+      query_result.save()
+      yield QUERY_EVENT_REFERENCES, query_references
+      yield QUERY_EVENT_TOKEN, cached_result.response
+      yield QUERY_EVENT_RESULT, (query_result, query_references)
+      return
+
   # perform retrieval
   query_references = await retrieve_references(prompt,
                                                q_engine,
@@ -169,7 +283,7 @@ async def query_generate(
   # from multiple child engines.
   if q_engine.query_engine_type == QE_TYPE_INTEGRATED_SEARCH and \
       len(query_references) > 1:
-    query_references = rerank_references(prompt, query_references)
+    query_references = await rerank_references(prompt, query_references)
 
   # Update user query with ranked references. We do this before generating
   # the answer so the frontend can display the retrieved results as soon as
@@ -177,6 +291,7 @@ async def query_generate(
   if user_query:
     update_user_query(
         prompt, None, user_id, q_engine, query_references, user_query)
+  yield QUERY_EVENT_REFERENCES, query_references
 
   # generate question prompt
   # (from user's text prompt plus text info in query_references)
@@ -188,20 +303,20 @@ async def query_generate(
 
   # generate list of URLs for additional context
   # (from non-text info in query_references)
-  context_files = []
-  for ref in query_references:
-    if ref.modality != "text" and ref.chunk_url:
-      ref_filename = ref.chunk_url
-      ref_mimetype = validate_multimodal_file_type(file_name=ref_filename,
-                                                   file_b64=None)
-      context_files.append(DataSourceFile(gcs_path=ref_filename,
-                                          mime_type=ref_mimetype))
-      # TODO: If ref is a video chunk, then update new element of
-      # context_files according to ref.timestamp_start and ref.timestamp_stop
+  context_files = get_reference_context_files(query_references)
 
   # send prompt and additional context to model
-  question_response = await llm_chat(question_prompt, llm_type,
-                                     chat_files=context_files)
+  response = await llm_chat(question_prompt, llm_type,
+                            chat_files=context_files, stream=stream)
+  if isinstance(response, str):
+    question_response = response
+    yield QUERY_EVENT_TOKEN, response
+  else:
+    response_chunks = []
+    async for chunk in response:
+      response_chunks.append(chunk)
+      yield QUERY_EVENT_TOKEN, chunk
+    question_response = "".join(response_chunks)
 
   # update user query with response
   if user_query:
@@ -218,8 +333,29 @@ async def query_generate(
                              prompt=prompt,
                              response=question_response)
   query_result.save()
+  if cache_key is not None:
+    store_semantic_cache(q_engine, cache_key, prompt_embedding, query_result)
+
+  yield QUERY_EVENT_RESULT, (query_result, query_references)
 
-  return query_result, query_references
+
+def get_reference_context_files(query_references: List[QueryReference]) \
+    -> List[DataSourceFile]:
+  """
+  Build the list of files for additional model context from the non-text
+  references in query_references.
+  """
+  context_files = []
+  for ref in query_references:
+    if ref.modality != "text" and ref.chunk_url:
+      ref_filename = ref.chunk_url
+      ref_mimetype = validate_multimodal_file_type(file_name=ref_filename,
+                                                   file_b64=None)
+      context_files.append(DataSourceFile(gcs_path=ref_filename,
+                                          mime_type=ref_mimetype))
+      # TODO: If ref is a video chunk, then update new element of
+      # context_files according to ref.timestamp_start and ref.timestamp_stop
+  return context_files
 
 async def query_generate_for_chat(
             user_id: str,
@@ -275,16 +411,7 @@ async def query_generate_for_chat(
                                              query_filter)
 
   # Extract multimodal content from references
-  context_files = []
-  for ref in query_references:
-    if ref.modality != "text" and ref.chunk_url:
-      ref_filename = ref.chunk_url
-      ref_mimetype = validate_multimodal_file_type(file_name=ref_filename,
-                                                 file_b64=None)
-      context_files.append(DataSourceFile(gcs_path=ref_filename,
-                                        mime_type=ref_mimetype))
-      # TODO: If ref is a video chunk, then update new element of
-      # context_files according to ref.timestamp_start and ref.timestamp_stop
+  context_files = get_reference_context_files(query_references)
 
   return query_references, context_files
 
@@ -311,45 +438,47 @@ async def generate_question_prompt(prompt: str,
   Raises:
     ContextWindowExceededException if the model context window is exceeded
   """
-  # incorporate user query context in prompt if it exists
+  # incorporate user query context in prompt if it exists; history
+  # entries are counted separately so their token counts are cached
   chat_history = ""
+  history_tokens = 0
   if user_query is not None:
-    chat_history = get_context_prompt(user_query=user_query)
+    history_entries = get_context_prompt_entries(user_query=user_query)
+    chat_history = "\n\n".join(history_entries)
+    history_tokens = sum(
+      token_counters.count_tokens_many(history_entries, llm_type))
+
+  context_length = get_context_length(llm_type)
+  if context_length is None:
+    question_prompt = get_question_prompt(
+      prompt, chat_history, query_references, llm_type)
+    return question_prompt, query_references
+
+  # pack references into the context token budget left by the prompt and
+  # chat history, counting each part once rather than the assembled prompt
+  base_tokens = question_prompt_tokens(prompt, history_tokens, llm_type)
+  packed_references, context_texts = pack_question_context(
+    query_references, context_length - base_tokens, llm_type)
+
+  # summarize the chat history if it leaves room for fewer than the
+  # minimum number of references
+  min_references = min(MIN_QUERY_REFERENCES, sum(
+    1 for ref in query_references if ref.modality == "text"))
+  if chat_history and len(context_texts) < min_references:
+    Logger.info(f"Summarizing chat history for prompt [{prompt}]")
+    chat_history = await summarize_history(chat_history, llm_type)
+    base_tokens = question_prompt_tokens(
+      prompt, count_tokens(chat_history, llm_type), llm_type)
+    packed_references, context_texts = pack_question_context(
+      query_references, context_length - base_tokens, llm_type)
 
-  # generate default prompt
   question_prompt = get_question_prompt(
-    prompt, chat_history, query_references, llm_type)
+    prompt, chat_history, packed_references, llm_type, context_texts)
+  # exception will be propagated if context is too long at this point
+  check_token_length(base_tokens + context_tokens(context_texts, llm_type),
+                     llm_type)
 
-  # check prompt against context length of generation model
-  try:
-    check_context_length(question_prompt, llm_type)
-  except ContextWindowExceededException:
-    # first try popping reference results
-    while len(query_references) > MIN_QUERY_REFERENCES:
-      q_ref = query_references.pop()
-      Logger.info(f"Dropped reference {q_ref.id}")
-      question_prompt = get_question_prompt(
-        prompt, chat_history, query_references, llm_type
-      )
-      try:
-        check_context_length(question_prompt, llm_type)
-        break
-      except ContextWindowExceededException:
-        pass
-    # check again
-    try:
-      check_context_length(question_prompt, llm_type)
-    except ContextWindowExceededException:
-      # summarize chat history
-      Logger.info(f"Summarizing chat history for {question_prompt}")
-      chat_history = await summarize_history(chat_history, llm_type)
-      question_prompt = get_question_prompt(
-        prompt, chat_history, query_references, llm_type
-      )
-      # exception will be propagated if context is too long at this point
-      check_context_length(question_prompt, llm_type)
-
-  return question_prompt, query_references
+  return question_prompt, packed_references
 
 async def summarize_history(chat_history: str,
                             llm_type: str) -> str:
@@ -371,15 +500,28 @@ async def retrieve_references(prompt: str,
                               q_engine: QueryEngine,
                               user_id: str,
                               rank_sentences: bool = False,
-                              query_filter: dict = None)-> List[QueryReference]:
+                              query_filter: dict = None,
+                              embeddings_cache: Optional[dict] = None,
+                              save_references: bool = True) -> \
+                                List[QueryReference]:
   """
   Execute a query over a query engine and retrieve reference documents.
 
+  For integrated search engines, retrieval on the child engines is run
+  concurrently, each with a deadline.  A child engine that fails or times
+  out is logged and dropped, and references from the remaining children
+  are returned.
+
   Args:
     prompt: the text prompt to pass to the query engine
     q_engine: the name of the query engine to use
     user_id: user id of user making query
     rank_sentences (bool): rank sentence relevance in retrieved chunks
+    query_filter: (optional): dict of key value pairs for filtering results
+    embeddings_cache: (optional): dict used to share prompt embeddings
+      between engines with the same embedding type
+    save_references: save the QueryReference models (see
+      hydrate_query_references)
   Returns:
     list of QueryReference objects
   """
@@ -389,51 +531,90 @@ async def retrieve_references(prompt: str,
   if q_engine.query_engine_type == QE_TYPE_VERTEX_SEARCH:
     query_references = \
          await query_vertex_search(q_engine, prompt,
-                                   NUM_MATCH_RESULTS, query_filter)
+                                   NUM_MATCH_RESULTS, query_filter,
+                                   save_references)
   elif q_engine.query_engine_type == QE_TYPE_INTEGRATED_SEARCH:
     child_engines = QueryEngine.find_children(q_engine)
-    for child_engine in child_engines:
-      # make a recursive call to retrieve references for child engine
-      child_query_references = await retrieve_references(prompt,
-                                                         child_engine,
-                                                         user_id,
-                                                         query_filter)
-      query_references += child_query_references
+    params = q_engine.params or {}
+    child_timeout = float(params.get("child_timeout",
+                                     INTEGRATED_SEARCH_CHILD_TIMEOUT))
+    if embeddings_cache is None:
+      embeddings_cache = {}
+
+    # make concurrent recursive calls to retrieve references for children
+    child_retrievals = [
+      asyncio.wait_for(retrieve_references(prompt,
+                                           child_engine,
+                                           user_id,
+                                           rank_sentences,
+                                           query_filter,
+                                           embeddings_cache,
+                                           save_references),
+                       timeout=child_timeout)
+      for child_engine in child_engines
+    ]
+    child_results = await asyncio.gather(*child_retrievals,
+                                         return_exceptions=True)
+    for child_engine, child_result in zip(child_engines, child_results):
+      if isinstance(child_result, asyncio.TimeoutError):
+        Logger.error(f"Retrieval for child engine [{child_engine.name}] "
+                     f"timed out after {child_timeout}s, skipping")
+        continue
+      if isinstance(child_result, BaseException):
+        Logger.error(f"Retrieval for child engine [{child_engine.name}] "
+                     f"failed, skipping: {child_result}")
+        continue
+      query_references += child_result
   elif q_engine.query_engine_type == QE_TYPE_LLM_SERVICE or \
       not q_engine.query_engine_type:
     # default if type is not set to llm service query
     query_references = await query_search(q_engine, prompt,
-                                          rank_sentences, query_filter)
+                                          rank_sentences, query_filter,
+                                          embeddings_cache, save_references)
 
   return query_references
 
-async def query_search(q_engine: QueryEngine,
-                       query_prompt: str,
-                       rank_sentences: bool = False,
-                       query_filter: dict = None) -> List[QueryReference]:
+def is_multimodal_engine(q_engine: QueryEngine) -> bool:
+  """ Get is_multimodal flag from q_engine params """
+  params = q_engine.params or {}
+  is_multimodal = params.get("is_multimodal", "false")
+  return isinstance(is_multimodal, str) and is_multimodal.lower() == "true"
+
+async def get_query_embeddings(q_engine: QueryEngine,
+                               query_prompt: str,
+                               is_multimodal: bool,
+                               embeddings_cache: Optional[dict] = None):
   """
-  For a query prompt, retrieve text chunks with doc references
-  from matching documents.
+  Generate embeddings for a query prompt using the query engine embedding
+  type.  If embeddings_cache is passed, the embedding is computed once per
+  (embedding type, modality) and shared between all callers using the
+  same cache, including concurrent ones.
 
   Args:
     q_engine: QueryEngine to search
     query_prompt (str):  user query
-    rank_sentences: rank sentence relevance in retrieved chunks
+    is_multimodal: True if the engine uses multimodal embeddings
+    embeddings_cache: (optional): dict used to share prompt embeddings
 
   Returns:
-    list of QueryReference models
-
+    Tuple of (query embeddings as returned by the embeddings service,
+              single embedding vector for the prompt)
   """
-  # Get is_multimodal flag from q_engine
-  params = q_engine.params #q_engine should always have a field called params
-  is_multimodal = False
-  if "is_multimodal" in params and isinstance(params["is_multimodal"], str):
-    is_multimodal = params["is_multimodal"].lower()
-    is_multimodal = is_multimodal == "true"
-
-  Logger.info(f"Retrieving doc references for q_engine=[{q_engine.name}], "
-              f"query_prompt=[{query_prompt}]")
-  # generate embeddings for prompt
+  if embeddings_cache is None:
+    return await _generate_query_embeddings(q_engine, query_prompt,
+                                            is_multimodal)
+
+  cache_key = (q_engine.embedding_type, is_multimodal)
+  if cache_key not in embeddings_cache:
+    embeddings_cache[cache_key] = asyncio.ensure_future(
+        _generate_query_embeddings(q_engine, query_prompt, is_multimodal))
+  # shield the shared task so a caller timing out does not cancel it
+  # for the other callers
+  return await asyncio.shield(embeddings_cache[cache_key])
+
+async def _generate_query_embeddings(q_engine: QueryEngine,
+                                     query_prompt: str,
+                                     is_multimodal: bool):
   if is_multimodal:
     # TODO: Once multimodal embedding model can operate in batch mode
     # and get_multimodal_embeddings is edited to send multiple chunks to
@@ -458,64 +639,376 @@ async def query_search(q_engine: QueryEngine,
     # instead of a single text string.  Then we
     # extract a single embedding vector from the output instead
     # of a LIST of embedding vectors.
-    _, query_embeddings = \
+    query_embedding = await query_embedding_cache.get(
+        q_engine.embedding_type, query_prompt)
+    if query_embedding is not None:
+      return [query_embedding], query_embedding
+
+    is_successful, query_embeddings = \
         await embeddings.get_embeddings([query_prompt],
                                         q_engine.embedding_type)
     query_embedding = query_embeddings[0]
+    if is_successful and is_successful[0]:
+      await query_embedding_cache.set(q_engine.embedding_type, query_prompt,
+                                      query_embedding)
+  return query_embeddings, query_embedding
+
+async def query_search(q_engine: QueryEngine,
+                       query_prompt: str,
+                       rank_sentences: bool = False,
+                       query_filter: dict = None,
+                       embeddings_cache: Optional[dict] = None,
+                       save_references: bool = True) -> \
+                        List[QueryReference]:
+  """
+  For a query prompt, retrieve text chunks with doc references
+  from matching documents.
+
+  Args:
+    q_engine: QueryEngine to search
+    query_prompt (str):  user query
+    rank_sentences: rank sentence relevance in retrieved chunks
+    query_filter: (optional): dict of key value pairs for filtering results
+    embeddings_cache: (optional): dict used to share prompt embeddings
+    save_references: save the QueryReference models
+
+  Returns:
+    list of QueryReference models
+
+  """
+  is_multimodal = is_multimodal_engine(q_engine)
+
+  Logger.info(f"Retrieving doc references for q_engine=[{q_engine.name}], "
+              f"query_prompt=[{query_prompt}]")
+
+  # for hybrid search start the lexical search, which runs concurrently
+  # with embedding the prompt and the vector search
+  lexical_search = None
+  if not is_multimodal and is_hybrid_search_enabled(q_engine) \
+      and has_lexical_index(q_engine):
+    lexical_search = asyncio.create_task(asyncio.to_thread(
+        search_lexical_matches, q_engine, query_prompt, query_filter))
+
+  # generate embeddings for prompt
+  _, query_embedding = \
+      await get_query_embeddings(q_engine, query_prompt, is_multimodal,
+                                 embeddings_cache)
+
+  # retrieve indexes of relevant document chunks from vector store.
+  # the search is a blocking call so run it in a thread, allowing
+  # searches on multiple engines to proceed concurrently.
+  qe_vector_store = vector_store_from_query_engine(q_engine)
+  match_indexes_list = await asyncio.to_thread(
+      qe_vector_store.similarity_search,
+      q_engine, query_embedding, query_filter)
+
+  if lexical_search is not None:
+    try:
+      lexical_indexes_list = await lexical_search
+      match_indexes_list = reciprocal_rank_fusion(
+          [match_indexes_list, lexical_indexes_list],
+          limit=max(len(match_indexes_list), NUM_MATCH_RESULTS))
+    except Exception as e:
+      Logger.error(f"Lexical search failed for q_engine=[{q_engine.name}], "
+                   f"using vector matches: {e}")
+
+  query_references = await hydrate_query_references(q_engine,
+                                                    match_indexes_list,
+                                                    query_embedding,
+                                                    rank_sentences,
+                                                    save_references)
+
+  Logger.info(f"Retrieved {len(query_references)} "
+               f"references={query_references}")
+
+  return query_references
+
+
+async def get_query_embeddings_many(q_engine: QueryEngine,
+                                    query_prompts: List[str],
+                                    is_multimodal: bool) -> \
+                                      List[List[float]]:
+  """
+  Generate embeddings for multiple query prompts.  For text engines the
+  prompts not already in the query embedding cache are embedded in a
+  single batched request.
+
+  Returns:
+    list of embedding vectors, one per prompt
+  """
+  if is_multimodal:
+    results = await asyncio.gather(*[
+        get_query_embeddings(q_engine, query_prompt, is_multimodal)
+        for query_prompt in query_prompts])
+    return [query_embedding for _, query_embedding in results]
+
+  query_embeddings = [
+    await query_embedding_cache.get(q_engine.embedding_type, query_prompt)
+    for query_prompt in query_prompts
+  ]
+  missing = [i for i, query_embedding in enumerate(query_embeddings)
+             if query_embedding is None]
+  if missing:
+    is_successful, generated = await embeddings.get_embeddings(
+        [query_prompts[i] for i in missing], q_engine.embedding_type)
+    generated = iter(generated)
+    for i, success in zip(missing, is_successful):
+      if not success:
+        raise InternalServerError(
+            f"Failed to generate embeddings for query [{query_prompts[i]}]")
+      query_embeddings[i] = next(generated)
+      await query_embedding_cache.set(q_engine.embedding_type,
+                                      query_prompts[i], query_embeddings[i])
+  return query_embeddings
+
+async def query_search_many(q_engine: QueryEngine,
+                            query_prompts: List[str],
+                            rank_sentences: bool = False,
+                            query_filter: dict = None,
+                            save_references: bool = True) -> \
+                              List[List[QueryReference]]:
+  """
+  Retrieve doc references for multiple query prompts on one query engine.
+  The prompts are embedded in one batched request and searched with
+  one vector store request (see VectorStore.similarity_search_many).
+
+  Args:
+    q_engine: QueryEngine to search
+    query_prompts: list of user queries
+    rank_sentences: rank sentence relevance in retrieved chunks
+    query_filter: (optional): dict of key value pairs for filtering results
+    save_references: save the QueryReference models
+
+  Returns:
+    list of QueryReference model lists, one per prompt
+  """
+  if not query_prompts:
+    return []
+  is_multimodal = is_multimodal_engine(q_engine)
+
+  Logger.info(f"Retrieving doc references for q_engine=[{q_engine.name}], "
+              f"{len(query_prompts)} query prompts")
+
+  # for hybrid search start the lexical searches of all prompts, which
+  # run concurrently with each other and with the vector search, as in
+  # query_search
+  lexical_searches = None
+  if not is_multimodal and is_hybrid_search_enabled(q_engine) \
+      and has_lexical_index(q_engine):
+    lexical_searches = asyncio.gather(*[
+      asyncio.to_thread(search_lexical_matches, q_engine, query_prompt,
+                        query_filter)
+      for query_prompt in query_prompts
+    ], return_exceptions=True)
+
+  query_embeddings = await get_query_embeddings_many(q_engine, query_prompts,
+                                                     is_multimodal)
 
-  # retrieve indexes of relevant document chunks from vector store
   qe_vector_store = vector_store_from_query_engine(q_engine)
-  match_indexes_list = qe_vector_store.similarity_search(q_engine,
-                                                         query_embedding,
-                                                         query_filter)
+  match_indexes_lists = await asyncio.to_thread(
+      qe_vector_store.similarity_search_many,
+      q_engine, query_embeddings, query_filter)
+
+  # fuse lexical matches for hybrid search
+  if lexical_searches is not None:
+    lexical_indexes_lists = await lexical_searches
+    for i, lexical_indexes_list in enumerate(lexical_indexes_lists):
+      if isinstance(lexical_indexes_list, BaseException):
+        Logger.error(f"Lexical search failed for q_engine=[{q_engine.name}],"
+                     f" using vector matches: {lexical_indexes_list}")
+        continue
+      match_indexes_lists[i] = reciprocal_rank_fusion(
+          [match_indexes_lists[i], lexical_indexes_list],
+          limit=max(len(match_indexes_lists[i]), NUM_MATCH_RESULTS))
+
+  return list(await asyncio.gather(*[
+    hydrate_query_references(q_engine, match_indexes_list, query_embedding,
+                             rank_sentences, save_references)
+    for match_indexes_list, query_embedding in zip(match_indexes_lists,
+                                                   query_embeddings)
+  ]))
+
+
+def search_lexical_matches(q_engine: QueryEngine,
+                           query_prompt: str,
+                           query_filter: Optional[Union[str, dict]] = None) \
+                           -> List[int]:
+  """
+  Search the lexical index of a query engine for hybrid search.  Lexical
+  matches are filtered with the query filter of the vector search (see
+  filter_lexical_matches).  Reads from GCS and Firestore, so call this in
+  a thread.
 
+  Returns:
+    list of matching chunk indexes, best first
+  """
+  match_indexes_list = search_lexical_index(q_engine, query_prompt,
+                                            NUM_MATCH_RESULTS)
+  if query_filter and match_indexes_list:
+    match_indexes_list = filter_lexical_matches(q_engine, match_indexes_list,
+                                                query_filter)
+  return match_indexes_list
+
+
+def filter_lexical_matches(q_engine: QueryEngine,
+                           match_indexes_list: List[int],
+                           query_filter: Union[str, dict]) -> List[int]:
+  """
+  Keep the lexical matches whose metadata matches a query filter.  The
+  lexical index holds only chunk text, so the filter is evaluated on the
+  metadata of the chunk's QueryDocument, which is the metadata indexed
+  with the chunk embeddings.  Filters are parsed by the engine's vector
+  store and evaluated as by LocalVectorStore.
+
+  Returns:
+    list of matching chunk indexes, in the order of match_indexes_list
+  """
+  if isinstance(query_filter, str):
+    query_filter = \
+        vector_store_from_query_engine(q_engine).parse_filter(query_filter)
+  if isinstance(query_filter, dict):
+    def is_match(metadata):
+      return LocalVectorStore.match_dict_filter(query_filter, metadata)
+  else:
+    def is_match(metadata):
+      return LocalVectorStore.match_filter(query_filter, metadata)
+
+  doc_chunks = QueryDocumentChunk.find_by_indexes(q_engine.id,
+                                                  match_indexes_list)
+  query_docs = {
+    query_doc.id: query_doc for query_doc in QueryDocument.find_by_ids(
+        [chunk.query_document_id for chunk in doc_chunks])
+  }
+  matching_indexes = set()
+  for chunk in doc_chunks:
+    query_doc = query_docs.get(chunk.query_document_id)
+    if query_doc is not None and is_match(query_doc.metadata):
+      matching_indexes.add(int(chunk.index))
+  return [index for index in match_indexes_list if index in matching_indexes]
+
+
+async def hydrate_query_references(q_engine: QueryEngine,
+                                   match_indexes_list: List[int],
+                                   query_embedding: List[float],
+                                   rank_sentences: bool = False,
+                                   save_references: bool = True) -> \
+                                    List[QueryReference]:
+  """
+  Build and save QueryReference models for a list of vector store match
+  indexes.  Matched chunks, their parent documents and any linked chunks
+  (other modalities of the same chunk) are each fetched with a bulk query,
+  and the resulting references are written in Firestore batches, so the
+  number of Firestore round trips does not grow with the number of matches.
+
+  Args:
+    q_engine: QueryEngine that was searched
+    match_indexes_list: list of chunk indexes returned by the vector store
+    query_embedding: The embedding vector for the query prompt
+    rank_sentences: rank sentence relevance in retrieved chunks
+    save_references: save the references.  Batch queries over files
+      write references to their output instead.
+
+  Returns:
+    list of QueryReference models, in match order.  Matches whose chunk
+    or document is missing are skipped.
+  """
+  # Firestore reads and writes run in threads, so concurrent retrievals
+  # (e.g. child engines of an integrated search) are not blocked
+  doc_chunks, query_doc_lookup, linked_chunk_lookup = \
+      await asyncio.to_thread(fetch_reference_chunks, q_engine,
+                              match_indexes_list)
+  doc_chunk_lookup = {int(chunk.index): chunk for chunk in doc_chunks}
+
+  # rank sentences of all retrieved chunks in a single batch
+  ranked_texts = {}
+  if rank_sentences:
+    ranked_chunks = doc_chunks + list(linked_chunk_lookup.values())
+    ranked_texts = await rank_chunk_sentences(q_engine, query_embedding,
+                                              ranked_chunks,
+                                              expand_neighbors=2,
+                                              highlight_top_sentence=True)
+
+  # matches without a chunk or document are skipped, e.g. during a
+  # refresh, when new embeddings can be searched before their chunks
+  # are written
   query_references = []
-  # Assemble document chunk models from vector store indexes
   for match in match_indexes_list:
-    doc_chunk = QueryDocumentChunk.find_by_index(q_engine.id, match)
+    doc_chunk = doc_chunk_lookup.get(match)
     if doc_chunk is None:
-      raise ResourceNotFoundException(
-        f"Missing doc chunk match index {match} q_engine {q_engine.name}")
-
-    query_doc = QueryDocument.find_by_id(doc_chunk.query_document_id)
+      Logger.warning(f"Skipping missing doc chunk match index {match} "
+                     f"q_engine {q_engine.name}")
+      continue
+    query_doc = query_doc_lookup.get(doc_chunk.query_document_id)
     if query_doc is None:
-      raise ResourceNotFoundException(
-        f"Query doc {doc_chunk.query_document_id} q_engine {q_engine.name}")
-
-    query_reference = make_query_reference(q_engine=q_engine,
-                                           query_doc=query_doc,
-                                           doc_chunk=doc_chunk,
-                                           query_embeddings=query_embeddings,
-                                           rank_sentences=rank_sentences)
-    query_reference.save()
+      Logger.warning(f"Skipping missing query doc "
+                     f"{doc_chunk.query_document_id} "
+                     f"q_engine {q_engine.name}")
+      continue
+
+    query_reference = make_query_reference(
+      q_engine=q_engine,
+      query_doc=query_doc,
+      doc_chunk=doc_chunk,
+      ranked_text=ranked_texts.get(doc_chunk.id))
     query_references.append(query_reference)
 
     # Also create a query_reference for other modalities of the same chunk
-    linked_ids = query_reference.linked_ids
-    if linked_ids:
-      for linked_id in linked_ids:
-        query_doc_chunk_friend = QueryDocumentChunk.find_by_id(linked_id)
-        query_reference_friend = make_query_reference(
-          q_engine=q_engine,
-          query_doc=query_doc,
-          doc_chunk=query_doc_chunk_friend,
-          query_embeddings=query_embeddings,
-          rank_sentences=rank_sentences)
-        query_reference_friend.save()
-        query_references.append(query_reference_friend)
+    for linked_id in doc_chunk.linked_ids or []:
+      query_doc_chunk_friend = linked_chunk_lookup.get(linked_id)
+      if query_doc_chunk_friend is None:
+        Logger.warning(f"Skipping missing linked doc chunk {linked_id} "
+                       f"q_engine {q_engine.name}")
+        continue
+      query_reference_friend = make_query_reference(
+        q_engine=q_engine,
+        query_doc=query_doc,
+        doc_chunk=query_doc_chunk_friend,
+        ranked_text=ranked_texts.get(query_doc_chunk_friend.id))
+      query_references.append(query_reference_friend)
 
-  Logger.info(f"Retrieved {len(query_references)} "
-               f"references={query_references}")
+  # write all references in Firestore batches
+  if save_references:
+    await asyncio.to_thread(QueryReference.save_all, query_references)
 
   return query_references
 
+def fetch_reference_chunks(q_engine: QueryEngine,
+                           match_indexes_list: List[int]) -> \
+                            Tuple[List[QueryDocumentChunk], dict, dict]:
+  """
+  Fetch the chunks matched by a vector store search, with their parent
+  documents and linked chunks of other modalities.
+
+  Returns:
+    list of matched chunks, dict of QueryDocuments by id, and dict of
+    linked chunks by id.  Match indexes without a chunk are left out.
+  """
+  # fetch all matched chunks
+  doc_chunks = QueryDocumentChunk.find_by_indexes(q_engine.id,
+                                                  match_indexes_list)
+
+  # fetch parent documents and linked chunks of other modalities
+  query_doc_ids = [chunk.query_document_id for chunk in doc_chunks]
+  query_doc_lookup = {
+    query_doc.id: query_doc
+    for query_doc in QueryDocument.find_by_ids(query_doc_ids)
+  }
+  linked_ids = [linked_id for chunk in doc_chunks
+                for linked_id in (chunk.linked_ids or [])]
+  linked_chunk_lookup = {}
+  if linked_ids:
+    linked_chunk_lookup = {
+      chunk.id: chunk
+      for chunk in QueryDocumentChunk.find_by_ids(linked_ids)
+    }
+  return doc_chunks, query_doc_lookup, linked_chunk_lookup
+
 
 # Create a single QueryReference object
 def make_query_reference(q_engine: QueryEngine,
                            query_doc: QueryDocument,
                            doc_chunk: QueryDocumentChunk,
-                           query_embeddings: List[Optional[List[float]]],
-                           rank_sentences: bool = False) -> \
+                           ranked_text: Optional[str] = None) -> \
                             QueryReference:
   """
   Make a single QueryReference object, with appropriate fields
@@ -525,7 +1018,8 @@ def make_query_reference(q_engine: QueryEngine,
     q_engine: The QueryEngine object that was searched
     query_doc: The QueryDocument object retreived from q_engine
     doc_chunk: The QueryDocumentChunk object of the retrieved query_doc
-    query_embeddings: The embedding vector for the query prompt
+    ranked_text: (optional) text of the top ranked sentences of the chunk
+      (see rank_chunk_sentences), used in place of the chunk text
     
   Returns:
     query_reference: The QueryReference object corresponding to doc_chunk
@@ -545,21 +1039,9 @@ def make_query_reference(q_engine: QueryEngine,
     if not clean_text:
       clean_text = text_helper.clean_text(doc_chunk.text)
 
-    # Pick out sentences from document chunk and rank them.
-    if rank_sentences:
-      # Assemble sentences from a document chunk. Currently it gets the
-      # sentences from the top-ranked document chunk.
-      sentences = doc_chunk.sentences
-      if not sentences or len(sentences) == 0:
-        sentences = text_helper.text_to_sentence_list(doc_chunk.text)
-
-      # Only update clean_text when sentences is not empty.
-      Logger.info(f"Processing {len(sentences)} sentences.")
-      if sentences and len(sentences) > 0:
-        top_sentences = get_top_relevant_sentences(
-            q_engine, query_embeddings, sentences,
-            expand_neighbors=2, highlight_top_sentence=True)
-        clean_text = " ".join(top_sentences)
+    # Use the ranked sentences from the document chunk if available.
+    if ranked_text:
+      clean_text = ranked_text
 
   # Clean up image chunk
   elif modality=="image":
@@ -608,9 +1090,9 @@ def make_query_reference(q_engine: QueryEngine,
   return query_reference
 
 
-def rerank_references(prompt: str,
-                      query_references: List[QueryReference]) -> \
-                        List[QueryReference]:
+async def rerank_references(prompt: str,
+                            query_references: List[QueryReference]) -> \
+                              List[QueryReference]:
   """
   Return a list of QueryReferences ranked by relevance to the prompt.
 
@@ -625,42 +1107,137 @@ def rerank_references(prompt: str,
   Logger.info(f"Reranking {len(query_references)} references for "
               f"query_prompt=[{prompt}]")
 
-  # reranker function requires text and ids as separate params
-  query_ref_text = []
-  query_ref_ids = []
-  query_ref_lookup = {}
-
-  for query_ref in query_references:
-    Logger.info(f"Query ref {query_ref.id}, {query_ref.chunk_id}")
-    query_ref_text.append(query_ref.document_text)
-    query_ref_ids.append(query_ref.id)
-    query_ref_lookup[query_ref.id] = query_ref
+  query_ref_text = [query_ref.document_text for query_ref in query_references]
 
-  # rerank, passing in QueryReference ids
-  ranked_results = reranker.rank(
-    query=prompt,
-    docs=query_ref_text,
-    doc_ids=query_ref_ids)
-  ranked_results = ranked_results.top_k(NUM_INTEGRATED_QUERY_REFERENCES)
+  # rerank in the shared reranker service, which returns positions in
+  # query_ref_text ordered by relevance
+  ranked_positions = await reranker_service.rerank(prompt, query_ref_text)
+  ranked_positions = ranked_positions[:NUM_INTEGRATED_QUERY_REFERENCES]
 
   # order the original references based on the rank
-  ranked_query_refs = []
-  ranked_query_ref_ids = [r.doc_id for r in ranked_results]
-  for i in ranked_query_ref_ids:
-    ranked_query_refs.append(query_ref_lookup[i])
+  return [query_references[i] for i in ranked_positions]
 
-  return ranked_query_refs
-
-def get_top_relevant_sentences(q_engine, query_embeddings,
-    sentences, expand_neighbors=2, highlight_top_sentence=False) -> list:
+@functools.lru_cache(maxsize=None)
+def get_query_storage_client() -> storage.Client:
+  """
+  Return the GCS client used at query time, created once per process
+  rather than per query.
+  """
+  return storage.Client(project=PROJECT_ID)
+
+async def rank_chunk_sentences(q_engine: QueryEngine,
+                               query_embedding: List[float],
+                               doc_chunks: List[QueryDocumentChunk],
+                               expand_neighbors: int = 2,
+                               highlight_top_sentence: bool = False) -> \
+                                Dict[str, str]:
+  """
+  Rank the sentences of a set of text chunks by relevance to the query.
 
-  _, sentence_embeddings = embeddings.get_embeddings(sentences,
-                                                     q_engine.embedding_type)
-  similarity_scores = get_similarity(query_embeddings, sentence_embeddings)
-  Logger.info("Similarity scores of query_embeddings and sentence_embeddings: "
-              f"{len(similarity_scores)}")
+  Sentence embeddings stored at build time are used where available
+  (see SentenceEmbeddingStore); the sentences of any remaining chunks are
+  embedded with a single batched embeddings call.  All sentences are scored
+  against the query with a single matrix product.
 
-  top_sentence_index = np.argmax(similarity_scores)
+  Args:
+    q_engine: QueryEngine that was searched
+    query_embedding: The embedding vector for the query prompt
+    doc_chunks: list of QueryDocumentChunk models; non-text chunks
+      are ignored
+    expand_neighbors: number of sentences to keep either side of the
+      top sentence
+    highlight_top_sentence: wrap the top sentence in <b></b> tags
+  Returns:
+    dict of chunk id to text of the top sentence and its neighbors
+  """
+  # assemble sentences for all text chunks, tracking each chunk's
+  # slice of the combined sentence list
+  chunk_sentences = []
+  all_sentences = []
+  for doc_chunk in doc_chunks:
+    if (doc_chunk.modality or "text").casefold() != "text":
+      continue
+    sentences = doc_chunk.sentences
+    if not sentences:
+      sentences = text_helper.text_to_sentence_list(doc_chunk.text)
+    if not sentences:
+      continue
+    start = len(all_sentences)
+    all_sentences.extend(sentences)
+    chunk_sentences.append((doc_chunk.id, list(sentences), start))
+
+  if not all_sentences:
+    return {}
+
+  # use sentence embeddings stored at build time where available
+  stored_embeddings = {}
+  if SentenceEmbeddingStore.is_enabled(q_engine):
+    try:
+      sentence_store = SentenceEmbeddingStore(q_engine,
+                                              get_query_storage_client())
+      stored_embeddings = await sentence_store.load(
+          [chunk_id for chunk_id, _, _ in chunk_sentences])
+    except Exception as e:
+      Logger.error(f"Error loading stored sentence embeddings: {e}")
+    # ignore stored vectors that don't line up with the chunk sentences
+    sentence_counts = {chunk_id: len(sentences)
+                       for chunk_id, sentences, _ in chunk_sentences}
+    stored_embeddings = {
+      chunk_id: vectors for chunk_id, vectors in stored_embeddings.items()
+      if len(vectors) == sentence_counts.get(chunk_id)
+    }
+
+  missing_sentences = [
+    sentence for chunk_id, sentences, _ in chunk_sentences
+    if chunk_id not in stored_embeddings for sentence in sentences
+  ]
+  Logger.info(f"Ranking {len(all_sentences)} sentences "
+              f"from {len(chunk_sentences)} chunks, "
+              f"embedding {len(missing_sentences)}")
+  generated_embeddings = []
+  if missing_sentences:
+    is_successful, generated_embeddings = \
+        await embeddings.get_embeddings(missing_sentences,
+                                        q_engine.embedding_type)
+    if len(generated_embeddings) == 0 or not all(is_successful):
+      Logger.error("Failed to generate sentence embeddings, "
+                   "skipping sentence ranking")
+      return {}
+
+  # assemble embeddings in the order of all_sentences
+  sentence_embeddings = []
+  generated_start = 0
+  for chunk_id, sentences, _ in chunk_sentences:
+    if chunk_id in stored_embeddings:
+      sentence_embeddings.append(stored_embeddings[chunk_id])
+    else:
+      generated_end = generated_start + len(sentences)
+      sentence_embeddings.append(np.asarray(
+          generated_embeddings[generated_start:generated_end],
+          dtype=np.float32))
+      generated_start = generated_end
+  sentence_embeddings = np.concatenate(sentence_embeddings)
+
+  similarity_scores = get_similarity(query_embedding, sentence_embeddings)
+
+  ranked_texts = {}
+  for chunk_id, sentences, start in chunk_sentences:
+    top_sentences = get_top_relevant_sentences(
+        sentences, similarity_scores[start:start + len(sentences)],
+        expand_neighbors=expand_neighbors,
+        highlight_top_sentence=highlight_top_sentence)
+    ranked_texts[chunk_id] = " ".join(top_sentences)
+  return ranked_texts
+
+def get_top_relevant_sentences(sentences: List[str],
+                               similarity_scores: np.ndarray,
+                               expand_neighbors=2,
+                               highlight_top_sentence=False) -> list:
+  """
+  Return the highest scoring sentence along with expand_neighbors sentences
+  either side of it.
+  """
+  top_sentence_index = int(np.argmax(similarity_scores))
   start_index = top_sentence_index - expand_neighbors
   end_index = top_sentence_index + expand_neighbors + 1
 
@@ -673,19 +1250,11 @@ def get_top_relevant_sentences(q_engine, query_embeddings,
 
   return sentences[start_index:end_index]
 
-def get_similarity(query_embeddings, sentence_embeddings) -> list:
-  query_df = pd.DataFrame(query_embeddings.transpose())
-  sentence_df = pd.DataFrame(sentence_embeddings)
-
-  cos_sim = []
-  for _, row in sentence_df.iterrows():
-    x = row
-    y = query_df
-    # calculate the cosine similarity
-    cosine = np.dot(x, y) / (norm(x) * norm(y))
-    cos_sim.append(cosine[0])
-
-  return cos_sim
+def get_similarity(query_embedding, sentence_embeddings) -> np.ndarray:
+  """
+  Cosine similarity of a query embedding against each sentence embedding.
+  """
+  return cosine_similarity(query_embedding, sentence_embeddings)
 
 async def batch_query_generate(request_body: Dict, job: BatchJobModel) -> Dict:
   """
@@ -717,8 +1286,13 @@ async def batch_query_generate(request_body: Dict, job: BatchJobModel) -> Dict:
   Logger.info(f"Starting batch job for query on [{q_engine.name}] "
               f"job id [{job.id}], request_body=[{request_body}]")
 
+  if request_body.get("prompts_uri"):
+    return await batch_query_generate_file(request_body, q_engine, job)
+
   query_result, query_references = await query_generate(
-      user_id, prompt, q_engine, llm_type, user_query, rank_sentences)
+      user_id, prompt, q_engine, llm_type=llm_type, user_query=user_query,
+      rank_sentences=rank_sentences,
+      query_filter=request_body.get("query_filter"))
 
   # update user query
   user_query, query_reference_dicts = \
@@ -743,6 +1317,243 @@ async def batch_query_generate(request_body: Dict, job: BatchJobModel) -> Dict:
 
   return result_data
 
+def read_batch_prompts(storage_client: storage.Client,
+                       prompts_uri: str) -> List[dict]:
+  """
+  Read a JSONL file of prompts from GCS.  Each line is either a JSON
+  object with a "prompt" and optional "id", or a JSON string.
+
+  Returns:
+    list of prompt dicts
+  """
+  blob = storage.Blob.from_string(prompts_uri, client=storage_client)
+  items = []
+  for line_number, line in enumerate(
+      blob.download_as_text().splitlines(), start=1):
+    if not line.strip():
+      continue
+    item = json.loads(line)
+    if isinstance(item, str):
+      item = {"prompt": item}
+    if not isinstance(item, dict) or not item.get("prompt"):
+      raise ValidationError(
+          f"Missing prompt on line {line_number} of {prompts_uri}")
+    items.append(item)
+  return items
+
+def batch_chunks(num_items: int, completed: set, chunk_size: int):
+  """
+  Yield chunks of item positions not in completed.  Each chunk is a
+  contiguous run of positions, at most chunk_size long.
+  """
+  chunk = []
+  for i in range(num_items):
+    if i in completed:
+      if chunk:
+        yield chunk
+        chunk = []
+      continue
+    chunk.append(i)
+    if len(chunk) == chunk_size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+async def _batch_query_chunk(q_engine: QueryEngine,
+                             items: List[dict],
+                             user_id: str,
+                             llm_type: str,
+                             rank_sentences: bool,
+                             query_filter: Optional[dict],
+                             semaphore: asyncio.Semaphore) -> List[dict]:
+  """
+  Retrieve references for and answer a chunk of batch query prompts.
+
+  Returns:
+    list of result dicts, one per item
+  """
+  prompts = [item["prompt"] for item in items]
+
+  async def retrieve(prompt):
+    async with semaphore:
+      return await retrieve_references(prompt, q_engine, user_id,
+                                       rank_sentences, query_filter,
+                                       save_references=False)
+
+  # llm service engines search all prompts of the chunk with batched
+  # embedding and vector store requests.  References are written to the
+  # job output, and not saved as QueryReference models.
+  references_list = None
+  if q_engine.query_engine_type in (QE_TYPE_LLM_SERVICE, None, ""):
+    try:
+      references_list = await query_search_many(q_engine, prompts,
+                                                rank_sentences, query_filter,
+                                                save_references=False)
+    except Exception as e:
+      Logger.error(f"Batched search failed for q_engine=[{q_engine.name}], "
+                   f"retrieving per prompt: {e}")
+  if references_list is None:
+    references_list = await asyncio.gather(
+        *[retrieve(prompt) for prompt in prompts], return_exceptions=True)
+
+  async def answer(item, query_references):
+    result = {"id": item.get("id"), "prompt": item["prompt"]}
+    try:
+      if isinstance(query_references, BaseException):
+        raise query_references
+      async with semaphore:
+        # rerank the references of child engines, as for single queries
+        if q_engine.query_engine_type == QE_TYPE_INTEGRATED_SEARCH and \
+            len(query_references) > 1:
+          query_references = await rerank_references(item["prompt"],
+                                                     query_references)
+        question_prompt, query_references = \
+            await generate_question_prompt(item["prompt"], llm_type,
+                                           query_references)
+        result["response"] = await llm_chat(
+            question_prompt, llm_type,
+            chat_files=get_reference_context_files(query_references))
+      result["query_references"] = [
+        ref.get_fields(reformat_datetime=True) for ref in query_references
+      ]
+    except Exception as e:
+      Logger.error(f"Batch query failed for prompt [{item['prompt']}]: {e}")
+      result["error"] = str(e)
+    return result
+
+  return await asyncio.gather(*[
+    answer(item, query_references)
+    for item, query_references in zip(items, references_list)
+  ])
+
+def write_batch_shard(output_bucket: storage.Bucket, output_prefix: str,
+                      shard_name: str, results: List[Tuple[int, dict]]):
+  """
+  Write (prompt index, result) pairs as a JSONL shard named by the range
+  of prompt indexes.
+  """
+  start, end = results[0][0], results[-1][0] + 1
+  shard_lines = [json.dumps({"index": i, **result}, default=str)
+                 for i, result in results]
+  output_bucket.blob(
+      f"{output_prefix}{shard_name.format(start, end)}"
+  ).upload_from_string("\n".join(shard_lines) + "\n",
+                       content_type="application/jsonl")
+
+async def batch_query_generate_file(request_body: Dict,
+                                    q_engine: QueryEngine,
+                                    job: BatchJobModel) -> Dict:
+  """
+  Run a batch query job over a JSONL file of prompts in GCS (see
+  read_batch_prompts).
+
+  Prompts are processed in chunks of QUERY_BATCH_CHUNK_SIZE.  The prompts
+  of a chunk are searched with batched requests and answered with at most
+  QUERY_BATCH_CONCURRENCY concurrent retrievals and model calls.  The
+  results of each chunk are written to output_uri as JSONL shards named by
+  the range of prompts they hold, which are the checkpoint: a restarted
+  job skips the prompts that already have results.  Failed prompts are
+  written to an errors shard for the chunk, and are retried by a
+  restarted job.  References are written with the results, and are not
+  saved as QueryReference models.  Job progress is saved at most every
+  QUERY_BATCH_PROGRESS_INTERVAL seconds.
+
+  Args:
+    request_body: dict of query params, with prompts_uri, optional
+                  output_uri (defaults to <prompts_uri>_results/) and
+                  optional authz_filter of the user (see
+                  create_authz_filter)
+    q_engine: QueryEngine to query
+    job: BatchJobModel model object
+  Returns:
+    dict containing job meta data
+  """
+  prompts_uri = request_body["prompts_uri"]
+  output_uri = request_body.get("output_uri") or \
+      f"{os.path.splitext(prompts_uri)[0]}_results/"
+  if not output_uri.endswith("/"):
+    output_uri += "/"
+  llm_type = request_body.get("llm_type") or q_engine.llm_type or \
+      DEFAULT_QUERY_CHAT_MODEL
+  rank_sentences = bool(request_body.get("rank_sentences", False))
+  query_filter = request_body.get("query_filter")
+  if isinstance(query_filter, str):
+    query_filter = json.loads(query_filter)
+  # merge the RBAC filter of the user that started the job, as in
+  # query_generate_stream
+  authz_filter = request_body.get("authz_filter")
+  if authz_filter:
+    query_filter = {**(query_filter or {}), **authz_filter}
+
+  storage_client = storage.Client(project=PROJECT_ID)
+  items = read_batch_prompts(storage_client, prompts_uri)
+  output_bucket_name, output_prefix = \
+      output_uri[len("gs://"):].split("/", 1)
+  output_bucket = storage_client.bucket(output_bucket_name)
+
+  # find prompts with results from a previous run of the job.  Prompts
+  # that failed are retried, so their errors shards are removed.
+  completed = set()
+  for blob in storage_client.list_blobs(output_bucket_name,
+                                        prefix=output_prefix):
+    shard_name = blob.name[len(output_prefix):]
+    match = BATCH_RESULTS_SHARD_PATTERN.fullmatch(shard_name)
+    if match:
+      completed.update(range(int(match.group(1)), int(match.group(2))))
+    elif BATCH_ERRORS_SHARD_PATTERN.fullmatch(shard_name):
+      blob.delete()
+
+  result_data = {
+    "query_engine_id": q_engine.id,
+    "prompts_uri": prompts_uri,
+    "output_uri": output_uri,
+    "total": len(items),
+    "completed": len(completed),
+    "failed": 0,
+  }
+  Logger.info(f"Batch query on [{q_engine.name}]: {len(items)} prompts, "
+              f"{len(completed)} already completed, output {output_uri}")
+
+  semaphore = asyncio.Semaphore(QUERY_BATCH_CONCURRENCY)
+  last_progress_time = time.monotonic()
+  for chunk in batch_chunks(len(items), completed, QUERY_BATCH_CHUNK_SIZE):
+    results = await _batch_query_chunk(q_engine,
+                                       [items[i] for i in chunk],
+                                       request_body.get("user_id"),
+                                       llm_type, rank_sentences,
+                                       query_filter, semaphore)
+    # results are written as one shard per run of consecutive successful
+    # prompts, so shard names cover only prompts with results
+    succeeded = [(i, result) for i, result in zip(chunk, results)
+                 if "error" not in result]
+    failed = [(i, result) for i, result in zip(chunk, results)
+              if "error" in result]
+    run = []
+    for i, result in succeeded + [(None, None)]:
+      if run and (i is None or i != run[-1][0] + 1):
+        write_batch_shard(output_bucket, output_prefix,
+                          BATCH_RESULTS_SHARD_NAME, run)
+        run = []
+      if i is not None:
+        run.append((i, result))
+    if failed:
+      write_batch_shard(output_bucket, output_prefix,
+                        BATCH_ERRORS_SHARD_NAME, failed)
+
+    result_data["completed"] += len(succeeded)
+    result_data["failed"] += len(failed)
+    if time.monotonic() - last_progress_time >= QUERY_BATCH_PROGRESS_INTERVAL:
+      Logger.info(f"Batch query progress: {result_data}")
+      job.result_data = result_data
+      job.save(merge=True)
+      last_progress_time = time.monotonic()
+
+  job.result_data = result_data
+  job.save(merge=True)
+  Logger.info(f"Completed batch query on [{q_engine.name}]: {result_data}")
+  return result_data
+
 def update_user_query(prompt: str,
                       response: str,
                       user_id: str,
@@ -804,11 +1615,14 @@ async def batch_build_query_engine(request_body: Dict,
   Logger.info(f"vector store type: [{vector_store_type}]")
   Logger.info(f"params: [{params}]")
 
+  embedding_cache = get_chunk_embedding_cache()
+  embedding_cache_start = embedding_cache.stats()
   q_engine, docs_processed, docs_not_processed = \
       await query_engine_build(doc_url, query_engine, user_id,
                                query_engine_type,
                                llm_type, description,
-                               embedding_type, vector_store_type, params)
+                               embedding_type, vector_store_type, params,
+                               progress_fn=job_progress_fn(job))
 
   # update result data in batch job model
   docs_processed_urls = [doc.doc_url for doc in docs_processed]
@@ -817,6 +1631,9 @@ async def batch_build_query_engine(request_body: Dict,
     "docs_processed": docs_processed_urls,
     "docs_not_processed": docs_not_processed
   }
+  if embedding_cache.enabled:
+    result_data["embedding_cache"] = \
+        embedding_cache.stats_since(embedding_cache_start)
   job.result_data = result_data
   job.save(merge=True)
 
@@ -824,6 +1641,53 @@ async def batch_build_query_engine(request_body: Dict,
 
   return result_data
 
+def job_progress_fn(job: BatchJobModel) -> Callable[[Dict], None]:
+  """
+  Return a function that reports query engine build progress in the
+  result data of a batch job.
+  """
+  def progress_fn(progress: Dict):
+    job.result_data = {"progress": progress}
+    job.save(merge=True)
+  return progress_fn
+
+async def batch_refresh_query_engine(request_body: Dict,
+                                     job: BatchJobModel) -> Dict:
+  """
+  Handle a batch job request for query engine refresh.
+
+  Args:
+    request_body: dict with the query_engine_id of the engine to refresh
+    job: BatchJobModel model object
+  Returns:
+    dict containing job meta data
+  """
+  query_engine_id = request_body.get("query_engine_id")
+  Logger.info(f"Starting batch job for query engine refresh "
+              f"[{query_engine_id}] job id [{job.id}]")
+
+  q_engine = QueryEngine.find_by_id(query_engine_id)
+  if q_engine is None:
+    raise ResourceNotFoundException(f"Query Engine id {query_engine_id}")
+
+  embedding_cache = get_chunk_embedding_cache()
+  embedding_cache_start = embedding_cache.stats()
+  result_data = await query_engine_refresh(
+      q_engine, progress_fn=job_progress_fn(job))
+
+  # update result data in batch job model
+  result_data["query_engine_id"] = q_engine.id
+  if embedding_cache.enabled:
+    result_data["embedding_cache"] = \
+        embedding_cache.stats_since(embedding_cache_start)
+  job.result_data = result_data
+  job.save(merge=True)
+
+  Logger.info(f"Completed batch job query engine refresh for "
+              f"{q_engine.name}")
+
+  return result_data
+
 async def query_engine_build(doc_url: str,
                              query_engine: str,
                              user_id: str,
@@ -832,7 +1696,9 @@ async def query_engine_build(doc_url: str,
                              query_description: Optional[str] = None,
                              embedding_type: Optional[str] = None,
                              vector_store_type: Optional[str] = None,
-                             params: Optional[dict] = None
+                             params: Optional[dict] = None,
+                             progress_fn: Optional[Callable[[Dict], None]]
+                             = None
                              ) -> Tuple[str, List[QueryDocument], List[str]]:
   """
   Build a new query engine.
@@ -847,6 +1713,7 @@ async def query_engine_build(doc_url: str,
     query_description: description of the query engine
     vector_store_type: vector store type (from config.vector_store_config)
     params: query engine build params
+    progress_fn: optional function called with build progress counts
 
   Returns:
     Tuple of QueryEngine id, list of QueryDocument objects of docs processed,
@@ -941,7 +1808,7 @@ async def query_engine_build(doc_url: str,
 
     elif query_engine_type == QE_TYPE_LLM_SERVICE:
       # retrieve vector store class and store type in q_engine
-      qe_vector_store = vector_store_from_query_engine(q_engine)
+      qe_vector_store = vector_store_from_query_engine(q_engine, cached=False)
       q_engine.vector_store = qe_vector_store.vector_store_type
       q_engine.update()
 
@@ -949,7 +1816,8 @@ async def query_engine_build(doc_url: str,
           await build_doc_index(doc_url,
                                 q_engine,
                                 qe_vector_store,
-                                is_multimodal)
+                                is_multimodal,
+                                progress_fn=progress_fn)
 
     elif query_engine_type == QE_TYPE_INTEGRATED_SEARCH:
       # for each associated query engine store the current engine as its parent
@@ -970,7 +1838,8 @@ async def query_engine_build(doc_url: str,
 
 async def build_doc_index(doc_url: str, q_engine: QueryEngine,
                     qe_vector_store: VectorStore,
-                    is_multimodal: Optional[bool]=False) -> \
+                    is_multimodal: Optional[bool]=False,
+                    progress_fn: Optional[Callable[[Dict], None]] = None) -> \
         Tuple[List[QueryDocument], List[str]]:
   """
   Build the document index.
@@ -982,6 +1851,7 @@ async def build_doc_index(doc_url: str, q_engine: QueryEngine,
     q_engine: the query engine name to build the index for
     qe_vector_store: the vector store used for the query engine
     is_multimodal: True if multimodal, False if text-only (default False)
+    progress_fn: optional function called with build progress counts
 
   Returns:
     Tuple of list of QueryDocument objects of docs processed,
@@ -995,7 +1865,8 @@ async def build_doc_index(doc_url: str, q_engine: QueryEngine,
   try:
     # process docs at url and upload embeddings to vector store
     docs_processed, docs_not_processed = await process_documents(
-      doc_url, qe_vector_store, q_engine, storage_client, is_multimodal)
+      doc_url, qe_vector_store, q_engine, storage_client, is_multimodal,
+      progress_fn=progress_fn)
 
     # make sure we actually processed some docs
     if len(docs_processed) == 0:
@@ -1006,6 +1877,11 @@ async def build_doc_index(doc_url: str, q_engine: QueryEngine,
     # db vector stores typically don't require this step.
     qe_vector_store.deploy()
 
+    # cached answers and vector store instances from a previous build
+    # of this engine are stale
+    invalidate_semantic_cache(q_engine)
+    vector_store_registry.invalidate(q_engine.id)
+
     return docs_processed, docs_not_processed
 
   except Exception as e:
@@ -1013,20 +1889,210 @@ async def build_doc_index(doc_url: str, q_engine: QueryEngine,
     Logger.error(traceback.print_exc())
     raise InternalServerError(str(e)) from e
 
+async def query_engine_refresh(q_engine: QueryEngine,
+                               progress_fn: Optional[Callable[[Dict], None]]
+                               = None) -> Dict:
+  """
+  Refresh a query engine from its doc_url: index new docs, re-index
+  changed docs and delete removed docs.
+
+  Docs are matched to stored QueryDocuments by doc id or url, and compared
+  by content hash (see DataSource.iter_documents), so unchanged docs are
+  not chunked or embedded again (or downloaded, for GCS), and keep their
+  chunks and vector store indexes.  New and changed docs are indexed
+  after the highest existing index.  The previous version of a changed doc
+  is replaced once the new version is indexed, and kept if the new version
+  fails to process.  The models of removed and replaced docs are deleted
+  after the refreshed index is deployed, so live queries never match
+  embeddings whose chunks are gone.
+
+  Args:
+    q_engine: the query engine to refresh
+    progress_fn: optional function called with build progress counts
+  Returns:
+    dict with lists of doc urls docs_added, docs_updated, docs_deleted
+      and docs_not_processed, and the number of docs_unchanged
+  Raises:
+    InternalServerError if the engine type or vector store does not
+      support refresh, or the refresh fails
+  """
+  Logger.info(f"Refreshing query engine [{q_engine.name}] from "
+              f"[{q_engine.doc_url}]")
+  if q_engine.query_engine_type in (QE_TYPE_VERTEX_SEARCH,
+                                    QE_TYPE_INTEGRATED_SEARCH):
+    raise InternalServerError(
+        f"Refresh not supported for {q_engine.query_engine_type} engines")
+  vector_store_type = q_engine.vector_store or DEFAULT_VECTOR_STORE
+  if vector_store_type not in REFRESH_VECTOR_STORES:
+    raise InternalServerError(
+        f"Refresh not supported for {vector_store_type} vector stores")
+
+  is_multimodal = is_multimodal_engine(q_engine)
+  storage_client = storage.Client(project=PROJECT_ID)
+  data_source = datasource_from_url(q_engine.doc_url, q_engine, storage_client)
+
+  # stored docs by doc id or url
+  query_docs = {
+    query_doc.index_file or query_doc.doc_url: query_doc
+    for query_doc in QueryDocument.find_by_query_engine_id(q_engine.id,
+                                                           limit=None)
+  }
+  index_base = max((query_doc.index_end or 0
+                    for query_doc in query_docs.values()), default=0)
+
+  source_keys = set()
+  def is_new_or_changed(data_source_file: DataSourceFile) -> bool:
+    key = data_source_file.doc_id or data_source_file.src_url
+    source_keys.add(key)
+    query_doc = query_docs.get(key)
+    return query_doc is None or \
+        query_doc.content_hash != data_source_file.content_hash
+
+  try:
+    with tempfile.TemporaryDirectory() as temp_dir:
+      # download new and changed docs
+      data_source_files = await asyncio.to_thread(
+          lambda: list(data_source.iter_documents(
+              q_engine.doc_url, temp_dir, is_new_or_changed)))
+
+      changed_docs = [
+        query_docs[key] for key in
+        (dsf.doc_id or dsf.src_url for dsf in data_source_files)
+        if key in query_docs
+      ]
+      removed_docs = [query_doc for key, query_doc in query_docs.items()
+                      if key not in source_keys]
+      result = {
+        "docs_added": [dsf.src_url for dsf in data_source_files
+                       if (dsf.doc_id or dsf.src_url) not in query_docs],
+        "docs_updated": [query_doc.doc_url for query_doc in changed_docs],
+        "docs_deleted": [query_doc.doc_url for query_doc in removed_docs],
+        "docs_unchanged": len(source_keys) - len(data_source_files),
+        "docs_not_processed": [],
+      }
+      Logger.info(f"Refresh of [{q_engine.name}]: "
+                  f"{len(result['docs_added'])} new, "
+                  f"{len(changed_docs)} changed, "
+                  f"{len(removed_docs)} removed and "
+                  f"{result['docs_unchanged']} unchanged docs")
+      if not data_source_files and not removed_docs:
+        return result
+
+      # delete the embeddings of removed docs.  Their models are deleted
+      # once the refreshed index is deployed, as live queries can still
+      # match them until then.
+      qe_vector_store = vector_store_from_query_engine(q_engine,
+                                                       cached=False)
+      removed_chunks = QueryDocumentChunk.find_by_query_document_ids(
+          q_engine.id, [query_doc.id for query_doc in removed_docs])
+      qe_vector_store.init_refresh(
+          sorted({int(chunk.index) for chunk in removed_chunks}))
+
+      docs_processed, result["docs_not_processed"] = await process_documents(
+          q_engine.doc_url, qe_vector_store, q_engine, storage_client,
+          is_multimodal, data_source_files=data_source_files,
+          index_base=index_base, build_lexical_index=False,
+          progress_fn=progress_fn)
+
+    # the previous versions of changed docs are deleted once their new
+    # versions are indexed, so they stay searchable during the refresh.
+    # Docs that failed to process keep their previous version.
+    processed_keys = {query_doc.index_file or query_doc.doc_url
+                      for query_doc in docs_processed}
+    replaced_docs = [
+      query_doc for query_doc in changed_docs
+      if (query_doc.index_file or query_doc.doc_url) in processed_keys
+    ]
+    if len(replaced_docs) < len(changed_docs):
+      Logger.warning(f"Keeping the previous version of "
+                     f"{len(changed_docs) - len(replaced_docs)} changed docs "
+                     f"not processed in refresh of [{q_engine.name}]")
+    replaced_chunks = QueryDocumentChunk.find_by_query_document_ids(
+        q_engine.id, [query_doc.id for query_doc in replaced_docs])
+    qe_vector_store.delete_embeddings(
+        sorted({int(chunk.index) for chunk in replaced_chunks}))
+
+    # the lexical index is rebuilt with the chunks of all current docs
+    purged_docs = removed_docs + replaced_docs
+    purged_chunks = removed_chunks + replaced_chunks
+    if not is_multimodal and is_hybrid_search_enabled(q_engine):
+      purged_chunk_ids = {chunk.id for chunk in purged_chunks}
+      lexical_texts = {
+        chunk.index: chunk.clean_text
+        for chunk in QueryDocumentChunk.collection.filter(
+            "query_engine_id", "==", q_engine.id).filter(
+            "deleted_at_timestamp", "==", None).fetch()
+        if chunk.id not in purged_chunk_ids
+      }
+      if lexical_texts:
+        save_lexical_index(q_engine, LexicalIndex.build(lexical_texts),
+                           storage_client)
+
+    qe_vector_store.deploy()
+
+    # the models of removed and replaced docs are deleted once the
+    # refreshed vector store and lexical indexes no longer match them
+    delete_query_documents(q_engine, purged_docs, purged_chunks,
+                           storage_client)
+
+  except Exception as e:
+    Logger.error(f"Error refreshing query engine {q_engine.name}: {e}")
+    Logger.error(traceback.print_exc())
+    raise InternalServerError(str(e)) from e
+
+  # cached answers and vector store instances are stale
+  invalidate_semantic_cache(q_engine)
+  vector_store_registry.invalidate(q_engine.id)
+
+  Logger.info(f"Completed query engine refresh for {q_engine.name}")
+  return result
+
+def delete_query_documents(q_engine: QueryEngine,
+                           query_docs: List[QueryDocument],
+                           query_doc_chunks: List[QueryDocumentChunk],
+                           storage_client):
+  """
+  Delete QueryDocuments and their chunks and stored sentence embeddings,
+  e.g. docs removed or replaced in a refresh.  Their vector store
+  embeddings are deleted separately.
+  """
+  if SentenceEmbeddingStore.is_enabled(q_engine):
+    SentenceEmbeddingStore(q_engine, storage_client).delete_chunks(
+        [chunk.id for chunk in query_doc_chunks])
+  QueryDocumentChunk.delete_by_ids([chunk.id for chunk in query_doc_chunks])
+  QueryDocument.delete_by_ids([query_doc.id for query_doc in query_docs])
+
 async def process_documents(doc_url: str, qe_vector_store: VectorStore,
                       q_engine: QueryEngine, storage_client,
-                      is_multimodal: Optional[bool] = False) -> \
-                      Tuple[List[QueryDocument], List[str]]:
+                      is_multimodal: Optional[bool] = False,
+                      data_source_files: Optional[List[DataSourceFile]] = None,
+                      index_base: int = 0,
+                      build_lexical_index: bool = True,
+                      progress_fn: Optional[Callable[[Dict], None]] = None) \
+                      -> Tuple[List[QueryDocument], List[str]]:
   """
   Process docs in data source and upload embeddings to vector store
-  
+
+  Docs go through a pipeline of stages that overlap across docs:
+  download, chunk (in a thread, or in a pool of QUERY_BUILD_PARSE_WORKERS
+  processes for text docs if set), embed and write to the vector store,
+  and save document and chunk models.  The number of docs in flight in
+  each stage is set by the QUERY_BUILD_* settings.
+
   Args:
     doc_url: URL pointing to folder of documents
     qe_vector_store: the vector store used for the query engine
     q_engine: the query engine name to build the index for
     storage_client: client used for storing the data source
     is_multimodal: True if multimodal, False if text-only (default False)
-  
+    data_source_files: docs already downloaded from doc_url to process,
+      instead of downloading all docs (for a refresh)
+    index_base: first vector store index for the docs
+    build_lexical_index: build the lexical index for hybrid search from the
+      processed docs (a refresh builds it from all docs of the engine)
+    progress_fn: optional function called with a dict of progress counts
+      at most every QUERY_BUILD_PROGRESS_INTERVAL seconds
+
   Returns:
      Tuple of list of QueryDocument objects for docs processed,
         list of doc urls of docs not processed
@@ -1037,156 +2103,262 @@ async def process_documents(doc_url: str, qe_vector_store: VectorStore,
   # initialize metadata
   metadata_manifest = data_source.init_metadata(q_engine)
 
-  docs_processed = []
-  with tempfile.TemporaryDirectory() as temp_dir:
-    data_source_files = data_source.download_documents(doc_url, temp_dir)
-
-    # counter for unique index ids
-    index_base = 0
-
-    for data_source_file in data_source_files:
-      doc_name = data_source_file.doc_name
-      index_doc_url = data_source_file.src_url
-      doc_filepath = data_source_file.local_path
-
-      Logger.info(f"processing [{doc_name}] with {is_multimodal=}")
+  # chunk texts for the lexical index used by hybrid search
+  if is_multimodal or not build_lexical_index or \
+      not is_hybrid_search_enabled(q_engine):
+    lexical_texts = None
+  else:
+    lexical_texts = {}
+
+  # optionally precompute sentence embeddings for rank_sentences
+  sentence_store = None
+  if not is_multimodal and SentenceEmbeddingStore.is_requested(q_engine):
+    sentence_store = SentenceEmbeddingStore(q_engine, storage_client)
+    if not SentenceEmbeddingStore.is_enabled(q_engine):
+      sentence_store.init_store()
+
+  # text docs are chunked in a thread, or in worker processes if
+  # QUERY_BUILD_PARSE_WORKERS is set; multimodal chunking calls GCS and
+  # models so always runs in threads
+  parse_pool = None
+  if not is_multimodal and QUERY_BUILD_PARSE_WORKERS > 0:
+    parse_pool = ProcessPoolExecutor(
+        max_workers=QUERY_BUILD_PARSE_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"))
+
+  # next unused vector store index.  Text docs are allocated their index
+  # range before they are embedded, so they can be indexed concurrently.
+  # Multimodal docs are indexed one at a time, as the number of
+  # embeddings for a doc is only known once it is embedded.
+  next_index = index_base
+
+  async def chunk_doc(data_source_file: DataSourceFile):
+    doc_name = data_source_file.doc_name
+    index_doc_url = data_source_file.src_url
+    doc_filepath = data_source_file.local_path
+
+    Logger.info(f"processing [{doc_name}] with {is_multimodal=}")
 
+    if is_multimodal:
+      doc_chunks = await asyncio.to_thread(
+          data_source.chunk_document_multimodal,
+          doc_name, index_doc_url, doc_filepath)
+    elif parse_pool is not None:
+      doc_chunks, docs_not_processed = \
+          await asyncio.get_running_loop().run_in_executor(
+              parse_pool, chunk_document_in_worker, type(data_source),
+              data_source.params, doc_name, index_doc_url, doc_filepath)
+      data_source.docs_not_processed.extend(docs_not_processed)
+    else:
+      doc_chunks = await asyncio.to_thread(
+          data_source.chunk_document, doc_name, index_doc_url, doc_filepath)
+
+    if doc_chunks is None or len(doc_chunks) == 0:
+      # unable to process this doc; skip
+      Logger.error(f"unable to chunk doc [{index_doc_url}]")
+      return None
+
+    Logger.info(f"doc chunks extracted for [{doc_name}]")
+    return data_source_file, doc_chunks
+
+  async def index_doc(item):
+    nonlocal next_index
+    data_source_file, doc_chunks = item
+    doc_name = data_source_file.doc_name
+    index_doc_url = data_source_file.src_url
+
+    # generate embedding data and store in vector store
+    metadata = metadata_manifest.get(doc_name, None)
+    index_base = next_index
+    try:
       if is_multimodal:
-        doc_chunks = data_source.chunk_document_multimodal(doc_name,
-                                                      index_doc_url,
-                                                      doc_filepath)
+        new_index_base = \
+          await qe_vector_store.index_document_multimodal(doc_name,
+                                                          doc_chunks,
+                                                          index_base)
+        next_index = new_index_base
       else:
-        doc_chunks = data_source.chunk_document(doc_name,
-                                                index_doc_url,
-                                                doc_filepath)
-
-      if doc_chunks is None or len(doc_chunks) == 0:
-        # unable to process this doc; skip
-        Logger.error(f"unable to chunk doc [{index_doc_url}]")
-        continue
-
-      Logger.info(f"doc chunks extracted for [{doc_name}]")
-
-      # generate embedding data and store in vector store
-      try:
-        metadata = metadata_manifest.get(doc_name, None)
+        next_index += len(doc_chunks)
         metadata_list = []
         if metadata is not None:
           metadata_list = [deepcopy(metadata) for chunk in doc_chunks]
-        if is_multimodal:
-          new_index_base = \
-            await qe_vector_store.index_document_multimodal(doc_name,
-                                                       doc_chunks,
-                                                       index_base)
-          Logger.info(
-            f"Successfully indexed {len(doc_chunks)} chunks for [{doc_name}]"
-            )
-        else:
-          new_index_base = \
-            await qe_vector_store.index_document(doc_name,
-                                                 doc_chunks,
-                                                 index_base,
-                                                 metadata_list)
-          Logger.info(
-            f"Successfully indexed {len(doc_chunks)} chunks for [{doc_name}]"
-            )
+        new_index_base = \
+          await qe_vector_store.index_document(doc_name,
+                                               doc_chunks,
+                                               index_base,
+                                               metadata_list)
+      Logger.info(
+        f"Successfully indexed {len(doc_chunks)} chunks for [{doc_name}]")
+    except Exception as e:
+      # unable to process this doc; skip
+      Logger.error(f"error indexing doc [{index_doc_url}]: {str(e)}")
+      data_source.docs_not_processed.append(index_doc_url)
+      return None
+
+    # cleanup temp local file
+    os.remove(data_source_file.local_path)
+
+    return data_source_file, doc_chunks, metadata, index_base, new_index_base
+
+  # chunk models are written in batches across docs
+  chunk_writer = ChunkWriter()
+  num_docs_saved = 0
+  last_progress_time = time.monotonic()
+
+  def report_progress():
+    nonlocal last_progress_time
+    if progress_fn is None or \
+        time.monotonic() - last_progress_time < QUERY_BUILD_PROGRESS_INTERVAL:
+      return
+    progress = {
+      "docs_processed": num_docs_saved,
+      "docs_not_processed": len(data_source.docs_not_processed),
+      "chunks_written": chunk_writer.num_written,
+    }
+    Logger.info(f"Build progress for [{q_engine.name}]: {progress}")
+    progress_fn(progress)
+    last_progress_time = time.monotonic()
+
+  async def save_doc(item):
+    nonlocal num_docs_saved
+    data_source_file, doc_chunks, metadata, index_base, new_index_base = item
+    doc_name = data_source_file.doc_name
+
+    # store QueryDocument and QueryDocumentChunk models
+    query_doc, query_doc_chunks = await asyncio.to_thread(
+        save_query_document, q_engine, data_source, data_source_file,
+        doc_chunks, metadata, index_base, new_index_base, is_multimodal)
+    await chunk_writer.add(query_doc_chunks)
+    num_docs_saved += 1
+    report_progress()
+
+    text_doc_chunks = [] if is_multimodal else query_doc_chunks
+
+    if lexical_texts is not None:
+      for query_doc_chunk in text_doc_chunks:
+        lexical_texts[query_doc_chunk.index] = query_doc_chunk.clean_text
+
+    if sentence_store is not None:
+      try:
+        num_stored = await sentence_store.index_chunks(text_doc_chunks)
+        Logger.info(f"Stored sentence embeddings for {num_stored} chunks "
+                    f"of [{doc_name}]")
       except Exception as e:
-        # unable to process this doc; skip
-        Logger.error(f"error indexing doc [{index_doc_url}]: {str(e)}")
-        data_source.docs_not_processed.append(index_doc_url)
-        continue
+        # non-fatal: rank_sentences falls back to embedding at query time
+        Logger.error(f"error storing sentence embeddings for "
+                     f"[{doc_name}]: {str(e)}")
+    return query_doc
+
+  stages = [
+    PipelineStage("chunk", chunk_doc, QUERY_BUILD_PARSE_WORKERS),
+    PipelineStage("index", index_doc,
+                  1 if is_multimodal else QUERY_BUILD_EMBED_CONCURRENCY),
+    PipelineStage("save", save_doc, QUERY_BUILD_WRITE_CONCURRENCY),
+  ]
+  try:
+    if data_source_files is not None:
+      docs_processed = await run_pipeline(
+          data_source_files, stages, queue_size=QUERY_BUILD_QUEUE_SIZE)
+    else:
+      with tempfile.TemporaryDirectory() as temp_dir:
+        docs_processed = await run_pipeline(
+            data_source.iter_documents(doc_url, temp_dir), stages,
+            queue_size=QUERY_BUILD_QUEUE_SIZE)
+    await chunk_writer.flush()
+  finally:
+    # a failed build is cleaned up once in flight chunk writes complete
+    await chunk_writer.wait()
+    if parse_pool is not None:
+      parse_pool.shutdown(cancel_futures=True)
+  Logger.info(f"Wrote {chunk_writer.num_written} doc chunk models for "
+              f"[{q_engine.name}]")
+
+  # docs complete out of order
+  docs_processed.sort(key=lambda query_doc: query_doc.index_start)
+
+  if lexical_texts:
+    save_lexical_index(q_engine, LexicalIndex.build(lexical_texts),
+                       storage_client)
 
-      # cleanup temp local file
-      os.remove(doc_filepath)
-
-      # store QueryDocument and QueryDocumentChunk models
-      query_doc = QueryDocument(query_engine_id=q_engine.id,
-                                query_engine=q_engine.name,
-                                doc_url=index_doc_url,
-                                index_file=data_source_file.doc_id,
-                                index_start=index_base,
-                                index_end=new_index_base,
-                                metadata=metadata)
-      query_doc.save()
-
-      # Initialize counter of all ORM objects to be made from all chunks
-      j = 0
-      # Iterate over all chunks
-      for i in range(0, len(doc_chunks)):
-
-        if is_multimodal:
-          # Use multimodal pipeline
-
-          # Initialize list of ORM object indexes and ids to be made
-          # from this chunk
-          linked_indexes = []
-          linked_ids = []
-          # Sort keys of ith chunk in alphabetical order
-          # Keys of interest are in MODALITY_SET
-          # These keys hold info related to specific modalities that
-          # need to be stored in ORM objects
-          sorted_keys = sorted(list(doc_chunks[i].keys()))
-
-          # Create a QueryDocumentChunk ORM object for each modality
-          # of ith chunk, in alphabetical order
-          for key in sorted_keys:
-            if key in MODALITY_SET:
-              # doc_chunk is dict representing ith chunk
-              doc_chunk = doc_chunks[i]
-              # Make ORM object for current modality of ith chunk
-              query_doc_chunk = make_query_document_chunk(
-                query_engine_id=q_engine.id,
-                query_document_id=query_doc.id,
-                index=j+index_base,
-                doc_chunk=doc_chunk,
-                page=i,
-                data_source=data_source,
-                modality=key)
-              # Save ORM object in Firestore
-              query_doc_chunk.save()
-              # Build up lists of ORM object indexes and ids made for ith chunk
-              linked_indexes.append(query_doc_chunk.index)
-              linked_ids.append(query_doc_chunk.id)
-              # Increment counter of all ORM objects made for all chunks
-              j+=1
-
-          # Set linked_ids field of all ORM objects just made for ith chunk
-          for index in linked_indexes:
-            query_doc_chunk = \
-              QueryDocumentChunk.find_by_index(q_engine.id, index)
-            friend_ids = [friend_id for friend_id in linked_ids
-                          if friend_id != query_doc_chunk.id]
-            query_doc_chunk.linked_ids = friend_ids
-            query_doc_chunk.save()
-
-        else:
-          # Use text-only pipeline
-
-          # doc_chunk is a dict representing the ith chunk
-          # with key "text"
-          doc_chunk = {}
-          doc_chunk["text"] = doc_chunks[i]
-          # Make ORM object for text modality of ith chunk
-          query_doc_chunk = make_query_document_chunk(
+  return docs_processed, data_source.docs_not_processed
+
+def save_query_document(q_engine: QueryEngine,
+                        data_source: DataSource,
+                        data_source_file: DataSourceFile,
+                        doc_chunks: list,
+                        metadata: Optional[dict],
+                        index_base: int,
+                        new_index_base: int,
+                        is_multimodal: bool) -> \
+                          Tuple[QueryDocument, List[QueryDocumentChunk]]:
+  """
+  Save the QueryDocument for an indexed doc and make its
+  QueryDocumentChunk models.  The chunks are assigned ids, and the chunks
+  of each modality of a multimodal chunk are linked by id, but they are
+  not saved: they are written in batches with a ChunkWriter.
+
+  Returns:
+    the QueryDocument, and the list of QueryDocumentChunks
+  """
+  doc_name = data_source_file.doc_name
+  query_doc = QueryDocument(query_engine_id=q_engine.id,
+                            query_engine=q_engine.name,
+                            doc_url=data_source_file.src_url,
+                            index_file=data_source_file.doc_id,
+                            index_start=index_base,
+                            index_end=new_index_base,
+                            metadata=metadata,
+                            content_hash=data_source_file.content_hash)
+  query_doc.save()
+
+  query_doc_chunks = []
+  if is_multimodal:
+    # Use multimodal pipeline
+    for i, doc_chunk in enumerate(doc_chunks):
+      # Create a QueryDocumentChunk ORM object for each modality of the
+      # ith chunk, in alphabetical order.  Keys of interest are in
+      # MODALITY_SET.  Each object gets the next index.
+      linked_chunks = []
+      for key in sorted(doc_chunk.keys()):
+        if key in MODALITY_SET:
+          linked_chunks.append(make_query_document_chunk(
             query_engine_id=q_engine.id,
             query_document_id=query_doc.id,
-            index=i+index_base,
+            index=index_base + len(query_doc_chunks) + len(linked_chunks),
             doc_chunk=doc_chunk,
-            page=None,
+            page=i,
             data_source=data_source,
-            modality="text")
-          # Save ORM object in Firestore
-          query_doc_chunk.save()
-
-      if is_multimodal:
-        Logger.info(f"{j} doc chunk models created for [{doc_name}]")
-      else:
-        Logger.info(f"{i+1} doc chunk models created for [{doc_name}]")
+            modality=key))
 
-      index_base = new_index_base
-      docs_processed.append(query_doc)
+      # Link the ORM objects made for the ith chunk to each other
+      assign_chunk_ids(linked_chunks)
+      for query_doc_chunk in linked_chunks:
+        query_doc_chunk.linked_ids = [
+          linked_chunk.id for linked_chunk in linked_chunks
+          if linked_chunk.id != query_doc_chunk.id]
+      query_doc_chunks.extend(linked_chunks)
 
-  return docs_processed, data_source.docs_not_processed
+  else:
+    # Use text-only pipeline
+    for i, text_chunk in enumerate(doc_chunks):
+      # doc_chunk is a dict representing the ith chunk
+      # with key "text"
+      doc_chunk = {"text": text_chunk}
+      # Make ORM object for text modality of ith chunk
+      query_doc_chunks.append(make_query_document_chunk(
+        query_engine_id=q_engine.id,
+        query_document_id=query_doc.id,
+        index=i+index_base,
+        doc_chunk=doc_chunk,
+        page=None,
+        data_source=data_source,
+        modality="text"))
+    assign_chunk_ids(query_doc_chunks)
+
+  Logger.info(f"{len(query_doc_chunks)} doc chunk models created for "
+              f"[{doc_name}]")
+
+  return query_doc, query_doc_chunks
 
 # Create a single QueryDocumentChunk object
 def make_query_document_chunk(query_engine_id: str,
@@ -1253,13 +2425,23 @@ def make_query_document_chunk(query_engine_id: str,
   return query_document_chunk
 
 
-def vector_store_from_query_engine(q_engine: QueryEngine) -> VectorStore:
+def vector_store_from_query_engine(q_engine: QueryEngine,
+                                   cached: bool = True) -> VectorStore:
   """
   Retrieve Vector Store object for a Query Engine.
 
   A Query Engine is configured for the vector store it uses when it is
   built.  If there is no configured vector store the default is used.
+
+  By default the instance is shared through the vector store registry,
+  so clients and connections are reused across queries.  Pass
+  cached=False to get a new instance, e.g. for a build.
   """
+  if cached:
+    return vector_store_registry.get(
+        q_engine, lambda q_engine: vector_store_from_query_engine(
+            q_engine, cached=False))
+
   qe_vector_store_type = q_engine.vector_store
   if qe_vector_store_type is None:
     # set to default vector store
@@ -1314,6 +2496,20 @@ def datasource_from_url(doc_url: str,
     raise InternalServerError(
         f"No datasource available for doc url [{doc_url}]")
 
+def reindex_engine(q_engine: QueryEngine):
+  """
+  Rebuild the vector store search index for a query engine, e.g. after
+  documents have been bulk loaded.
+  """
+  Logger.info(f"Reindexing query engine [{q_engine.name}]")
+  if q_engine.query_engine_type in (QE_TYPE_VERTEX_SEARCH,
+                                    QE_TYPE_INTEGRATED_SEARCH):
+    raise InternalServerError(
+        f"Reindex not supported for {q_engine.query_engine_type} engines")
+  qe_vector_store = vector_store_from_query_engine(q_engine, cached=False)
+  qe_vector_store.reindex()
+  vector_store_registry.invalidate(q_engine.id)
+
 def delete_engine(q_engine: QueryEngine, hard_delete: bool=False):
   """
   Delete query engine and associated models and vector store data.
@@ -1321,12 +2517,17 @@ def delete_engine(q_engine: QueryEngine, hard_delete: bool=False):
   Logger.info(f"Deleting query engine [{q_engine.id}]"
               f" hard_delete=[{hard_delete}]")
 
+  # cached answers of the engine, and of a parent integrated search engine,
+  # may reference this engine
+  invalidate_semantic_cache(q_engine)
+
   # delete vector store data
   try:
     if q_engine.query_engine_type == QE_TYPE_VERTEX_SEARCH:
       delete_vertex_search(q_engine)
     else:
-      qe_vector_store = vector_store_from_query_engine(q_engine)
+      vector_store_registry.invalidate(q_engine.id)
+      qe_vector_store = vector_store_from_query_engine(q_engine, cached=False)
       qe_vector_store.delete()
   except Exception:
     # we make this error non-fatal as we want to delete the models
@@ -1334,6 +2535,24 @@ def delete_engine(q_engine: QueryEngine, hard_delete: bool=False):
         f"error deleting vector store for query engine {q_engine.id}")
     Logger.error(traceback.print_exc())
 
+  # delete the lexical index
+  if has_lexical_index(q_engine):
+    try:
+      delete_lexical_index(q_engine)
+    except Exception:
+      Logger.error(
+          f"error deleting lexical index for query engine {q_engine.id}")
+      Logger.error(traceback.print_exc())
+
+  # delete stored sentence embeddings
+  if SentenceEmbeddingStore.is_enabled(q_engine):
+    try:
+      SentenceEmbeddingStore(q_engine).delete()
+    except Exception:
+      Logger.error(
+          f"error deleting sentence embeddings for query engine {q_engine.id}")
+      Logger.error(traceback.print_exc())
+
   if hard_delete is True:
     Logger.info(f"performing hard delete of query engine {q_engine.id}")
 
@@ -17,8 +17,10 @@
 """
 # disabling pylint rules that conflict with pytest fixtures
 # pylint: disable=unused-argument,redefined-outer-name,ungrouped-imports,unused-import
+import json
 from copy import deepcopy
 from pathlib import Path
+import numpy as np
 import pytest
 from typing import List, Optional
 from unittest import mock
@@ -52,11 +54,21 @@ with set_env_var("PG_HOST", ""):
 
 from services.query.query_service import (query_generate,
                                           query_search,
+                                          query_search_many,
+                                          batch_chunks,
+                                          batch_query_generate_file,
+                                          rank_chunk_sentences,
                                           query_engine_build,
                                           process_documents,
+                                          query_engine_refresh,
                                           build_doc_index,
-                                          retrieve_references)
-from services.query.vector_store import VectorStore
+                                          retrieve_references,
+                                          reindex_engine,
+                                          vector_store_from_query_engine)
+from services.query.vector_store import VectorStore, vector_store_registry
+from services.embedding_cache import query_embedding_cache
+from services.query.semantic_cache import (invalidate_semantic_cache,
+                                           semantic_cache_index)
 from services.query.data_source import DataSource, DataSourceFile
 
 Logger = Logger.get_logger(__file__)
@@ -69,6 +81,20 @@ def restore_config():
   get_model_config().copy_model_config(mc)
   Logger.info(f"*** model config: {mc.llm_models}")
 
+@pytest.fixture(autouse=True)
+def clear_embedding_cache():
+  # start each test with an empty, in-process only query embedding cache
+  query_embedding_cache.clear()
+  with mock.patch.object(query_embedding_cache, "use_redis", False):
+    yield
+  query_embedding_cache.clear()
+
+@pytest.fixture(autouse=True)
+def clear_semantic_cache():
+  semantic_cache_index.clear()
+  yield
+  semantic_cache_index.clear()
+
 @pytest.fixture
 def create_query_reference(firestore_emulator, clean_firestore):
   query_reference_dict = QUERY_REFERENCE_EXAMPLE_1
@@ -238,6 +264,55 @@ async def test_query_generate(mock_query_search, mock_llm_chat,
   assert query_references[0] == create_query_reference
   assert query_references[1] == create_query_reference_2
 
+@pytest.mark.asyncio
+@mock.patch("services.query.query_service.get_query_embeddings")
+@mock.patch("services.query.query_service.llm_chat")
+@mock.patch("services.query.query_service.query_search")
+async def test_query_generate_semantic_cache(mock_query_search, mock_llm_chat,
+                        mock_get_query_embeddings,
+                        restore_config, create_engine, create_user,
+                        create_query_reference, create_query_reference_2):
+  create_engine.params = {"semantic_cache": "true"}
+  create_engine.update()
+  prompt = QUERY_EXAMPLE["prompt"]
+  mock_query_search.return_value = [create_query_reference,
+                                    create_query_reference_2]
+  mock_llm_chat.return_value = FAKE_GENERATE_RESPONSE
+  mock_get_query_embeddings.return_value = ([[1.0, 0.0]], [1.0, 0.0])
+  query_result, _ = \
+      await query_generate(create_user.id, prompt, create_engine)
+  assert mock_llm_chat.call_count == 1
+  # the prompt embedding is not stored on the user facing result
+  assert "prompt_embedding" not in query_result.get_fields()
+
+  # a paraphrased prompt is answered from the cache
+  mock_get_query_embeddings.return_value = ([[0.99, 0.05]], [0.99, 0.05])
+  cached_result, cached_references = \
+      await query_generate(create_user.id, "paraphrased prompt", create_engine)
+  assert mock_llm_chat.call_count == 1
+  assert cached_result.id != query_result.id
+  assert cached_result.prompt == "paraphrased prompt"
+  assert cached_result.response == FAKE_GENERATE_RESPONSE
+  assert [ref.id for ref in cached_references] == \
+      [create_query_reference.id, create_query_reference_2.id]
+
+  # a dissimilar prompt is not
+  mock_get_query_embeddings.return_value = ([[0.0, 1.0]], [0.0, 1.0])
+  await query_generate(create_user.id, "other prompt", create_engine)
+  assert mock_llm_chat.call_count == 2
+
+  # other engine updates keep the cache
+  create_engine.update()
+  mock_get_query_embeddings.return_value = ([[1.0, 0.0]], [1.0, 0.0])
+  await query_generate(create_user.id, prompt, create_engine)
+  assert mock_llm_chat.call_count == 2
+
+  # rebuilding the engine invalidates the cache
+  invalidate_semantic_cache(create_engine)
+  mock_get_query_embeddings.return_value = ([[1.0, 0.0]], [1.0, 0.0])
+  await query_generate(create_user.id, prompt, create_engine)
+  assert mock_llm_chat.call_count == 3
+
 @pytest.mark.asyncio
 @mock.patch("services.query.query_service.llm_chat")
 @mock.patch("services.query.query_service.query_search")
@@ -333,6 +408,396 @@ async def test_query_search(mock_get_top_relevant_sentences,
   assert query_references[1].chunk_id == qdoc_chunk2.id
   assert query_references[2].chunk_id == qdoc_chunk3.id
 
+@pytest.mark.asyncio
+@mock.patch("services.query.query_service.search_lexical_index")
+@mock.patch("services.query.query_service.embeddings.get_embeddings")
+@mock.patch("services.query.query_service.vector_store_from_query_engine")
+async def test_query_search_hybrid(mock_get_vector_store, mock_get_embeddings,
+                                   mock_search_lexical_index,
+                                   create_engine, create_query_docs,
+                                   create_query_doc_chunks):
+  create_engine.params = {
+    "hybrid_search": "true",
+    "lexical_index_uri": "gs://fake-bucket/lexical_index.npz"
+  }
+  create_engine.update()
+  mock_get_embeddings.return_value = [True], [[0.1]]
+  fake_vector_store = FakeVectorStore()
+  fake_vector_store.similarity_search = mock.Mock(return_value=[0, 1])
+  mock_get_vector_store.return_value = fake_vector_store
+  mock_search_lexical_index.return_value = [2, 1]
+  prompt = QUERY_EXAMPLE["prompt"]
+
+  # vector and lexical matches are fused by reciprocal rank
+  query_references = await query_search(create_engine, prompt)
+  assert [ref.chunk_id for ref in query_references] == [
+    create_query_doc_chunks[1].id,
+    create_query_doc_chunks[0].id,
+    create_query_doc_chunks[2].id
+  ]
+
+  # lexical matches of filtered queries are filtered on document metadata
+  query_doc1 = create_query_docs[0]
+  query_doc1.metadata = {"authz": ["x"]}
+  query_doc1.update()
+  query_references = await query_search(
+      create_engine, prompt, query_filter={"authz": {"contains": "x"}})
+  assert [ref.chunk_id for ref in query_references] == [
+    create_query_doc_chunks[1].id,
+    create_query_doc_chunks[0].id,
+    create_query_doc_chunks[2].id
+  ]
+  query_references = await query_search(
+      create_engine, prompt, query_filter={"authz": {"contains": "y"}})
+  assert [ref.chunk_id for ref in query_references] == [
+    create_query_doc_chunks[0].id,
+    create_query_doc_chunks[1].id
+  ]
+
+@pytest.mark.asyncio
+@mock.patch("services.query.query_service.embeddings.get_embeddings")
+@mock.patch("services.query.query_service.vector_store_from_query_engine")
+async def test_query_search_many(mock_get_vector_store, mock_get_embeddings,
+                                 create_engine, create_query_docs,
+                                 create_query_doc_chunks):
+  mock_get_embeddings.return_value = [True, True], [[0.1], [0.2]]
+  fake_vector_store = FakeVectorStore()
+  fake_vector_store.similarity_search_many = mock.Mock(
+      return_value=[[0, 1], [2]])
+  mock_get_vector_store.return_value = fake_vector_store
+
+  query_references = await query_search_many(create_engine,
+                                              ["prompt 1", "prompt 2"])
+  # prompts are embedded and searched in single batched requests
+  mock_get_embeddings.assert_called_once()
+  assert mock_get_embeddings.call_args[0][0] == ["prompt 1", "prompt 2"]
+  fake_vector_store.similarity_search_many.assert_called_once_with(
+      create_engine, [[0.1], [0.2]], None)
+  assert [[ref.chunk_id for ref in refs] for refs in query_references] == [
+    [create_query_doc_chunks[0].id, create_query_doc_chunks[1].id],
+    [create_query_doc_chunks[2].id]
+  ]
+
+@pytest.mark.asyncio
+@mock.patch("services.query.query_service.search_lexical_index")
+@mock.patch("services.query.query_service.embeddings.get_embeddings")
+@mock.patch("services.query.query_service.vector_store_from_query_engine")
+async def test_query_search_many_hybrid(mock_get_vector_store,
+                                        mock_get_embeddings,
+                                        mock_search_lexical_index,
+                                        create_engine, create_query_docs,
+                                        create_query_doc_chunks):
+  create_engine.params = {
+    "hybrid_search": "true",
+    "lexical_index_uri": "gs://fake-bucket/lexical_index.npz"
+  }
+  create_engine.update()
+  mock_get_embeddings.return_value = [True, True], [[0.1], [0.2]]
+  fake_vector_store = FakeVectorStore()
+  fake_vector_store.similarity_search_many = mock.Mock(
+      return_value=[[0, 1], [2]])
+  mock_get_vector_store.return_value = fake_vector_store
+  def search_lexical_index(q_engine, query_prompt, num_results):
+    if query_prompt == "prompt 2":
+      raise RuntimeError("lexical index unavailable")
+    return [2, 1]
+  mock_search_lexical_index.side_effect = search_lexical_index
+
+  # each prompt is fused with its own lexical matches, and a failed
+  # lexical search falls back to the vector matches
+  query_references = await query_search_many(create_engine,
+                                              ["prompt 1", "prompt 2"])
+  assert mock_search_lexical_index.call_count == 2
+  assert [[ref.chunk_id for ref in refs] for refs in query_references] == [
+    [create_query_doc_chunks[1].id, create_query_doc_chunks[0].id,
+     create_query_doc_chunks[2].id],
+    [create_query_doc_chunks[2].id]
+  ]
+
+def test_batch_chunks():
+  assert list(batch_chunks(7, set(), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+  assert list(batch_chunks(7, {2, 3}, 2)) == [[0, 1], [4, 5], [6]]
+  assert not list(batch_chunks(2, {0, 1}, 2))
+
+@pytest.mark.asyncio
+@mock.patch("services.query.query_service.llm_chat")
+@mock.patch("services.query.query_service.query_search_many")
+@mock.patch("services.query.query_service.read_batch_prompts")
+@mock.patch("services.query.query_service.storage.Client")
+async def test_batch_query_generate_file(mock_storage_client,
+                                         mock_read_batch_prompts,
+                                         mock_query_search_many,
+                                         mock_llm_chat, create_engine,
+                                         create_query_reference):
+  mock_read_batch_prompts.return_value = [
+    {"id": "q0", "prompt": "prompt 0"},
+    {"id": "q1", "prompt": "prompt 1"},
+    {"id": "q2", "prompt": "prompt 2"},
+    {"id": "q3", "prompt": "prompt 3"},
+  ]
+  # results for the first two prompts were written by a previous run, and
+  # the errors of the failed prompt are retried
+  previous_shard = mock.Mock()
+  previous_shard.name = "eval/results/results-00000000-00000002.jsonl"
+  previous_errors = mock.Mock()
+  previous_errors.name = "eval/results/errors-00000002-00000003.jsonl"
+  storage_client = mock_storage_client.return_value
+  storage_client.list_blobs.return_value = [previous_shard, previous_errors]
+  mock_query_search_many.return_value = [[create_query_reference],
+                                         [create_query_reference]]
+  def llm_chat(prompt, llm_type, chat_files=None):
+    if "prompt 3" in prompt:
+      raise RuntimeError("model unavailable")
+    return FAKE_GENERATE_RESPONSE
+  mock_llm_chat.side_effect = llm_chat
+  job = mock.Mock()
+
+  request_body = {
+    "prompts_uri": "gs://bucket/eval/prompts.jsonl",
+    "output_uri": "gs://bucket/eval/results",
+    "query_filter": '{"category": "faq"}',
+    "authz_filter": {"authz": {"contains": "admin"}},
+  }
+  result_data = await batch_query_generate_file(request_body, create_engine,
+                                                job)
+
+  previous_shard.delete.assert_not_called()
+  previous_errors.delete.assert_called_once()
+  mock_query_search_many.assert_called_once()
+  assert mock_query_search_many.call_args[0][1] == ["prompt 2", "prompt 3"]
+  # the authz filter of the user is merged into the query filter
+  assert mock_query_search_many.call_args[0][3] == {
+    "category": "faq", "authz": {"contains": "admin"}}
+  # references are written with the results, not saved
+  assert mock_query_search_many.call_args[1]["save_references"] is False
+  # the failed prompt is written to an errors shard, which is not part of
+  # the checkpoint
+  output_bucket = storage_client.bucket.return_value
+  assert [call[0][0] for call in output_bucket.blob.call_args_list] == [
+    "eval/results/results-00000002-00000003.jsonl",
+    "eval/results/errors-00000003-00000004.jsonl",
+  ]
+  uploads = output_bucket.blob.return_value.upload_from_string.call_args_list
+  result = json.loads(uploads[0][0][0])
+  assert result["index"] == 2
+  assert result["id"] == "q2"
+  assert result["response"] == FAKE_GENERATE_RESPONSE
+  assert len(result["query_references"]) == 1
+  error = json.loads(uploads[1][0][0])
+  assert error["index"] == 3
+  assert error["error"] == "model unavailable"
+  assert result_data["completed"] == 3
+  assert result_data["failed"] == 1
+  assert job.result_data == result_data
+
+@pytest.mark.asyncio
+@mock.patch("services.query.query_service.llm_chat")
+@mock.patch("services.query.query_service.rerank_references")
+@mock.patch("services.query.query_service.retrieve_references")
+@mock.patch("services.query.query_service.read_batch_prompts")
+@mock.patch("services.query.query_service.storage.Client")
+async def test_batch_query_generate_file_integrated(mock_storage_client,
+                                                    mock_read_batch_prompts,
+                                                    mock_retrieve_references,
+                                                    mock_rerank_references,
+                                                    mock_llm_chat,
+                                                    create_engine,
+                                                    create_query_reference,
+                                                    create_query_reference_2):
+  create_engine.query_engine_type = QE_TYPE_INTEGRATED_SEARCH
+  create_engine.update()
+  mock_read_batch_prompts.return_value = [{"id": "q0", "prompt": "prompt 0"}]
+  storage_client = mock_storage_client.return_value
+  storage_client.list_blobs.return_value = []
+  # child engine references are reranked before the question prompt is
+  # generated, as for single queries
+  mock_retrieve_references.return_value = [create_query_reference,
+                                           create_query_reference_2]
+  mock_rerank_references.return_value = [create_query_reference_2,
+                                         create_query_reference]
+  mock_llm_chat.return_value = FAKE_GENERATE_RESPONSE
+  job = mock.Mock()
+
+  request_body = {
+    "prompts_uri": "gs://bucket/eval/prompts.jsonl",
+    "output_uri": "gs://bucket/eval/results",
+  }
+  result_data = await batch_query_generate_file(request_body, create_engine,
+                                                job)
+
+  mock_rerank_references.assert_called_once_with(
+      "prompt 0", [create_query_reference, create_query_reference_2])
+  output_bucket = storage_client.bucket.return_value
+  shard = output_bucket.blob.return_value.upload_from_string.call_args[0][0]
+  result = json.loads(shard)
+  assert result["response"] == FAKE_GENERATE_RESPONSE
+  assert [ref["id"] for ref in result["query_references"]] == \
+      [create_query_reference_2.id, create_query_reference.id]
+  assert result_data["completed"] == 1
+  assert result_data["failed"] == 0
+
+@pytest.mark.asyncio
+@mock.patch("services.query.query_service.embeddings.get_embeddings")
+@mock.patch("services.query.query_service.vector_store_from_query_engine")
+async def test_query_search_missing_chunk(mock_get_vector_store,
+                                          mock_get_embeddings,
+                                          create_engine, create_query_docs,
+                                          create_query_doc_chunks):
+  mock_get_embeddings.return_value = [True], [[0.1]]
+  fake_vector_store = FakeVectorStore()
+  fake_vector_store.similarity_search = mock.Mock(return_value=[0, 1, 99])
+  mock_get_vector_store.return_value = fake_vector_store
+  prompt = QUERY_EXAMPLE["prompt"]
+  # the match without a chunk is skipped
+  query_references = await query_search(create_engine, prompt)
+  qdoc_chunk1, qdoc_chunk2, _ = create_query_doc_chunks
+  assert [ref.chunk_id for ref in query_references] == [
+      qdoc_chunk1.id, qdoc_chunk2.id]
+  assert len(QueryReference.fetch_all()) == 2
+
+@pytest.mark.asyncio
+@mock.patch("services.query.query_service.embeddings.get_embeddings")
+@mock.patch("services.query.query_service.vector_store_from_query_engine")
+async def test_retrieve_references_integrated_partial(mock_get_vector_store,
+                                                      mock_get_embeddings,
+                                                      create_engine,
+                                                      create_user,
+                                                      create_query_docs,
+                                                      create_query_doc_chunks):
+  # second child engine whose vector store search fails
+  failing_engine_dict = deepcopy(QUERY_ENGINE_EXAMPLE)
+  failing_engine_dict["id"] = "failing-engine-id"
+  failing_engine_dict["name"] = "failing-engine"
+  failing_engine = QueryEngine.from_dict(failing_engine_dict)
+  failing_engine.save()
+
+  failing_vector_store = FakeVectorStore()
+  failing_vector_store.similarity_search = mock.Mock(
+      side_effect=RuntimeError("vector store unavailable"))
+  def get_vector_store(q_engine):
+    if q_engine.id == failing_engine.id:
+      return failing_vector_store
+    return FakeVectorStore()
+  mock_get_vector_store.side_effect = get_vector_store
+  mock_get_embeddings.return_value = [True], [[0.1]]
+
+  build_params = {
+    "associated_engines": f"{create_engine.name},{failing_engine.name}"
+  }
+  q_engine_2, _, _ = \
+      await query_engine_build("", "test integrated search",
+                               create_user.id,
+                               query_engine_type=QE_TYPE_INTEGRATED_SEARCH,
+                               params=build_params)
+  prompt = QUERY_EXAMPLE["prompt"]
+  query_references = \
+      await retrieve_references(prompt, q_engine_2, create_user.id)
+
+  # references from the healthy child are returned
+  assert len(query_references) == len(create_query_doc_chunks)
+  assert {ref.query_engine_id for ref in query_references} == \
+      {create_engine.id}
+  # both children share the same embedding type so the prompt is
+  # embedded only once
+  assert mock_get_embeddings.call_count == 1
+
+@pytest.mark.asyncio
+@mock.patch("services.query.query_service.embeddings.get_embeddings")
+async def test_rank_chunk_sentences(mock_get_embeddings, create_engine):
+  chunk1 = QueryDocumentChunk.from_dict(QUERY_DOCUMENT_CHUNK_EXAMPLE_1)
+  chunk1.sentences = ["first a.", "first b.", "first c."]
+  chunk2 = QueryDocumentChunk.from_dict(QUERY_DOCUMENT_CHUNK_EXAMPLE_2)
+  chunk2.sentences = ["second a.", "second b."]
+  # sentence embeddings for both chunks, in order
+  mock_get_embeddings.return_value = (
+    [True] * 5,
+    np.array([[0.0, 1.0], [1.0, 0.0], [0.0, 1.0], [0.5, 0.5], [1.0, 0.1]])
+  )
+  ranked_texts = await rank_chunk_sentences(create_engine, [1.0, 0.0],
+                                            [chunk1, chunk2],
+                                            expand_neighbors=0,
+                                            highlight_top_sentence=True)
+  # all sentences are embedded in a single call
+  assert mock_get_embeddings.call_count == 1
+  assert len(mock_get_embeddings.call_args[0][0]) == 5
+  assert ranked_texts == {
+    chunk1.id: "<b>first b.</b>",
+    chunk2.id: "<b>second b.</b>"
+  }
+
+@pytest.mark.asyncio
+@mock.patch("services.query.query_service.get_query_storage_client")
+@mock.patch("services.query.query_service.SentenceEmbeddingStore.load")
+@mock.patch("services.query.query_service.embeddings.get_embeddings")
+async def test_rank_chunk_sentences_stored(mock_get_embeddings,
+                                           mock_load_stored,
+                                           mock_storage_client,
+                                           create_engine):
+  create_engine.params = {"sentence_embeddings_bucket": "fake-bucket"}
+  chunk1 = QueryDocumentChunk.from_dict(QUERY_DOCUMENT_CHUNK_EXAMPLE_1)
+  chunk1.sentences = ["first a.", "first b.", "first c."]
+  chunk2 = QueryDocumentChunk.from_dict(QUERY_DOCUMENT_CHUNK_EXAMPLE_2)
+  chunk2.sentences = ["second a.", "second b."]
+  # embeddings for chunk1 were stored at build time
+  mock_load_stored.return_value = {
+    chunk1.id: np.array([[0.0, 1.0], [1.0, 0.0], [0.0, 1.0]],
+                        dtype=np.float32)
+  }
+  mock_get_embeddings.return_value = (
+    [True] * 2, np.array([[0.5, 0.5], [1.0, 0.1]])
+  )
+  ranked_texts = await rank_chunk_sentences(create_engine, [1.0, 0.0],
+                                            [chunk1, chunk2],
+                                            expand_neighbors=0)
+  # only the sentences of chunk2 are embedded
+  assert mock_get_embeddings.call_args[0][0] == chunk2.sentences
+  # the store uses the shared query time storage client
+  mock_storage_client.assert_called_once()
+  assert ranked_texts == {
+    chunk1.id: "first b.",
+    chunk2.id: "second b."
+  }
+
+def test_vector_store_from_query_engine(create_engine):
+  create_engine.vector_store = "fake_vector_store"
+  create_engine.update()
+  with mock.patch.dict("services.query.query_service.VECTOR_STORES",
+                       {"fake_vector_store":
+                        mock.Mock(side_effect=lambda *args: mock.Mock())}):
+    # instances are shared across calls
+    qe_vector_store = vector_store_from_query_engine(create_engine)
+    assert vector_store_from_query_engine(create_engine) is qe_vector_store
+    assert vector_store_from_query_engine(
+        create_engine, cached=False) is not qe_vector_store
+
+    # modifying (rebuilding) the engine replaces the instance
+    create_engine.update()
+    qe_vector_store_2 = vector_store_from_query_engine(create_engine)
+    assert qe_vector_store_2 is not qe_vector_store
+
+    vector_store_registry.invalidate(create_engine.id)
+    assert vector_store_from_query_engine(create_engine) \
+        is not qe_vector_store_2
+
+
+def test_reindex_engine(create_engine):
+  create_engine.vector_store = "fake_vector_store"
+  create_engine.update()
+  instances = []
+  def fake_vector_store(*args):
+    instances.append(mock.Mock())
+    return instances[-1]
+  with mock.patch.dict("services.query.query_service.VECTOR_STORES",
+                       {"fake_vector_store": fake_vector_store}):
+    qe_vector_store = vector_store_from_query_engine(create_engine)
+    reindex_engine(create_engine)
+    assert len(instances) == 2
+    instances[1].reindex.assert_called_once()
+
+    # the shared instance is replaced after a reindex
+    assert vector_store_from_query_engine(create_engine) \
+        is not qe_vector_store
+
 # Test of query_engine_build function, with no optional input argument params
 # Uses same 3 example docs as other tests of this function
 @pytest.mark.asyncio
@@ -544,6 +1009,7 @@ async def test_build_doc_index_textonly(mock_process_documents,
 # is_multimodal (which defaults to False)
 # Uses same 3 example docs as other tests of this function
 @pytest.mark.asyncio
+@mock.patch("services.query.query_service.QUERY_BUILD_PARSE_WORKERS", 0)
 @mock.patch("services.query.query_service.datasource_from_url")
 async def test_process_documents(mock_get_datasource, create_engine):
   mock_get_datasource.return_value = FakeDataSource()
@@ -563,6 +1029,7 @@ async def test_process_documents(mock_get_datasource, create_engine):
 # is_multimodal=True
 # Uses same 3 example docs as other tests of this function
 @pytest.mark.asyncio
+@mock.patch("services.query.query_service.QUERY_BUILD_PARSE_WORKERS", 0)
 @mock.patch("services.query.query_service.datasource_from_url")
 async def test_process_documents_multimodal(mock_get_datasource, create_engine):
   mock_get_datasource.return_value = FakeDataSource()
@@ -583,6 +1050,7 @@ async def test_process_documents_multimodal(mock_get_datasource, create_engine):
 # is_multimodal=False
 # Uses same 3 example docs as other tests of this function
 @pytest.mark.asyncio
+@mock.patch("services.query.query_service.QUERY_BUILD_PARSE_WORKERS", 0)
 @mock.patch("services.query.query_service.datasource_from_url")
 async def test_process_documents_textonly(mock_get_datasource, create_engine):
   mock_get_datasource.return_value = FakeDataSource()
@@ -599,3 +1067,134 @@ async def test_process_documents_textonly(mock_get_datasource, create_engine):
   assert {doc.doc_url for doc in docs_processed} == \
          {DSF1.src_url, DSF2.src_url}
   assert set(docs_not_processed) == {DSF3.src_url}
+
+
+DOC_URL_4 = "abcd.com/pdf4"
+
+class FakeRefreshVectorStore(FakeVectorStore):
+  """ mock vector store class recording refreshed indexes """
+  def __init__(self):
+    self.deleted_indexes = []
+    self.events = []
+    self.failing_docs = set()
+  def init_refresh(self, delete_indexes: List[int]):
+    self.deleted_indexes.extend(delete_indexes)
+  def delete_embeddings(self, delete_indexes: List[int]):
+    self.events.append(("delete", delete_indexes))
+  async def index_document(self,
+                           doc_name: str,
+                           text_chunks: List[str],
+                           index_base: int,
+                           metadata: List[dict] = None) -> \
+                            int:
+    if doc_name in self.failing_docs:
+      raise RuntimeError(f"failed to generate embeddings for {doc_name}")
+    self.events.append(("index", doc_name))
+    return index_base + len(text_chunks)
+
+class FakeRefreshDataSource(FakeDataSource):
+  """ mock data source class with content hashes """
+  def __init__(self, data_source_files: List[DataSourceFile]):
+    super().__init__()
+    self.docs_not_processed = []
+    self.data_source_files = data_source_files
+
+  def download_documents(self, doc_url: str, temp_dir: str) -> \
+        List[DataSourceFile]:
+    for data_source_file in self.data_source_files:
+      Path(data_source_file.local_path).touch()
+    return self.data_source_files
+
+  def chunk_document(self, doc_name: str, doc_url: str,
+                     doc_filepath: str) -> List[str]:
+    return [f"text of {doc_name}"]
+
+def refresh_file(data_source_file: DataSourceFile,
+                 content_hash: str) -> DataSourceFile:
+  data_source_file = deepcopy(data_source_file)
+  data_source_file.content_hash = content_hash
+  return data_source_file
+
+@pytest.mark.asyncio
+@mock.patch("services.query.query_service.QUERY_BUILD_PARSE_WORKERS", 0)
+@mock.patch("services.query.query_service.storage.Client")
+@mock.patch("services.query.query_service.vector_store_from_query_engine")
+@mock.patch("services.query.query_service.datasource_from_url")
+async def test_query_engine_refresh(mock_get_datasource, mock_get_vector_store,
+                                    mock_storage_client, create_engine,
+                                    create_query_docs,
+                                    create_query_doc_chunks):
+  query_doc1, query_doc2, _ = create_query_docs
+  query_doc1.content_hash = "hash1"
+  query_doc1.update()
+  query_doc2.content_hash = "hash2"
+  query_doc2.update()
+  qe_vector_store = FakeRefreshVectorStore()
+  mock_get_vector_store.return_value = qe_vector_store
+
+  # doc 1 changed, doc 2 unchanged and doc 4 new
+  dsf4 = DataSourceFile("pdf4", DOC_URL_4, "/tmp/pdf4",
+                        f"{FAKE_GCS_PATH}/pdf4")
+  mock_get_datasource.return_value = FakeRefreshDataSource([
+    refresh_file(DSF1, "hash1-v2"),
+    refresh_file(DSF2, "hash2"),
+    refresh_file(dsf4, "hash4"),
+  ])
+  result = await query_engine_refresh(create_engine)
+  assert result["docs_added"] == [DOC_URL_4]
+  assert result["docs_updated"] == [DSF1.src_url]
+  assert result["docs_deleted"] == []
+  assert result["docs_unchanged"] == 1
+  assert not qe_vector_store.deleted_indexes
+  # the previous embeddings of doc 1 are deleted after the new ones are
+  # indexed
+  assert sorted(qe_vector_store.events[:2]) == \
+      [("index", DSF1.doc_name), ("index", "pdf4")]
+  assert qe_vector_store.events[2:] == [("delete", [0, 1, 2])]
+
+  # unchanged docs keep their models, and new docs are indexed after the
+  # highest existing index
+  assert QueryDocument.find_by_id(query_doc2.id).index_end == 11
+  assert QueryDocument.find_by_id(query_doc1.id) is None
+  assert not QueryDocumentChunk.find_by_query_document_ids(
+      create_engine.id, [query_doc1.id])
+  new_doc1 = QueryDocument.find_by_url(create_engine.id, DSF1.src_url)
+  new_doc4 = QueryDocument.find_by_url(create_engine.id, DOC_URL_4)
+  assert new_doc1.content_hash == "hash1-v2"
+  assert {new_doc1.index_start, new_doc4.index_start} == {123, 124}
+
+  # doc 2 changed, but fails to index: its previous version is kept
+  qe_vector_store.events = []
+  qe_vector_store.failing_docs = {DSF2.doc_name}
+  mock_get_datasource.return_value = FakeRefreshDataSource([
+    refresh_file(DSF1, "hash1-v2"),
+    refresh_file(DSF2, "hash2-v2"),
+    refresh_file(dsf4, "hash4"),
+  ])
+  result = await query_engine_refresh(create_engine)
+  assert result["docs_updated"] == [DSF2.src_url]
+  assert result["docs_not_processed"] == [DSF2.src_url]
+  assert qe_vector_store.events == [("delete", [])]
+  assert QueryDocument.find_by_url(create_engine.id, DSF2.src_url).id == \
+      query_doc2.id
+  qe_vector_store.failing_docs = set()
+
+  # docs 1 and 4 removed: their models are kept until the refreshed
+  # index is deployed
+  qe_vector_store.deleted_indexes = []
+  def deploy():
+    assert QueryDocument.find_by_url(create_engine.id, DOC_URL_4) is not None
+    assert QueryDocument.find_by_url(create_engine.id, DSF1.src_url) \
+        is not None
+  qe_vector_store.deploy = deploy
+  mock_get_datasource.return_value = FakeRefreshDataSource([
+    refresh_file(DSF2, "hash2"),
+  ])
+  result = await query_engine_refresh(create_engine)
+  assert result["docs_added"] == []
+  assert set(result["docs_deleted"]) == {DSF1.src_url, DOC_URL_4}
+  assert result["docs_unchanged"] == 1
+  assert qe_vector_store.deleted_indexes == [123, 124]
+  assert QueryDocument.find_by_url(create_engine.id, DOC_URL_4) is None
+  assert QueryDocument.find_by_url(create_engine.id, DSF2.src_url).id == \
+      query_doc2.id
@@ -0,0 +1,208 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Reranker service.
+
+The rerank model is loaded on first use, in a dedicated single thread
+executor that also runs all model inference, so neither loading nor
+scoring blocks the event loop.  Rerank requests that arrive while a batch
+is being collected (up to RERANK_MAX_BATCH_SIZE requests or
+RERANK_MAX_WAIT_MS) are scored together; for ColBERT the documents of all
+requests in a batch are encoded in a single forward pass.
+"""
+# pylint: disable=broad-exception-caught,protected-access
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from rerankers import Reranker
+from common.utils.logging_handler import Logger
+from config import (RERANK_MODEL_NAME, RERANK_MODEL_TYPE, RERANK_QUANTIZE,
+                    RERANK_MAX_BATCH_SIZE, RERANK_MAX_WAIT_MS)
+from metrics import RERANK_LATENCY, RERANK_BATCH_SIZE
+
+Logger = Logger.get_logger(__file__)
+
+# a rerank request: query and document texts
+RerankRequest = Tuple[str, List[str]]
+
+
+class RerankerService():
+  """
+  Lazily loaded reranker that batches concurrent requests.
+  """
+
+  def __init__(self,
+               model_name: str = RERANK_MODEL_NAME,
+               model_type: Optional[str] = RERANK_MODEL_TYPE,
+               quantize: bool = RERANK_QUANTIZE,
+               max_batch_size: int = RERANK_MAX_BATCH_SIZE,
+               max_wait_ms: int = RERANK_MAX_WAIT_MS) -> None:
+    self.model_name = model_name
+    self.model_type = model_type
+    self.quantize = quantize
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000
+    self._ranker = None
+    self._load_lock = threading.Lock()
+    self._executor = ThreadPoolExecutor(max_workers=1,
+                                        thread_name_prefix="reranker")
+    self._pending = []
+    self._flush_handle = None
+
+  @property
+  def ranker(self):
+    """ The rerankers model, loaded on first access """
+    if self._ranker is None:
+      with self._load_lock:
+        if self._ranker is None:
+          self._ranker = self._load()
+    return self._ranker
+
+  def _load(self):
+    start = time.monotonic()
+    kwargs = {"verbose": 0}
+    if self.model_type:
+      kwargs["model_type"] = self.model_type
+    ranker = Reranker(self.model_name, **kwargs)
+    if self.quantize:
+      self._quantize(ranker)
+    Logger.info(f"Loaded rerank model [{self.model_name}] in "
+                f"{time.monotonic() - start:.1f}s")
+    return ranker
+
+  def _quantize(self, ranker):
+    """ Apply int8 dynamic quantization to the linear layers of a torch
+    model on CPU """
+    model = getattr(ranker, "model", None)
+    device = str(getattr(ranker, "device", "cpu"))
+    try:
+      import torch  # pylint: disable=import-outside-toplevel
+      if not isinstance(model, torch.nn.Module) or device != "cpu":
+        Logger.warning(f"Not quantizing rerank model [{self.model_name}] "
+                       f"on device [{device}]")
+        return
+      ranker.model = torch.quantization.quantize_dynamic(
+          model, {torch.nn.Linear}, dtype=torch.qint8)
+      Logger.info(f"Quantized rerank model [{self.model_name}] to int8")
+    except Exception as e:
+      Logger.error(f"Error quantizing rerank model [{self.model_name}]: {e}")
+
+  async def rerank(self, query: str, docs: List[str]) -> List[int]:
+    """
+    Rank documents by relevance to a query.
+
+    Args:
+      query: query text
+      docs: list of document texts
+    Returns:
+      list of document positions in docs, most relevant first
+    """
+    if not docs:
+      return []
+    start = time.monotonic()
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    self._pending.append(((query, docs), future))
+    if len(self._pending) >= self.max_batch_size:
+      self._flush()
+    elif self._flush_handle is None:
+      self._flush_handle = loop.call_later(self.max_wait, self._flush)
+    try:
+      return await future
+    finally:
+      RERANK_LATENCY.labels(model=self.model_name).observe(
+          time.monotonic() - start)
+
+  def _flush(self):
+    if self._flush_handle is not None:
+      self._flush_handle.cancel()
+      self._flush_handle = None
+    batch, self._pending = self._pending, []
+    if batch:
+      asyncio.ensure_future(self._run_batch(batch))
+
+  async def _run_batch(self, batch):
+    RERANK_BATCH_SIZE.labels(model=self.model_name).observe(len(batch))
+    requests = [request for request, _ in batch]
+    try:
+      results = await asyncio.get_running_loop().run_in_executor(
+          self._executor, self.rank_batch, requests)
+    except Exception as e:
+      for _, future in batch:
+        if not future.done():
+          future.set_exception(e)
+      return
+    for (_, future), result in zip(batch, results):
+      if not future.done():
+        future.set_result(result)
+
+  def rank_batch(self, requests: List[RerankRequest]) -> List[List[int]]:
+    """
+    Rank a batch of requests with the model (blocking).
+
+    Returns:
+      for each request, the list of document positions ranked best first
+    """
+    ranker = self.ranker
+    if len(requests) > 1 and hasattr(ranker, "_document_encode"):
+      try:
+        return self._colbert_rank_batch(ranker, requests)
+      except Exception as e:
+        Logger.error(f"Batched rerank failed, ranking per request: {e}")
+    return [self._rank(ranker, query, docs) for query, docs in requests]
+
+  @classmethod
+  def _rank(cls, ranker, query: str, docs: List[str]) -> List[int]:
+    ranked_results = ranker.rank(query=query, docs=docs,
+                                 doc_ids=list(range(len(docs))))
+    return [result.doc_id for result in ranked_results.results]
+
+  @classmethod
+  def _colbert_rank_batch(cls, ranker,
+                          requests: List[RerankRequest]) -> List[List[int]]:
+    """
+    Encode the documents of all requests in one pass of a ColBERT model,
+    then score each query against its own documents.  Queries are encoded
+    separately as ColBERT query lengths vary per query.  This uses private
+    internals of the rerankers ColBERT ranker, so the rerankers version is
+    pinned in requirements.txt.
+    """
+    # pylint: disable=import-outside-toplevel
+    import torch
+    from rerankers.models.colbert_ranker import _colbert_score
+
+    all_docs = [doc for _, docs in requests for doc in docs]
+    results = []
+    with torch.inference_mode():
+      doc_encoding = ranker._document_encode(all_docs)
+      doc_embeddings = ranker._to_embs(doc_encoding)
+      start = 0
+      for query, docs in requests:
+        end = start + len(docs)
+        query_encoding = ranker._query_encode([query])
+        query_embeddings = ranker._to_embs(query_encoding)
+        scores = _colbert_score(
+            query_embeddings, doc_embeddings[start:end],
+            query_encoding["attention_mask"],
+            doc_encoding["attention_mask"][start:end]).cpu().tolist()[0]
+        results.append(sorted(range(len(docs)), key=scores.__getitem__,
+                              reverse=True))
+        start = end
+    return results
+
+
+reranker_service = RerankerService()
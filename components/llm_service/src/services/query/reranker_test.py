@@ -0,0 +1,131 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Unit tests for the reranker service
+"""
+import asyncio
+import pytest
+import torch
+from unittest import mock
+from common.utils.config import set_env_var
+
+with set_env_var("PG_HOST", ""):
+  from services.query.reranker import RerankerService
+
+
+class FakeRankedResult():
+  def __init__(self, doc_id):
+    self.doc_id = doc_id
+
+
+class FakeRanker():
+  """ Ranks documents by the number of query words they contain """
+
+  def __init__(self):
+    self.calls = 0
+
+  def rank(self, query, docs, doc_ids):
+    self.calls += 1
+    words = set(query.split())
+    scores = [len(words.intersection(doc.split())) for doc in docs]
+    ranked = sorted(doc_ids, key=lambda i: -scores[i])
+    return mock.Mock(results=[FakeRankedResult(i) for i in ranked])
+
+
+class FakeColbertRanker():
+  """
+  ColBERT ranker with the internals used for batched scoring, and fixed
+  random token embeddings.  rank scores each request on its own, as the
+  rerankers ColBERT ranker does.
+  """
+
+  def __init__(self, dim=8):
+    self.vocab = {"[PAD]": 0}
+    generator = torch.Generator().manual_seed(0)
+    self.embeddings = torch.nn.functional.normalize(
+        torch.randn(64, dim, generator=generator), dim=-1)
+
+  def _encode(self, texts):
+    tokens = [[self.vocab.setdefault(word, len(self.vocab))
+               for word in text.split()] for text in texts]
+    length = max(len(ids) for ids in tokens)
+    return {
+      "input_ids": torch.tensor(
+          [ids + [0] * (length - len(ids)) for ids in tokens]),
+      "attention_mask": torch.tensor(
+          [[1] * len(ids) + [0] * (length - len(ids)) for ids in tokens]),
+    }
+
+  def _query_encode(self, queries):
+    return self._encode(queries)
+
+  def _document_encode(self, docs):
+    return self._encode(docs)
+
+  def _to_embs(self, encoding):
+    return self.embeddings[encoding["input_ids"]]
+
+  def rank(self, query, docs, doc_ids):
+    # pylint: disable=import-outside-toplevel
+    from rerankers.models.colbert_ranker import _colbert_score
+    query_encoding = self._query_encode([query])
+    doc_encoding = self._document_encode(docs)
+    scores = _colbert_score(self._to_embs(query_encoding),
+                            self._to_embs(doc_encoding),
+                            query_encoding["attention_mask"],
+                            doc_encoding["attention_mask"])[0].tolist()
+    ranked = sorted(doc_ids, key=lambda i: -scores[i])
+    return mock.Mock(results=[FakeRankedResult(i) for i in ranked])
+
+
+@pytest.mark.asyncio
+@mock.patch("services.query.reranker.Reranker")
+async def test_rerank_batches_requests(mock_reranker):
+  mock_reranker.return_value = FakeRanker()
+  service = RerankerService(max_batch_size=2, max_wait_ms=1000)
+  assert not mock_reranker.called
+
+  results = await asyncio.gather(
+      service.rerank("red apple", ["blue sky", "red apple", "red car"]),
+      service.rerank("blue car", ["blue car", "red apple", "blue sky"]))
+  assert results == [[1, 2, 0], [0, 2, 1]]
+  mock_reranker.assert_called_once()
+
+  # a single request is flushed after max wait
+  service.max_wait = 0.01
+  assert await service.rerank("sky", ["car", "sky"]) == [1, 0]
+  assert await service.rerank("sky", []) == []
+
+
+@mock.patch("services.query.reranker.Reranker")
+def test_colbert_rank_batch(mock_reranker):
+  ranker = FakeColbertRanker()
+  mock_reranker.return_value = ranker
+  service = RerankerService()
+  # documents of different lengths, padded together in the batch
+  requests = [
+    ("red apple", ["blue sky today", "red apple", "a red car in the rain"]),
+    ("blue car", ["blue car", "red apple pie with cream", "blue sky"]),
+    ("sky", ["car", "sky", "the clear sky at night", "sea"]),
+  ]
+
+  # documents of all requests are encoded in one pass, and each request
+  # is ranked as it is on its own
+  with mock.patch.object(ranker, "_document_encode",
+                         wraps=ranker._document_encode) as mock_encode:
+    results = service.rank_batch(requests)
+  mock_encode.assert_called_once()
+  assert results == [RerankerService._rank(ranker, query, docs)
+                     for query, docs in requests]
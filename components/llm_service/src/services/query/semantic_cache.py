@@ -0,0 +1,267 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Semantic answer cache for query engines.
+
+The prompt embeddings of cacheable query results are kept in a bounded
+in-process index per engine, with a cache key (a hash of llm type, query
+filter and retrieval options).  A query is answered from the cache when a
+previous result for the same engine and cache key has a prompt embedding
+within a cosine similarity threshold of the new prompt.
+
+Cached results expire after a TTL.  Each engine has a cache generation
+param, bumped by builds, refreshes and deletes, and results of an older
+generation are not used.
+"""
+# pylint: disable=broad-exception-caught
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import numpy as np
+from common.models import QueryEngine, QueryResult, QueryReference
+from common.utils.errors import ResourceNotFoundException
+from common.utils.logging_handler import Logger
+from config import (QUERY_SEMANTIC_CACHE,
+                    QUERY_SEMANTIC_CACHE_SIZE,
+                    QUERY_SEMANTIC_CACHE_THRESHOLD,
+                    QUERY_SEMANTIC_CACHE_TTL)
+from metrics import SEMANTIC_CACHE_HIT_COUNT, SEMANTIC_CACHE_MISS_COUNT
+from utils.vector_helper import cosine_similarity
+
+Logger = Logger.get_logger(__file__)
+
+# query engine params to enable the cache and override the threshold
+SEMANTIC_CACHE_PARAM = "semantic_cache"
+SEMANTIC_CACHE_THRESHOLD_PARAM = "semantic_cache_threshold"
+
+# query engine param holding the cache generation
+SEMANTIC_CACHE_GENERATION_PARAM = "semantic_cache_generation"
+
+
+def is_semantic_cache_enabled(q_engine: QueryEngine) -> bool:
+  """
+  The cache is enabled per engine with the "semantic_cache" param,
+  defaulting to the QUERY_SEMANTIC_CACHE setting.
+  """
+  params = q_engine.params or {}
+  value = params.get(SEMANTIC_CACHE_PARAM)
+  if isinstance(value, str):
+    return value.lower() == "true"
+  return QUERY_SEMANTIC_CACHE
+
+
+def semantic_cache_threshold(q_engine: QueryEngine) -> float:
+  params = q_engine.params or {}
+  try:
+    return float(params.get(SEMANTIC_CACHE_THRESHOLD_PARAM,
+                            QUERY_SEMANTIC_CACHE_THRESHOLD))
+  except ValueError:
+    return QUERY_SEMANTIC_CACHE_THRESHOLD
+
+
+def semantic_cache_key(llm_type: str,
+                       query_filter: Optional[dict],
+                       rank_sentences: bool) -> str:
+  """
+  Hash of the query options that must match for a cached result to be used.
+  The query filter includes the authz filter for the user.
+  """
+  key_data = {
+    "llm_type": llm_type,
+    "query_filter": query_filter or {},
+    "rank_sentences": bool(rank_sentences),
+  }
+  return hashlib.sha256(
+      json.dumps(key_data, sort_keys=True, default=str).encode("utf-8")
+  ).hexdigest()
+
+
+def semantic_cache_generation(q_engine: QueryEngine) -> int:
+  params = q_engine.params or {}
+  try:
+    return int(params.get(SEMANTIC_CACHE_GENERATION_PARAM, 0))
+  except ValueError:
+    return 0
+
+
+class SemanticCacheIndex():
+  """
+  Bounded in-process index of the prompt embeddings of cached query
+  results.  Each engine keeps the max_size most recent results of its
+  current cache generation.
+  """
+
+  def __init__(self, max_size: int = QUERY_SEMANTIC_CACHE_SIZE,
+               ttl: int = QUERY_SEMANTIC_CACHE_TTL) -> None:
+    self.max_size = max_size
+    self.ttl = ttl
+    # engine id -> (generation, result id -> (cache key, embedding, expiry))
+    self._engines = {}
+    self._lock = threading.Lock()
+
+  def _entries(self, engine_id: str, generation: int) -> Optional[OrderedDict]:
+    # called with the lock held.  Returns None for an older generation.
+    current_generation, entries = self._engines.get(engine_id, (-1, None))
+    if generation < current_generation:
+      return None
+    if generation > current_generation:
+      entries = OrderedDict()
+      self._engines[engine_id] = (generation, entries)
+    return entries
+
+  def add(self, engine_id: str, generation: int, cache_key: str,
+          result_id: str, embedding: List[float]):
+    """ Add the prompt embedding of a query result """
+    if self.max_size <= 0:
+      return
+    embedding = np.asarray(embedding, dtype=np.float32)
+    with self._lock:
+      entries = self._entries(engine_id, generation)
+      if entries is None:
+        return
+      entries[result_id] = (cache_key, embedding, time.time() + self.ttl)
+      while len(entries) > self.max_size:
+        entries.popitem(last=False)
+
+  def search(self, engine_id: str, generation: int, cache_key: str,
+             embedding: List[float],
+             threshold: float) -> Optional[Tuple[str, float]]:
+    """
+    Find the result with the most similar prompt embedding.
+
+    Returns:
+      tuple of the result id and similarity score, or None if no result is
+      within the threshold
+    """
+    now = time.time()
+    with self._lock:
+      entries = self._entries(engine_id, generation)
+      if not entries:
+        return None
+      for result_id in [result_id for result_id, (_, _, expiry)
+                        in entries.items() if expiry <= now]:
+        del entries[result_id]
+      candidates = [(result_id, candidate_embedding)
+                    for result_id, (key, candidate_embedding, _)
+                    in entries.items() if key == cache_key]
+    if not candidates:
+      return None
+
+    scores = cosine_similarity(
+        embedding, np.stack([candidate for _, candidate in candidates]))
+    best = int(np.argmax(scores))
+    if scores[best] < threshold:
+      return None
+    return candidates[best][0], float(scores[best])
+
+  def discard(self, engine_id: str, result_id: str):
+    with self._lock:
+      _, entries = self._engines.get(engine_id, (-1, {}))
+      entries.pop(result_id, None)
+
+  def clear(self):
+    with self._lock:
+      self._engines.clear()
+
+
+# shared index of cached results
+semantic_cache_index = SemanticCacheIndex()
+
+
+def lookup_semantic_cache(q_engine: QueryEngine,
+                          cache_key: str,
+                          prompt_embedding: List[float]) -> \
+                            Optional[Tuple[QueryResult, List[QueryReference]]]:
+  """
+  Find a cached query result for a prompt embedding.  Reads the cached
+  result and its references from Firestore, so call this in a thread.
+
+  Args:
+    q_engine: QueryEngine being queried
+    cache_key: key from semantic_cache_key
+    prompt_embedding: embedding vector for the prompt
+  Returns:
+    tuple of the cached QueryResult and its QueryReferences, or None
+  """
+  match = semantic_cache_index.search(
+      q_engine.id, semantic_cache_generation(q_engine), cache_key,
+      prompt_embedding, semantic_cache_threshold(q_engine))
+
+  cached = None
+  query_references = None
+  if match is not None:
+    result_id, score = match
+    try:
+      cached = QueryResult.find_by_id(result_id)
+    except ResourceNotFoundException:
+      # the result has been deleted; treat as a miss
+      cached = None
+    if cached is not None:
+      ref_lookup = {
+        ref.id: ref for ref in QueryReference.find_by_ids(cached.query_refs)
+      }
+      query_references = [
+        ref_lookup.get(ref_id) for ref_id in cached.query_refs
+      ]
+      if None in query_references:
+        # references have been deleted; treat as a miss
+        cached = None
+    if cached is None:
+      semantic_cache_index.discard(q_engine.id, result_id)
+    else:
+      Logger.info(f"Semantic cache hit for q_engine [{q_engine.name}] "
+                  f"query_result [{cached.id}] score [{score:.4f}]")
+
+  if cached is None:
+    SEMANTIC_CACHE_MISS_COUNT.labels(engine_name=q_engine.name).inc()
+    return None
+
+  SEMANTIC_CACHE_HIT_COUNT.labels(engine_name=q_engine.name).inc()
+  return cached, query_references
+
+
+def store_semantic_cache(q_engine: QueryEngine,
+                         cache_key: str,
+                         prompt_embedding: List[float],
+                         query_result: QueryResult):
+  """ Add a saved query result to the cache """
+  semantic_cache_index.add(q_engine.id, semantic_cache_generation(q_engine),
+                           cache_key, query_result.id, prompt_embedding)
+
+
+def _bump_generation(q_engine: QueryEngine):
+  params = q_engine.params or {}
+  params[SEMANTIC_CACHE_GENERATION_PARAM] = \
+      str(semantic_cache_generation(q_engine) + 1)
+  q_engine.params = params
+  q_engine.update()
+
+
+def invalidate_semantic_cache(q_engine: QueryEngine):
+  """
+  Invalidate cached results for an engine, and for its parent integrated
+  search engine if it has one, by bumping their cache generation.
+  """
+  Logger.info(f"Invalidating semantic cache for q_engine [{q_engine.name}]")
+  _bump_generation(q_engine)
+  if q_engine.parent_engine_id:
+    try:
+      _bump_generation(QueryEngine.find_by_id(q_engine.parent_engine_id))
+    except Exception as e:
+      Logger.error(f"Error invalidating semantic cache for parent engine "
+                   f"[{q_engine.parent_engine_id}]: {e}")
@@ -0,0 +1,73 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+  Unit tests for the semantic cache index
+"""
+from unittest import mock
+from common.utils.errors import ResourceNotFoundException
+from services.query.semantic_cache import (SemanticCacheIndex,
+                                           semantic_cache_generation,
+                                           semantic_cache_index,
+                                           lookup_semantic_cache)
+
+
+def test_semantic_cache_index():
+  index = SemanticCacheIndex(max_size=2, ttl=60)
+  index.add("engine", 0, "key", "result-1", [1.0, 0.0])
+  index.add("engine", 0, "other-key", "result-2", [1.0, 0.0])
+
+  result_id, score = index.search("engine", 0, "key", [0.99, 0.05], 0.95)
+  assert result_id == "result-1"
+  assert score > 0.95
+  assert index.search("engine", 0, "key", [0.0, 1.0], 0.95) is None
+  assert index.search("other-engine", 0, "key", [1.0, 0.0], 0.95) is None
+
+  # the oldest result is evicted
+  index.add("engine", 0, "key", "result-3", [0.0, 1.0])
+  assert index.search("engine", 0, "key", [1.0, 0.0], 0.95) is None
+  assert index.search("engine", 0, "key", [0.0, 1.0], 0.95)[0] == "result-3"
+
+  # results expire
+  with mock.patch("services.query.semantic_cache.time.time",
+                  return_value=10 ** 12):
+    assert index.search("engine", 0, "key", [0.0, 1.0], 0.95) is None
+
+
+def test_semantic_cache_index_generation():
+  index = SemanticCacheIndex(max_size=10, ttl=60)
+  index.add("engine", 0, "key", "result-1", [1.0, 0.0])
+
+  # a new generation drops the results of older generations
+  assert index.search("engine", 1, "key", [1.0, 0.0], 0.95) is None
+  index.add("engine", 0, "key", "result-2", [1.0, 0.0])
+  assert index.search("engine", 0, "key", [1.0, 0.0], 0.95) is None
+  index.add("engine", 1, "key", "result-3", [1.0, 0.0])
+  assert index.search("engine", 1, "key", [1.0, 0.0], 0.95)[0] == "result-3"
+
+  assert semantic_cache_generation(mock.Mock(params=None)) == 0
+  assert semantic_cache_generation(
+      mock.Mock(params={"semantic_cache_generation": "2"})) == 2
+
+
+@mock.patch("services.query.semantic_cache.QueryResult.find_by_id")
+def test_lookup_semantic_cache_deleted_result(mock_find_by_id):
+  q_engine = mock.Mock(id="deleted-result-engine", params={})
+  q_engine.name = "deleted result engine"
+  semantic_cache_index.add(q_engine.id, 0, "key", "result-1", [1.0, 0.0])
+  mock_find_by_id.side_effect = ResourceNotFoundException("result-1")
+
+  # a cached result that has been deleted is a miss, and is discarded
+  assert lookup_semantic_cache(q_engine, "key", [1.0, 0.0]) is None
+  assert semantic_cache_index.search(q_engine.id, 0, "key", [1.0, 0.0],
+                                     0.95) is None
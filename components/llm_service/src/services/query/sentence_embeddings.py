@@ -0,0 +1,219 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Sentence embedding store for query engines.
+
+When a query engine is built with the "store_sentence_embeddings" param, the
+sentences of each text chunk are embedded once at index time and stored in a
+GCS bucket for the engine, as a float16 numpy array per chunk keyed by chunk
+id.  At query time rank_sentences loads these vectors instead of embedding
+the sentences of every retrieved chunk again.
+"""
+# pylint: disable=broad-exception-caught
+
+import asyncio
+import io
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+import numpy as np
+from google.cloud import storage
+from google.api_core.exceptions import NotFound
+from common.models import QueryEngine, QueryDocumentChunk
+from common.utils.logging_handler import Logger
+from services import embeddings
+from config import PROJECT_ID, REGION
+from utils.gcs_helper import create_bucket
+
+Logger = Logger.get_logger(__file__)
+
+# query engine build param to enable the sentence embedding store
+SENTENCE_EMBEDDINGS_PARAM = "store_sentence_embeddings"
+
+# query engine param holding the bucket for the store (set by the build)
+SENTENCE_EMBEDDINGS_BUCKET_PARAM = "sentence_embeddings_bucket"
+
+# number of parallel GCS uploads/downloads
+MAX_GCS_WORKERS = 16
+
+# max blob deletes per GCS batch request
+DELETE_BATCH_SIZE = 100
+
+
+class SentenceEmbeddingStore():
+  """
+  Stores per-sentence embeddings of query document chunks in GCS.
+  """
+
+  def __init__(self, q_engine: QueryEngine, storage_client=None) -> None:
+    self.q_engine = q_engine
+    self.storage_client = storage_client or storage.Client(project=PROJECT_ID)
+    params = q_engine.params or {}
+    self.bucket_name = params.get(SENTENCE_EMBEDDINGS_BUCKET_PARAM)
+
+  @classmethod
+  def is_enabled(cls, q_engine: QueryEngine) -> bool:
+    """ True if the query engine was built with a sentence embedding store """
+    params = q_engine.params or {}
+    return bool(params.get(SENTENCE_EMBEDDINGS_BUCKET_PARAM))
+
+  @classmethod
+  def is_requested(cls, q_engine: QueryEngine) -> bool:
+    """ True if the query engine build params request the store """
+    params = q_engine.params or {}
+    value = params.get(SENTENCE_EMBEDDINGS_PARAM, "false")
+    return isinstance(value, str) and value.lower() == "true"
+
+  def init_store(self):
+    """
+    Create the bucket for the store and record it in the query engine params.
+    """
+    self.bucket_name = str(uuid.uuid4())
+    create_bucket(self.storage_client, self.bucket_name, location=REGION)
+    params = self.q_engine.params or {}
+    params[SENTENCE_EMBEDDINGS_BUCKET_PARAM] = self.bucket_name
+    self.q_engine.params = params
+    self.q_engine.update()
+    Logger.info(f"Created sentence embedding store {self.bucket_name} "
+                f"for q_engine {self.q_engine.name}")
+
+  @classmethod
+  def blob_name(cls, chunk_id: str) -> str:
+    return f"{chunk_id}.npy"
+
+  @classmethod
+  def encode(cls, sentence_embeddings: np.ndarray) -> bytes:
+    """ Encode a sentence embedding matrix as float16 npy bytes """
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(sentence_embeddings, dtype=np.float16),
+            allow_pickle=False)
+    return buffer.getvalue()
+
+  @classmethod
+  def decode(cls, data: bytes) -> np.ndarray:
+    """ Decode npy bytes to a float32 sentence embedding matrix """
+    return np.load(io.BytesIO(data), allow_pickle=False).astype(np.float32)
+
+  async def index_chunks(self, doc_chunks: List[QueryDocumentChunk]) -> int:
+    """
+    Embed the sentences of a list of text chunks with a single batched
+    embeddings call and upload the vectors for each chunk.
+
+    Args:
+      doc_chunks: list of saved QueryDocumentChunk models
+    Returns:
+      number of chunks stored
+    """
+    chunk_sentences = [
+      (doc_chunk.id, doc_chunk.sentences) for doc_chunk in doc_chunks
+      if doc_chunk.sentences
+    ]
+    all_sentences = [sentence for _, sentences in chunk_sentences
+                     for sentence in sentences]
+    if not all_sentences:
+      return 0
+
+    is_successful, sentence_embeddings = \
+        await embeddings.get_embeddings(all_sentences,
+                                        self.q_engine.embedding_type)
+    if len(sentence_embeddings) == 0 or not all(is_successful):
+      Logger.error(f"Failed to generate sentence embeddings for "
+                   f"{len(chunk_sentences)} chunks, not storing")
+      return 0
+
+    uploads = {}
+    start = 0
+    for chunk_id, sentences in chunk_sentences:
+      end = start + len(sentences)
+      uploads[self.blob_name(chunk_id)] = \
+          self.encode(sentence_embeddings[start:end])
+      start = end
+
+    await asyncio.to_thread(self._upload_blobs, uploads)
+    return len(uploads)
+
+  def _upload_blobs(self, uploads: Dict[str, bytes]):
+    bucket = self.storage_client.bucket(self.bucket_name)
+    def upload(item):
+      blob_name, data = item
+      bucket.blob(blob_name).upload_from_string(
+          data, content_type="application/octet-stream")
+    with ThreadPoolExecutor(max_workers=MAX_GCS_WORKERS) as pool:
+      list(pool.map(upload, uploads.items()))
+
+  async def load(self, chunk_ids: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Load stored sentence embeddings for a list of chunk ids.  Chunks with
+    no stored embeddings are omitted from the result.
+
+    Returns:
+      dict of chunk id to sentence embedding matrix
+    """
+    if not self.bucket_name or not chunk_ids:
+      return {}
+    return await asyncio.to_thread(self._download_blobs, chunk_ids)
+
+  def _download_blobs(self, chunk_ids: List[str]) -> Dict[str, np.ndarray]:
+    bucket = self.storage_client.bucket(self.bucket_name)
+    def download(chunk_id):
+      try:
+        data = bucket.blob(self.blob_name(chunk_id)).download_as_bytes()
+        return chunk_id, self.decode(data)
+      except NotFound:
+        return chunk_id, None
+      except Exception as e:
+        Logger.error(f"Error loading sentence embeddings for {chunk_id}: {e}")
+        return chunk_id, None
+    with ThreadPoolExecutor(
+        max_workers=min(MAX_GCS_WORKERS, len(chunk_ids))) as pool:
+      results = pool.map(download, chunk_ids)
+    return {chunk_id: vectors for chunk_id, vectors in results
+            if vectors is not None}
+
+  def delete_chunks(self, chunk_ids: List[str]):
+    """ Delete stored sentence embeddings for a list of chunk ids """
+    if not self.bucket_name or not chunk_ids:
+      return
+    bucket = self.storage_client.bucket(self.bucket_name)
+    def delete(chunk_id):
+      try:
+        bucket.blob(self.blob_name(chunk_id)).delete()
+      except NotFound:
+        pass
+    with ThreadPoolExecutor(
+        max_workers=min(MAX_GCS_WORKERS, len(chunk_ids))) as pool:
+      list(pool.map(delete, chunk_ids))
+
+  def delete(self):
+    """ Delete the store bucket for this query engine """
+    if not self.bucket_name:
+      return
+    Logger.info(f"Deleting sentence embedding store {self.bucket_name}")
+    bucket = self.storage_client.bucket(self.bucket_name)
+
+    # Bucket.delete(force=True) refuses buckets of over 256 blobs, so the
+    # blobs (one per chunk) are deleted first, in parallel batch requests
+    def delete_blobs(blob_names):
+      try:
+        with self.storage_client.batch():
+          for blob_name in blob_names:
+            bucket.blob(blob_name).delete()
+      except NotFound:
+        pass
+    blobs = self.storage_client.list_blobs(self.bucket_name,
+                                           page_size=DELETE_BATCH_SIZE)
+    with ThreadPoolExecutor(max_workers=MAX_GCS_WORKERS) as pool:
+      list(pool.map(delete_blobs,
+                    ([blob.name for blob in page] for page in blobs.pages)))
+    bucket.delete()
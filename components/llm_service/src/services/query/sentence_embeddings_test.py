@@ -0,0 +1,87 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+  Unit tests for the sentence embedding store
+"""
+import threading
+from contextlib import contextmanager
+from unittest import mock
+from services.query.sentence_embeddings import (
+    SentenceEmbeddingStore, SENTENCE_EMBEDDINGS_BUCKET_PARAM)
+
+
+class FakeBlob():
+  """ A listed GCS blob """
+  def __init__(self, name):
+    self.name = name
+
+
+class FakeBucket():
+  """ A GCS bucket recording blob and bucket deletes """
+  def __init__(self, client):
+    self.client = client
+
+  def blob(self, blob_name):
+    return mock.Mock(
+        delete=lambda: self.client.record(("delete_blob", blob_name)))
+
+  def delete(self):
+    self.client.record(("delete_bucket", None))
+
+
+class FakeStorageClient():
+  """ A GCS client for a bucket of blob_names """
+  def __init__(self, blob_names):
+    self.blob_names = blob_names
+    self.events = []
+    self.num_batches = 0
+    self.lock = threading.Lock()
+
+  def record(self, event):
+    with self.lock:
+      self.events.append(event)
+
+  def bucket(self, bucket_name):
+    assert bucket_name == "fake-bucket"
+    return FakeBucket(self)
+
+  @contextmanager
+  def batch(self):
+    with self.lock:
+      self.num_batches += 1
+    yield
+
+  def list_blobs(self, bucket_name, page_size):
+    assert bucket_name == "fake-bucket"
+    pages = [
+      [FakeBlob(name) for name in self.blob_names[i:i + page_size]]
+      for i in range(0, len(self.blob_names), page_size)
+    ]
+    return mock.Mock(pages=iter(pages))
+
+
+def test_delete():
+  blob_names = [f"chunk-{i}.npy" for i in range(1000)]
+  storage_client = FakeStorageClient(blob_names)
+  q_engine = mock.Mock(params={SENTENCE_EMBEDDINGS_BUCKET_PARAM:
+                               "fake-bucket"})
+  SentenceEmbeddingStore(q_engine, storage_client).delete()
+
+  # all blobs are deleted in batches before the bucket
+  assert storage_client.events[-1] == ("delete_bucket", None)
+  deleted = [name for event, name in storage_client.events[:-1]
+             if event == "delete_blob"]
+  assert sorted(deleted) == sorted(blob_names)
+  assert len(storage_client.events) == len(blob_names) + 1
+  assert storage_client.num_batches == 10
@@ -20,18 +20,23 @@ from abc import ABC, abstractmethod
 from base64 import b64decode
 import json
 import gc
+import math
 import os
 import uuid
 import shutil
 import tempfile
+import threading
 import numpy as np
+import sqlalchemy
+from sqlalchemy.orm import Session
+from pgvector.sqlalchemy import Vector
 from pathlib import Path
 from typing import List, Tuple, Any, Optional, Union
 from google.cloud import aiplatform, storage
 import pyparsing
 from pyparsing import (Word, alphanums, Suppress, ParseResults,
                        delimitedList, Literal, Forward, ZeroOrMore,
-                       oneOf, ParserElement, QuotedString, Regex)
+                       oneOf, ParserElement, QuotedString, Regex, Group)
 from common.models import QueryEngine
 from common.utils.logging_handler import Logger
 from common.utils.http_exceptions import InternalServerError
@@ -39,11 +44,16 @@ from services import embeddings
 from config import PROJECT_ID, REGION, MODALITY_SET
 from config.vector_store_config import (PG_HOST, PG_PORT,
                                         PG_DBNAME, PG_USER, PG_PASSWD,
+                                        PG_POOL_SIZE, PG_MAX_OVERFLOW,
+                                        PG_POOL_PRE_PING, PG_POOL_RECYCLE,
+                                        PG_ANN_INDEX, PG_HNSW_M,
+                                        PG_HNSW_EF_CONSTRUCTION,
                                         DEFAULT_VECTOR_STORE,
                                         VECTOR_STORE_LANGCHAIN_PGVECTOR,
                                         VECTOR_STORE_MATCHING_ENGINE)
 from langchain.schema.vectorstore import VectorStore as LCVectorStore
 from langchain.vectorstores.pgvector import PGVector as LangchainPGVector
+from langchain.vectorstores.pgvector import DistanceStrategy
 from langchain.docstore.document import Document
 from utils.gcs_helper import create_bucket
 
@@ -58,6 +68,33 @@ NUM_MATCH_RESULTS = 5
 # number of text chunks to process into an embeddings file
 MAX_NUM_TEXT_CHUNK_PROCESS = 1000
 
+# number of embeddings to delete per statement on a refresh
+PG_DELETE_BATCH_SIZE = 1000
+
+# pgvector ANN index types
+PG_ANN_INDEX_HNSW = "hnsw"
+PG_ANN_INDEX_IVFFLAT = "ivfflat"
+PG_ANN_INDEX_NONE = "none"
+
+# query engine params for pgvector ANN indexes.  ann_index, hnsw_m,
+# hnsw_ef_construction and ivfflat_lists are build params, ef_search and
+# probes are applied per query.  ann_index_name and ann_index_dimensions
+# are set when the index is created.
+ANN_INDEX_PARAM = "ann_index"
+ANN_INDEX_NAME_PARAM = "ann_index_name"
+ANN_INDEX_DIMENSIONS_PARAM = "ann_index_dimensions"
+ANN_SEARCH_PARAMS = {
+  "ef_search": "hnsw.ef_search",
+  "probes": "ivfflat.probes",
+}
+
+# pgvector operator classes and sqlalchemy comparators for distance strategies
+PG_DISTANCE_OPS = {
+  DistanceStrategy.COSINE: ("vector_cosine_ops", "cosine_distance"),
+  DistanceStrategy.EUCLIDEAN: ("vector_l2_ops", "l2_distance"),
+  DistanceStrategy.MAX_INNER_PRODUCT: ("vector_ip_ops", "max_inner_product"),
+}
+
 
 class VectorStore(ABC):
   """
@@ -102,6 +139,37 @@ class VectorStore(ABC):
     """ Delete vector store index for this query engine """
     raise NotImplementedError("Not implemented")
 
+  def reindex(self):
+    """
+    Rebuild search indexes for this query engine, e.g. after a bulk load.
+    Vector stores without separately maintained indexes do nothing.
+    """
+    Logger.info(f"No index maintenance for {self.vector_store_type}")
+
+  def init_refresh(self, delete_indexes: List[int]):
+    """
+    Called before a refresh adds documents to the existing index of this
+    query engine, instead of init_index.  Deletes the embeddings of
+    removed documents.
+
+    Args:
+      delete_indexes: indexes of the embeddings to delete
+    """
+    raise NotImplementedError(
+        f"Refresh not supported for {self.vector_store_type}")
+
+  def delete_embeddings(self, delete_indexes: List[int]):
+    """
+    Delete embeddings by index during a refresh, e.g. the previous
+    embeddings of changed documents once their new embeddings are indexed.
+    Called before deploy.
+
+    Args:
+      delete_indexes: indexes of the embeddings to delete
+    """
+    raise NotImplementedError(
+        f"Refresh not supported for {self.vector_store_type}")
+
   @abstractmethod
   def similarity_search(self, q_engine: QueryEngine,
                         query_embedding: List[float],
@@ -120,13 +188,87 @@ class VectorStore(ABC):
       list of indexes that are matched of length NUM_MATCH_RESULTS
     """
 
+  def similarity_search_many(self, q_engine: QueryEngine,
+                             query_embeddings: List[List[float]],
+                             query_filter: Optional[str] = None) -> \
+                               List[List[int]]:
+    """
+    Retrieve text matches for multiple query embeddings.  Vector stores
+    that support batched queries override this to search in one request.
+
+    Args:
+      q_engine: QueryEngine model
+      query_embeddings: list of embedding arrays, one per query
+      query_filter: (optional) filter expression applied to all queries
+    Returns:
+      list of matched index lists, one per query embedding
+    """
+    return [self.similarity_search(q_engine, query_embedding, query_filter)
+            for query_embedding in query_embeddings]
+
+  async def get_multimodal_chunk_embeddings(self, doc_name: str,
+                                            doc_chunks: List[object]) -> \
+      Tuple[List[str], List[List[float]]]:
+    """
+    Generate embeddings for each modality of multimodal document chunks.
+
+    Args:
+      doc_name (str): name of document to be indexed
+      doc_chunks (List[object]): list of multimodal chunk dicts
+    Returns:
+      tuple of chunk text and embedding lists, one entry per embedding
+    """
+    # Convert multimodal chunks to embeddings
+    # Note that multimodal embedding model can only embed one chunk
+    # at a time. As opposed to the text-only embedding model, which
+    # can embed an array of multiple chunks at the same time.
+    chunk_texts = []
+    chunk_embeddings = []
+
+    # Loop over chunks
+    for doc in doc_chunks:
+      # Raise error is doc object is formatted incorrectly
+      modality_list_sorted = sorted(MODALITY_SET)
+      modality_list_sorted_exist = \
+        [modality in doc.keys() for modality in modality_list_sorted]
+      if not any(modality_list_sorted_exist):
+        raise RuntimeError(
+          f"failed to retrieve any modality for {doc_name}")
+      for modality, exist in \
+        zip(modality_list_sorted, modality_list_sorted_exist):
+        if not exist:
+          doc[modality] = None
+
+      # Get chunk embeddings
+      user_file_bytes = None
+      if doc["image"]:
+        user_file_bytes = b64decode(doc["image"])
+      chunk_embedding = \
+        await embeddings.get_multimodal_embeddings(
+          user_text=doc["text"],
+          user_file_bytes=user_file_bytes,
+          embedding_type=self.embedding_type)
+      # TODO: Also embed doc["video"] (video chunk) and
+      # potentially doc["audio"] (audio chunk)
+
+      # Check to make sure that embeddings for available modalities exist
+      for modality in modality_list_sorted:
+        if modality in chunk_embedding:
+          chunk_texts.append(doc["text"])
+          chunk_embeddings.append(chunk_embedding[modality])
+        else:
+          raise RuntimeError(
+            f"failed to generate {modality} chunk embedding for {doc_name}")
+    return chunk_texts, chunk_embeddings
+
   def parse_filter(self, filter_str: str) -> Union[ParseResults, dict]:
     """
     Parse filter expressions in the Vertex Search format:
       https://cloud.google.com/generative-ai-app-builder/docs/filter-search-metadata#filter-expression-syntax
 
     Returns:
-      A pyparsing ParseResults object
+      A pyparsing ParseResults object.  Parenthesized expressions are
+      nested ParseResults.
     """
     # Enable packrat parsing for better performance
     ParserElement.enable_packrat()
@@ -164,15 +306,15 @@ class VectorStore(ABC):
         + RPAR
     ) | (numerical_field + comparison + double)
 
-    expression = Forward()
-    expression <<= (
+    filter_expr = Forward()
+    expression = (
         pyparsing.Optional(oneOf("- NOT"))
         + (simple_text_expr | simple_numerical_expr | \
-          (LPAR + expression + RPAR))
+          Group(LPAR + filter_expr + RPAR))
     )
 
     # Define the full filter with AND/OR combinations
-    filter_expr = expression + ZeroOrMore((oneOf("AND OR") + expression))
+    filter_expr <<= expression + ZeroOrMore((oneOf("AND OR") + expression))
 
     # parse expression
     parsed_expr = filter_expr.parse_string(filter_str, parse_all=True)
@@ -180,6 +322,30 @@ class VectorStore(ABC):
     return parsed_expr
 
 
+_index_endpoints = {}
+_index_endpoints_lock = threading.Lock()
+
+def get_index_endpoint(endpoint_name: str) -> \
+    aiplatform.MatchingEngineIndexEndpoint:
+  """
+  Return the process-wide client for a Matching Engine index endpoint,
+  creating it on first use.  Creating the client looks up the endpoint
+  resource and sets up its channel, so clients are reused across queries.
+  """
+  with _index_endpoints_lock:
+    index_endpoint = _index_endpoints.get(endpoint_name)
+    if index_endpoint is None:
+      Logger.info(f"Creating matching engine endpoint client for "
+                  f"{endpoint_name}")
+      index_endpoint = aiplatform.MatchingEngineIndexEndpoint(endpoint_name)
+      _index_endpoints[endpoint_name] = index_endpoint
+    return index_endpoint
+
+def drop_index_endpoint(endpoint_name: str):
+  """ Remove a cached Matching Engine index endpoint client """
+  with _index_endpoints_lock:
+    _index_endpoints.pop(endpoint_name, None)
+
 class MatchingEngineVectorStore(VectorStore):
   """
   Class for vector store based on Vertex matching engine.
@@ -314,6 +480,8 @@ class MatchingEngineVectorStore(VectorStore):
   def delete(self):
     """ Delete vector store index for this query engine """
     Logger.info(f"deleting matching engine index {self.index_name}")
+    if self.q_engine.endpoint:
+      drop_index_endpoint(self.q_engine.endpoint)
     if self.index_endpoint:
       self.index_endpoint.delete(force=True)
     if self.tree_ah_index:
@@ -375,16 +543,35 @@ class MatchingEngineVectorStore(VectorStore):
     Returns:
       list of indexes that are matched of length NUM_MATCH_RESULTS
     """
+    return self.similarity_search_many(
+        q_engine, [query_embedding], query_filter)[0]
+
+  def similarity_search_many(self, q_engine: QueryEngine,
+                             query_embeddings: List[List[float]],
+                             query_filter: Optional[str] = None) -> \
+                               List[List[int]]:
+    """
+    Retrieve text matches for multiple query embeddings in a single
+    find_neighbors request.
+    Args:
+      q_engine: QueryEngine model
+      query_embeddings: list of embedding arrays, one per query
+      query_filter: (optional) filter expression
+    Returns:
+      list of matched index lists, one per query embedding
+    """
     # TODO: implement query filters for matching engine
-    index_endpoint = aiplatform.MatchingEngineIndexEndpoint(q_engine.endpoint)
+    if not query_embeddings:
+      return []
+    index_endpoint = get_index_endpoint(q_engine.endpoint)
 
-    match_indexes_list = index_endpoint.find_neighbors(
-        queries=[query_embedding],
+    neighbors_list = index_endpoint.find_neighbors(
+        queries=query_embeddings,
         deployed_index_id=q_engine.deployed_index_name,
         num_neighbors=NUM_MATCH_RESULTS
     )
-    match_indexes = [int(match.id) for match in match_indexes_list[0]]
-    return match_indexes
+    return [[int(match.id) for match in neighbors]
+            for neighbors in neighbors_list]
 
 class LangChainVectorStore(VectorStore):
   """
@@ -417,53 +604,9 @@ class LangChainVectorStore(VectorStore):
                                  index_base: int) -> \
                                   int:
 
-    # Initialize counter for all embeddings of all modalities
-    # created from all chunks of document
-    num_embeddings = 0
-
-    # Convert multimodal chunks to embeddings
-    # Note that multimodal embedding model can only embed one chunk
-    # at a time. As opposed to the text-only embedding model, which
-    # can embed an array of multiple chunks at the same time.
-    chunk_texts = []
-    chunk_embeddings = []
-
-    # Loop over chunks
-    for doc in doc_chunks:
-      # Raise error is doc object is formatted incorrectly
-      modality_list_sorted = sorted(MODALITY_SET)
-      modality_list_sorted_exist = \
-        [modality in doc.keys() for modality in modality_list_sorted]
-      if not any(modality_list_sorted_exist):
-        raise RuntimeError(
-          f"failed to retrieve any modality for {doc_name}")
-      for modality, exist in \
-        zip(modality_list_sorted, modality_list_sorted_exist):
-        if not exist:
-          doc[modality] = None
-
-      # Get chunk embeddings
-      user_file_bytes = None
-      if doc["image"]:
-        user_file_bytes = b64decode(doc["image"])
-      chunk_embedding = \
-        await embeddings.get_multimodal_embeddings(
-          user_text=doc["text"],
-          user_file_bytes=user_file_bytes,
-          embedding_type=self.embedding_type)
-      # TODO: Also embed doc["video"] (video chunk) and
-      # potentially doc["audio"] (audio chunk)
-
-      # Check to make sure that embeddings for available modalities exist
-      for modality in modality_list_sorted:
-        if modality in chunk_embedding:
-          chunk_texts.append(doc["text"])
-          chunk_embeddings.append(chunk_embedding[modality])
-          # Increment counter
-          num_embeddings += 1
-        else:
-          raise RuntimeError(
-            f"failed to generate {modality} chunk embedding for {doc_name}")
+    chunk_texts, chunk_embeddings = \
+        await self.get_multimodal_chunk_embeddings(doc_name, doc_chunks)
+    num_embeddings = len(chunk_embeddings)
 
     # now that all embeddings are created for all modalities of all chunks,
     # generate list of chunk IDs starting from index base
@@ -480,7 +623,8 @@ class LangChainVectorStore(VectorStore):
                                         ids=ids)
     # return new index base
     new_index_base = index_base + num_embeddings
-    self.index_length = new_index_base
+    # documents may be indexed concurrently, in any order
+    self.index_length = max(self.index_length, new_index_base)
 
     return new_index_base
 
@@ -510,7 +654,8 @@ class LangChainVectorStore(VectorStore):
                                         metadatas=metadata)
     # return new index base
     new_index_base = index_base + len(text_chunks)
-    self.index_length = new_index_base
+    # documents may be indexed concurrently, in any order
+    self.index_length = max(self.index_length, new_index_base)
     return new_index_base
 
   def similarity_search(self, q_engine: QueryEngine,
@@ -605,7 +750,71 @@ class LangChainVectorStore(VectorStore):
 class LLMServicePGVector(LangchainPGVector):
   """
   Our version of langchain PGVector with override for result processing.
+
+  If the collection has an ANN index the query distance is computed on
+  the embedding cast to the index dimensions, so that postgres can use the
+  (expression) index, and search settings such as hnsw.ef_search are set
+  for the query transaction.
   """
+  def __init__(self, *args, ann_dimensions: Optional[int] = None,
+               search_settings: Optional[dict] = None, **kwargs) -> None:
+    self.ann_dimensions = ann_dimensions
+    self.search_settings = search_settings or {}
+    super().__init__(*args, **kwargs)
+
+  def _query_collection(self, embedding: List[float], k: int = 4,
+                        filter: Optional[dict] = None # pylint: disable=redefined-builtin
+                        ) -> List[Any]:
+    if not self.ann_dimensions and not self.search_settings:
+      return super()._query_collection(embedding, k, filter)
+
+    with Session(self._bind) as session:
+      # SET LOCAL only lasts for this transaction, so pooled connections
+      # are not affected
+      for setting, value in self.search_settings.items():
+        session.execute(sqlalchemy.text(f"SET LOCAL {setting} = {int(value)}"))
+
+      collection = self.get_collection(session)
+      if not collection:
+        raise ValueError("Collection not found")
+
+      filter_by = [self.EmbeddingStore.collection_id == collection.uuid]
+      if filter:
+        if self.use_jsonb:
+          filter_clauses = self._create_filter_clause(filter)
+          if filter_clauses is not None:
+            filter_by.append(filter_clauses)
+        else:
+          filter_by.extend(self._create_filter_clause_json_deprecated(filter))
+
+      results = (
+        session.query(
+            self.EmbeddingStore,
+            self.ann_distance(embedding).label("distance"))
+        .filter(*filter_by)
+        .order_by(sqlalchemy.asc("distance"))
+        .join(self.CollectionStore,
+              self.EmbeddingStore.collection_id == self.CollectionStore.uuid)
+        .limit(k)
+        .all()
+      )
+    return results
+
+  @property
+  def distance_operator_class(self) -> str:
+    """ pgvector operator class for the distance strategy """
+    operator_class, _ = PG_DISTANCE_OPS[self._distance_strategy]
+    return operator_class
+
+  def ann_distance(self, embedding: List[float]):
+    """ Distance expression matching the ANN index expression """
+    if not self.ann_dimensions:
+      return self.distance_strategy(embedding)
+    embedding_column = sqlalchemy.cast(self.EmbeddingStore.embedding,
+                                       Vector(self.ann_dimensions))
+    _, comparator = PG_DISTANCE_OPS[self._distance_strategy]
+    return getattr(embedding_column, comparator)(embedding)
+
   def _results_to_docs_and_scores(self, results: Any) -> \
     List[Tuple[Document, float, int]]:
     """
@@ -625,6 +834,38 @@ class LLMServicePGVector(LangchainPGVector):
     ]
     return docs
 
+def pg_connection_string() -> str:
+  # get postgres connection string using LangchainPGVector utility method
+  return LangchainPGVector.connection_string_from_db_params(
+      driver="psycopg2",
+      host=PG_HOST,
+      port=PG_PORT,
+      database=PG_DBNAME,
+      user=PG_USER,
+      password=PG_PASSWD
+  )
+
+_pg_engine = None
+_pg_engine_lock = threading.Lock()
+
+def get_pg_engine() -> sqlalchemy.engine.Engine:
+  """
+  Return the process-wide pooled SQLAlchemy engine for the pgvector
+  database, creating it on first use.
+  """
+  global _pg_engine
+  with _pg_engine_lock:
+    if _pg_engine is None:
+      Logger.info(f"Creating pgvector connection pool for {PG_HOST} "
+                  f"pool_size={PG_POOL_SIZE} max_overflow={PG_MAX_OVERFLOW}")
+      _pg_engine = sqlalchemy.create_engine(
+          pg_connection_string(),
+          pool_size=PG_POOL_SIZE,
+          max_overflow=PG_MAX_OVERFLOW,
+          pool_pre_ping=PG_POOL_PRE_PING,
+          pool_recycle=PG_POOL_RECYCLE)
+    return _pg_engine
+
 class PostgresVectorStore(LangChainVectorStore):
   """
   LLM Service interface for Postgres Vector Stores, based on langchain
@@ -636,29 +877,173 @@ class PostgresVectorStore(LangChainVectorStore):
 
   def _get_langchain_vector_store(self) -> LCVectorStore:
 
-    # get postgres connection string using LangchainPGVector utility method
-    connection_string = LangchainPGVector.connection_string_from_db_params(
-        driver="psycopg2",
-        host=PG_HOST,
-        port=PG_PORT,
-        database=PG_DBNAME,
-        user=PG_USER,
-        password=PG_PASSWD
-    )
-
     # Each query engine is stored in a different PGVector collection,
     # where the collection name is just the query engine name.
     collection_name = self.q_engine.name
 
-    # instantiate the langchain vector store object
+    params = self.q_engine.params or {}
+    ann_dimensions = None
+    if params.get(ANN_INDEX_NAME_PARAM):
+      ann_dimensions = int(params[ANN_INDEX_DIMENSIONS_PARAM])
+
+    # instantiate the langchain vector store object, using connections
+    # from the shared pool
     langchain_vector_store = LLMServicePGVector(
         embedding_function=embeddings.LangchainEmbeddings,
-        connection_string=connection_string,
-        collection_name=collection_name
+        connection_string=pg_connection_string(),
+        collection_name=collection_name,
+        connection=get_pg_engine(),
+        ann_dimensions=ann_dimensions,
+        search_settings=self.search_settings()
         )
 
     return langchain_vector_store
 
+  def search_settings(self) -> dict:
+    """ Postgres settings for ANN search from query engine params """
+    params = self.q_engine.params or {}
+    settings = {}
+    for param, setting in ANN_SEARCH_PARAMS.items():
+      if params.get(param) is None:
+        continue
+      try:
+        settings[setting] = int(params[param])
+      except ValueError:
+        Logger.error(f"Invalid {param} [{params[param]}] for "
+                     f"q_engine [{self.q_engine.name}]")
+    return settings
+
+  def deploy(self):
+    """ Create the ANN index for the query engine collection """
+    params = self.q_engine.params or {}
+    index_type = str(params.get(ANN_INDEX_PARAM, PG_ANN_INDEX)).lower()
+    if index_type == PG_ANN_INDEX_NONE:
+      Logger.info(f"No ANN index for q_engine [{self.q_engine.name}]")
+      return
+    if index_type not in (PG_ANN_INDEX_HNSW, PG_ANN_INDEX_IVFFLAT):
+      raise InternalServerError(f"Unsupported ANN index type {index_type}")
+    self.create_ann_index(index_type)
+
+  def delete(self):
+    """ Drop the ANN index and delete the query engine collection """
+    self.drop_ann_index()
+    self.lc_vector_store.delete_collection()
+
+  def init_refresh(self, delete_indexes: List[int]):
+    """ Delete embeddings by index from the query engine collection """
+    self.delete_embeddings(delete_indexes)
+
+  def delete_embeddings(self, delete_indexes: List[int]):
+    """ Delete embeddings by index from the query engine collection """
+    Logger.info(f"Deleting {len(delete_indexes)} embeddings for q_engine "
+                f"[{self.q_engine.name}]")
+    for i in range(0, len(delete_indexes), PG_DELETE_BATCH_SIZE):
+      self.lc_vector_store.delete(
+          ids=[str(index) for index in
+               delete_indexes[i: i + PG_DELETE_BATCH_SIZE]],
+          collection_only=True)
+
+  def reindex(self):
+    """
+    Rebuild the ANN index after bulk loads.  HNSW indexes are rebuilt in
+    place; IVFFlat indexes are recreated, as the number of lists depends
+    on the number of rows.
+    """
+    params = self.q_engine.params or {}
+    index_type = str(params.get(ANN_INDEX_PARAM, PG_ANN_INDEX)).lower()
+    index_name = params.get(ANN_INDEX_NAME_PARAM)
+    if index_name and index_type == PG_ANN_INDEX_HNSW:
+      Logger.info(f"Reindexing {index_name}")
+      self._execute_autocommit([
+        f"REINDEX INDEX CONCURRENTLY {index_name}",
+        f"ANALYZE {self.lc_vector_store.EmbeddingStore.__tablename__}"
+      ])
+    else:
+      self.drop_ann_index()
+      self.deploy()
+
+  def create_ann_index(self, index_type: str):
+    """
+    Create an ANN index for the query engine collection.  The index is a
+    partial index on the collection id over the embedding cast to the
+    embedding dimensions, as the shared langchain embedding table has no
+    fixed dimensions.  Indexes are created concurrently so that builds
+    and queries on other engines are not blocked.
+    """
+    collection_id, num_rows, dimensions = self._collection_stats()
+    if num_rows == 0:
+      Logger.warning(f"No embeddings for q_engine [{self.q_engine.name}], "
+                     "not creating ANN index")
+      return
+
+    params = self.q_engine.params or {}
+    if index_type == PG_ANN_INDEX_HNSW:
+      index_options = (
+          f"m = {int(params.get('hnsw_m', PG_HNSW_M))}, "
+          f"ef_construction = "
+          f"{int(params.get('hnsw_ef_construction', PG_HNSW_EF_CONSTRUCTION))}")
+    else:
+      lists = int(params.get("ivfflat_lists", ivfflat_lists(num_rows)))
+      index_options = f"lists = {lists}"
+
+    table_name = self.lc_vector_store.EmbeddingStore.__tablename__
+    index_name = f"ix_lc_embedding_{collection_id.hex}"
+    operator_class = self.lc_vector_store.distance_operator_class
+    Logger.info(f"Creating {index_type} index {index_name} for q_engine "
+                f"[{self.q_engine.name}] with {num_rows} rows")
+    self._execute_autocommit([
+      f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} "
+      f"ON {table_name} USING {index_type} "
+      f"((embedding::vector({dimensions})) {operator_class}) "
+      f"WITH ({index_options}) "
+      f"WHERE collection_id = '{collection_id}'",
+      f"ANALYZE {table_name}"
+    ])
+
+    params[ANN_INDEX_PARAM] = index_type
+    params[ANN_INDEX_NAME_PARAM] = index_name
+    params[ANN_INDEX_DIMENSIONS_PARAM] = str(dimensions)
+    self.q_engine.params = params
+    self.q_engine.update()
+
+  def drop_ann_index(self):
+    params = self.q_engine.params or {}
+    index_name = params.pop(ANN_INDEX_NAME_PARAM, None)
+    if not index_name:
+      return
+    Logger.info(f"Dropping index {index_name}")
+    self._execute_autocommit(
+        [f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"])
+    params.pop(ANN_INDEX_DIMENSIONS_PARAM, None)
+    self.q_engine.params = params
+    self.q_engine.update()
+
+  def _collection_stats(self) -> Tuple[Any, int, int]:
+    """
+    Returns:
+      tuple of collection uuid, number of embeddings and embedding dimensions
+    """
+    lc_vector_store = self.lc_vector_store
+    embedding_store = lc_vector_store.EmbeddingStore
+    with Session(get_pg_engine()) as session:
+      collection = lc_vector_store.get_collection(session)
+      if not collection:
+        raise InternalServerError(
+            f"Collection not found for q_engine [{self.q_engine.name}]")
+      num_rows, dimensions = session.query(
+          sqlalchemy.func.count(), # pylint: disable=not-callable
+          sqlalchemy.func.max(
+              sqlalchemy.func.vector_dims(embedding_store.embedding))
+      ).filter(embedding_store.collection_id == collection.uuid).one()
+    return collection.uuid, num_rows, dimensions
+
+  def _execute_autocommit(self, statements: List[str]):
+    # CREATE/DROP/REINDEX CONCURRENTLY can't run in a transaction
+    with get_pg_engine().connect().execution_options(
+        isolation_level="AUTOCOMMIT") as conn:
+      for statement in statements:
+        conn.execute(sqlalchemy.text(statement))
+
   def process_results(self, results: List[Any]) -> List[int]:
     """
     Our overridden method _results_to_docs_and_scores returns a tuple of
@@ -669,6 +1054,53 @@ class PostgresVectorStore(LangChainVectorStore):
     return processed_results
 
 
+def ivfflat_lists(num_rows: int) -> int:
+  """ Number of IVFFlat lists recommended by pgvector for a row count """
+  if num_rows <= 1000000:
+    return max(num_rows // 1000, 1)
+  return int(math.sqrt(num_rows))
+
+
 LC_VECTOR_STORES = {
   VECTOR_STORE_LANGCHAIN_PGVECTOR: PostgresVectorStore
 }
+
+
+class VectorStoreRegistry():
+  """
+  Process-wide registry of vector store instances keyed by query engine id,
+  so that clients and connections are reused across queries.
+
+  An entry is replaced when the query engine has been modified (e.g.
+  rebuilt) since the instance was created, and removed on invalidate.
+  """
+
+  def __init__(self) -> None:
+    self._stores = {}
+    self._lock = threading.Lock()
+
+  def get(self, q_engine: QueryEngine, create_fn) -> VectorStore:
+    """
+    Return the registered vector store for a query engine, calling
+    create_fn(q_engine) to create one if needed.
+    """
+    version = (q_engine.vector_store, q_engine.last_modified_time)
+    with self._lock:
+      entry = self._stores.get(q_engine.id)
+      if entry is not None and entry[0] == version:
+        return entry[1]
+    vector_store = create_fn(q_engine)
+    with self._lock:
+      self._stores[q_engine.id] = (version, vector_store)
+    return vector_store
+
+  def invalidate(self, q_engine_id: str):
+    with self._lock:
+      self._stores.pop(q_engine_id, None)
+
+  def clear(self):
+    with self._lock:
+      self._stores.clear()
+
+
+vector_store_registry = VectorStoreRegistry()
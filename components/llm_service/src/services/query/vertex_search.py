@@ -16,8 +16,10 @@ Vertex Search-based Query Engines
 """
 # pylint: disable=broad-exception-caught
 
+import asyncio
 import re
 import tempfile
+import threading
 import traceback
 from typing import List, Tuple
 from pathlib import Path
@@ -40,10 +42,43 @@ VALID_FILE_EXTENSIONS = [".pdf", ".html", ".csv", ".json"]
 # as of 2/2025 Vertex Search only supports text modality
 DEFAULT_MODALITY = "text"
 
+# Vertex Search serving location
+SEARCH_LOCATION = "global"
+
+# search client per event loop, as async gRPC channels are bound to the
+# loop they are created on
+_search_clients = {}
+_search_clients_lock = threading.Lock()
+
+def get_search_client() -> discoveryengine.SearchServiceAsyncClient:
+  """
+  Return the Vertex Search client for the running event loop, creating it
+  on first use so its channel and credentials are reused across queries.
+  """
+  loop = asyncio.get_running_loop()
+  with _search_clients_lock:
+    client = _search_clients.get(loop)
+    if client is None:
+      client_options = (
+          ClientOptions(
+              api_endpoint=f"{SEARCH_LOCATION}-discoveryengine.googleapis.com")
+          if SEARCH_LOCATION != "global"
+          else None
+      )
+      client = discoveryengine.SearchServiceAsyncClient(
+          client_options=client_options)
+      # drop clients of closed loops
+      for closed_loop in [l for l in _search_clients if l.is_closed()]:
+        del _search_clients[closed_loop]
+      _search_clients[loop] = client
+  return client
+
 async def query_vertex_search(q_engine: QueryEngine,
                               search_query: str,
                               num_results: int,
-                              query_filter: dict) -> List[QueryReference]:
+                              query_filter: dict,
+                              save_references: bool = True) -> \
+                                List[QueryReference]:
   """
   For a query prompt, retrieve text chunks with doc references
   from matching documents from a vertex search engine.
@@ -52,6 +87,7 @@ async def query_vertex_search(q_engine: QueryEngine,
     q_engine: QueryEngine to search
     search_query (str):  user query
     query_filter (dict): filter for query
+    save_references (bool): save the QueryReference models
   Returns:
     list of QueryReference models
 
@@ -67,32 +103,41 @@ async def query_vertex_search(q_engine: QueryEngine,
                                                search_query,
                                                num_results)
 
-  # create query document and reference models to store results
-  query_references = []
-  n = 0
-  for search_result in search_results:
-    document_data = \
-        proto.Message.to_dict(search_result.document)["derived_struct_data"]
-
-    # Find or create document model
-    query_document = QueryDocument.find_by_index_file(
-        q_engine.id, document_data["link"])
-    if not query_document:
-      # By not assuming the document models exist, we can more easily search an
-      # existing datastore. The LLM Service just needs the datastore id
-      # associated with a query engine model.
+  # look up the documents for all result links in one batch
+  results_data = [
+      proto.Message.to_dict(search_result.document)["derived_struct_data"]
+      for search_result in search_results
+  ]
+  links = [document_data["link"] for document_data in results_data]
+  query_documents = {
+      query_document.index_file: query_document
+      for query_document in QueryDocument.find_by_index_files(q_engine.id,
+                                                              links)
+  }
+
+  # By not assuming the document models exist, we can more easily search an
+  # existing datastore. The LLM Service just needs the datastore id
+  # associated with a query engine model.
+  new_documents = []
+  for link in dict.fromkeys(links):
+    if link not in query_documents:
       Logger.warning(
-          f"Creating document model for {document_data['link']} engine"
-          f" {q_engine.name}")
+          f"Creating document model for {link} engine {q_engine.name}")
       query_document = QueryDocument(
         query_engine_id=q_engine.id,
         query_engine=q_engine.name,
-        doc_url=document_data["link"],
-        index_file=document_data["link"]
+        doc_url=link,
+        index_file=link
       )
-      query_document.save()
+      query_documents[link] = query_document
+      new_documents.append(query_document)
+  if new_documents:
+    QueryDocument.save_all(new_documents)
 
-    # create query reference model
+  # create query reference models
+  query_references = []
+  for n, document_data in enumerate(results_data):
+    query_document = query_documents[document_data["link"]]
     Logger.info(
         f"Creating query ref for search result [{document_data['link']}]")
     query_reference = QueryReference(
@@ -104,9 +149,9 @@ async def query_vertex_search(q_engine: QueryEngine,
       document_text=document_data["snippets"][0]["snippet"],
       chunk_id=str(n) # fake chunk id for ux's that dedup on chunk id
     )
-    n += 1
-    query_reference.save()
     query_references.append(query_reference)
+  if save_references:
+    QueryReference.save_all(query_references)
 
   return query_references
 
@@ -116,17 +161,9 @@ async def perform_vertex_search(data_store_id: str,
     List[discoveryengine.SearchResponse.SearchResult]:
   """ Send a search request to Vertex Search """
   project_id = PROJECT_ID
-  location = "global"
-
-  client_options = (
-      ClientOptions(api_endpoint=f"{location}-discoveryengine.googleapis.com")
-      if location != "global"
-      else None
-  )
+  location = SEARCH_LOCATION
 
-  # Create a client
-  client = \
-      discoveryengine.SearchServiceAsyncClient(client_options=client_options)
+  client = get_search_client()
 
   # The full resource name of the search engine serving config, e.g.
   # "projects/{project_id}/locations/{location}/dataStores/{data_store_id}"
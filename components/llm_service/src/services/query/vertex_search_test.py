@@ -0,0 +1,140 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+  Unit tests for Vertex Search query engines
+"""
+# disabling pylint rules that conflict with pytest fixtures
+# pylint: disable=unused-argument,redefined-outer-name,ungrouped-imports,unused-import
+from unittest import mock
+import pytest
+from google.cloud import discoveryengine_v1alpha as discoveryengine
+from schemas.schema_examples import QUERY_ENGINE_EXAMPLE
+from common.models import QueryEngine, QueryDocument, QueryReference
+from common.utils.config import set_env_var
+from common.testing.firestore_emulator import firestore_emulator, clean_firestore
+
+with set_env_var("PG_HOST", ""):
+  from services.query import vertex_search
+  from services.query.vertex_search import query_vertex_search
+
+
+@pytest.fixture(autouse=True)
+def clear_search_clients():
+  # each test runs on its own event loop, so start without cached clients
+  with mock.patch.object(vertex_search, "_search_clients", {}):
+    yield
+
+@pytest.fixture
+def create_engine(firestore_emulator, clean_firestore):
+  q_engine = QueryEngine.from_dict(QUERY_ENGINE_EXAMPLE)
+  q_engine.save()
+  return q_engine
+
+@pytest.fixture
+def search_client():
+  with mock.patch.object(vertex_search.discoveryengine,
+                         "SearchServiceAsyncClient") as client_class:
+    client = client_class.return_value
+    client.serving_config_path.return_value = (
+        "projects/fake-project/locations/global/dataStores/fake-datastore"
+        "/servingConfigs/default_config")
+    client.search = mock.AsyncMock()
+    yield client_class
+
+def search_response(links):
+  return discoveryengine.SearchResponse(results=[
+      discoveryengine.SearchResponse.SearchResult(
+          document=discoveryengine.Document(derived_struct_data={
+              "link": link,
+              "snippets": [{"snippet": f"snippet {n}"}]
+          }))
+      for n, link in enumerate(links)
+  ])
+
+
+@pytest.mark.asyncio
+async def test_search_client_reused(create_engine, search_client):
+  client = search_client.return_value
+  client.search.return_value = search_response(["gs://fake-bucket/doc1.pdf"])
+
+  await query_vertex_search(create_engine, "test query", 5, {})
+  await query_vertex_search(create_engine, "test query", 5, {})
+
+  # one client serves all searches on the loop
+  search_client.assert_called_once()
+  assert client.search.await_count == 2
+  assert vertex_search.get_search_client() is client
+
+
+@pytest.mark.asyncio
+async def test_query_vertex_search_documents(create_engine, search_client):
+  existing_doc = QueryDocument(
+      query_engine_id=create_engine.id,
+      query_engine=create_engine.name,
+      doc_url="gs://fake-bucket/doc1.pdf",
+      index_file="gs://fake-bucket/doc1.pdf")
+  existing_doc.save()
+
+  links = ["gs://fake-bucket/doc1.pdf",
+           "gs://fake-bucket/doc2.pdf",
+           "gs://fake-bucket/doc2.pdf"]
+  search_client.return_value.search.return_value = search_response(links)
+
+  with mock.patch.object(QueryReference, "save_all",
+                         wraps=QueryReference.save_all) as save_refs:
+    query_references = await query_vertex_search(
+        create_engine, "test query", 5, {})
+
+  # references are saved in one batch
+  save_refs.assert_called_once_with(query_references)
+  assert [ref.document_url for ref in query_references] == links
+  assert [ref.chunk_id for ref in query_references] == ["0", "1", "2"]
+  assert query_references[1].document_text == "snippet 1"
+  for ref in query_references:
+    assert ref.id is not None
+    assert QueryReference.find_by_id(ref.id) is not None
+
+  # existing documents are reused and duplicate links share one new document
+  assert query_references[0].document_id == existing_doc.id
+  assert query_references[1].document_id == query_references[2].document_id
+  new_docs = QueryDocument.find_by_index_files(
+      create_engine.id, ["gs://fake-bucket/doc2.pdf"])
+  assert len(new_docs) == 1
+  assert new_docs[0].id == query_references[1].document_id
+
+
+@pytest.mark.asyncio
+async def test_query_vertex_search_many_documents(create_engine,
+                                                  search_client):
+  # more links than fit in a single firestore "in" filter
+  links = [f"gs://fake-bucket/doc{i}.pdf" for i in range(35)]
+  existing_docs = [
+      QueryDocument(
+          query_engine_id=create_engine.id,
+          query_engine=create_engine.name,
+          doc_url=link,
+          index_file=link)
+      for link in links
+  ]
+  QueryDocument.save_all(existing_docs)
+  search_client.return_value.search.return_value = search_response(links)
+
+  with mock.patch.object(QueryDocument, "save_all") as save_docs:
+    query_references = await query_vertex_search(
+        create_engine, "test query", 35, {})
+
+  # all documents are found, so none are created
+  save_docs.assert_not_called()
+  assert [ref.document_id for ref in query_references] == \
+      [doc.id for doc in existing_docs]
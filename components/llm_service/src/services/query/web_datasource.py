@@ -106,13 +106,15 @@ class WebDataSourceParser:
       }
 
     file_name = sanitize_url(response.url)
+    etag = response.headers.get("ETag")
     item = {
       "url": response.url,
       "filename": file_name,
       "bucket_name": self.bucket_name,
       "filepath": self.filepath,
       "content_type": content_type,
-      "content": file_content
+      "content": file_content,
+      "etag": etag.decode("utf-8") if etag else None
     }
     saved_path = save_content(self.filepath, file_name, file_content)
     if self.storage_client and self.bucket_name:
@@ -236,7 +238,8 @@ class WebDataSource(DataSource):
       filepath = os.path.join(item["filepath"], item["filename"])
       data_source_file = DataSourceFile(doc_name=item["filename"],
                                         src_url=item["url"],
-                                        local_path=filepath)
+                                        local_path=filepath,
+                                        content_hash=item.get("etag"))
       if "gcs_path" in item:
         data_source_file.gcs_path = item["gcs_path"]
       self.doc_data.append(data_source_file)
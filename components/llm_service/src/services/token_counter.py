@@ -0,0 +1,250 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Token counting for context length accounting.
+
+Each llm type gets a token counter, created on first use and cached:
+  - the "tokenizer" model config value if set: "tiktoken:<encoding or
+    model name>", "vertex:<model name>" or "chars"
+  - otherwise the Vertex local tokenizer for Vertex models (requires
+    sentencepiece), or tiktoken if it knows the model name
+  - otherwise an estimate of CHARS_PER_TOKEN chars per token
+
+Counts are cached by text, so text that is counted on every request, such
+as chat history entries, is tokenized once.
+
+Creating a counter can load or download a tokenizer, so the counters of
+configured models are loaded in the background at startup (see
+load_token_counters), and code on the event loop, such as request metrics,
+uses count_tokens_nowait.
+"""
+# pylint: disable=broad-exception-caught,import-outside-toplevel
+
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from common.utils.logging_handler import Logger
+from config import (get_model_config_value, KEY_PROVIDER, KEY_MODEL_NAME,
+                    KEY_MODEL_TOKENIZER, PROVIDER_VERTEX)
+
+Logger = Logger.get_logger(__file__)
+
+# estimated chars per token for models without a tokenizer
+CHARS_PER_TOKEN = 3
+
+# number of (counter, text) token counts to cache
+TOKEN_COUNT_CACHE_SIZE = 10000
+
+TOKENIZER_TIKTOKEN = "tiktoken"
+TOKENIZER_VERTEX = "vertex"
+TOKENIZER_CHARS = "chars"
+
+
+class TokenCounter():
+  """ Estimates tokens from the length of text """
+
+  name = TOKENIZER_CHARS
+
+  def count(self, text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+class TiktokenCounter(TokenCounter):
+  """ Counts tokens with a tiktoken encoding """
+
+  def __init__(self, encoding_name: str) -> None:
+    import tiktoken
+    try:
+      self.encoding = tiktoken.get_encoding(encoding_name)
+    except ValueError:
+      self.encoding = tiktoken.encoding_for_model(encoding_name)
+    self.name = f"{TOKENIZER_TIKTOKEN}:{self.encoding.name}"
+
+  def count(self, text: str) -> int:
+    return len(self.encoding.encode(text, disallowed_special=()))
+
+
+class VertexTokenCounter(TokenCounter):
+  """ Counts tokens with the Vertex AI local tokenizer """
+
+  def __init__(self, model_name: str) -> None:
+    from vertexai.preview import tokenization
+    self.tokenizer = tokenization.get_tokenizer_for_model(model_name)
+    self.name = f"{TOKENIZER_VERTEX}:{model_name}"
+
+  def count(self, text: str) -> int:
+    return self.tokenizer.count_tokens(text).total_tokens
+
+
+def create_token_counter(llm_type: str) -> TokenCounter:
+  """ Create the token counter for a model (see module docstring) """
+  tokenizer = get_model_config_value(llm_type, KEY_MODEL_TOKENIZER, None)
+  model_name = get_model_config_value(llm_type, KEY_MODEL_NAME, None) \
+      or llm_type
+  if tokenizer:
+    kind, _, name = tokenizer.partition(":")
+    name = name or model_name
+    if kind == TOKENIZER_TIKTOKEN:
+      return TiktokenCounter(name)
+    if kind == TOKENIZER_VERTEX:
+      return VertexTokenCounter(name)
+    return TokenCounter()
+
+  if get_model_config_value(llm_type, KEY_PROVIDER, None) == PROVIDER_VERTEX:
+    try:
+      return VertexTokenCounter(model_name)
+    except Exception as e:
+      Logger.info(f"No Vertex local tokenizer for [{llm_type}]: {e}")
+  try:
+    return TiktokenCounter(model_name)
+  except Exception:
+    pass
+  return TokenCounter()
+
+
+class TokenCounterRegistry():
+  """
+  Per-process token counters by llm type, and an LRU of token counts by
+  counter and text.
+  """
+
+  def __init__(self, cache_size: int = TOKEN_COUNT_CACHE_SIZE) -> None:
+    self.cache_size = cache_size
+    self._counters: Dict[str, TokenCounter] = {}
+    self._counts = OrderedDict()
+    self._loading = set()
+    self._lock = threading.Lock()
+    self._loaded = threading.Condition(self._lock)
+
+  def get_counter(self, llm_type: Optional[str]) -> TokenCounter:
+    """
+    Return the counter of a model, creating it if needed.  If the counter
+    is being created by another thread, waits for it instead of loading
+    the tokenizer again.  Creating a counter blocks, so code on the event
+    loop should use count_tokens_nowait.
+    """
+    with self._loaded:
+      while llm_type in self._loading:
+        self._loaded.wait()
+      counter = self._counters.get(llm_type)
+      if counter is not None:
+        return counter
+      self._loading.add(llm_type)
+    return self._load_counter(llm_type)
+
+  def _load_counter(self, llm_type: Optional[str]) -> TokenCounter:
+    """ Create the counter of an llm type marked as loading """
+    try:
+      try:
+        counter = create_token_counter(llm_type) if llm_type \
+            else TokenCounter()
+      except Exception as e:
+        Logger.error(f"Error loading tokenizer for [{llm_type}], "
+                     f"estimating tokens from chars: {e}")
+        counter = TokenCounter()
+      Logger.info(f"Using token counter [{counter.name}] for [{llm_type}]")
+      with self._lock:
+        counter = self._counters.setdefault(llm_type, counter)
+    finally:
+      with self._loaded:
+        self._loading.discard(llm_type)
+        self._loaded.notify_all()
+    return counter
+
+  def count_tokens(self, text: str, llm_type: Optional[str]) -> int:
+    """ Return the number of tokens in text for a model """
+    if not text:
+      return 0
+    counter = self.get_counter(llm_type)
+    key = (counter.name, hash(text), len(text))
+    with self._lock:
+      count = self._counts.get(key)
+      if count is not None:
+        self._counts.move_to_end(key)
+        return count
+    count = counter.count(text)
+    with self._lock:
+      self._counts[key] = count
+      while len(self._counts) > self.cache_size:
+        self._counts.popitem(last=False)
+    return count
+
+  def count_tokens_nowait(self, text: str, llm_type: Optional[str]) -> int:
+    """
+    Return the number of tokens in text for a model, without waiting for
+    its tokenizer to load.  If the counter of the model is not loaded yet,
+    it is loaded in the background and tokens are estimated from chars.
+    """
+    if not text:
+      return 0
+    with self._lock:
+      is_loaded = llm_type in self._counters
+    if not is_loaded:
+      self.load_in_background([llm_type])
+      return TokenCounter().count(text)
+    return self.count_tokens(text, llm_type)
+
+  def load_in_background(self, llm_types: List[Optional[str]]):
+    """ Create the counters for llm types in a background thread """
+    with self._lock:
+      llm_types = [llm_type for llm_type in dict.fromkeys(llm_types)
+                   if llm_type not in self._counters
+                   and llm_type not in self._loading]
+      self._loading.update(llm_types)
+    if not llm_types:
+      return
+
+    def load():
+      for llm_type in llm_types:
+        self._load_counter(llm_type)
+
+    threading.Thread(target=load, name="token-counter-loader",
+                     daemon=True).start()
+
+  def count_tokens_many(self, texts: List[str],
+                        llm_type: Optional[str]) -> List[int]:
+    """
+    Return token counts for a list of texts, e.g. chat history entries.
+    Texts counted before are not tokenized again.
+    """
+    return [self.count_tokens(text, llm_type) for text in texts]
+
+  def clear(self):
+    with self._lock:
+      self._counters.clear()
+      self._counts.clear()
+      self._loading.clear()
+      self._loaded.notify_all()
+
+
+token_counters = TokenCounterRegistry()
+
+
+def count_tokens(text: str, llm_type: Optional[str]) -> int:
+  """ Return the number of tokens in text for a model """
+  return token_counters.count_tokens(text, llm_type)
+
+
+def count_tokens_nowait(text: str, llm_type: Optional[str]) -> int:
+  """
+  Return the number of tokens in text for a model, estimated from chars
+  until its tokenizer is loaded (see TokenCounterRegistry.count_tokens_nowait)
+  """
+  return token_counters.count_tokens_nowait(text, llm_type)
+
+
+def load_token_counters(llm_types: List[str]):
+  """ Load the token counters of models in a background thread """
+  token_counters.load_in_background(llm_types)
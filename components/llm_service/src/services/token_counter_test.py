@@ -0,0 +1,135 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Unit tests for token counting
+"""
+import threading
+from unittest import mock
+from services.token_counter import (TokenCounter, TokenCounterRegistry,
+                                    create_token_counter, CHARS_PER_TOKEN)
+
+
+class FakeCounter(TokenCounter):
+  """ Counts words and the number of texts counted """
+
+  name = "fake"
+
+  def __init__(self):
+    self.calls = 0
+
+  def count(self, text):
+    self.calls += 1
+    return len(text.split())
+
+
+def test_char_counter():
+  counter = TokenCounter()
+  assert counter.count("a" * CHARS_PER_TOKEN) == 1
+  assert counter.count("a" * (CHARS_PER_TOKEN + 1)) == 2
+
+
+@mock.patch("services.token_counter.TiktokenCounter")
+@mock.patch("services.token_counter.get_model_config_value")
+def test_create_token_counter(mock_config_value, mock_tiktoken):
+  config = {"tokenizer": "tiktoken:cl100k_base", "model_name": "gpt-4o"}
+  mock_config_value.side_effect = lambda llm_type, key, default: \
+      config.get(key, default)
+  assert create_token_counter("gpt") == mock_tiktoken.return_value
+  mock_tiktoken.assert_called_with("cl100k_base")
+
+  # tiktoken by model name when no tokenizer is configured
+  del config["tokenizer"]
+  assert create_token_counter("gpt") == mock_tiktoken.return_value
+  mock_tiktoken.assert_called_with("gpt-4o")
+
+  # chars estimate when tiktoken does not know the model
+  mock_tiktoken.side_effect = KeyError("gpt-4o")
+  assert create_token_counter("gpt").name == "chars"
+  config["tokenizer"] = "chars"
+  assert create_token_counter("gpt").name == "chars"
+
+
+@mock.patch("services.token_counter.create_token_counter")
+def test_registry_caches_counts(mock_create):
+  counter = FakeCounter()
+  mock_create.return_value = counter
+  registry = TokenCounterRegistry(cache_size=2)
+
+  history = ["Human input: hi there", "AI response: hello"]
+  assert registry.count_tokens_many(history, "model") == [4, 3]
+  assert registry.count_tokens_many(history, "model") == [4, 3]
+  assert counter.calls == 2
+  mock_create.assert_called_once_with("model")
+
+  # a new history entry is the only text tokenized, and evicts the oldest
+  history.append("Human input: and now?")
+  assert registry.count_tokens_many(history[1:], "model") == [3, 4]
+  assert counter.calls == 3
+  assert registry.count_tokens(history[0], "model") == 4
+  assert counter.calls == 4
+  assert registry.count_tokens("", "model") == 0
+
+
+@mock.patch("services.token_counter.create_token_counter")
+def test_registry_count_tokens_nowait(mock_create):
+  counter = FakeCounter()
+  mock_create.return_value = counter
+  registry = TokenCounterRegistry()
+  text = "one two three four five six"
+
+  # tokens are estimated from chars until the counter is loaded in the
+  # background
+  with mock.patch("services.token_counter.threading.Thread") as mock_thread:
+    assert registry.count_tokens_nowait(text, "model") == \
+        TokenCounter().count(text)
+    assert registry.count_tokens_nowait(text, "model") == \
+        TokenCounter().count(text)
+  mock_thread.assert_called_once()
+  mock_create.assert_not_called()
+
+  mock_thread.call_args.kwargs["target"]()
+  mock_create.assert_called_once_with("model")
+  assert registry.count_tokens_nowait(text, "model") == 6
+
+
+@mock.patch("services.token_counter.create_token_counter")
+def test_registry_waits_for_background_load(mock_create):
+  counter = FakeCounter()
+  mock_create.return_value = counter
+  registry = TokenCounterRegistry()
+
+  # a counter requested while it loads in the background is not created
+  # a second time
+  with mock.patch("services.token_counter.threading.Thread") as mock_thread:
+    registry.load_in_background(["model"])
+  counters = []
+  waiter = threading.Thread(
+      target=lambda: counters.append(registry.get_counter("model")))
+  waiter.start()
+  waiter.join(timeout=0.1)
+  assert waiter.is_alive()
+  mock_thread.call_args.kwargs["target"]()
+  waiter.join(timeout=5)
+  assert counters == [counter]
+  mock_create.assert_called_once_with("model")
+
+
+@mock.patch("services.token_counter.create_token_counter")
+def test_registry_falls_back_to_chars(mock_create):
+  mock_create.side_effect = ImportError("no tokenizer")
+  registry = TokenCounterRegistry()
+  assert registry.get_counter("model").name == "chars"
+  assert registry.count_tokens("abcdef", "model") == 2
+  mock_create.assert_called_once()
@@ -0,0 +1,47 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Embedding vector helper functions.
+"""
+
+import numpy as np
+
+
+def normalize_rows(vectors) -> np.ndarray:
+  """
+  Return a float32 copy of a 2D array of vectors with each row scaled to
+  unit length.  Zero rows are left as zero.
+  """
+  vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+  norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+  norms[norms == 0] = 1.0
+  return vectors / norms
+
+
+def cosine_similarity(query_embedding, embeddings) -> np.ndarray:
+  """
+  Compute the cosine similarity of a single query vector against every
+  row of a matrix of embeddings with a single matrix-vector product.
+
+  Args:
+    query_embedding: query vector, shape (dim,) or (1, dim)
+    embeddings: matrix of vectors, shape (n, dim)
+  Returns:
+    numpy array of n similarity scores
+  """
+  query = normalize_rows(query_embedding).reshape(-1)
+  if len(embeddings) == 0:
+    return np.zeros(0, dtype=np.float32)
+  return normalize_rows(embeddings) @ query
@@ -0,0 +1,48 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+  Unit tests for LLM Service vector helper utils
+"""
+import numpy.testing as npt
+import numpy as np
+from utils.vector_helper import normalize_rows, cosine_similarity
+
+
+def test_normalize_rows():
+  vectors = normalize_rows([[3.0, 4.0], [0.0, 0.0]])
+  assert vectors.dtype == np.float32
+  npt.assert_allclose(vectors, [[0.6, 0.8], [0.0, 0.0]], rtol=1e-6)
+
+
+def test_cosine_similarity():
+  query = np.array([[1.0, 0.0]])
+  embeddings = np.array([[2.0, 0.0], [0.0, 3.0], [-1.0, 0.0], [1.0, 1.0]])
+  scores = cosine_similarity(query, embeddings)
+  npt.assert_allclose(scores, [1.0, 0.0, -1.0, np.sqrt(0.5)], rtol=1e-6)
+
+  # matches a per-row computation
+  rng = np.random.default_rng(0)
+  query = rng.normal(size=16)
+  embeddings = rng.normal(size=(50, 16))
+  expected = [
+    np.dot(row, query) / (np.linalg.norm(row) * np.linalg.norm(query))
+    for row in embeddings
+  ]
+  npt.assert_allclose(cosine_similarity(query, embeddings), expected,
+                      rtol=1e-5)
+
+
+def test_cosine_similarity_empty():
+  assert len(cosine_similarity([1.0, 0.0], [])) == 0
@@ -0,0 +1,300 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Offline retrieval benchmark for LLM Service query engines.
+
+Builds a query engine with query_service.query_engine_build from a local
+corpus, then runs a query set through query_service.query_search, and
+reports build throughput, retrieval latency percentiles and recall@k
+against known-relevant chunks as JSON.
+
+Models are stored in the Firestore emulator and embeddings come from a
+deterministic fake embedding provider (hashed bag of words), so results
+are reproducible and comparable across commits.  The default corpus is
+synthetic: each paragraph of each document contains a unique fact, and
+each query asks for one fact.  A local corpus can be used instead:
+BENCHMARK_CORPUS is a directory of documents (txt, html, csv, pdf), and
+BENCHMARK_QUERIES a JSONL file of {"query": ..., "relevant": [...]},
+where a chunk is relevant to a query if its text contains any of the
+relevant strings.
+
+Settings (environment variables):
+  BENCHMARK_CORPUS, BENCHMARK_QUERIES: local corpus and query set
+  NUM_DOCS, PARAGRAPHS_PER_DOC: size of the synthetic corpus
+  EMBEDDING_DIMENSIONS: dimensions of the fake embeddings
+  VECTOR_STORE: vector store type (default "local")
+  BENCHMARK_PARAMS: query engine build params as JSON,
+    e.g. '{"chunk_size": "250"}'
+  RANK_SENTENCES: "true" to rank sentences in retrieved chunks
+  RERANK: "true" to rerank retrieved references
+  BENCHMARK_OUTPUT: file to write the JSON results to (default stdout)
+
+Start the emulator, then run from the repo root:
+  firebase emulators:start --only firestore --project fake-project &
+  python tests/benchmarks/retrieval_benchmark.py
+"""
+
+# pylint: disable=wrong-import-position,redefined-outer-name,unused-argument,unused-import,line-too-long
+
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from unittest import mock
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__),
+                             "../../components/llm_service/src"))
+sys.path.append(os.path.join(os.path.dirname(__file__),
+                             "../../components/common/src"))
+
+# index data of local vector store builds is written to a temp directory
+os.environ.setdefault("LOCAL_VECTOR_STORE_PATH", tempfile.mkdtemp())
+
+from common.models import QueryDocumentChunk
+from common.testing.firestore_emulator import firestore_emulator, clean_firestore
+from services import embeddings
+from services.query import query_service
+from services.query.data_source import DataSource, DataSourceFile
+
+NUM_DOCS = int(os.environ.get("NUM_DOCS", 50))
+PARAGRAPHS_PER_DOC = int(os.environ.get("PARAGRAPHS_PER_DOC", 8))
+SENTENCES_PER_PARAGRAPH = 6
+WORDS_PER_SENTENCE = 12
+VOCABULARY_SIZE = 5000
+
+VECTOR_STORE = os.environ.get("VECTOR_STORE", "local")
+BUILD_PARAMS = json.loads(os.environ.get("BENCHMARK_PARAMS", "{}"))
+RANK_SENTENCES = os.environ.get("RANK_SENTENCES", "false").lower() == "true"
+RERANK = os.environ.get("RERANK", "false").lower() == "true"
+
+# fake embedding dimensions, high enough that hash collisions between
+# words rarely change the ranking
+DIMENSIONS = int(os.environ.get("EMBEDDING_DIMENSIONS", 4096))
+K_VALUES = [1, 3, 5]
+PERCENTILES = [50, 90, 99]
+ENGINE_NAME = "retrieval-benchmark"
+USER_ID = "benchmark-user"
+
+TOKEN_PATTERN = re.compile(r"\w+")
+STOP_WORDS = {"a", "an", "and", "is", "of", "the", "what"}
+
+
+class FakeEmbeddingProvider():
+  """
+  Deterministic embeddings: each word other than stop words is hashed to
+  a dimension with a sign, so texts that share words have similar
+  embeddings.
+  """
+
+  def __init__(self, dimensions: int = DIMENSIONS):
+    self.dimensions = dimensions
+    self.num_texts = 0
+
+  def embed(self, text: str) -> list:
+    vector = np.zeros(self.dimensions)
+    for word in TOKEN_PATTERN.findall(text.lower()):
+      if word in STOP_WORDS:
+        continue
+      digest = hashlib.md5(word.encode("utf-8")).digest()
+      index = int.from_bytes(digest[:4], "little") % self.dimensions
+      vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+  def generate_embeddings(self, batch: list, embedding_type: str) -> list:
+    """ replaces embeddings.generate_embeddings """
+    self.num_texts += len(batch)
+    return [self.embed(text) for text in batch]
+
+
+class LocalDataSource(DataSource):
+  """ Reads the documents of a local directory """
+
+  def download_documents(self, doc_url: str, temp_dir: str) -> list:
+    data_source_files = []
+    for doc_name in sorted(os.listdir(doc_url)):
+      # the build deletes each file once it is indexed, so index a copy
+      local_path = os.path.join(temp_dir, doc_name)
+      shutil.copyfile(os.path.join(doc_url, doc_name), local_path)
+      data_source_files.append(DataSourceFile(doc_name=doc_name,
+                                              src_url=f"file://{doc_name}",
+                                              local_path=local_path,
+                                              doc_id=doc_name))
+    return data_source_files
+
+
+def make_synthetic_corpus(corpus_dir: str, rng: random.Random) -> list:
+  """
+  Write synthetic documents to corpus_dir.  Each paragraph has filler
+  sentences from a per-document topic vocabulary and one unique fact.
+
+  Returns:
+    query set, a list of {"query": ..., "relevant": [fact sentence]}
+  """
+  def word():
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz")
+                   for _ in range(rng.randint(4, 9)))
+
+  vocabulary = [word() for _ in range(VOCABULARY_SIZE)]
+  queries = []
+  for doc in range(NUM_DOCS):
+    topic = rng.sample(vocabulary, 200)
+    paragraphs = []
+    for _ in range(PARAGRAPHS_PER_DOC):
+      sentences = [
+          " ".join(rng.choice(topic) for _ in range(WORDS_PER_SENTENCE))
+          .capitalize() + "."
+          for _ in range(SENTENCES_PER_PARAGRAPH)]
+      attribute, entity, value = word(), word(), word()
+      fact = f"The {attribute} of {entity} is {value}."
+      sentences.insert(rng.randrange(len(sentences) + 1), fact)
+      paragraphs.append(" ".join(sentences))
+      queries.append({"query": f"What is the {attribute} of {entity}?",
+                      "relevant": [fact]})
+    with open(os.path.join(corpus_dir, f"doc-{doc:04d}.txt"), "w",
+              encoding="utf-8") as f:
+      f.write("\n\n".join(paragraphs))
+  return queries
+
+
+def load_queries(queries_path: str) -> list:
+  with open(queries_path, "r", encoding="utf-8") as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def percentiles(values: list) -> dict:
+  stats = {f"p{p}": round(float(np.percentile(values, p)), 3)
+           for p in PERCENTILES}
+  stats["mean"] = round(float(np.mean(values)), 3)
+  return stats
+
+
+async def build_engine(corpus_dir: str) -> dict:
+  """ Build the benchmark query engine and measure build throughput """
+  start = time.perf_counter()
+  q_engine, docs_processed, docs_not_processed = \
+      await query_service.query_engine_build(
+          corpus_dir, ENGINE_NAME, USER_ID,
+          vector_store_type=VECTOR_STORE,
+          params=dict(BUILD_PARAMS))
+  build_s = time.perf_counter() - start
+  num_chunks = sum(doc.index_end - doc.index_start for doc in docs_processed)
+  return q_engine, {
+    "docs": len(docs_processed),
+    "docs_not_processed": len(docs_not_processed),
+    "chunks": num_chunks,
+    "seconds": round(build_s, 3),
+    "docs_per_s": round(len(docs_processed) / build_s, 2),
+    "chunks_per_s": round(num_chunks / build_s, 2),
+  }
+
+
+def relevant_chunk_ids(q_engine, queries: list) -> list:
+  """ ids of the chunks that contain a relevant string, per query """
+  chunks = QueryDocumentChunk.collection.filter(
+      "query_engine_id", "==", q_engine.id).fetch()
+  chunk_texts = [(chunk.id, chunk.text or "") for chunk in chunks]
+  return [
+      {chunk_id for chunk_id, text in chunk_texts
+       if any(relevant in text for relevant in query["relevant"])}
+      for query in queries
+  ]
+
+
+async def run_queries(q_engine, queries: list, relevant_ids: list) -> dict:
+  """ Run the query set and measure latency and recall@k """
+  # load the index before measuring
+  await query_service.query_search(q_engine, queries[0]["query"],
+                                   RANK_SENTENCES)
+
+  latencies_ms = []
+  recalls = {k: [] for k in K_VALUES}
+  for query, relevant in zip(queries, relevant_ids):
+    start = time.perf_counter()
+    references = await query_service.query_search(q_engine, query["query"],
+                                                  RANK_SENTENCES)
+    if RERANK:
+      references = await query_service.rerank_references(query["query"],
+                                                         references)
+    latencies_ms.append((time.perf_counter() - start) * 1000)
+
+    if not relevant:
+      continue
+    retrieved = [ref.chunk_id for ref in references]
+    for k in K_VALUES:
+      recalls[k].append(len(relevant.intersection(retrieved[:k])) /
+                        len(relevant))
+
+  return {
+    "queries": len(queries),
+    "queries_with_relevant_chunks": len(recalls[K_VALUES[0]]),
+    "latency_ms": percentiles(latencies_ms),
+    "recall_at_k": {str(k): round(float(np.mean(values)), 4) if values
+                    else None for k, values in recalls.items()},
+  }
+
+
+@pytest.mark.asyncio
+async def test_retrieval_benchmark(clean_firestore):
+  fake_embeddings = FakeEmbeddingProvider()
+  with tempfile.TemporaryDirectory() as temp_dir, \
+      mock.patch.object(embeddings, "generate_embeddings",
+                        fake_embeddings.generate_embeddings), \
+      mock.patch.object(query_service.storage, "Client"), \
+      mock.patch.object(query_service, "datasource_from_url",
+                        lambda doc_url, q_engine, storage_client:
+                        LocalDataSource(storage_client, q_engine.params)):
+    corpus_dir = os.environ.get("BENCHMARK_CORPUS")
+    if corpus_dir:
+      queries = load_queries(os.environ["BENCHMARK_QUERIES"])
+    else:
+      corpus_dir = temp_dir
+      queries = make_synthetic_corpus(corpus_dir, random.Random(42))
+
+    q_engine, build = await build_engine(corpus_dir)
+    build["embedded_texts"] = fake_embeddings.num_texts
+    relevant_ids = relevant_chunk_ids(q_engine, queries)
+    retrieval = await run_queries(q_engine, queries, relevant_ids)
+    query_service.delete_engine(q_engine, hard_delete=True)
+
+  results = {
+    "config": {
+      "corpus": os.environ.get("BENCHMARK_CORPUS", "synthetic"),
+      "vector_store": VECTOR_STORE,
+      "params": BUILD_PARAMS,
+      "rank_sentences": RANK_SENTENCES,
+      "rerank": RERANK,
+    },
+    "build": build,
+    "retrieval": retrieval,
+  }
+  output = json.dumps(results, indent=2)
+  if os.environ.get("BENCHMARK_OUTPUT"):
+    with open(os.environ["BENCHMARK_OUTPUT"], "w", encoding="utf-8") as f:
+      f.write(output)
+  else:
+    print(output)
+  assert build["chunks"] > 0
+
+
+if __name__ == "__main__":
+  sys.exit(pytest.main([__file__, "-q", "-s", "-p", "no:cacheprovider"]))
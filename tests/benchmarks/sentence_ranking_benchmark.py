@@ -0,0 +1,122 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Micro-benchmark for query time sentence ranking (rank_sentences=True).
+
+Compares the previous per-chunk pandas iterrows cosine scoring with the
+vectorized scoring used by query_service.rank_chunk_sentences, which scores
+the sentences of all retrieved chunks with a single matrix product.
+
+Run from the repo root:
+  python tests/benchmarks/sentence_ranking_benchmark.py
+"""
+
+#pylint: disable=wrong-import-position
+
+import json
+import os
+import sys
+import timeit
+import numpy as np
+import pandas as pd
+from numpy.linalg import norm
+
+sys.path.append(os.path.join(os.path.dirname(__file__),
+                             "../../components/llm_service/src"))
+from utils.vector_helper import cosine_similarity
+
+# embedding dimensions generated by TextEmbeddingModel
+DIMENSIONS = 768
+# number of chunks retrieved per query (NUM_MATCH_RESULTS)
+NUM_CHUNKS = 5
+SENTENCES_PER_CHUNK = [50, 100, 250, 500]
+REPEATS = 5
+
+
+def legacy_get_similarity(query_embeddings, sentence_embeddings) -> list:
+  """ previous implementation of query_service.get_similarity """
+  query_df = pd.DataFrame(query_embeddings.transpose())
+  sentence_df = pd.DataFrame(sentence_embeddings)
+
+  cos_sim = []
+  for _, row in sentence_df.iterrows():
+    x = row
+    y = query_df
+    cosine = np.dot(x, y) / (norm(x) * norm(y))
+    cos_sim.append(cosine[0])
+  return cos_sim
+
+
+def legacy_rank(query_embedding, chunk_embeddings):
+  """ previous flow: one scoring pass per chunk """
+  return [int(np.argmax(legacy_get_similarity(query_embedding, embeddings)))
+          for embeddings in chunk_embeddings]
+
+
+def vectorized_rank(query_embedding, chunk_embeddings):
+  """ current flow: one scoring pass over all chunks """
+  all_embeddings = np.concatenate(chunk_embeddings)
+  scores = cosine_similarity(query_embedding, all_embeddings)
+  top_indexes = []
+  start = 0
+  for embeddings in chunk_embeddings:
+    top_indexes.append(int(np.argmax(scores[start:start + len(embeddings)])))
+    start += len(embeddings)
+  return top_indexes
+
+
+def random_embeddings(rng, num_sentences: int):
+  """ random query embedding, and sentence embeddings for each chunk """
+  query_embedding = rng.normal(size=(1, DIMENSIONS))
+  chunk_embeddings = [rng.normal(size=(num_sentences, DIMENSIONS))
+                      for _ in range(NUM_CHUNKS)]
+  return query_embedding, chunk_embeddings
+
+
+def run_benchmark() -> list:
+  # warm up with the largest inputs, so the first size measured doesn't
+  # pay one-time allocation costs (such as the malloc mmap threshold
+  # being raised once the first large arrays are freed)
+  warmup_embeddings = random_embeddings(np.random.default_rng(0),
+                                        max(SENTENCES_PER_CHUNK))
+  legacy_rank(*warmup_embeddings)
+  vectorized_rank(*warmup_embeddings)
+
+  rng = np.random.default_rng(42)
+  results = []
+  for num_sentences in SENTENCES_PER_CHUNK:
+    query_embedding, chunk_embeddings = random_embeddings(rng, num_sentences)
+
+    assert legacy_rank(query_embedding, chunk_embeddings) == \
+        vectorized_rank(query_embedding, chunk_embeddings)
+
+    legacy_s = min(timeit.repeat(
+        lambda q=query_embedding, c=chunk_embeddings: legacy_rank(q, c),
+        number=1, repeat=REPEATS))
+    vectorized_s = min(timeit.repeat(
+        lambda q=query_embedding, c=chunk_embeddings: vectorized_rank(q, c),
+        number=1, repeat=REPEATS))
+    results.append({
+      "chunks": NUM_CHUNKS,
+      "sentences_per_chunk": num_sentences,
+      "legacy_ms": round(legacy_s * 1000, 3),
+      "vectorized_ms": round(vectorized_s * 1000, 3),
+      "speedup": round(legacy_s / vectorized_s, 1),
+    })
+  return results
+
+
+if __name__ == "__main__":
+  print(json.dumps(run_benchmark(), indent=2))